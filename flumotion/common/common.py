@@ -159,6 +159,19 @@ def parseFullFeedId(fullFeedId):
     return (flowName, componentName, parts[1])
 
 
+def feedServerSocketPath(port):
+    """
+    Get the path of the unix socket on which the feed server listening on
+    the given TCP port also accepts connections from the same host.
+
+    @param port: the TCP port of the feed server
+    @type  port: int
+
+    @rtype: str
+    """
+    return os.path.join(configure.rundir, 'feedserver.%d.socket' % port)
+
+
 def objRepr(object):
     """
     Return a string giving the fully qualified class of the given object.
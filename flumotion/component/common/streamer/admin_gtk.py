@@ -19,6 +19,7 @@ import gettext
 import os
 import time
 
+from flumotion.common import format as formatting
 from flumotion.common.mimetypes import launchApplicationByUrl
 from flumotion.component.base.admin_gtk import BaseAdminGtk
 from flumotion.component.base.baseadminnode import BaseAdminGtkNode
@@ -28,6 +29,26 @@ _ = gettext.gettext
 __version__ = "$Rev$"
 
 
+def _formatBitrate(value):
+    return formatting.formatStorage(value) + 'bit/s'
+
+
+def _formatBytes(value):
+    return formatting.formatStorage(value) + 'Byte'
+
+
+# the statistics are sent as raw numbers, the others are shown with str()
+_FORMATTERS = {
+    'stream-uptime': formatting.formatTime,
+    'stream-bitrate': _formatBitrate,
+    'stream-current-bitrate': _formatBitrate,
+    'stream-totalbytes': _formatBytes,
+    'consumption-bitrate': _formatBitrate,
+    'consumption-bitrate-current': _formatBitrate,
+    'consumption-totalbytes': _formatBytes,
+}
+
+
 class StatisticsAdminGtkNode(BaseAdminGtkNode):
     gladeFile = os.path.join('flumotion', 'component', 'common',
                               'streamer', 'streamer.glade')
@@ -101,9 +122,12 @@ class StatisticsAdminGtkNode(BaseAdminGtkNode):
         for name in self._labels:
             if name == 'clients-peak-time':
                 continue
+            # changed in 0.11.1 to be raw numbers, formatted here
             text = state.get(name)
             if text is None:
                 text = ''
+            elif not isinstance(text, str):
+                text = _FORMATTERS.get(name, str)(text)
 
             self._labels[name].set_text(text)
 
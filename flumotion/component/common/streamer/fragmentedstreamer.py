@@ -100,9 +100,11 @@ class FragmentedStreamer(Streamer, Stats):
         self._minWindow = props.get('min-window', self.DEFAULT_MIN_WINDOW)
         self._maxWindow = props.get('max-window', self.DEFAULT_MAX_WINDOW)
 
-        self.sink = pipeline.get_by_name('sink')
-        self._configure_sink()
-        self._connect_sink_signals()
+        sinks = self._get_sinks(pipeline)
+        self.sink = sinks[0]
+        for sink in sinks:
+            self._configure_sink(sink)
+            self._connect_sink_signals(sink)
 
         Streamer.configure_pipeline(self, pipeline, props)
         Stats.__init__(self, self.resource)
@@ -122,16 +124,24 @@ class FragmentedStreamer(Streamer, Stats):
     def _get_root(self):
         return self.resource
 
-    def _configure_sink(self):
+    def _get_sinks(self, pipeline):
+        '''
+        Returns the sink elements of the pipeline. Can be used by
+        subclasses with more than one sink; the first one is kept in
+        L{sink}
+        '''
+        return [pipeline.get_by_name('sink')]
+
+    def _configure_sink(self, sink):
         '''
         Configure sink properties. Can be used by subclasses to set
         configuration parameters in the element
         '''
         pass
 
-    def _connect_sink_signals(self):
-        self.sink.get_pad("sink").add_buffer_probe(self._sink_pad_probe, None)
-        self.sink.connect('eos', self._eos)
+    def _connect_sink_signals(self, sink):
+        sink.get_pad("sink").add_buffer_probe(self._sink_pad_probe, None)
+        sink.connect('eos', self._eos)
 
     ### START OF THREAD-AWARE CODE (called from non-reactor threads)
 
@@ -27,7 +27,6 @@ from zope.interface import implements
 
 from flumotion.common import errors
 from flumotion.common import messages, netutils, interfaces
-from flumotion.common import format as formatting
 from flumotion.component import feedcomponent
 from flumotion.component.base import http
 from flumotion.component.component import moods
@@ -159,6 +158,13 @@ class Stats(object):
         return self.load_deltas
 
     def updateState(self, set):
+        """
+        Update the statistics in the UI state with the given function.
+        They are set as raw numbers, formatted by the admin.
+
+        @param set: function setting a key of the UI state to a value
+        @type  set: callable
+        """
         c = self
 
         bytes_sent = c.getBytesSent()
@@ -167,31 +173,26 @@ class Stats(object):
 
         set('stream-mime', c.get_mime())
         set('stream-url', c.getUrl())
-        set('stream-uptime', formatting.formatTime(uptime))
+        # in seconds, but only as precise as the admin shows it
+        set('stream-uptime', int(uptime) - int(uptime) % 60)
         bitspeed = bytes_received * 8 / uptime
         currentbitrate = self.getCurrentBitrate()
-        set('stream-bitrate', formatting.formatStorage(bitspeed) + 'bit/s')
-        set('stream-current-bitrate',
-            formatting.formatStorage(currentbitrate) + 'bit/s')
-        set('stream-totalbytes',
-            formatting.formatStorage(bytes_received) + 'Byte')
+        set('stream-bitrate', bitspeed)
+        set('stream-current-bitrate', currentbitrate)
+        set('stream-totalbytes', bytes_received)
         set('stream-bitrate-raw', bitspeed)
         set('stream-totalbytes-raw', bytes_received)
 
-        set('clients-current', str(c.getClients()))
-        set('clients-max', str(c.getMaxClients()))
-        set('clients-peak', str(c.getPeakClients()))
+        set('clients-current', c.getClients())
+        set('clients-max', c.getMaxClients())
+        set('clients-peak', c.getPeakClients())
         set('clients-peak-time', c.getPeakEpoch())
-        set('clients-average', str(int(c.getAverageClients())))
+        set('clients-average', int(c.getAverageClients()))
 
         bitspeed = bytes_sent * 8 / uptime
-        set('consumption-bitrate',
-            formatting.formatStorage(bitspeed) + 'bit/s')
-        set('consumption-bitrate-current',
-            formatting.formatStorage(
-                currentbitrate * c.getClients()) + 'bit/s')
-        set('consumption-totalbytes',
-            formatting.formatStorage(bytes_sent) + 'Byte')
+        set('consumption-bitrate', bitspeed)
+        set('consumption-bitrate-current', currentbitrate * c.getClients())
+        set('consumption-totalbytes', bytes_sent)
         set('consumption-bitrate-raw', bitspeed)
         set('consumption-totalbytes-raw', bytes_sent)
 
@@ -296,6 +297,7 @@ class Streamer(feedcomponent.ParseLaunchComponent, Stats):
         self._updateCallLaterId = None
         self._lastUpdate = 0
         self._updateUI_DC = None
+        self._uiObservers = 0
 
         self._pending_removals = {}
 
@@ -488,15 +490,16 @@ class Streamer(feedcomponent.ParseLaunchComponent, Stats):
         Such updates (through this function) are throttled to a maximum rate,
         to avoid saturating admin clients with traffic when many clients are
         connecting/disconnecting.
+        Nothing is done while nobody observes the uiState; it is updated
+        when somebody starts to.
         """
 
         def setIfChanged(k, v):
             if self.uiState.get(k) != v:
                 self.uiState.set(k, v)
 
-        def update_ui_state_later():
-            self._updateUI_DC = None
-            self.update_ui_state()
+        if not self._uiObservers:
+            return
 
         now = time.time()
 
@@ -509,18 +512,52 @@ class Streamer(feedcomponent.ParseLaunchComponent, Stats):
             self._lastUpdate = now
             # fixme: have updateState just update what changed itself
             # without the hack above
-            self.updateState(setIfChanged)
+            # the changed keys are sent to the observers in one message
+            self.uiState.beginBatch()
+            try:
+                self.updateState(setIfChanged)
+            finally:
+                self.uiState.commitBatch()
         elif not self._updateUI_DC:
             # Otherwise, schedule doing this in a few seconds (unless an update
             # was already scheduled)
             self._updateUI_DC = reactor.callLater(UI_UPDATE_THROTTLE_PERIOD,
-                                                  update_ui_state_later)
+                                                  self._update_ui_state_later)
+
+    def _update_ui_state_later(self):
+        self._updateUI_DC = None
+        self.update_ui_state()
+
+    ### IStateCacheableListener Interface
+
+    def observerAppend(self, observer, num):
+        feedcomponent.ParseLaunchComponent.observerAppend(self, observer, num)
+        self._uiObservers = num
+        # the uiState was not updated while nobody observed it; PB may not
+        # have finished setting up the observer yet, so update it later
+        if not self._updateUI_DC:
+            self._updateUI_DC = reactor.callLater(0,
+                                                  self._update_ui_state_later)
+
+    def observerRemove(self, observer, num):
+        feedcomponent.ParseLaunchComponent.observerRemove(self, observer, num)
+        self._uiObservers = num
+        if num == 0:
+            if self._updateUI_DC:
+                self._updateUI_DC.cancel()
+                self._updateUI_DC = None
+            # update right away when somebody observes again
+            self._lastUpdate = 0
 
     def do_stop(self):
         if self._updateCallLaterId:
             self._updateCallLaterId.cancel()
             self._updateCallLaterId = None
 
+        if self._updateUI_DC:
+            self._updateUI_DC.cancel()
+            self._updateUI_DC = None
+
         if self.httpauth:
             self.httpauth.stopKeepAlive()
 
@@ -0,0 +1,155 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_hls_ring -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""on-disk storage for HLS fragments.
+Fragments that don't fit in the ring's memory budget are copied into
+memory-mapped segment files on local disk, and read back from there in
+chunks when they are served.
+"""
+
+import mmap
+import os
+import tempfile
+
+from flumotion.common import log
+
+__version__ = "$Rev$"
+
+# The size of the segment files fragments are appended to
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+
+# The size of the chunks a fragment is read back in
+CHUNK_SIZE = 64 * 1024
+
+
+class Segment(object):
+    """
+    A memory-mapped file holding a number of fragments.
+
+    The file is unlinked as soon as it is created, so its space is given
+    back when the last reference to the segment goes away, even if the
+    streamer dies.
+    """
+
+    def __init__(self, directory, size):
+        fd, path = tempfile.mkstemp(prefix='hls-', suffix='.segment',
+                                    dir=directory)
+        try:
+            os.unlink(path)
+            os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.size = size
+        self.used = 0
+        self.refs = 0
+
+    def available(self):
+        return self.size - self.used
+
+    def append(self, chunks):
+        """
+        Copy the given strings at the end of the segment.
+
+        @returns: the offset they were written at
+        """
+        offset = position = self.used
+        for chunk in chunks:
+            end = position + len(chunk)
+            self._map[position:end] = chunk
+            position = end
+        self.used = position
+        self.refs += 1
+        return offset
+
+    def read(self, offset, size):
+        return self._map[offset:offset + size]
+
+
+class DiskFragment(object):
+    """
+    A fragment kept in a L{Segment}. Iterating over me reads the fragment
+    back in chunks of at most L{CHUNK_SIZE} bytes.
+    """
+
+    def __init__(self, segment, offset, length):
+        self.segment = segment
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        end = self.offset + self.length
+        for offset in xrange(self.offset, end, CHUNK_SIZE):
+            yield self.segment.read(offset, min(CHUNK_SIZE, end - offset))
+
+    def read(self):
+        return self.segment.read(self.offset, self.length)
+
+
+class FragmentSpool(log.Loggable):
+    """
+    I copy fragments to segment files in a directory.
+
+    A segment is dropped once all the fragments written to it have been
+    released; fragments that are still being served keep it alive.
+    """
+
+    logCategory = 'hls-spool'
+
+    def __init__(self, directory, segmentSize=DEFAULT_SEGMENT_SIZE):
+        self.directory = directory
+        self.segmentSize = segmentSize
+        self._segment = None
+        self._segments = 0
+
+    def store(self, chunks, length):
+        """
+        Write a fragment to disk.
+
+        @param chunks: the strings making up the fragment
+        @type  chunks: list of str
+        @param length: the total length of the chunks
+        @type  length: int
+
+        @rtype: L{DiskFragment}
+        """
+        segment = self._segment
+        if segment is None or segment.available() < length:
+            segment = Segment(self.directory, max(length, self.segmentSize))
+            self._segments += 1
+            self.debug("created segment %d of %d bytes",
+                       self._segments, segment.size)
+            self._segment = segment
+        offset = segment.append(chunks)
+        return DiskFragment(segment, offset, length)
+
+    def release(self, fragment):
+        """
+        Release a fragment that is no longer part of the ring.
+
+        @type fragment: L{DiskFragment}
+        """
+        segment = fragment.segment
+        segment.refs -= 1
+        if segment.refs == 0 and segment is self._segment:
+            self._segment = None
+
+    def close(self):
+        self._segment = None
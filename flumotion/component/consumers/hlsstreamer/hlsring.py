@@ -16,6 +16,8 @@
 # Headers in this file shall remain intact.
 
 import os
+import random
+import zlib
 from collections import deque
 
 from Crypto.Cipher import AES
@@ -23,11 +25,85 @@ from Crypto.Cipher import AES
 from twisted.internet import reactor
 from flumotion.component.common.streamer.fragmentedresource import\
     FragmentNotAvailable, FragmentNotFound, PlaylistNotFound, KeyNotFound
+from flumotion.component.consumers.hlsstreamer import fragmentspool
+
+
+def getFragmentLength(fragment):
+    '''
+    Returns the length in bytes of a fragment as returned by
+    L{HLSRing.getFragment}
+    '''
+    if isinstance(fragment, (str, fragmentspool.DiskFragment)):
+        return len(fragment)
+    length = 0
+    for chunk in fragment:
+        length += len(chunk)
+    return length
+
+
+class FragmentWindow(object):
+    """
+    I hold the fragments of a playlist window in the order they were
+    added, indexed by sequence number. Adding, evicting and looking up a
+    fragment take constant time, and so does finding the shortest
+    duration in the window.
+    """
+
+    def __init__(self):
+        self._sequences = deque()
+        self._fragments = {}
+        # (sequenceNumber, duration) pairs with increasing durations; the
+        # first one is the shortest fragment in the window
+        self._shortest = deque()
+
+    def __len__(self):
+        return len(self._sequences)
+
+    def __contains__(self, sequenceNumber):
+        return sequenceNumber in self._fragments
+
+    def __getitem__(self, sequenceNumber):
+        return self._fragments[sequenceNumber]
+
+    def __iter__(self):
+        fragments = self._fragments
+        for sequenceNumber in self._sequences:
+            yield fragments[sequenceNumber]
+
+    def append(self, sequenceNumber, duration, fragment):
+        """
+        Add a fragment at the end of the window.
+        """
+        self._sequences.append(sequenceNumber)
+        self._fragments[sequenceNumber] = fragment
+        shortest = self._shortest
+        while shortest and shortest[-1][1] >= duration:
+            shortest.pop()
+        shortest.append((sequenceNumber, duration))
+
+    def popleft(self):
+        """
+        Remove the oldest fragment from the window and return it.
+        """
+        sequenceNumber = self._sequences.popleft()
+        if self._shortest[0][0] == sequenceNumber:
+            self._shortest.popleft()
+        return self._fragments.pop(sequenceNumber)
+
+    def getFirstSequenceNumber(self):
+        return self._sequences[0]
+
+    def getShortestDuration(self):
+        return self._shortest[0][1]
 
 
 class Playlister:
     """
     I write HTTP Live Streaming playlists based on added fragments.
+
+    The playlists are rendered once each time they change and kept as a
+    list of parts, between which the query arguments of each request are
+    spliced.
     """
 
     def __init__(self):
@@ -40,13 +116,46 @@ class Playlister:
         self.newFragmentTolerance = 0
         self.window = 0
         self.keysURI = ''
+        # The configured URI of the keys, the hostname it defaults to
+        # when it isn't under my own hostname, and the prefix of the
+        # fragment names in its key argument
+        self._keysURI = None
+        self._keysHostname = None
+        self._keyPrefix = ''
         self.filenameExt = 'webm'
         #FIXME: Make it a property
         self.allowCache = True
-        self._fragments = []
-        self._dummyFragments = []
+        self._fragments = FragmentWindow()
+        self._dummyFragments = set()
         self._counter = 0
+        self._duration = 0
         self._isAutoUpdate = False
+        # Identifies this instance in ETags, so that a restarted streamer
+        # doesn't match ETags of the previous one
+        self._etagPrefix = '%08x' % random.getrandbits(32)
+        self._version = 0
+        self._mainPlaylistParts = None
+        self._streamPlaylistParts = None
+
+        # The rendered lines of each fragment in the window, by sequence
+        # number
+        self._fragmentLines = {}
+
+    def _playlistChanged(self):
+        self._version += 1
+        self._streamPlaylistParts = None
+
+    def _fragmentsChanged(self):
+        # Something used in the lines of every fragment changed
+        self._fragmentLines = {}
+        self._playlistChanged()
+
+    def getPlaylistVersion(self):
+        """
+        Returns a number that changes whenever the rendered playlists
+        change
+        """
+        return self._version
 
     def setHostname(self, hostname):
         if hostname.startswith('/'):
@@ -56,38 +165,67 @@ class Playlister:
         if not hostname.startswith('http://'):
             hostname = 'http://' + hostname
         self._hostname = hostname
+        self._updateKeysURI()
+        self._mainPlaylistParts = None
+        self._fragmentsChanged()
+
+    def setKeysLocation(self, hostname, keyPrefix):
+        '''
+        Sets where the keys are requested when no URI was configured for
+        them, and the prefix of the fragment names in their key argument.
+
+        @param hostname:  the hostname the key resource is under
+        @type  hostname:  str
+        @param keyPrefix: prefix of the fragment names
+        @type  keyPrefix: str
+        '''
+        self._keysHostname = hostname
+        self._keyPrefix = keyPrefix
+        self._updateKeysURI()
+        self._fragmentsChanged()
+
+    def _updateKeysURI(self):
+        # The resource serves the keys as 'key' under the mount point
+        self.keysURI = (self._keysURI or
+                        (self._keysHostname or self._hostname) + 'key')
 
     def setAllowCache(self, allowed):
         self.allowCache = allowed
+        self._playlistChanged()
+
+    def setFilenameExt(self, filenameExt):
+        self.filenameExt = filenameExt
+        self._fragmentsChanged()
 
     def _getFragmentName(self, sequenceNumber):
         return '%s-%s.%s' % (self.fragmentPrefix, sequenceNumber,
                              self.filenameExt)
 
     def _getTargetDuration(self):
-        sorted_list = sorted(self._fragments, key=lambda fragment: fragment[1])
-        return int(sorted_list[0][1])
+        return int(self._fragments.getShortestDuration())
 
     def _autoUpdate(self, count):
         if self._counter == count:
             self._isAutoUpdate = True
-            self._dummyFragments.append(self._getFragmentName(count))
+            self._dummyFragments.add(self._getFragmentName(count))
             self._addPlaylistFragment(count, self._duration, False)
 
     def _addPlaylistFragment(self, sequenceNumber, duration, encrypted):
         # Add the fragment to the playlist if it wasn't added before
-        if not sequenceNumber in [frag[0] for frag in self._fragments]:
+        if not sequenceNumber in self._fragments:
             # Add a discontinuity if the sequenceNumber is not the expected
-            self._fragments.append((sequenceNumber, duration, encrypted,
-                sequenceNumber != self._counter and self._counter != 0))
+            self._fragments.append(sequenceNumber, duration,
+                (sequenceNumber, duration, encrypted,
+                 sequenceNumber != self._counter and self._counter != 0))
             self._counter = sequenceNumber + 1
+            self._duration = duration
+            self._playlistChanged()
             # Remove fragments that are out of the window
             while len(self._fragments) > self.window:
                 # If it's a dummy fragment, remove it from the list too
-                fragName = self._getFragmentName(self._fragments[0][0])
-                if fragName in self._dummyFragments:
-                    self._dummyFragments.remove(fragName)
-                del self._fragments[0]
+                oldest = self._fragments.popleft()[0]
+                self._dummyFragments.discard(self._getFragmentName(oldest))
+                self._fragmentLines.pop(oldest, None)
 
         # Auto update the playlist when the next fragment was not added
         # If the fragment was automatically added update again after 'duration'
@@ -108,42 +246,92 @@ class Playlister:
         return '?' + '&'.join(["%s=%s" % (k, v[0]) for k, v in
                               args.iteritems()])
 
-    def _renderMainPlaylist(self, args):
-        lines = []
+    def _splitPlaylist(self, lines, urlLines):
+        # Split the playlist after each URL, where the query arguments go.
+        # The last item of the list is the playlist without arguments.
+        parts = []
+        start = 0
+        for end in urlLines:
+            part = "\n".join(lines[start:end + 1])
+            if start:
+                part = "\n" + part
+            parts.append(part)
+            start = end + 1
+        if start:
+            parts.append("\n".join([''] + lines[start:]))
+        else:
+            parts.append("\n".join(lines))
+        parts.append(''.join(parts))
+        return parts
+
+    def _getMainPlaylistParts(self):
+        if self._mainPlaylistParts is None:
+            lines = []
+
+            lines.append("#EXTM3U")
+            #The bandwith value is not significant for single bitrate
+            lines.append("#EXT-X-STREAM-INF:PROGRAM-ID=1,BANDWIDTH=%s" %
+                    self.streamBitrate)
+            lines.append("".join([self._hostname, self.streamPlaylist]))
+            lines.append("")
+
+            self._mainPlaylistParts = self._splitPlaylist(lines, [2])
+        return self._mainPlaylistParts
+
+    def _renderFragmentLines(self, fragment):
+        sequenceNumber, duration, encrypted, discon = fragment
+        fragmentName = self._getFragmentName(sequenceNumber)
+        lines = ['']
+        if discon:
+            lines.append("#EXT-X-DISCONTINUITY")
+        # FIXME: Not fully implemented yet
+        if encrypted:
+            lines.append('#EXT-X-KEY:METHOD=AES-128,URI="%s?key=%s%s"' %
+                    (self.keysURI, self._keyPrefix, fragmentName))
+        lines.append("#EXTINF:%d,%s" % (duration, self.title))
+        lines.append(''.join([self._hostname, fragmentName]))
+        return "\n".join(lines)
 
-        lines.append("#EXTM3U")
-        #The bandwith value is not significant for single bitrate
-        lines.append("#EXT-X-STREAM-INF:PROGRAM-ID=1,BANDWIDTH=%s" %
-                self.streamBitrate)
-        lines.append("".join([self._hostname, self.streamPlaylist,
-            self.renderArgs(args)]))
-        lines.append("")
+    def _getStreamPlaylistParts(self):
+        if self._streamPlaylistParts is None:
+            lines = []
+
+            lines.append("#EXTM3U")
+            lines.append("#EXT-X-ALLOW-CACHE:%s" %
+                    (self.allowCache and 'YES' or 'NO'))
+            lines.append("#EXT-X-TARGETDURATION:%d" %
+                    self._getTargetDuration())
+            lines.append("#EXT-X-MEDIA-SEQUENCE:%s" %
+                    self._fragments.getFirstSequenceNumber())
+
+            # Each part ends with the URL of a fragment; the lines of a
+            # fragment are rendered once while it is in the window
+            fragmentLines = self._fragmentLines
+            parts = []
+            for fragment in self._fragments:
+                part = fragmentLines.get(fragment[0])
+                if part is None:
+                    part = fragmentLines[fragment[0]] = \
+                        self._renderFragmentLines(fragment)
+                parts.append(part)
+            parts[0] = "\n".join(lines) + parts[0]
+            parts.append("\n")
+            parts.append(''.join(parts))
+
+            self._streamPlaylistParts = parts
+        return self._streamPlaylistParts
+
+    def _spliceArgs(self, parts, args):
+        renderedArgs = self.renderArgs(args)
+        if not renderedArgs:
+            return parts[-1]
+        return renderedArgs.join(parts[:-1])
 
-        return "\n".join(lines)
+    def _renderMainPlaylist(self, args):
+        return self._spliceArgs(self._getMainPlaylistParts(), args)
 
     def _renderStreamPlaylist(self, args):
-        lines = []
-
-        lines.append("#EXTM3U")
-        lines.append("#EXT-X-ALLOW-CACHE:%s" %
-                (self.allowCache and 'YES' or 'NO'))
-        lines.append("#EXT-X-TARGETDURATION:%d" % self._getTargetDuration())
-        lines.append("#EXT-X-MEDIA-SEQUENCE:%s" % self._fragments[0][0])
-
-        for sequenceNumber, duration, encrypted, discon in self._fragments:
-            if discon:
-                lines.append("#EXT-X-DISCONTINUITY")
-            # FIXME: Not fully implemented yet
-            if encrypted:
-                lines.append('#EXT-X-KEY:METHOD=AES-128,URI="%s?key=%s"' %
-                        (self.keysURI, fragment))
-            lines.append("#EXTINF:%d,%s" % (duration, self.title))
-            lines.append(''.join([self._hostname,
-                self._getFragmentName(sequenceNumber), self.renderArgs(args)]))
-
-        lines.append("")
-
-        return "\n".join(lines)
+        return self._spliceArgs(self._getStreamPlaylistParts(), args)
 
     def renderPlaylist(self, playlist, args):
         '''
@@ -156,11 +344,26 @@ class Playlister:
             return self._renderStreamPlaylist(args)
         raise PlaylistNotFound()
 
+    def getPlaylistETag(self, playlist, args):
+        '''
+        Returns the entity tag of the requested playlist as rendered for
+        the given query arguments, or raise an Exception if the playlist
+        is not found
+        '''
+        if playlist not in (self.mainPlaylist, self.streamPlaylist):
+            raise PlaylistNotFound()
+        return '"%s-%x-%08x"' % (self._etagPrefix, self._version,
+                                 zlib.crc32(self.renderArgs(args)) &
+                                 0xffffffff)
+
 
 class HLSRing(Playlister):
     '''
     I hold a ring with the fragments available in the playlist
     and update the playlist according to this.
+
+    With a spool directory, only the most recent fragments that fit in
+    the memory budget are kept in memory; older ones are moved to disk.
     '''
 
     BLOCK_SIZE = 16
@@ -169,7 +372,8 @@ class HLSRing(Playlister):
     def __init__(self, mainPlaylist, streamPlaylist,
             streamBitrate=300000, title='', fragmentPrefix='fragment',
             newFragTolerance = 0, window=5, maxExtraBuffers=None,
-            keyInterval=0, keysURI=None):
+            keyInterval=0, keysURI=None, spoolDirectory=None,
+            memoryBudget=None):
         '''
         @param mainPlaylist:    resource name of the main playlist
         @type  mainPlaylist:    str
@@ -192,6 +396,13 @@ class HLSRing(Playlister):
         @type  keyInterval:     int
         @param keysURI          URI used to retrieve the encription keys
         @type  keysURI          str
+        @param spoolDirectory:  directory to move fragments to when they
+                                don't fit in the memory budget, or None to
+                                keep all of them in memory
+        @type  spoolDirectory:  str
+        @param memoryBudget:    maximum number of bytes of fragments to keep
+                                in memory when spooling to disk
+        @type  memoryBudget:    int
         '''
 
         Playlister.__init__(self)
@@ -207,13 +418,21 @@ class HLSRing(Playlister):
         else:
             self.maxBuffers = window + maxExtraBuffers
         self.keyInterval = keyInterval
-        self.keysURI = keysURI or self._hostname
+        self._keysURI = keysURI
+        self._updateKeysURI()
         self._encrypted = (keyInterval != 0)
         self._fragmentsDict = {}
         self._keysDict = {}
         self._secret = ''
         self._availableFragments = deque('')
         self._lastSequence = None
+        self._spool = None
+        if spoolDirectory:
+            self._spool = fragmentspool.FragmentSpool(spoolDirectory)
+        self.memoryBudget = memoryBudget or 0
+        # Names of the fragments in memory, oldest first, and their size
+        self._memoryFragments = deque()
+        self._memoryUsed = 0
 
     def _encryptFragment(self, fragment, secret, IV):
         # FIXME: Not tested
@@ -227,22 +446,28 @@ class HLSRing(Playlister):
         return EncodeAES(cipher, fragment)
 
     def reset(self):
+        for fragment in self._fragmentsDict.values():
+            self._releaseFragment(fragment)
+        self._memoryFragments = deque()
+        self._memoryUsed = 0
         self._fragmentsDict = {}
         self._keysDict = {}
         self._secret = ''
         self._availableFragments = deque('')
-        self._fragments = []
-        self._dummyFragments = []
+        self._fragments = FragmentWindow()
+        self._dummyFragments = set()
         self._lastSequence = None
         self._counter = 0
+        self._fragmentsChanged()
 
     def addFragment(self, fragment, sequenceNumber, duration):
         '''
         Adds a fragment to the ring and updates the playlist.
         If the ring is full, removes the oldest fragment.
 
-        @param fragment:        mpegts raw fragment
-        @type  fragment:        array
+        @param fragment:        mpegts raw fragment, or the list of strings
+                                making it up
+        @type  fragment:        str or list of str
         @param sequenceNumber:  sequence number relative to the stream's start
         @type  sequenceNumber:  int
         @param duration:        duration of the the segment in seconds
@@ -257,14 +482,16 @@ class HLSRing(Playlister):
         fragmentName = self._addPlaylistFragment(sequenceNumber, duration,
                 self._encrypted)
         # Don't add duplicated fragments
-        if fragmentName in self._availableFragments:
+        if fragmentName in self._fragmentsDict:
             return
         self._lastSequence = sequenceNumber
 
         # If the ring is full, delete the oldest segment.
         while len(self._fragmentsDict) >= self.maxBuffers:
             pop = self._availableFragments.popleft()
-            del self._fragmentsDict[pop]
+            self._releaseFragment(self._fragmentsDict.pop(pop))
+            if self._memoryFragments and self._memoryFragments[0] == pop:
+                self._memoryFragments.popleft()
             if pop in self._keysDict:
                 del self._keysDict[pop]
 
@@ -272,12 +499,37 @@ class HLSRing(Playlister):
         if self._encrypted:
             if sequenceNumber % self.keyInterval == 0:
                 self._secret = os.urandom(self.BLOCK_SIZE)
+            if not isinstance(fragment, str):
+                fragment = ''.join(fragment)
             fragment = self._encryptFragment(fragment, self._secret,
                     sequenceNumber)
             self._keysDict[fragmentName] = self._secret
         self._fragmentsDict[fragmentName] = fragment
+        if self._spool:
+            self._memoryFragments.append(fragmentName)
+            self._memoryUsed += getFragmentLength(fragment)
+            self._spoolFragments()
         return fragmentName
 
+    def _releaseFragment(self, fragment):
+        if isinstance(fragment, fragmentspool.DiskFragment):
+            self._spool.release(fragment)
+        elif self._spool:
+            self._memoryUsed -= getFragmentLength(fragment)
+
+    def _spoolFragments(self):
+        # Move the oldest fragments to disk until the rest fits in the
+        # budget, always keeping the newest one in memory
+        while self._memoryUsed > self.memoryBudget and \
+                len(self._memoryFragments) > 1:
+            name = self._memoryFragments.popleft()
+            fragment = self._fragmentsDict[name]
+            length = getFragmentLength(fragment)
+            if isinstance(fragment, str):
+                fragment = (fragment, )
+            self._fragmentsDict[name] = self._spool.store(fragment, length)
+            self._memoryUsed -= length
+
     def getFragment(self, fragmentName):
         '''
         Returns a fragment of the playlist or raises an Exception
@@ -286,8 +538,10 @@ class HLSRing(Playlister):
         @param fragmentName:    name of the fragment to retrieve
         @type  fragmentName:    str
 
-        @return:                an mpegts raw fragment
-        @rtype:                 array
+        @return:                an mpegts raw fragment, as it was added, or
+                                read back from disk in chunks
+        @rtype:                 str, list of str or
+                                L{fragmentspool.DiskFragment}
         '''
 
         if fragmentName in self._fragmentsDict:
@@ -311,3 +565,197 @@ class HLSRing(Playlister):
         if key in self._keysDict:
             return self._keysDict[key]
         raise KeyNotFound()
+
+
+class SequenceAligner(object):
+    '''
+    I give the same sequence number to the fragments of different
+    renditions of a stream that start at the same time, so that clients
+    can switch between renditions at any fragment boundary.
+
+    The fragments of the renditions are cut at the same timestamps, but
+    don't arrive in the same order, so I remember the start time of the
+    last fragments numbered.
+    '''
+
+    def __init__(self, size):
+        '''
+        @param size: number of fragments to remember
+        @type  size: int
+        '''
+        self.size = size
+        self._next = 0
+        self._starts = deque()
+
+    def reset(self):
+        '''
+        Forget the fragments numbered so far. The sequence numbers keep
+        growing from the last one given.
+        '''
+        self._starts = deque()
+
+    def getSequenceNumber(self, timestamp, duration):
+        '''
+        Returns the sequence number of the fragment starting at the given
+        time, or None if it's older than the fragments I remember
+
+        @param timestamp: start of the fragment in nanoseconds
+        @type  timestamp: int
+        @param duration:  duration of the fragment in nanoseconds
+        @type  duration:  int
+        '''
+        tolerance = duration / 2
+        for start, sequenceNumber in self._starts:
+            if abs(start - timestamp) <= tolerance:
+                return sequenceNumber
+        if self._starts and timestamp < self._starts[-1][0]:
+            return None
+        sequenceNumber = self._next
+        self._next += 1
+        self._starts.append((timestamp, sequenceNumber))
+        while len(self._starts) > self.size:
+            self._starts.popleft()
+        return sequenceNumber
+
+
+class HLSRenditions(Playlister):
+    '''
+    I hold one L{HLSRing} for each rendition of a stream and serve the
+    master playlist listing them.
+
+    The playlists and fragments of a rendition are found under its name,
+    as in 'low/stream.m3u8' or 'low/fragment-1.ts'.
+    '''
+
+    def __init__(self, mainPlaylist, title=''):
+        '''
+        @param mainPlaylist: resource name of the master playlist
+        @type  mainPlaylist: str
+        @param title:        description of the stream
+        @type  title:        str
+        '''
+        Playlister.__init__(self)
+        self.mainPlaylist = mainPlaylist
+        self.title = title
+        self._rings = {}
+        self._names = []
+
+    def addRendition(self, name, ring):
+        '''
+        Adds the ring of a rendition, listed in the master playlist after
+        the ones added before.
+
+        @param name: name of the rendition, used as its directory
+        @type  name: str
+        @type  ring: L{HLSRing}
+        '''
+        self._rings[name] = ring
+        self._names.append(name)
+        ring.setHostname(self._hostname + name)
+        # The keys are requested from the master resource
+        ring.setKeysLocation(self._hostname, name + '/')
+        self._mainPlaylistParts = None
+        self._playlistChanged()
+
+    def getRendition(self, name):
+        return self._rings[name]
+
+    def getRenditionNames(self):
+        return self._names[:]
+
+    def setHostname(self, hostname):
+        Playlister.setHostname(self, hostname)
+        for name in self._names:
+            self._rings[name].setHostname(self._hostname + name)
+            self._rings[name].setKeysLocation(self._hostname, name + '/')
+
+    def setAllowCache(self, allowed):
+        for ring in self._rings.values():
+            ring.setAllowCache(allowed)
+
+    def setFilenameExt(self, filenameExt):
+        for ring in self._rings.values():
+            ring.setFilenameExt(filenameExt)
+
+    def reset(self):
+        for ring in self._rings.values():
+            ring.reset()
+
+    def addFragment(self, name, fragment, sequenceNumber, duration):
+        '''
+        Adds a fragment to the ring of a rendition.
+
+        @param name: name of the rendition
+        @type  name: str
+
+        @return:     the name used in the playlist for the fragment
+        @rtype :     str
+        '''
+        return self._rings[name].addFragment(fragment, sequenceNumber,
+                                             duration)
+
+    def _getMainPlaylistParts(self):
+        if self._mainPlaylistParts is None:
+            lines = ["#EXTM3U"]
+            urlLines = []
+            for name in self._names:
+                ring = self._rings[name]
+                lines.append("#EXT-X-STREAM-INF:PROGRAM-ID=1,BANDWIDTH=%s" %
+                        ring.streamBitrate)
+                urlLines.append(len(lines))
+                lines.append("".join([self._hostname, name, '/',
+                                      ring.streamPlaylist]))
+            lines.append("")
+
+            self._mainPlaylistParts = self._splitPlaylist(lines, urlLines)
+        return self._mainPlaylistParts
+
+    def _getRing(self, resource, notFound):
+        # Split 'name/resource' into the ring of the rendition and the
+        # name of the resource in that ring
+        try:
+            name, resource = resource.split('/', 1)
+            return self._rings[name], resource
+        except (ValueError, KeyError):
+            raise notFound()
+
+    def renderPlaylist(self, playlist, args):
+        '''
+        Returns a string representation of the requested playlist or raise
+        an Exception if the playlist is not found
+        '''
+        if playlist == self.mainPlaylist:
+            return self._renderMainPlaylist(args)
+        ring, playlist = self._getRing(playlist, PlaylistNotFound)
+        if playlist != ring.streamPlaylist:
+            raise PlaylistNotFound()
+        return ring.renderPlaylist(playlist, args)
+
+    def getPlaylistETag(self, playlist, args):
+        '''
+        Returns the entity tag of the requested playlist as rendered for
+        the given query arguments, or raise an Exception if the playlist
+        is not found
+        '''
+        if playlist == self.mainPlaylist:
+            return Playlister.getPlaylistETag(self, playlist, args)
+        ring, playlist = self._getRing(playlist, PlaylistNotFound)
+        if playlist != ring.streamPlaylist:
+            raise PlaylistNotFound()
+        return ring.getPlaylistETag(playlist, args)
+
+    def getFragment(self, fragmentName):
+        '''
+        Returns a fragment of a rendition or raises an Exception if the
+        fragment is not found
+        '''
+        ring, fragmentName = self._getRing(fragmentName, FragmentNotFound)
+        return ring.getFragment(fragmentName)
+
+    def getEncryptionKey(self, key):
+        '''
+        Returns an encryption key of a rendition or raises an Exception if
+        the key is not found
+        '''
+        ring, key = self._getRing(key, KeyNotFound)
+        return ring.getEncryptionKey(key)
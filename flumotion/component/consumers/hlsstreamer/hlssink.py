@@ -28,10 +28,18 @@ import gobject
 class Fragment(gobject.GObject):
     '''
     I am a Python implementation of the GstFragment
+
+    Besides the 'buffer' property of the GstFragment, I keep the data of
+    the fragment as the list of strings it was received in, in
+    L{chunks}, so that it doesn't need to be joined into one buffer.
+    The 'buffer' property is only created when it is asked for.
     '''
     index = 0
     name = 'fragment'
     duration = 0
+    timestamp = gst.CLOCK_TIME_NONE
+    chunks = ()
+    in_caps = False
     buf = None
 
     __gproperties__ = {
@@ -46,12 +54,23 @@ class Fragment(gobject.GObject):
             'Duration of the fragment in ns',
             0, gst.CLOCK_TIME_NONE, 0, gobject.PARAM_READABLE)}
 
-    def __init__(self, index, buf):
+    def __init__(self, index, chunks, timestamp, duration, in_caps=False):
         gobject.GObject.__init__(self)
         self.index = index
         self.name = "fragment-%s" % index
-        self.duration = buf.duration
-        self.buf = buf
+        self.chunks = chunks
+        self.timestamp = timestamp
+        self.duration = duration
+        self.in_caps = in_caps
+
+    def _get_buffer(self):
+        if self.buf is None:
+            self.buf = gst.Buffer(''.join(self.chunks))
+            self.buf.timestamp = self.timestamp
+            self.buf.duration = self.duration
+            if self.in_caps:
+                self.buf.flag_set(gst.BUFFER_FLAG_IN_CAPS)
+        return self.buf
 
     def do_get_property(self, prop):
         if prop.name == "name":
@@ -61,7 +80,7 @@ class Fragment(gobject.GObject):
         if prop.name == "duration":
             return self.duration
         if prop.name == "buffer":
-            return self.buf
+            return self._get_buffer()
         else:
             raise AttributeError('unknown property %s' % property.name)
 
@@ -109,6 +128,8 @@ class HLSSink(gst.Element):
         self._reset_fragment()
         self._last_fragment = None
         self._last_event_ts = gst.CLOCK_TIME_NONE
+        self._streamheader_caps = None
+        self._streamheader = []
 
         self.sinkpad = gst.Pad(self._sinkpadtemplate, "sink")
         self.sinkpad.set_chain_function(self.chainfunc)
@@ -120,7 +141,9 @@ class HLSSink(gst.Element):
             self._in_caps = True
             return gst.FLOW_OK
 
-        self._fragment.append(buf)
+        # Copy the data out of the buffer once; fragments are kept as
+        # lists of these strings from here on
+        self._fragment.append(buf.data)
         return gst.FLOW_OK
 
     def eventfunc(self, pad, event):
@@ -150,13 +173,22 @@ class HLSSink(gst.Element):
         self._in_caps = False
         self._last_event_ts = last_event_ts
 
+    def _get_streamheader(self):
+        # The streamheaders only change with the caps, so their data is
+        # shared by all the fragments
+        caps = self.sinkpad.get_negotiated_caps()
+        if self._streamheader_caps is None or \
+                not caps.is_equal(self._streamheader_caps):
+            s = caps[0]
+            self._streamheader = []
+            if s.has_field('streamheader'):
+                self._streamheader = [b.data for b in s['streamheader']]
+            self._streamheader_caps = caps
+        return self._streamheader
+
     def _finish_fragment(self, timestamp, index):
         # Write streamheaders at the beginning of each fragment
-        s = self.sinkpad.get_negotiated_caps()[0]
-        frag = []
-        if s.has_field('streamheader'):
-            frag = list(s['streamheader'])
-        frag.extend(self._fragment)
+        frag = self._get_streamheader() + self._fragment
 
         # Check for discontinuities
         if self._last_event_ts == gst.CLOCK_TIME_NONE or\
@@ -165,16 +197,10 @@ class HLSSink(gst.Element):
             self._last_fragment = None
             return
 
-        # Create the GstBuffer
-        data = ''.join([b.data for b in frag])
-        buf = gst.Buffer(data)
-        buf.timestamp = self._last_event_ts
-        buf.duration = timestamp - buf.timestamp
-        if self._in_caps:
-            buf.flag_set(gst.BUFFER_FLAG_IN_CAPS)
-
         # Create the GstFragment and emit the new-fragment signal
-        self._last_fragment = Fragment(index, buf)
+        self._last_fragment = Fragment(index, frag, self._last_event_ts,
+                                       timestamp - self._last_event_ts,
+                                       self._in_caps)
         self.emit('new-fragment')
         self._reset_fragment(timestamp)
 
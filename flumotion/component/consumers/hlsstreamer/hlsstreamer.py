@@ -20,7 +20,7 @@ import urlparse
 
 from twisted.internet import reactor
 
-from flumotion.common import gstreamer
+from flumotion.common import errors, gstreamer
 from flumotion.common.i18n import gettexter
 from flumotion.component.base import http
 from flumotion.component.component import moods
@@ -28,7 +28,8 @@ from flumotion.component.common.streamer.fragmentedstreamer import\
         FragmentedStreamer, Stats
 from flumotion.component.consumers.hlsstreamer.resources import \
         HTTPLiveStreamingResource
-from flumotion.component.consumers.hlsstreamer.hlsring import HLSRing
+from flumotion.component.consumers.hlsstreamer.hlsring import HLSRing, \
+        HLSRenditions, SequenceAligner
 from flumotion.component.consumers.hlsstreamer import hlssink
 
 __all__ = ['HLSStreamer']
@@ -36,6 +37,8 @@ __version__ = ""
 T_ = gettexter()
 
 
+MB = 1024 * 1024
+
 SUPPORTED_FORMATS = {"video/mpegts": ("video/mpegts", "video/mpegts", "ts"),
                      "video/webm": ("video/webm", "video/webm", "webm")}
 
@@ -47,6 +50,7 @@ class HLSStreamer(FragmentedStreamer, Stats):
     DEFAULT_STREAM_PLAYLIST = 'stream.m3u8'
     DEFAULT_STREAM_BITRATE = 300000
     DEFAULT_KEYFRAMES_PER_SEGMENT = 10
+    DEFAULT_MEMORY_BUDGET = 64
 
     logCategory = 'hls-streamer'
 
@@ -57,6 +61,12 @@ class HLSStreamer(FragmentedStreamer, Stats):
     def init(self):
         self.debug("HTTP live streamer initialising")
         self.hlsring = None
+        # In multi-rendition mode, the rendition of each sink by name and
+        # the fragments received for each rendition
+        self._renditions = {}
+        self._renditionCounts = {}
+        self._lastTimestamps = {}
+        self._aligner = None
 
     def get_mime(self):
         return self._mime_type
@@ -69,7 +79,30 @@ class HLSStreamer(FragmentedStreamer, Stats):
         # when it is mature enough.
         # if not gstreamer.element_factory_exists('hlssink'):
         hlssink.register()
-        return "hlssink name=sink sync=false"
+        renditions = properties.get('rendition', [])
+        if not renditions:
+            return "hlssink name=sink sync=false"
+        # One sink per rendition, each eating its own feed
+        return ' '.join(['@ eater:%s @ ! hlssink name=sink-%s sync=false' %
+                         (r['feeder-alias'], r['name']) for r in renditions])
+
+    def check_properties(self, props, addMessage):
+        FragmentedStreamer.check_properties(self, props, addMessage)
+
+        aliases = []
+        for feeds in self.config.get('eater', {}).values():
+            aliases.extend([alias for feedId, alias in feeds])
+        names = []
+        for rendition in props.get('rendition', []):
+            name = rendition['name']
+            if name in names or '/' in name:
+                raise errors.ConfigError("invalid or duplicated rendition "
+                                         "name '%s'" % name)
+            names.append(name)
+            if rendition['feeder-alias'] not in aliases:
+                raise errors.ConfigError("rendition '%s' eats from unknown "
+                                         "feeder alias '%s'" %
+                                         (name, rendition['feeder-alias']))
 
     def configure_auth_and_resource(self):
         self.httpauth = http.HTTPAuthentication(self)
@@ -79,18 +112,44 @@ class HLSStreamer(FragmentedStreamer, Stats):
     def getRing(self):
         return self.hlsring
 
-    def configure_pipeline(self, pipeline, props):
-        self.hlsring = HLSRing(
+    def _makeRing(self, props, streamBitrate, memoryBudget):
+        return HLSRing(
             props.get('main-playlist', self.DEFAULT_MAIN_PLAYLIST),
             props.get('stream-playlist', self.DEFAULT_STREAM_PLAYLIST),
-            props.get('stream-bitrate', self.DEFAULT_STREAM_BITRATE),
+            streamBitrate,
             self.description,
             props.get('fragment-prefix', self.DEFAULT_FRAGMENT_PREFIX),
             props.get('new-fragment-tolerance', 0),
             props.get('max-window', self.DEFAULT_MAX_WINDOW),
             props.get('max-extra-buffers', None),
             props.get('key-rotation', 0),
-            props.get('keys-uri', None))
+            props.get('keys-uri', None),
+            props.get('spool-directory', None),
+            memoryBudget)
+
+    def configure_pipeline(self, pipeline, props):
+        memoryBudget = props.get('memory-budget',
+                                 self.DEFAULT_MEMORY_BUDGET) * MB
+        renditions = props.get('rendition', [])
+        if not renditions:
+            self.hlsring = self._makeRing(props,
+                props.get('stream-bitrate', self.DEFAULT_STREAM_BITRATE),
+                memoryBudget)
+        else:
+            # One ring per rendition, sharing the memory budget, behind
+            # a master playlist
+            self.hlsring = HLSRenditions(
+                props.get('main-playlist', self.DEFAULT_MAIN_PLAYLIST),
+                self.description)
+            for rendition in renditions:
+                name = rendition['name']
+                self.hlsring.addRendition(name, self._makeRing(props,
+                    rendition.get('stream-bitrate',
+                                  self.DEFAULT_STREAM_BITRATE),
+                    memoryBudget / len(renditions)))
+                self._renditions['sink-%s' % name] = name
+            self._aligner = SequenceAligner(
+                2 * props.get('max-window', self.DEFAULT_MAX_WINDOW))
 
         # Call the base class after initializing the ring and getting
         # the secret key and the session timeout
@@ -120,25 +179,93 @@ class HLSStreamer(FragmentedStreamer, Stats):
         self._ready = False
         self._fragmentsCount = 0
         self._last_index = 0
+        self._renditionCounts = {}
+        self._lastTimestamps = {}
+        if self._aligner:
+            self._aligner.reset()
         self.hlsring.reset()
 
+    def _get_sinks(self, pipeline):
+        if not self._renditions:
+            return FragmentedStreamer._get_sinks(self, pipeline)
+        return [pipeline.get_by_name('sink-%s' % name)
+                for name in self.hlsring.getRenditionNames()]
+
     def _setup_stream_type(self, stream_type):
         self.info("Setting up streamer for stream type %s", stream_type)
         mime_type, content_type, frag_ext = SUPPORTED_FORMATS[stream_type]
         self._mime_type = mime_type
         self._content_type = content_type
-        self.hlsring.filenameExt = frag_ext
+        self.hlsring.setFilenameExt(frag_ext)
         self._stream_setup = True
 
-    def _configure_sink(self):
-        self.sink.set_property('write-to-disk', False)
-        self.sink.set_property('playlist-max-window', 5)
+    def _configure_sink(self, sink):
+        sink.set_property('write-to-disk', False)
+        sink.set_property('playlist-max-window', 5)
+
+    def _connect_sink_signals(self, sink):
+        FragmentedStreamer._connect_sink_signals(self, sink)
+        sink.connect("new-fragment", self._new_fragment)
+
+    def _get_fragment_data(self, fragment):
+        if isinstance(fragment, hlssink.Fragment):
+            # Keep the fragment as the list of strings it was received in
+            return fragment.chunks
+        return fragment.get_property('buffer').data
+
+    def _get_fragment_timestamp(self, fragment):
+        if isinstance(fragment, hlssink.Fragment):
+            return fragment.timestamp
+        return fragment.get_property('buffer').timestamp
 
-    def _connect_sink_signals(self):
-        FragmentedStreamer._connect_sink_signals(self)
-        self.sink.connect("new-fragment", self._new_fragment)
+    def _process_rendition_fragment(self, fragment, sinkName):
+        name = self._renditions[sinkName]
+
+        if not self._stream_setup:
+            pad = self.get_element(sinkName).get_pad("sink")
+            caps = pad.get_negotiated_caps()
+            self._setup_stream_type(caps.get_structure(0).get_name())
+
+        timestamp = self._get_fragment_timestamp(fragment)
+        duration = fragment.get_property('duration')
+
+        if timestamp < self._lastTimestamps.get(name, 0):
+            self.warning("Found a discontinuity in rendition %s, last "
+                         "timestamp is %s but current one is %s", name,
+                         gst.TIME_ARGS(self._lastTimestamps[name]),
+                         gst.TIME_ARGS(timestamp))
+            self.soft_restart()
+        self._lastTimestamps[name] = timestamp
+
+        # Fragments of all the renditions starting at the same time get
+        # the same sequence number
+        sequenceNumber = self._aligner.getSequenceNumber(timestamp,
+                                                         duration)
+        if sequenceNumber is None:
+            self.warning("Dropping late fragment of rendition %s at %s",
+                         name, gst.TIME_ARGS(timestamp))
+            return
+
+        # Wait for hls-min-window fragments of every rendition to set the
+        # component 'happy'
+        self._renditionCounts[name] = self._renditionCounts.get(name, 0) + 1
+        if len(self._renditionCounts) == len(self._renditions):
+            self._fragmentsCount = min(self._renditionCounts.values())
+            if self._fragmentsCount == self._minWindow and not self._ready:
+                self.info("%d fragments of every rendition received. "
+                          "Changing mood to 'happy'", self._fragmentsCount)
+                self.setMood(moods.happy)
+                self._ready = True
+
+        fragName = self.hlsring.addFragment(name,
+                self._get_fragment_data(fragment), sequenceNumber,
+                round(duration / float(gst.SECOND)))
+        self.info('Added fragment "%s/%s", sequence=%s, duration=%s',
+                  name, fragName, sequenceNumber, gst.TIME_ARGS(duration))
 
-    def _process_fragment(self, fragment):
+    def _process_fragment(self, fragment, sinkName='sink'):
+        if self._renditions:
+            return self._process_rendition_fragment(fragment, sinkName)
 
         if not self._stream_setup:
             sink = self.get_element("sink")
@@ -156,7 +283,7 @@ class HLSStreamer(FragmentedStreamer, Stats):
             self.setMood(moods.happy)
             self._ready = True
 
-        b = fragment.get_property('buffer')
+        data = self._get_fragment_data(fragment)
         index = fragment.get_property('index')
         duration = fragment.get_property('duration')
 
@@ -165,7 +292,7 @@ class HLSStreamer(FragmentedStreamer, Stats):
                          "one is %s", self._last_index, index)
             self.soft_restart()
 
-        fragName = self.hlsring.addFragment(b.data, index,
+        fragName = self.hlsring.addFragment(data, index,
                 round(duration / float(gst.SECOND)))
         self.info('Added fragment "%s", index=%s, duration=%s',
                   fragName, index, gst.TIME_ARGS(duration))
@@ -178,6 +305,7 @@ class HLSStreamer(FragmentedStreamer, Stats):
             fragment = hlssink.get_property('fragment')
         except:
             fragment = hlssink.emit('pull-fragment')
-        reactor.callFromThread(self._process_fragment, fragment)
+        reactor.callFromThread(self._process_fragment, fragment,
+                               hlssink.get_name())
 
     ### END OF THREAD-AWARE CODE
@@ -15,17 +15,72 @@
 #
 # Headers in this file shall remain intact.
 
-from twisted.internet import defer
+from twisted.internet import defer, interfaces
 from twisted.web import server
+from zope.interface import implements
+
+try:
+    from twisted.web import http
+except ImportError:
+    from twisted.protocols import http
 
 from flumotion.component.common.streamer.fragmentedresource import\
     FragmentedResource
+from flumotion.component.consumers.hlsstreamer import fragmentspool, hlsring
 
 __version__ = "$Rev: $"
 
 M3U8_CONTENT_TYPE = 'application/vnd.apple.mpegurl'
 PLAYLIST_EXTENSION = '.m3u8'
 
+
+class FragmentProducer(object):
+    """
+    I write a fragment to a request a chunk at a time, whenever the
+    client is ready for more, and finish the request at the end.
+    """
+
+    implements(interfaces.IPullProducer)
+
+    def __init__(self, request, fragment, finished):
+        self._request = request
+        self._chunks = iter(fragment)
+        self._finished = finished
+
+    def start(self):
+        self._request.registerProducer(self, False)
+
+    def resumeProducing(self):
+        if not self._request:
+            return
+        try:
+            chunk = self._chunks.next()
+        except StopIteration:
+            request, self._request = self._request, None
+            request.unregisterProducer()
+            self._finished(request)
+            request.finish()
+            return
+        self._request.write(chunk)
+
+    def stopProducing(self):
+        self._request = None
+
+
+def _matchesETag(header, etag):
+    """
+    Tell if an If-None-Match header, '*' or a list of entity tags,
+    matches the given entity tag; weak tags match too.
+    """
+    if header is None:
+        return False
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag in ('*', etag, 'W/' + etag):
+            return True
+    return False
+
+
 ### the Twisted resource that handles the base URL
 
 
@@ -55,8 +110,17 @@ class HTTPLiveStreamingResource(FragmentedResource):
 
     def _renderPlaylist(self, res, request, resource):
         self.debug('_render(): asked for playlist %s', resource)
+        etag = self.ring.getPlaylistETag(resource, request.args)
         request.setHeader("Connection", "Keep-Alive")
+        if _matchesETag(request.getHeader('if-none-match'), etag):
+            self.debug('playlist %s not modified', resource)
+            self._writeHeaders(request, M3U8_CONTENT_TYPE,
+                               http.NOT_MODIFIED)
+            request.setHeader('ETag', etag)
+            request.finish()
+            return res
         self._writeHeaders(request, M3U8_CONTENT_TYPE)
+        request.setHeader('ETag', etag)
         if request.method == 'GET':
             playlist = self.ring.renderPlaylist(resource, request.args)
             request.write(playlist)
@@ -73,9 +137,19 @@ class HTTPLiveStreamingResource(FragmentedResource):
         self._writeHeaders(request)
         if request.method == 'GET':
             data = self.ring.getFragment(resource)
-            request.setHeader('content-length', len(data))
-            request.write(data)
-            self.bytesSent += len(data)
+            length = hlsring.getFragmentLength(data)
+            request.setHeader('content-length', length)
+            self.bytesSent += length
+            if isinstance(data, fragmentspool.DiskFragment):
+                # Read it from disk as the client takes it
+                FragmentProducer(request, data, self._logWrite).start()
+                return res
+            if isinstance(data, str):
+                data = (data, )
+            # Write the strings the fragment is made of one by one, to
+            # avoid joining them into a copy of the whole fragment
+            for chunk in data:
+                request.write(chunk)
             self._logWrite(request)
         if request.method == 'HEAD':
             self.debug('handling HEAD request')
@@ -22,7 +22,7 @@ implementation of a PB Client to interface with feedserver.py
 import socket
 import os
 
-from twisted.internet import reactor, main, defer, tcp
+from twisted.internet import reactor, main, defer, tcp, unix, error
 from twisted.python import failure
 from zope.interface import implements
 
@@ -54,7 +54,7 @@ class _SocketMaybeCloser(tcp._SocketCloser):
             from twisted import version as v
             if (v.major, v.minor, v.micro) > (11, 0, 0):
                 args.append(orderly)
-            tcp.Server._closeSocket(self, *args)
+            tcp._SocketCloser._closeSocket(self, *args)
 
 
 class PassableClientConnection(_SocketMaybeCloser, tcp.Client):
@@ -72,6 +72,29 @@ class PassableClientConnector(tcp.Connector):
                                         self.reactor)
 
 
+class PassableUNIXClientConnection(_SocketMaybeCloser, unix.Client):
+    pass
+
+
+class PassableUNIXClientConnector(unix.Connector):
+
+    def _makeTransport(self):
+        return PassableUNIXClientConnection(self.address, self,
+                                            self.reactor)
+
+
+def isLocalHost(host):
+    """
+    Whether the given host name or address is this host, as the manager
+    maps the feeds between components running on the same host.
+
+    @type  host: str
+
+    @rtype: bool
+    """
+    return host == 'localhost' or host.startswith('127.')
+
+
 class FeedClientFactory(fpb.FPBClientFactory, log.Loggable):
     """
     I am a client factory used by a feed component's medium to log into
@@ -122,6 +145,10 @@ class FeedMedium(fpb.Referenceable):
         cancelling an in-progress connection via the stopConnecting()
         method.
 
+        Feed servers on this host are connected to through their unix
+        socket instead, so that the feed does not go through the TCP/IP
+        stack; TCP is still used if that connection fails.
+
         @param host:          the remote host name
         @type  host:          str
         @param port:          the tcp port on which to connect
@@ -134,6 +161,32 @@ class FeedMedium(fpb.Referenceable):
                   once we have authenticated.
         """
         assert self._factory is None
+        path = common.feedServerSocketPath(port)
+        if not (isLocalHost(host) and os.path.exists(path)):
+            return self._connectTCP(host, port, authenticator, timeout,
+                                    bindAddress)
+
+        def connectFailed(failure, factory):
+            failure.trap(error.ConnectError)
+            if self._factory is not factory:
+                # stopConnecting() was called
+                return failure
+            self.info('could not connect to feed server socket %s, '
+                      'connecting to port %d instead', path, port)
+            self.debug('failure: %s', log.getFailureMessage(failure))
+            self._factory = None
+            return self._connectTCP(host, port, authenticator, timeout,
+                                    bindAddress)
+
+        self.debug('connecting to feed server socket %s', path)
+        self._factory = FeedClientFactory(self)
+        reactor.connectWith(PassableUNIXClientConnector, path,
+                            self._factory, timeout, checkPID=False)
+        d = self._factory.login(authenticator)
+        d.addErrback(connectFailed, self._factory)
+        return d
+
+    def _connectTCP(self, host, port, authenticator, timeout, bindAddress):
         self._factory = FeedClientFactory(self)
         reactor.connectWith(PassableClientConnector, host, port,
                             self._factory, timeout, bindAddress)
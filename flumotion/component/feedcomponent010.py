@@ -29,7 +29,7 @@ from flumotion.common.i18n import N_, gettexter
 from flumotion.common.planet import moods
 from flumotion.component import component as basecomponent
 from flumotion.component import padmonitor
-from flumotion.component.feeder import Feeder
+from flumotion.component.feeder import Feeder, FeederStatsCollector
 from flumotion.component.eater import Eater
 
 __version__ = "$Rev$"
@@ -46,6 +46,12 @@ class FeedComponent(basecomponent.BaseComponent):
 
     # how often to update the UIState feeder statistics
     FEEDER_STATS_UPDATE_FREQUENCY = 12.5
+    # how often to check whether joining feeder clients were sent data
+    FEEDER_JOIN_POLL_INTERVAL = 0.05
+    # start feeding new clients from the latest keyframe multifdsink
+    # holds, instead of the latest buffer, so that eaters don't wait for
+    # the next keyframe on (re)connection
+    burstFeedersOnConnect = True
     dropStreamHeaders = True
     swallowNewSegment = True
 
@@ -66,6 +72,8 @@ class FeedComponent(basecomponent.BaseComponent):
         self.bus_signal_id = None
         self.effects = {}
         self._feeder_probe_cl = None
+        self._feeder_join_cl = None
+        self._feeder_stats = FeederStatsCollector()
 
         self._pad_monitors = padmonitor.PadMonitorSet(
             lambda: self.setMood(moods.happy),
@@ -203,6 +211,11 @@ class FeedComponent(basecomponent.BaseComponent):
                 element.connect('client-fd-removed', client_fd_removed,
                                 feeder)
                 self.debug("Connected to client-fd-removed on %r", feeder)
+                if self.burstFeedersOnConnect:
+                    # multifdsink then keeps the buffers since the latest
+                    # keyframe, up to buffers-soft-max, for the clients
+                    # to start from
+                    element.set_property('sync-method', 2) # latest-keyframe
             else:
                 self.warning("No feeder %s in pipeline", feeder.elementName)
 
@@ -469,6 +482,9 @@ class FeedComponent(basecomponent.BaseComponent):
         if self._feeder_probe_cl:
             self._feeder_probe_cl.cancel()
             self._feeder_probe_cl = None
+        if self._feeder_join_cl:
+            self._feeder_join_cl.cancel()
+            self._feeder_join_cl = None
 
         # clean up checkEater callLaters
         for eater in self.eaters.values():
@@ -605,28 +621,36 @@ class FeedComponent(basecomponent.BaseComponent):
         self.pipeline.set_state(gst.STATE_PLAYING)
 
     def _feeder_probe_calllater(self):
-        for feedId, feeder in self.feeders.items():
-            feederElement = self.get_element(feeder.elementName)
-            for client in feeder.getClients():
-                # a currently disconnected client will have fd None
-                if client.fd is not None:
-                    array = feederElement.emit('get-stats', client.fd)
-                    if len(array) == 0:
-                        # There is an unavoidable race here: we can't know
-                        # whether the fd has been removed from multifdsink.
-                        # However, if we call get-stats on an fd that
-                        # multifdsink doesn't know about, we just get a
-                        # 0-length array. We ensure that we don't reuse
-                        # the FD too soon so this can't result in calling
-                        # this on a valid but WRONG fd
-                        self.debug('Feeder element for feed %s does not know '
-                            'client fd %d' % (feedId, client.fd))
-                    else:
-                        client.setStats(array)
+        self._feeder_stats.collect(self.feeders.values(), self.get_element,
+                                   self.uiState)
+        self.log('statistics of %d feeder client(s) changed',
+                 len(self._feeder_stats.delta))
         self._feeder_probe_cl = reactor.callLater(
             self.FEEDER_STATS_UPDATE_FREQUENCY,
             self._feeder_probe_calllater)
 
+    def _feeder_join_calllater(self):
+        # Polls the clients that were not sent data yet often, so that
+        # their join latency is accurate
+        self._feeder_join_cl = None
+        joining = False
+        for feeder in self.feeders.values():
+            feederElement = self.get_element(feeder.elementName)
+            for client in feeder.getClients():
+                if not client.isJoining():
+                    continue
+                array = feederElement.emit('get-stats', client.fd)
+                if len(array) == 0:
+                    # the client fd was removed, see FeederStatsCollector
+                    continue
+                client.setStats(array)
+                if client.isJoining():
+                    joining = True
+        if joining:
+            self._feeder_join_cl = reactor.callLater(
+                self.FEEDER_JOIN_POLL_INTERVAL,
+                self._feeder_join_calllater)
+
     def unblock_eater(self, eaterAlias):
         """
         After this function returns, the stream lock for this eater must have
@@ -815,6 +839,11 @@ class FeedComponent(basecomponent.BaseComponent):
         element.emit('add', fd)
         feeder.clientConnected(clientId, fd, cleanup)
 
+        if self._get_stats_supported and not self._feeder_join_cl:
+            self._feeder_join_cl = reactor.callLater(
+                self.FEEDER_JOIN_POLL_INTERVAL,
+                self._feeder_join_calllater)
+
     def eatFromFD(self, eaterAlias, feedId, fd):
         """
         Tell the component to eat the given feedId from the given fd.
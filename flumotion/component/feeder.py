@@ -99,6 +99,85 @@ class Feeder:
         return self._clients.values()
 
 
+class FeederStatsCollector:
+    """
+    I take the statistics of the clients of feeders, all in one pass,
+    and only hand the statistics of the clients whose statistics changed
+    since my previous pass to them.
+
+    @ivar delta: the clients whose statistics changed in my last pass,
+                 and their new statistics
+    @type delta: dict of L{FeederClient} -> tuple
+    """
+
+    # the statistics used by FeederClient.setStats, except the duration
+    # of the connection which always changes
+    _USED_STATS = (0, 4, 5, 6)
+
+    def __init__(self):
+        self.delta = {}
+        self._snapshot = {} # (FeederClient, fd) -> used statistics
+
+    def collect(self, feeders, getElement, uiState=None):
+        """
+        Take the statistics of the connected clients of the given feeders,
+        and update the UI state of those with changed statistics.
+
+        @param feeders:    the feeders to take the statistics of
+        @type  feeders:    list of L{Feeder}
+        @param getElement: function returning the multifdsink element of
+                           the given name
+        @type  getElement: callable
+        @param uiState:    the UI state holding the UI states of the
+                           feeders, to send all the changes in one message
+        @type  uiState:    L{componentui.WorkerComponentUIState}
+        """
+        snapshot = {}
+        delta = {}
+        for feeder in feeders:
+            element = getElement(feeder.elementName)
+            for client in feeder.getClients():
+                # a currently disconnected client will have fd None
+                if client.fd is None:
+                    continue
+                array = element.emit('get-stats', client.fd)
+                if len(array) == 0:
+                    # There is an unavoidable race here: we can't know
+                    # whether the fd has been removed from multifdsink.
+                    # However, if we call get-stats on an fd that
+                    # multifdsink doesn't know about, we just get a
+                    # 0-length array. We ensure that we don't reuse
+                    # the FD too soon so this can't result in calling
+                    # this on a valid but WRONG fd
+                    continue
+                stats = tuple(array)
+                used = tuple([stats[i] for i in self._USED_STATS
+                              if i < len(stats)])
+                key = (client, client.fd)
+                snapshot[key] = used
+                if self._snapshot.get(key) != used:
+                    delta[client] = stats
+        self._snapshot = snapshot
+        self.delta = delta
+
+        if not delta:
+            return
+        # the changes of all the clients are sent in the batch of the
+        # given UI state, or in one message per client without it
+        if uiState is not None:
+            uiState.beginBatch()
+        try:
+            for client, stats in delta.iteritems():
+                client.uiState.beginBatch(uiState)
+                try:
+                    client.setStats(stats)
+                finally:
+                    client.uiState.commitBatch()
+        finally:
+            if uiState is not None:
+                uiState.commitBatch()
+
+
 class FeederClient:
     """
     This class groups information related to the client of a feeder.
@@ -132,16 +211,23 @@ class FeederClient:
         for key in (
             'buffers-dropped-current', # buffers dropped over current conn
             'buffers-dropped-total',   # buffers dropped over all connections
+            'join-latency',            # seconds from the last connection to
+                                       # the first stats showing a buffer
+                                       # sent, as precise as the polling
             ):
             self.uiState.addKey(key, None)
 
         # internal state allowing us to track global numbers
         self._buffersDroppedBefore = 0
         self._bytesReadBefore = 0
+        # whether no buffer has been sent over the current connection yet
+        self._joining = False
 
-    def setStats(self, stats):
+    def setStats(self, stats, when=None):
         """
         @type stats: list
+        @param when: when the stats were taken, in epoch seconds
+        @type  when: float
         """
         bytesSent = stats[0]
         #timeAdded = stats[1]
@@ -156,14 +242,43 @@ class FeederClient:
             # since that would break integer addition below
             buffersDropped = 0
 
-        self.uiState.set('bytes-read-current', bytesSent)
-        self.uiState.set('buffers-dropped-current', buffersDropped)
-        self.uiState.set('bytes-read-total', self._bytesReadBefore + bytesSent)
-        self.uiState.set('last-activity', timeLastActivity)
+        self._setChanged('bytes-read-current', bytesSent)
+        self._setChanged('buffers-dropped-current', buffersDropped)
+        self._setChanged('bytes-read-total', self._bytesReadBefore + bytesSent)
+        self._setChanged('last-activity', timeLastActivity)
         if buffersDropped is not None:
-            self.uiState.set('buffers-dropped-total',
+            self._setChanged('buffers-dropped-total',
                 self._buffersDroppedBefore + buffersDropped)
 
+        if self._joining:
+            if len(stats) > 6:
+                # added in gst-plugins-base 0.10.24; the timestamp of the
+                # first buffer sent, not counting the stream headers
+                if stats[6] == gst.CLOCK_TIME_NONE:
+                    return
+                # that timestamp is the buffer's, not the time it was
+                # sent, so the latency is only known to the interval the
+                # stats of a joining client are taken at, see
+                # FeedComponent.FEEDER_JOIN_POLL_INTERVAL
+                if not when:
+                    when = time.time()
+                self.uiState.set('join-latency',
+                    when - self.uiState.get('last-connect'))
+            self._joining = False
+
+    def _setChanged(self, key, value):
+        # Every set is sent to every observer of the UI state
+        if self.uiState.get(key) != value:
+            self.uiState.set(key, value)
+
+    def isJoining(self):
+        """
+        @returns: whether the client is connected but has not been sent
+                  any buffer yet, as far as the last stats tell
+        @rtype:   bool
+        """
+        return self.fd is not None and self._joining
+
     def connected(self, fd, when=None):
         """
         The client has connected on this fd.
@@ -181,7 +296,9 @@ class FeederClient:
             self._updateUIStateForDisconnect(self.fd, when)
 
         self.fd = fd
+        self._joining = True
         self.uiState.set('fd', fd)
+        self.uiState.set('join-latency', None)
         self.uiState.set('last-connect', when)
         self.uiState.set('reconnects', self.uiState.get('reconnects', 0) + 1)
 
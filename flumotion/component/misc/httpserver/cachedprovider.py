@@ -104,6 +104,7 @@ class FileProviderLocalCachedPlug(fileprovider.FileProviderPlug,
         cleanupEnabled = props.get('cleanup-enabled')
         cleanupHighWatermark = props.get('cleanup-high-watermark')
         cleanupLowWatermark = props.get('cleanup-low-watermark')
+        evictionPolicy = props.get('cache-eviction-policy')
 
         self._sessions = {} # {CopySession: None}
         self._index = {} # {path: CopySession}
@@ -114,7 +115,8 @@ class FileProviderLocalCachedPlug(fileprovider.FileProviderPlug,
                                                cacheDir, cacheSize,
                                                cleanupEnabled,
                                                cleanupHighWatermark,
-                                               cleanupLowWatermark)
+                                               cleanupLowWatermark,
+                                               evictionPolicy=evictionPolicy)
 
         common.ensureDir(self._sourceDir, "source")
 
@@ -244,6 +246,7 @@ class LocalPath(localpath.LocalPath, log.Loggable):
         except OSError, e:
             if e.errno != errno.ENOENT:
                 self.warning("Error deleting file: %s", str(e))
+        self.plug.cache.forgetCacheFile(cachePath)
 
 
 class CopyThread(threading.Thread, log.Loggable):
@@ -484,7 +487,7 @@ class CopySession(log.Loggable):
 
     def _allocCacheSpace(self):
         # Retrieve a cache allocation tag, used to track the cache free space
-        return self.plug.cache.allocateCacheSpace(self.size)
+        return self.plug.cache.allocateCacheSpace(self.size, self.sourcePath)
 
     def _releaseCacheSpace(self):
         if not (self._cancelled or self._allocTag is None):
@@ -523,6 +526,7 @@ class CopySession(log.Loggable):
         except IOError, e:
             self.warning("Failed to open temporary file: %s",
                          log.getExceptionMessage(e))
+            self.plug.cache.reportError(self.tempPath, e)
             self._cancelSession()
             return
         # Truncate it to the source size
@@ -532,6 +536,7 @@ class CopySession(log.Loggable):
         except IOError, e:
             self.warning("Failed to truncate temporary file: %s",
                          log.getExceptionMessage(e))
+            self.plug.cache.reportError(self.tempPath, e)
             self._cancelSession()
             return
         # And move it to the real temporary file path
@@ -638,7 +643,13 @@ class CopySession(log.Loggable):
             else:
                 self.warning("Failed to rename temporary file: %s",
                              log.getExceptionMessage(e))
+                self.plug.cache.reportError(self.cachePath, e)
             self._cancelSession()
+        else:
+            if not (self._cancelled or self._allocTag is None):
+                self.plug.cache.commitCacheSpace(self._allocTag,
+                                                 self.cachePath)
+            self._allocTag = None
         # Complete all pending source read operations with the temporary file.
         for position, size, d in self._pending:
             try:
@@ -730,6 +741,11 @@ class TempFileDelegate(log.Loggable):
     def seek(self, offset):
         self._position = offset
 
+    def fileno(self):
+        # The file is still being copied, it can only be read through
+        # the copy session
+        return None
+
     def read(self, size, stats):
         assert not self._reading, "Simultaneous read not supported"
         d = self._session.read(self._position, size, stats)
@@ -788,6 +804,9 @@ class DirectFileDelegate(log.Loggable):
             cls = errnoLookup.get(e.errno, FileError)
             raise cls("Failed to read data from file: %s" % str(e))
 
+    def fileno(self):
+        return self._file.fileno()
+
     def close(self):
         if self._file is not None:
             try:
@@ -807,6 +826,10 @@ class CachedFileDelegate(DirectFileDelegate):
         stats.onBytesRead(0, len(data), 0)
         return data
 
+    def skip(self, size, stats):
+        self.seek(self.tell() + size)
+        stats.onBytesRead(0, size, 0)
+
     def close(self):
         if self._file is not None:
             self.log("Closing cached file [fd %d]", self._file.fileno())
@@ -888,6 +911,16 @@ class CachedFile(fileprovider.File, log.Loggable):
         except:
             return defer.fail()
 
+    def fileno(self):
+        if self._delegate is None:
+            raise FileClosedError("File closed")
+        return self._delegate.fileno()
+
+    def skip(self, size):
+        if self._delegate is None:
+            raise FileClosedError("File closed")
+        self._delegate.skip(size, self.stats)
+
     def close(self):
         if self._delegate:
             self.stats.onClosed()
@@ -927,6 +960,7 @@ class CachedFile(fileprovider.File, log.Loggable):
             return self._tryTempFile(sourcePath, sourceFile, sourceInfo)
         except FileError, e:
             self.debug("Failed to open cached file: %s", str(e))
+            self.plug.cache.reportError(cachedPath, e)
             self._removeCachedFile(cachedPath)
             return self._tryTempFile(sourcePath, sourceFile, sourceInfo)
         # Found a cached file, now check the modification time
@@ -944,6 +978,7 @@ class CachedFile(fileprovider.File, log.Loggable):
         self._closeSourceFile(sourceFile)
         # We have a valid cached file, just delegate to it.
         self.debug("Serving cached file '%s'", cachedPath)
+        self.plug.cache.touchCacheFile(cachedPath)
         delegate = CachedFileDelegate(self.plug, cachedPath,
                                       cachedFile, cachedInfo)
         self.stats.onStarted(delegate.size, cachestats.CACHE_HIT)
@@ -956,6 +991,7 @@ class CachedFile(fileprovider.File, log.Loggable):
         except OSError, e:
             if e.errno != errno.ENOENT:
                 self.warning("Error deleting cached file: %s", str(e))
+        self.plug.cache.forgetCacheFile(cachePath)
 
     def _tryTempFile(self, sourcePath, sourceFile, sourceInfo):
         session = self.plug.getCopySession(sourcePath)
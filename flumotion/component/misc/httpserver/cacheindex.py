@@ -0,0 +1,455 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_cache_manager -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""index of the files in a cache directory.
+Keeps the size and access time of every cached file in memory, so the
+cache usage is known and the least recently used files are found
+without listing the directory, and persists it in a journal file
+inside the cache directory.
+
+The journal is a list of records appended to by every process using
+the cache directory::
+
+    + <name> <size> <atime> [<hits>]    a file was added
+    * <name> <atime>                    a file was accessed
+    - <name>                            a file was removed
+
+Every process remembers where its own records are, to not apply them
+again when reading the records of the others. When it gets too long,
+the journal is rewritten with one record per file.
+
+The files to delete when the cache is full are chosen by an eviction
+policy from L{flumotion.component.misc.httpserver.cachepolicy}.
+"""
+
+import errno
+import os
+import stat
+import time
+
+from twisted.internet import defer, threads
+
+from flumotion.common import log
+from flumotion.component.misc.httpserver import cachepolicy
+
+__version__ = "$Rev$"
+
+LOG_CATEGORY = "cache-index"
+
+INDEX_FILENAME = "cache.index"
+# The journal isn't rewritten before it has that many records
+COMPACT_MIN_RECORDS = 10000
+
+
+class CacheEntry(object):
+    """
+    A cached file.
+
+    @ivar priority: used by the eviction policy
+    """
+
+    __slots__ = ('size', 'atime', 'hits', 'priority')
+
+    def __init__(self, size, atime, hits=0):
+        self.size = size
+        self.atime = atime
+        self.hits = hits
+        self.priority = None
+
+
+class CacheIndex(log.Loggable):
+    """
+    I am the index of the files in a cache directory.
+
+    I must be loaded before being used; the changes done meanwhile are
+    applied once I'm loaded. I'm not thread-safe, and my methods must be
+    called from the reactor thread.
+
+    @ivar usage: the total size of the indexed files, in bytes
+    @type usage: long
+    """
+
+    logCategory = LOG_CATEGORY
+
+    def __init__(self, directory, ignoredSuffix=None, policy=None):
+        """
+        @param directory:     the cache directory
+        @type  directory:     str
+        @param ignoredSuffix: the suffix of the files of the directory
+                              that are not cached files
+        @type  ignoredSuffix: str
+        @param policy:        the policy choosing the files to delete,
+                              least recently used ones by default
+        @type  policy:        L{cachepolicy.EvictionPolicy}
+        """
+        if policy is None:
+            policy = cachepolicy.LRUPolicy()
+        self._directory = directory
+        self._ignoredSuffix = ignoredSuffix
+        self._policy = policy
+        self._path = os.path.join(directory, INDEX_FILENAME)
+        self.usage = 0L
+        self.loaded = False
+        self._entries = {} # {name: CacheEntry}
+        self._fd = None
+        self._inode = None
+        self._offset = 0 # Position in the journal read up to
+        self._own = {} # {position: None} of the records we wrote
+        self._records = 0 # Records in the journal
+        self._queued = [] # Records waiting for the index to be loaded
+        self._waiting = [] # Deferreds waiting for the index to be loaded
+        self._reading = False
+        self._compacting = False
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def get(self, name):
+        """
+        @rtype: L{CacheEntry} or None
+        """
+        return self._entries.get(name)
+
+    def load(self):
+        """
+        Reads the journal in a thread, or builds it by looking at the
+        files of the directory if there's none.
+
+        @returns: a deferred fired with the cache usage once I'm loaded
+        @rtype:   L{twisted.internet.defer.Deferred}
+        """
+        d = defer.Deferred()
+        self._waiting.append(d)
+        if not self._reading:
+            self._reading = True
+            r = threads.deferToThread(self._read)
+            r.addCallbacks(self._loaded, self._loadFailed)
+        return d
+
+    def refresh(self):
+        """
+        Applies the records appended to the journal by other processes.
+
+        @returns: a deferred fired with the cache usage
+        @rtype:   L{twisted.internet.defer.Deferred}
+        """
+        if not self.loaded:
+            return self.load()
+        if self._compacting:
+            # The journal is being replaced by a new one
+            return defer.succeed(self.usage)
+        try:
+            info = os.stat(self._path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                return defer.fail(e)
+            # Somebody removed the journal, write it again
+            self.warning("Index journal '%s' removed", self._path)
+            self._closeJournal()
+            self._compact()
+            return defer.succeed(self.usage)
+        if info.st_ino != self._inode:
+            # Another process rewrote the journal
+            self.debug("Index journal '%s' rewritten, reloading", self._path)
+            self._reload()
+            return self.load()
+        if info.st_size > self._offset:
+            self._readRecords()
+        return defer.succeed(self.usage)
+
+    def add(self, name, size, atime=None):
+        if atime is None:
+            atime = int(time.time())
+        self._record("+ %s %d %d\n" % (name, size, atime))
+
+    def touch(self, name, atime=None):
+        if atime is None:
+            atime = int(time.time())
+        self._record("* %s %d\n" % (name, atime))
+
+    def remove(self, name):
+        self._record("- %s\n" % (name, ))
+
+    def popVictim(self):
+        """
+        Removes from the index the next file to delete,
+        as chosen by the eviction policy.
+
+        @returns: the name and size of the file, or None if I'm empty
+        @rtype:   tuple of (str, long)
+        """
+        name = self._policy.popVictim()
+        if name is None:
+            return None
+        size = self._entries[name].size
+        self.remove(name)
+        return name, size
+
+    def close(self):
+        self._closeJournal()
+
+    ## Private Methods ##
+
+    def _record(self, line):
+        if not self.loaded:
+            self._queued.append(line)
+            return
+        self._apply(line)
+        self._write(line)
+
+    def _apply(self, line):
+        parts = line.split()
+        if not parts:
+            return
+        try:
+            if parts[0] == '+':
+                name, size, atime = parts[1], long(parts[2]), int(parts[3])
+                hits = 0
+                if len(parts) > 4:
+                    hits = int(parts[4])
+                old = self._entries.get(name)
+                if old is not None:
+                    self.usage -= old.size
+                    self._onRemoved(name, old)
+                entry = CacheEntry(size, atime, hits)
+                self._entries[name] = entry
+                self.usage += size
+                if self.loaded:
+                    self._policy.onAdded(name, entry)
+            elif parts[0] == '*':
+                name, atime = parts[1], int(parts[2])
+                entry = self._entries.get(name)
+                if entry is not None:
+                    entry.atime = max(entry.atime, atime)
+                    entry.hits += 1
+                    if self.loaded:
+                        self._policy.onAccessed(name, entry)
+            elif parts[0] == '-':
+                entry = self._entries.pop(parts[1], None)
+                if entry is not None:
+                    self.usage -= entry.size
+                    self._onRemoved(parts[1], entry)
+            else:
+                raise ValueError(parts[0])
+        except (IndexError, ValueError):
+            self.warning("Invalid index record %r", line)
+
+    def _onRemoved(self, name, entry):
+        if self.loaded:
+            self._policy.onRemoved(name, entry)
+
+    def _write(self, data):
+        # The data is made of whole records
+        if self._fd is None:
+            return
+        try:
+            os.write(self._fd, data)
+            # The file is opened for appending, we're at the end of
+            # what we just wrote
+            position = os.lseek(self._fd, 0, 1) - len(data)
+        except OSError, e:
+            self.warning("Failed to write to index journal '%s': %s",
+                         self._path, log.getExceptionMessage(e))
+            return
+        for line in data.splitlines(True):
+            self._own[position] = None
+            position += len(line)
+
+    def _readRecords(self):
+        handle = open(self._path, 'rb')
+        try:
+            handle.seek(self._offset)
+            data = handle.read()
+        finally:
+            handle.close()
+        # Leave an incomplete last record for later
+        data = data[:data.rfind('\n') + 1]
+        self._applyRecords(data, self._offset)
+        self._offset += len(data)
+        if (not self._compacting and self._records > COMPACT_MIN_RECORDS
+                and self._records > 2 * len(self._entries)):
+            self._compact()
+
+    def _applyRecords(self, data, position):
+        # Applies the records of others found at a position of the journal
+        for line in data.splitlines(True):
+            if position in self._own:
+                del self._own[position]
+            else:
+                self._apply(line)
+            position += len(line)
+            self._records += 1
+
+    def _read(self):
+        # Called in a thread
+        try:
+            handle = open(self._path, 'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return self._scan()
+        index = CacheIndex(self._directory)
+        records = 0
+        offset = 0
+        try:
+            info = os.fstat(handle.fileno())
+            for line in handle:
+                if not line.endswith('\n'):
+                    break
+                offset += len(line)
+                records += 1
+                index._apply(line)
+        finally:
+            handle.close()
+        return index._entries, index.usage, records, info.st_ino, offset
+
+    def _scan(self):
+        # Called in a thread
+        self.info("Building index journal of '%s'", self._directory)
+        entries = {}
+        usage = 0L
+        for name in os.listdir(self._directory):
+            if name.startswith(INDEX_FILENAME):
+                continue
+            if self._ignoredSuffix and name.endswith(self._ignoredSuffix):
+                continue
+            try:
+                info = os.stat(os.path.join(self._directory, name))
+            except OSError, e:
+                if e.errno == errno.ENOENT:
+                    continue
+                raise
+            if not stat.S_ISREG(info.st_mode):
+                continue
+            entries[name] = CacheEntry(info.st_size, int(info.st_atime))
+            usage += info.st_size
+        items = [(n, entry.size, entry.atime, entry.hits)
+                 for n, entry in entries.iteritems()]
+        inode, offset = self._writeSnapshot(items)
+        return entries, usage, len(entries), inode, offset
+
+    def _writeSnapshot(self, items):
+        # Called in a thread
+        tempPath = self._path + ".new"
+        handle = open(tempPath, 'wb')
+        try:
+            handle.writelines(["+ %s %d %d %d\n" % item for item in items])
+        finally:
+            handle.close()
+        os.rename(tempPath, self._path)
+        info = os.stat(self._path)
+        return info.st_ino, info.st_size
+
+    def _loaded(self, (entries, usage, records, inode, offset)):
+        self._reading = False
+        self._entries = entries
+        self.usage = usage
+        self._records = records
+        self._inode = inode
+        self._offset = offset
+        self._own = {}
+        self._policy.start(entries)
+        self.loaded = True
+        self.debug("Loaded index of '%s' with %d files",
+                   self._directory, len(entries))
+        self._openJournal()
+        self.refresh()
+        if not self.loaded:
+            # Rewritten by another process meanwhile, loading again
+            return
+        queued, self._queued = self._queued, []
+        for line in queued:
+            self._record(line)
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(self.usage)
+
+    def _loadFailed(self, failure):
+        self._reading = False
+        self.warning("Failed to load index of '%s': %s",
+                     self._directory, log.getFailureMessage(failure))
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.errback(failure)
+
+    def _reload(self):
+        self._closeJournal()
+        self.loaded = False
+
+    def _openJournal(self):
+        try:
+            self._fd = os.open(self._path,
+                               os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+        except OSError, e:
+            self.warning("Failed to open index journal '%s': %s",
+                         self._path, log.getExceptionMessage(e))
+
+    def _closeJournal(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _compact(self):
+        self.debug("Rewriting index journal '%s' with %d records",
+                   self._path, len(self._entries))
+        self._compacting = True
+        # Keep the current journal open to copy what is appended to it
+        # while the new one is written
+        old = None
+        if self._fd is not None:
+            try:
+                old = open(self._path, 'rb')
+            except IOError:
+                pass
+        items = [(n, e.size, e.atime, e.hits)
+                 for n, e in self._entries.iteritems()]
+        d = threads.deferToThread(self._writeSnapshot, items)
+        d.addCallbacks(self._compacted, self._compactFailed,
+                       callbackArgs=(old, self._offset, len(items)),
+                       errbackArgs=(old, ))
+        return d
+
+    def _compacted(self, (inode, size), old, offset, records):
+        self._compacting = False
+        tail = ''
+        if old is not None:
+            try:
+                old.seek(offset)
+                tail = old.read()
+            finally:
+                old.close()
+            tail = tail[:tail.rfind('\n') + 1]
+            # Apply what the others appended meanwhile
+            self._applyRecords(tail, offset)
+        self._closeJournal()
+        self._inode = inode
+        self._offset = size
+        self._own = {}
+        self._records = records
+        self._openJournal()
+        if tail:
+            self._write(tail)
+
+    def _compactFailed(self, failure, old):
+        self._compacting = False
+        if old is not None:
+            old.close()
+        self.warning("Failed to rewrite index journal '%s': %s",
+                     self._path, log.getFailureMessage(failure))
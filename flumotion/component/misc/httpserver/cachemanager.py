@@ -15,16 +15,19 @@
 #
 # Headers in this file shall remain intact.
 
+import bisect
 import errno
 import os
 import tempfile
 import time
 import stat
 
-from twisted.internet import defer, threads, reactor, utils
+from twisted.internet import defer, threads, reactor
 
 from flumotion.common import log, common, python, errors
 from flumotion.common import format as formatting
+from flumotion.component.misc.httpserver import cacheindex
+from flumotion.component.misc.httpserver import cachepolicy
 
 LOG_CATEGORY = "cache-manager"
 
@@ -33,11 +36,154 @@ DEFAULT_CACHE_DIR = "/tmp/httpserver"
 DEFAULT_CLEANUP_ENABLED = True
 DEFAULT_CLEANUP_HIGH_WATERMARK = 1.0
 DEFAULT_CLEANUP_LOW_WATERMARK = 0.6
+DEFAULT_EVICTION_POLICY = "lru"
 ID_CACHE_MAX_SIZE = 1024
 TEMP_FILE_POSTFIX = ".tmp"
+# Points of every cache directory on the hash ring
+RING_POINTS = 160
+# Seconds between the checks of the cache directories taken out
+SHARD_RETRY_PERIOD = 60
+
+
+class HashRing(object):
+    """
+    I place keys on items by consistent hashing: when an item is added
+    or removed, only the keys placed on it move.
+    """
+
+    def __init__(self):
+        self._items = {}  # {item: name}
+        self._points = []
+        self._owners = []
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, item):
+        return item in self._items
+
+    def add(self, item, name):
+        """
+        @param name: what the points of the item are computed from,
+                     it must not change for the keys to stay in place
+        @type  name: str
+        """
+        self._items[item] = name
+        self._rebuild()
+
+    def remove(self, item):
+        if self._items.pop(item, None) is not None:
+            self._rebuild()
+
+    def get(self, key):
+        """
+        @param key: a hex digest
+        @type  key: str
+
+        @returns: the item the key is placed on, or None if I'm empty
+        """
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, long(key[:8], 16))
+        return self._owners[index % len(self._owners)]
+
+    def _rebuild(self):
+        points = []
+        for item, name in self._items.iteritems():
+            for i in range(RING_POINTS):
+                sha1Hash = python.sha1()
+                sha1Hash.update("%s#%d" % (name, i))
+                points.append((long(sha1Hash.hexdigest()[:8], 16), name, item))
+        points.sort()
+        self._points = [p[0] for p in points]
+        self._owners = [p[2] for p in points]
+
+
+class CacheShard(log.Loggable):
+    """
+    I am a cache directory, usually on its own disk, with its own usage
+    accounting and cleanup.
+
+    @ivar failed: if the directory is taken out because of I/O errors
+    @type failed: bool
+    """
+
+    logCategory = LOG_CATEGORY
+
+    def __init__(self, directory, size, highWatermark, lowWatermark,
+                 policyName):
+        self.directory = directory
+        self.size = size  # in bytes
+        self.maxUsage = size * highWatermark  # in bytes
+        self.minUsage = size * lowWatermark  # in bytes
+        self.failed = False
+        self.lastCheck = None
+        self._policyName = policyName
+        # Space allocated to files being written to the directory
+        self.allocations = {}  # {allocation id: size}
+        self.allocated = 0
+        self.index = None
+        self.reset()
+
+    def __str__(self):
+        return "<CacheShard '%s'>" % self.directory
+
+    def getUsage(self):
+        return self.index.usage + self.allocated
+    usage = property(getUsage)
+
+    def reset(self):
+        """
+        Starts again with a new index of the cached files,
+        with their size, access time and hit count.
+        """
+        if self.index is not None:
+            self.index.close()
+        policy = cachepolicy.POLICIES[self._policyName]()
+        self.index = cacheindex.CacheIndex(self.directory,
+                                           TEMP_FILE_POSTFIX, policy)
+
+    def check(self):
+        """
+        Checks files can be written to the directory.
+        Called in a thread.
+
+        @raise: OSError or IOError
+        """
+        common.ensureDir(self.directory, "cache")
+        fd, path = tempfile.mkstemp(TEMP_FILE_POSTFIX, "check",
+                                    self.directory)
+        try:
+            os.write(fd, "check")
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+            os.unlink(path)
+
+    def popVictims(self):
+        """
+        Removes from the index the files to delete for the usage
+        to drop below the low watermark.
+
+        @returns: the paths of the files to delete
+        @rtype:   list of str
+        """
+        victims = []
+        while self.usage > self.minUsage:
+            victim = self.index.popVictim()
+            if victim is None:
+                break
+            victims.append(os.path.join(self.directory, victim[0]))
+        return victims
 
 
 class CacheManager(object, log.Loggable):
+    """
+    I manage the files cached in one or more directories. With more than
+    one, the files are placed on them by consistent hashing, and each
+    directory has an equal part of the cache size.
+    A directory failing I/O checks is taken out until it works again.
+    """
 
     logCategory = LOG_CATEGORY
 
@@ -47,7 +193,12 @@ class CacheManager(object, log.Loggable):
                  cleanupEnabled = None,
                  cleanupHighWatermark = None,
                  cleanupLowWatermark = None,
-                 cacheRealm = None):
+                 cacheRealm = None,
+                 evictionPolicy=None):
+        """
+        @param cacheDir: the cache directory, or a list of them
+        @type  cacheDir: str or list of str
+        """
 
         if cacheDir is None:
             cacheDir = DEFAULT_CACHE_DIR
@@ -59,9 +210,18 @@ class CacheManager(object, log.Loggable):
             cleanupHighWatermark = DEFAULT_CLEANUP_HIGH_WATERMARK
         if cleanupLowWatermark is None:
             cleanupLowWatermark = DEFAULT_CLEANUP_LOW_WATERMARK
+        if evictionPolicy is None:
+            evictionPolicy = DEFAULT_EVICTION_POLICY
+        if evictionPolicy not in cachepolicy.POLICIES:
+            raise errors.PropertyError(
+                "Unknown cache eviction policy '%s', should be one of %s"
+                % (evictionPolicy, ", ".join(cachepolicy.POLICIES.keys())))
+        if isinstance(cacheDir, basestring):
+            cacheDir = [cacheDir]
 
         self.stats = stats
-        self._cacheDir = cacheDir
+        self._cacheDirs = [os.path.normpath(d) for d in cacheDir]
+        self._cacheDir = self._cacheDirs[0]
         self._cacheSize = cacheSize # in bytes
         self._cleanupEnabled = cleanupEnabled
         highWatermark = max(0.0, min(1.0, float(cleanupHighWatermark)))
@@ -72,18 +232,34 @@ class CacheManager(object, log.Loggable):
         self._identifiers = {} # {path: identifier}
 
         self.info("Cache Manager initialized")
-        self.debug("Cache directory: '%s'", self._cacheDir)
+        self.debug("Cache directories: %s",
+                   ", ".join(["'%s'" % d for d in self._cacheDirs]))
         self.debug("Cache size: %d bytes", self._cacheSize)
         self.debug("Cache cleanup enabled: %s", self._cleanupEnabled)
-
-        common.ensureDir(self._cacheDir, "cache")
+        self.debug("Cache eviction policy: %s", evictionPolicy)
 
         self._cacheUsage = None
         self._cacheUsageLastUpdate = None
-        self._lastCacheTime = None
-
-        self._cacheMaxUsage = self._cacheSize * highWatermark # in bytes
-        self._cacheMinUsage = self._cacheSize * lowWatermark # in bytes
+        self._shards = {}  # {directory: CacheShard}
+        self._ring = HashRing()
+        self._checking = {}  # {CacheShard: None}
+        self._allocations = {}  # {allocation id: CacheShard}
+        self._lastAllocation = 0
+        shardSize = self._cacheSize / len(self._cacheDirs)
+        for directory in self._cacheDirs:
+            shard = CacheShard(directory, shardSize, highWatermark,
+                               lowWatermark, evictionPolicy)
+            self._shards[directory] = shard
+            try:
+                common.ensureDir(directory, "cache")
+            except errors.FatalError, e:
+                if len(self._cacheDirs) == 1:
+                    raise
+                self._failShard(shard, str(e))
+            else:
+                self._ring.add(shard, directory)
+        if not self._ring:
+            raise errors.FatalError("could not create any cache directory")
 
     def setUp(self):
         """
@@ -120,7 +296,7 @@ class CacheManager(object, log.Loggable):
         @return: the cached file path for a path.
         """
         ident = self.getIdentifier(path)
-        return os.path.join(self._cacheDir, ident)
+        return os.path.join(self._getShard(ident).directory, ident)
 
     def getTempPath(self, path):
         """
@@ -130,13 +306,18 @@ class CacheManager(object, log.Loggable):
         Use newTempFile() instead.
         """
         ident = self.getIdentifier(path)
-        return os.path.join(self._cacheDir, ident + TEMP_FILE_POSTFIX)
+        return os.path.join(self._getShard(ident).directory,
+                            ident + TEMP_FILE_POSTFIX)
 
     def updateCacheUsageStatistics(self):
         self.stats.onEstimateCacheUsage(self._cacheUsage, self._cacheSize)
 
-    def _updateCacheUsage(self, usage):
-        self.log('Disk usage for path %r is %d bytes', self._cacheDir, usage)
+    def _updateCacheUsage(self, _=None):
+        usage = 0
+        for shard in self._shards.itervalues():
+            if not shard.failed:
+                usage += shard.usage
+        self.log('Cache usage is %d bytes', usage)
         self._cacheUsageLastUpdate = time.time()
         self._cacheUsage = usage
         self.updateCacheUsageStatistics()
@@ -144,102 +325,165 @@ class CacheManager(object, log.Loggable):
 
     def updateCacheUsage(self):
         """
+        The usage is the size of the cached files known by the indexes of
+        the cache directories, plus the space allocated to the files being
+        written. The directories taken out are checked again from time
+        to time.
+
         @return: a defered with the cache usage in bytes.
         @raise: OSError or FlumotionError
         """
+        dl = []
+        now = time.time()
+        for shard in self._shards.values():
+            if not shard.failed:
+                d = shard.index.refresh()
+                d.addErrback(self._refreshFailed, shard)
+                dl.append(d)
+            elif shard.lastCheck + SHARD_RETRY_PERIOD <= now:
+                self._checkShard(shard)
+        d = defer.DeferredList(dl)
+        d.addCallback(self._updateCacheUsage)
+        return d
 
-        # Only calculate cache usage if the cache directory
-        # modification time changed since the last time we looked at it.
-        try:
-            cacheTime = os.path.getmtime(self._cacheDir)
-        except OSError, e:
-            return defer.fail(e)
-
-        if ((self._cacheUsage is None) or (self._lastCacheTime < cacheTime)):
-            self._lastCacheTime = cacheTime
-            self.log('Getting disk usage for path %r', self._cacheDir)
-            d = utils.getProcessOutput('du', ['-bs', self._cacheDir])
-            d.addCallback(lambda o: int(o.split('\t', 1)[0]))
-            d.addCallback(self._updateCacheUsage)
-            return d
-        else:
-            return defer.succeed(self._cacheUsage)
+    def reportError(self, cachePath, error):
+        """
+        Tells an I/O error happened with a cached file, so its cache
+        directory is checked and taken out if it doesn't work anymore.
 
-    def _rmfiles(self, files):
-        try:
-            for path in files:
-                os.remove(path)
-        except OSError, e:
-            if e.errno != errno.ENOENT:
-                # TODO: is warning() thread safe?
-                self.warning("Error cleaning cached file: %s", str(e))
+        @param cachePath: the path of the cached or temporary file
+        @type  cachePath: str
+        @param error:     the error that happened
+        @type  error:     Exception
+        """
+        shard = self._getShardOf(cachePath)
+        if shard is None:
+            return
+        self.debug("Checking '%s' after an error with '%s': %s",
+                   shard.directory, cachePath, error)
+        self._checkShard(shard)
+
+    def _getShard(self, ident):
+        shard = self._ring.get(ident)
+        if shard is None:
+            # Every directory failed, the files won't be cached
+            shard = self._shards[self._cacheDir]
+        return shard
+
+    def _getShardOf(self, cachePath):
+        # Only the working ones
+        shard = self._shards.get(os.path.dirname(cachePath))
+        if shard is None or shard.failed:
+            return None
+        return shard
 
-    def _setCacheUsage(self, _, usage):
-        # Update the cache usage
-        self._cacheUsage = usage
-        self._cacheUsageLastUpdate = time.time()
-        return usage
+    def _checkShard(self, shard):
+        if shard in self._checking:
+            return
+        self._checking[shard] = None
+        shard.lastCheck = time.time()
+        d = threads.deferToThread(shard.check)
+        d.addCallbacks(self._shardChecked, self._shardCheckFailed,
+                       callbackArgs=(shard, ), errbackArgs=(shard, ))
+        d.addBoth(lambda _: self._checking.pop(shard, None))
+        return d
 
-    def _cleanUp(self):
-        # Update cleanup statistics
-        self.stats.onCleanup()
-        # List the cached files with file state
-        try:
-            listdir = os.listdir(self._cacheDir)
-        except OSError, e:
-            return defer.fail(e)
+    def _shardChecked(self, _, shard):
+        if not shard.failed:
+            return
+        # Working again, restart from a new index before putting
+        # it back in the ring
+        self.info("Cache directory '%s' is working again", shard.directory)
+        shard.reset()
+        d = shard.index.load()
+        d.addCallbacks(self._shardRestored, self._refreshFailed,
+                       callbackArgs=(shard, ), errbackArgs=(shard, ))
+        return d
 
-        files = []
-        for f in listdir:
-            f = os.path.join(self._cacheDir, f)
-            # There's a possibility of getting an error on os.stat here.
+    def _shardRestored(self, _, shard):
+        shard.failed = False
+        self._ring.add(shard, shard.directory)
+        self._updateCacheUsage()
+
+    def _shardCheckFailed(self, failure, shard):
+        self._failShard(shard, failure.getErrorMessage())
+
+    def _refreshFailed(self, failure, shard):
+        self._failShard(shard, "index failure: %s"
+                        % failure.getErrorMessage())
+
+    def _failShard(self, shard, reason):
+        shard.lastCheck = time.time()
+        if shard.failed:
+            return
+        self.warning("Taking out cache directory '%s': %s",
+                     shard.directory, reason)
+        shard.failed = True
+        self._ring.remove(shard)
+        self._updateCacheUsage()
+
+    def _rmfiles(self, files):
+        for path in files:
             try:
-                files.append((f, os.stat(f)))
+                os.remove(path)
             except OSError, e:
-                if e.errno == errno.ENOENT:
-                    pass
-                else:
-                    return defer.fail(e)
-
-        # Calculate the cached file total size
-        usage = sum([d[1].st_size for d in files])
-        # Delete the cached file starting by the oldest accessed ones
-        files.sort(key=lambda d: d[1].st_atime)
-        rmlist = []
-        for path, info in files:
-            usage -= info.st_size
-            rmlist.append(path)
-            if usage <= self._cacheMinUsage:
-                # We reach the cleanup limit
-                self.debug('cleaned up, cache use is now %sbytes',
-                    formatting.formatStorage(usage))
-                break
+                if e.errno != errno.ENOENT:
+                    # TODO: is warning() thread safe?
+                    self.warning("Error cleaning cached file: %s", str(e))
+
+    def _cleanUp(self, shard):
+        # Update cleanup statistics
+        self.stats.onCleanup()
+        # Delete the cached files chosen by the eviction policy
+        rmlist = shard.popVictims()
+        usage = self._updateCacheUsage()
+        self.debug('cleaned up %d files of %s, its use is now %sbytes',
+                   len(rmlist), shard.directory,
+                   formatting.formatStorage(shard.usage))
         d = threads.deferToThread(self._rmfiles, rmlist)
-        d.addBoth(self._setCacheUsage, usage)
+        d.addBoth(lambda _: usage)
         return d
 
-    def _allocateCacheSpaceAfterCleanUp(self, usage, size):
-        if (self._cacheUsage + size) >= self._cacheSize:
+    def _allocateCacheSpaceAfterCleanUp(self, usage, shard, size):
+        if (shard.usage + size) >= shard.size:
             # There is not enough space, allocation failed
             self.updateCacheUsageStatistics()
-            self.debug('not enough space in cache, '
+            self.debug('not enough space in %s, '
                        'cannot cache %d > %d' %
-                       (self._cacheUsage + size, self._cacheSize))
+                       (shard.directory, shard.usage + size, shard.size))
             return None
 
         # There is enough space to allocate, allocation succeed
-        self._cacheUsage += size
-        self.updateCacheUsageStatistics()
-        return (self._cacheUsageLastUpdate, size)
+        return self._allocate(shard, size)
+
+    def _allocate(self, shard, size):
+        self._lastAllocation += 1
+        self._allocations[self._lastAllocation] = shard
+        shard.allocations[self._lastAllocation] = size
+        shard.allocated += size
+        self._updateCacheUsage()
+        return (self._lastAllocation, size)
+
+    def _allocateCacheSpace(self, usage, size, path):
+        if path is not None:
+            shard = self._getShard(self.getIdentifier(path))
+        else:
+            # Where there's the most room
+            shards = [s for s in self._shards.itervalues() if not s.failed]
+            if not shards:
+                shards = self._shards.values()
+            shards.sort(key=lambda s: s.usage - s.maxUsage)
+            shard = shards[0]
+        if shard.failed:
+            self.debug('no cache directory working, cannot cache %d', size)
+            return defer.succeed(None)
 
-    def _allocateCacheSpace(self, usage, size):
-        if usage + size < self._cacheMaxUsage:
-            self._cacheUsage += size
-            self.updateCacheUsageStatistics()
-            return defer.succeed((self._cacheUsageLastUpdate, size))
+        if shard.usage + size < shard.maxUsage:
+            return defer.succeed(self._allocate(shard, size))
 
-        self.debug('cache usage will be %sbytes, need more cache',
-            formatting.formatStorage(usage + size))
+        self.debug('usage of %s will be %sbytes, need more cache',
+                   shard.directory,
+                   formatting.formatStorage(shard.usage + size))
 
         if not self._cleanupEnabled:
             # No space available and cleanup disabled: allocation failed.
@@ -247,53 +491,99 @@ class CacheManager(object, log.Loggable):
                        'so cannot cache %d' % size)
             return defer.succeed(None)
 
-        d = self._cleanUp()
-        d.addCallback(self._allocateCacheSpaceAfterCleanUp, size)
+        d = self._cleanUp(shard)
+        d.addCallback(self._allocateCacheSpaceAfterCleanUp, shard, size)
         return d
 
-    def allocateCacheSpace(self, size):
+    def allocateCacheSpace(self, size, path=None):
         """
         Try to reserve cache space.
 
         If there is not enough space and the cache cleanup is enabled,
-        it will delete files from the cache starting with the ones
-        with oldest access time until the cache usage drops below
-        the fraction specified by the property cleanup-low-threshold.
+        it will delete files from the cache directory starting with the
+        ones chosen by the eviction policy until the directory usage
+        drops below the fraction specified by the property
+        cleanup-low-threshold.
 
         Returns a 'tag' that should be used to 'free' the cache space
-        using releaseCacheSpace.
-        This tag is needed to better estimate the cache usage,
-        if the cache usage has been updated since cache space
-        has been allocated, freeing up the space should not change
-        the cache usage estimation.
+        using releaseCacheSpace, or to tell the space is used by a file
+        added to the cache using commitCacheSpace.
 
         @param size: size to reserve, in bytes
         @type  size: int
+        @param path: the path of the file the space is for, to reserve
+                     it in its cache directory
+        @type  path: str
 
         @return: an allocation tag or None if the allocation failed.
         @rtype:   defer to tuple
         """
         d = self.updateCacheUsage()
-        d.addCallback(self._allocateCacheSpace, size)
+        d.addCallback(self._allocateCacheSpace, size, path)
         return d
 
     def releaseCacheSpace(self, tag):
         """
         Low-level function to release reserved cache space.
+        Releasing it more than once does nothing.
         """
-        lastUpdate, size = tag
-        if lastUpdate == self._cacheUsageLastUpdate:
-            self._cacheUsage -= size
-            self.updateCacheUsageStatistics()
+        allocation, size = tag
+        shard = self._allocations.pop(allocation, None)
+        if shard is not None:
+            del shard.allocations[allocation]
+            shard.allocated -= size
+            self._updateCacheUsage()
+
+    def commitCacheSpace(self, tag, cachePath):
+        """
+        Low-level function telling reserved cache space is now used
+        by a cached file, adding it to the cache index.
+
+        @param cachePath: the path of the cached file
+        @type  cachePath: str
+        """
+        allocation, size = tag
+        shard = self._allocations.pop(allocation, None)
+        if shard is not None:
+            del shard.allocations[allocation]
+            shard.allocated -= size
+        shard = self._getShardOf(cachePath)
+        if shard is not None:
+            shard.index.add(os.path.basename(cachePath), size)
+        self._updateCacheUsage()
+
+    def touchCacheFile(self, cachePath):
+        """
+        Tells a cached file has been accessed,
+        so it is the last to be deleted when cleaning up the cache.
+        """
+        shard = self._getShardOf(cachePath)
+        if shard is not None:
+            shard.index.touch(os.path.basename(cachePath))
+
+    def forgetCacheFile(self, cachePath):
+        """
+        Tells a cached file has been deleted.
+        """
+        shard = self._getShardOf(cachePath)
+        if shard is not None:
+            shard.index.remove(os.path.basename(cachePath))
+            self._updateCacheUsage()
 
     def openCacheFile(self, path):
         """
         @return: a defer to a CacheFile instance or None
         """
         try:
-            return defer.succeed(CachedFile(self, path))
+            cachedFile = CachedFile(self, path)
+        except EnvironmentError, e:
+            if e.errno != errno.ENOENT:
+                self.reportError(self.getCachePath(path), e)
+            return defer.succeed(None)
         except:
             return defer.succeed(None)
+        self.touchCacheFile(cachedFile.name)
+        return defer.succeed(cachedFile)
 
     def _newTempFile(self, tag, path, size, mtime=None):
         # if allocation fails
@@ -302,14 +592,16 @@ class CacheManager(object, log.Loggable):
 
         try:
             return TempFile(self, path, tag, size, mtime)
-        except OSError:
+        except OSError, e:
+            self.releaseCacheSpace(tag)
+            self.reportError(self.getTempPath(path), e)
             return None
 
     def newTempFile(self, path, size, mtime=None):
         """
         @return: a defer to a TempFile instance or None
         """
-        d = self.allocateCacheSpace(size)
+        d = self.allocateCacheSpace(size, path)
         d.addCallback(self._newTempFile, path, size, mtime)
         return d
 
@@ -330,6 +622,7 @@ class CachedFile:
         cachemgr.log("Opened cached file %s [fd %d]",
                      cachedPath, handle.fileno())
 
+        self.cachemgr = cachemgr
         self.name = cachedPath
         self.file = handle
         self.stat = stat
@@ -346,6 +639,8 @@ class CachedFile:
             os.unlink(self.name)
         except OSError:
             pass
+        else:
+            self.cachemgr.forgetCacheFile(self.name)
 
     def __getattr__(self, name):
         a = getattr(self.__dict__['file'], name)
@@ -371,8 +666,8 @@ class TempFile:
         self.file = None
         self.size = size
 
-        fd, tempPath = tempfile.mkstemp(TEMP_FILE_POSTFIX,
-                                        LOG_CATEGORY, cachemgr._cacheDir)
+        fd, tempPath = tempfile.mkstemp(TEMP_FILE_POSTFIX, LOG_CATEGORY,
+                                        os.path.dirname(self._finishPath))
         cachemgr.log("Created temporary file '%s' [fd %d]",
                      tempPath, fd)
         self.file = os.fdopen(fd, "w+b")
@@ -468,6 +763,7 @@ class TempFile:
                 if mtime > self.mtime:
                     self.cachemgr.log("Did not complete(), "
                                       "a more recent version exists already")
+                    self.cachemgr.releaseCacheSpace(self.tag)
                     os.unlink(self.name)
                     self.name = self._finishPath
                     return
@@ -485,6 +781,7 @@ class TempFile:
                 return
 
         self.setModificationTime()
+        self.cachemgr.commitCacheSpace(self.tag, self._finishPath)
 
         self.name = self._finishPath
         self.cachemgr.log("Temporary file renamed to '%s' [fd %d]",
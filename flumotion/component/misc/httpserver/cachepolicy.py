@@ -0,0 +1,174 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_cache_manager -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""eviction policies of the HTTP server caches.
+A policy chooses the cached files to delete when a cache is full,
+following the files added to, accessed in and removed from the
+L{flumotion.component.misc.httpserver.cacheindex.CacheIndex}.
+"""
+
+import heapq
+
+__version__ = "$Rev$"
+
+
+class EvictionPolicy(object):
+    """
+    I choose the cached files to delete when the cache is full.
+    The entries I'm given have the size, access time and hit count of
+    the files; I can keep my own data in their priority attribute.
+    """
+
+    def start(self, entries):
+        """
+        Starts following the given files.
+
+        @param entries: the cached files
+        @type  entries: dict of str -> L{cacheindex.CacheEntry}
+        """
+        raise NotImplementedError
+
+    def onAdded(self, name, entry):
+        """
+        Called when a file is added to the cache.
+        """
+        raise NotImplementedError
+
+    def onAccessed(self, name, entry):
+        """
+        Called when a cached file is accessed, after updating its
+        access time and hit count.
+        """
+        raise NotImplementedError
+
+    def onRemoved(self, name, entry):
+        """
+        Called when a file is removed from the cache.
+        """
+        raise NotImplementedError
+
+    def popVictim(self):
+        """
+        Chooses the next file to delete. The caller removes it.
+
+        @returns: the name of the file, or None if there's none
+        @rtype:   str
+        """
+        raise NotImplementedError
+
+
+class HeapPolicy(EvictionPolicy):
+    """
+    I delete the files with the lowest priority first, keeping them in a
+    heap. Items outdated by accesses or removals are left in the heap and
+    skipped when popped.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._heap = []
+
+    def getPriority(self, entry):
+        """
+        @returns: the priority of a file, the files with the lowest
+                  priority are deleted first
+        """
+        raise NotImplementedError
+
+    def start(self, entries):
+        self._entries = entries
+        for entry in entries.itervalues():
+            entry.priority = self.getPriority(entry)
+        self._rebuild()
+
+    def onAdded(self, name, entry):
+        self._push(name, entry)
+
+    def onAccessed(self, name, entry):
+        self._push(name, entry)
+
+    def onRemoved(self, name, entry):
+        pass
+
+    def popVictim(self):
+        while self._heap:
+            priority, name = heapq.heappop(self._heap)
+            entry = self._entries.get(name)
+            if entry is not None and entry.priority == priority:
+                self.onEvicted(entry)
+                return name
+        return None
+
+    def onEvicted(self, entry):
+        pass
+
+    def _push(self, name, entry):
+        priority = self.getPriority(entry)
+        if priority == entry.priority:
+            return
+        entry.priority = priority
+        heapq.heappush(self._heap, (priority, name))
+        if len(self._heap) > 2 * len(self._entries) + 1024:
+            # Too many outdated items
+            self._rebuild()
+
+    def _rebuild(self):
+        self._heap = [(e.priority, n) for n, e in self._entries.iteritems()]
+        heapq.heapify(self._heap)
+
+
+class LRUPolicy(HeapPolicy):
+    """
+    I delete the least recently used files first.
+    """
+
+    def getPriority(self, entry):
+        return entry.atime
+
+
+class LFUPolicy(HeapPolicy):
+    """
+    I delete the least frequently used files first, with dynamic aging:
+    the priority of the last deleted file is added to the hit count, so
+    files that were popular a long time ago don't stay forever.
+    """
+
+    def __init__(self):
+        HeapPolicy.__init__(self)
+        self._age = 0
+
+    def getPriority(self, entry):
+        return self._age + entry.hits
+
+    def onEvicted(self, entry):
+        self._age = entry.priority
+
+
+class GDSFPolicy(LFUPolicy):
+    """
+    Greedy-Dual-Size-Frequency: I delete the files with the lowest hit
+    count per byte first, with dynamic aging. Many small popular files
+    are kept rather than a few big ones.
+    """
+
+    def getPriority(self, entry):
+        return self._age + float(entry.hits) / max(entry.size, 1)
+
+
+POLICIES = {'lru': LRUPolicy,
+            'lfu': LFUPolicy,
+            'gdsf': GDSFPolicy}
@@ -131,6 +131,14 @@ class CacheStatistics(object):
         self.cancelledCopyCount = 0
         self.bytesCopied = 0L
         self._copyRatios = 0.0
+        # For the in-memory cache
+        self.memoryHitCount = 0
+        self.memoryMissCount = 0
+        self.memoryUsage = 0
+        self.memoryUsageRatio = 0.0
+        # For the requests to the source
+        self.coalescedRequestCount = 0
+        self.sourceBytesSaved = 0L
 
     def startUpdates(self, updater):
         self._updater = updater
@@ -144,6 +152,8 @@ class CacheStatistics(object):
             self._set("cancelled-copy-count", self.cancelledCopyCount)
             self._set("mean-copy-ratio", self.meanCopyRatio)
             self._set("mean-bytes-copied", self.meanBytesCopied)
+            self._set("coalesced-request-count", self.coalescedRequestCount)
+            self._set("source-bytes-saved", self.sourceBytesSaved)
             self._update()
 
     def stopUpdates(self):
@@ -171,6 +181,13 @@ class CacheStatistics(object):
         return self._copyRatios / self.finishedCopyCount
     meanCopyRatio = property(getMeanCopyRatio)
 
+    def getMemoryHitRatio(self):
+        total = self.memoryHitCount + self.memoryMissCount
+        if total == 0:
+            return 0.0
+        return float(self.memoryHitCount) / total
+    memoryHitRatio = property(getMemoryHitRatio)
+
     def onEstimateCacheUsage(self, usage, max):
         self._cacheUsage = usage
         self._cacheUsageRatio = float(usage) / max
@@ -209,12 +226,37 @@ class CacheStatistics(object):
         self._set("mean-copy-ratio", self.meanCopyRatio)
         self._set("mean-bytes-copied", self.meanBytesCopied)
 
+    def onMemoryHit(self):
+        self.memoryHitCount += 1
+        self._set("memory-hit-count", self.memoryHitCount)
+
+    def onMemoryMiss(self):
+        self.memoryMissCount += 1
+        self._set("memory-miss-count", self.memoryMissCount)
+
+    def onMemoryUsage(self, usage, max):
+        self.memoryUsage = usage
+        self.memoryUsageRatio = float(usage) / max
+        self._set("memory-usage", self.memoryUsage)
+        self._set("memory-usage-ratio", self.memoryUsageRatio)
+
+    def onRequestCoalesced(self, size):
+        """
+        Called when a block is read from a retrieval shared
+        with other readers instead of being requested again.
+        """
+        self.coalescedRequestCount += 1
+        self.sourceBytesSaved += size
+        self._set("coalesced-request-count", self.coalescedRequestCount)
+        self._set("source-bytes-saved", self.sourceBytesSaved)
+
     def _set(self, key, value):
         if self._updater is not None:
             self._updater.update(key, value)
 
     def _update(self):
         self._set("cache-read-ratio", self.cacheReadRatio)
+        self._set("memory-hit-ratio", self.memoryHitRatio)
         self._logStatsLine()
         self._callId = reactor.callLater(STATS_UPDATE_PERIOD, self._update)
 
@@ -234,15 +276,21 @@ class CacheStatistics(object):
             PAC: coPy cAncellation Count
             MCS: Mean Copy Size
             MCR: Mean Copy Ratio
+            MHR: Memory Hit Ratio
+            MCU: Memory Current Usage
+            RCC: Request Coalesced Count
+            SBS: Source Bytes Saved
         """
         log.debug("stats-local-cache",
                   "CRR: %.4f; CMC: %d; CHC: %d; THC: %d; COC: %d; "
                   "CCC: %d; CCU: %d; CUR: %.5f; "
-                  "PTC: %d; PCC: %d; PAC: %d; MCS: %d; MCR: %.4f",
+                  "PTC: %d; PCC: %d; PAC: %d; MCS: %d; MCR: %.4f; "
+                  "MHR: %.4f; MCU: %d; RCC: %d; SBS: %d",
                   self.cacheReadRatio, self.cacheMissCount,
                   self.cacheHitCount, self.tempHitCount,
                   self.cacheOutdateCount, self.cleanupCount,
                   self._cacheUsage, self._cacheUsageRatio,
                   self.totalCopyCount, self.currentCopyCount,
                   self.cancelledCopyCount, self.meanBytesCopied,
-                  self.meanCopyRatio)
+                  self.meanCopyRatio, self.memoryHitRatio, self.memoryUsage,
+                  self.coalescedRequestCount, self.sourceBytesSaved)
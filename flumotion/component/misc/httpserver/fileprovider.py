@@ -167,6 +167,22 @@ class File(object):
         Close and cleanup the file.
         """
 
+    def fileno(self):
+        """
+        @returns: the descriptor of the local file, if its data can be sent
+                  straight from it with sendfile(2), or None
+        @rtype:   int
+        """
+
+    def skip(self, size):
+        """
+        Moves the position forward over data that was sent straight from
+        the file descriptor, as if it had been read.
+
+        @param size: the amount of bytes sent
+        @type  size: int
+        """
+
     def getLogFields(self):
         """
         @returns: a dictionary of log fields related to the file usage
@@ -190,6 +206,13 @@ class FileProviderPlug(plugbase.ComponentPlug):
         Stop updating statistics.
         """
 
+    def setServerStatistics(self, stats):
+        """
+        Gives the statistics of the server, to account file reads in.
+
+        @type stats: L{serverstats.ServerStatistics}
+        """
+
     def getRootPath(self):
         """
         @return: the root of the file repository
@@ -22,6 +22,7 @@ from flumotion.component.misc.httpserver import cachemanager
 from flumotion.component.misc.httpserver import cachestats
 from flumotion.component.misc.httpserver import localpath
 from flumotion.component.misc.httpserver.httpcached import http_client
+from flumotion.component.misc.httpserver.httpcached import http_pool
 from flumotion.component.misc.httpserver.httpcached import http_utils
 from flumotion.component.misc.httpserver.httpcached import request_manager
 from flumotion.component.misc.httpserver.httpcached import resource_manager
@@ -39,6 +40,7 @@ DEFAULT_SERVER_PORT = 3128
 DEFAULT_PROXY_PRIORITY = 1
 DEFAULT_CONN_TIMEOUT = 2
 DEFAULT_IDLE_TIMEOUT = 5
+DEFAULT_READ_AHEAD = 2
 
 
 class FileReaderHTTPCachedPlug(log.Loggable):
@@ -49,6 +51,7 @@ class FileReaderHTTPCachedPlug(log.Loggable):
      - Load-balanced HTTP servers with priority level (fall-back).
      - More than one IP by server hostname with periodic DNS refresh.
      - Connection resuming if HTTP connection got disconnected.
+     - HTTP/1.1 persistent connections, pooled by server.
     """
 
     logCategory = LOG_CATEGORY
@@ -65,6 +68,7 @@ class FileReaderHTTPCachedPlug(log.Loggable):
         cleanupEnabled = props.get('cleanup-enabled')
         cleanupHighWatermark = props.get('cleanup-high-watermark')
         cleanupLowWatermark = props.get('cleanup-low-watermark')
+        evictionPolicy = props.get('cache-eviction-policy')
 
         self.virtualHost = props.get('virtual-hostname')
         self.virtualPort = props.get('virtual-port', DEFAULT_VIRTUAL_PORT)
@@ -80,7 +84,8 @@ class FileReaderHTTPCachedPlug(log.Loggable):
                                                   cleanupEnabled,
                                                   cleanupHighWatermark,
                                                   cleanupLowWatermark,
-                                                  self.virtualHost)
+                                                  self.virtualHost,
+                                                  evictionPolicy)
 
         selector = server_selection.ServerSelector(dnsRefresh)
 
@@ -115,14 +120,29 @@ class FileReaderHTTPCachedPlug(log.Loggable):
         connTimeout = props.get('connection-timeout', DEFAULT_CONN_TIMEOUT)
         idleTimeout = props.get('idle-timeout', DEFAULT_IDLE_TIMEOUT)
 
-        client = http_client.StreamRequester(connTimeout, idleTimeout)
+        keepaliveTimeout = props.get('keepalive-timeout',
+                                     http_pool.DEFAULT_KEEPALIVE_TIMEOUT)
+        if keepaliveTimeout > 0:
+            maxConnections = props.get('server-connections',
+                                       http_pool.DEFAULT_MAX_CONNECTIONS)
+            pipelineDepth = props.get('pipeline-depth',
+                                      http_pool.DEFAULT_PIPELINE_DEPTH)
+            client = http_pool.PooledStreamRequester(connTimeout,
+                                                     idleTimeout,
+                                                     maxConnections,
+                                                     pipelineDepth,
+                                                     keepaliveTimeout)
+        else:
+            client = http_client.StreamRequester(connTimeout, idleTimeout)
 
         reqmgr = request_manager.RequestManager(selector, client)
 
         cacheTTL = props.get('cache-ttl', DEFAULT_CACHE_TTL)
+        readAhead = props.get('read-ahead', DEFAULT_READ_AHEAD)
 
         self.strategy = strategy_basic.CachingStrategy(self.cachemgr,
-                                                       reqmgr, cacheTTL)
+                                                       reqmgr, cacheTTL,
+                                                       readAhead)
 
         self.resmgr = resource_manager.ResourceManager(self.strategy,
                                                        self.stats)
@@ -79,7 +79,7 @@ class StreamInfo(object):
             if length is not None:
                 self.size = int(length)
             else:
-                self.size = end - start
+                self.size = end - start + 1
         elif length is not None:
             self.length = int(length)
             self.size = int(length)
@@ -122,6 +122,9 @@ class StreamRequester(log.Loggable):
         getter.connect(proxyAddress, proxyPort, self.connTimeout)
         return getter
 
+    def cleanup(self):
+        pass
+
 
 class StreamGetter(protocol.ClientFactory, http.HTTPClient, log.Loggable):
     """
@@ -0,0 +1,664 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""HTTP/1.1 persistent connections to the servers of the caching provider.
+Each server gets a pool of connections reused by the requests to it,
+saving a TCP handshake for each block of a stream.
+"""
+
+from collections import deque
+
+from twisted.internet import protocol, reactor
+from twisted.protocols import basic
+from twisted.web import http
+
+from flumotion.common import log
+from flumotion.component.misc.httpserver.httpcached import common
+from flumotion.component.misc.httpserver.httpcached import http_client
+
+__version__ = "$Rev$"
+
+LOG_CATEGORY = "stream-provider"
+
+DEFAULT_MAX_CONNECTIONS = 4
+DEFAULT_PIPELINE_DEPTH = 1
+DEFAULT_KEEPALIVE_TIMEOUT = 30
+
+# Biggest body read from an abandoned response to keep its connection
+MAX_DRAIN_SIZE = 64 * 1024
+# Times a request is sent again when its connection is closed unanswered
+MAX_RETRIES = 1
+
+
+class PooledStreamRequester(http_client.StreamRequester):
+    """
+    Allows retrieval of data streams using HTTP 1.1 persistent
+    connections, kept in a pool for each server.
+    """
+
+    def __init__(self, connTimeout=0, idleTimeout=0,
+                 maxConnections=DEFAULT_MAX_CONNECTIONS,
+                 pipelineDepth=DEFAULT_PIPELINE_DEPTH,
+                 keepaliveTimeout=DEFAULT_KEEPALIVE_TIMEOUT):
+        """
+        @param maxConnections:   the most connections opened to a server
+        @type  maxConnections:   int
+        @param pipelineDepth:    the most requests sent on a connection
+                                 before its first response is received
+        @type  pipelineDepth:    int
+        @param keepaliveTimeout: the seconds an unused connection is kept
+        @type  keepaliveTimeout: int
+        """
+        http_client.StreamRequester.__init__(self, connTimeout, idleTimeout)
+        self.maxConnections = max(maxConnections, 1)
+        self.pipelineDepth = max(pipelineDepth, 1)
+        self.keepaliveTimeout = keepaliveTimeout
+        self._pools = {}  # {(host, port): ConnectionPool}
+
+    def retrieve(self, consumer, url, proxyAddress=None, proxyPort=None,
+                 ifModifiedSince=None, ifUnmodifiedSince=None,
+                 start=None, size=None):
+        self.log("Requesting %s%s%s%s%s%s",
+                 size and (" %d bytes" % size) or "",
+                 start and (" starting at %d" % start) or "",
+                 (size or start) and " from " or "",
+                 url.toString(),
+                 ifModifiedSince and (" if modified since %s"
+                                      % http_client.ts2str(ifModifiedSince))
+                 or "",
+                 ifUnmodifiedSince
+                 and (" if not modified since %s"
+                      % http_client.ts2str(ifUnmodifiedSince))
+                 or "")
+
+        getter = PooledStreamGetter(self, consumer, url,
+                                    ifModifiedSince, ifUnmodifiedSince,
+                                    start, size, self.idleTimeout)
+        getter.connect(proxyAddress, proxyPort, self.connTimeout)
+        return getter
+
+    def getPool(self, host, port):
+        """
+        @returns: the pool of connections to a server
+        @rtype:   L{ConnectionPool}
+        """
+        key = (host, port)
+        pool = self._pools.get(key)
+        if pool is None:
+            pool = ConnectionPool(host, port, self.maxConnections,
+                                  self.pipelineDepth, self.connTimeout,
+                                  self.keepaliveTimeout)
+            self._pools[key] = pool
+        return pool
+
+    def cleanup(self):
+        for pool in self._pools.values():
+            pool.close()
+        self._pools.clear()
+
+
+class ConnectionPool(log.Loggable):
+    """
+    I keep the persistent connections to a server.
+
+    A request is sent on an unused connection, or on a new one while
+    there are less than maxConnections. Past that it's pipelined on the
+    least busy connection, or queued until one can take it.
+    Connections unused for keepaliveTimeout seconds are closed.
+    """
+
+    logCategory = LOG_CATEGORY
+
+    def __init__(self, host, port, maxConnections, pipelineDepth,
+                 connTimeout, keepaliveTimeout):
+        self.host = host
+        self.port = port
+        self.maxConnections = maxConnections
+        self.pipelineDepth = pipelineDepth
+        self.connTimeout = connTimeout
+        self.keepaliveTimeout = keepaliveTimeout
+
+        self.connections = []
+        self._connecting = 0
+        # Getters not sent yet, the abandoned ones are skipped
+        self._waiting = deque()
+
+        self.logName = "%s:%s" % (host, port)
+
+    def __len__(self):
+        return len(self.connections)
+
+    def submit(self, getter):
+        """
+        Sends a request as soon as a connection can take it.
+
+        @type getter: L{PooledStreamGetter}
+        """
+        self._waiting.append(getter)
+        self._dispatch()
+
+    def close(self):
+        for connection in list(self.connections):
+            connection.close()
+
+    ### Called by the connections ###
+
+    def connectionMade(self, connection):
+        self._connecting -= 1
+        self.connections.append(connection)
+        self.log("Connection made, %d open", len(self.connections))
+        self._dispatch()
+
+    def connectionFailed(self, reason):
+        self._connecting -= 1
+        if self.connections or self._connecting:
+            # The requests can still be sent on the other connections
+            self._dispatch()
+            return
+        self.debug("Connection failed: %s", reason.getErrorMessage())
+        waiting = list(self._waiting)
+        self._waiting.clear()
+        for getter in waiting:
+            if not getter.abandoned:
+                getter.connectFailed(reason)
+
+    def connectionLost(self, connection, unanswered):
+        """
+        @param unanswered: the requests sent on the connection that
+                           can be sent again
+        """
+        if connection in self.connections:
+            self.connections.remove(connection)
+        self.log("Connection closed, %d open", len(self.connections))
+        for getter in reversed(unanswered):
+            self._waiting.appendleft(getter)
+        self._dispatch()
+
+    def connectionAvailable(self, connection):
+        self._dispatch()
+
+    ### Private Methods ###
+
+    def _dispatch(self):
+        while self._waiting:
+            if self._waiting[0].abandoned:
+                self._waiting.popleft()
+                continue
+            connection = self._findConnection(0)
+            if connection is None:
+                opened = len(self.connections) + self._connecting
+                if opened < self.maxConnections:
+                    if self._connecting < len(self._waiting):
+                        self._connect()
+                        continue
+                    break
+                connection = self._findConnection(self.pipelineDepth - 1)
+                if connection is None:
+                    break
+            connection.send(self._waiting.popleft())
+
+    def _findConnection(self, maxPending):
+        best = None
+        for connection in self.connections:
+            if not connection.canSend():
+                continue
+            pending = connection.pending()
+            if pending > maxPending:
+                continue
+            if best is None or pending < best.pending():
+                best = connection
+        return best
+
+    def _connect(self):
+        self._connecting += 1
+        self.log("Connecting, %d open and %d connecting",
+                 len(self.connections), self._connecting)
+        reactor.connectTCP(self.host, self.port, _ConnectionFactory(self),
+                           self.connTimeout)
+
+
+class _ConnectionFactory(protocol.ClientFactory):
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def buildProtocol(self, addr):
+        connection = PersistentConnection(self.pool)
+        connection.factory = self
+        return connection
+
+    def clientConnectionFailed(self, connector, reason):
+        self.pool.connectionFailed(reason)
+
+
+class PersistentConnection(basic.LineReceiver, log.Loggable):
+    """
+    I'm a HTTP/1.1 connection carrying one request after another,
+    pipelined or not, and giving the responses to their getters.
+
+    The response of an abandoned request is read and thrown away if it's
+    small enough, otherwise the connection is closed.
+    Chunked responses are decoded before giving their body to the getter.
+    """
+
+    logCategory = LOG_CATEGORY
+
+    def __init__(self, pool):
+        self.pool = pool
+        self._requests = deque()  # Getters sent, the first is answered
+        self._closing = False
+        self._idleCall = None
+        self._transportPaused = False
+        self._resetResponse()
+        self.logName = common.log_id(self)
+
+    def canSend(self):
+        return self.connected and not self._closing
+
+    def pending(self):
+        return len(self._requests)
+
+    def send(self, getter):
+        self._cancelIdleTimeout()
+        self._requests.append(getter)
+        self.log("Sending request for %s, %d pending",
+                 getter.url, len(self._requests))
+        getter.attach(self)
+        self.transport.write(getter.buildRequest())
+        if len(self._requests) == 1:
+            self._startResponse()
+
+    def close(self):
+        self._closing = True
+        if self.transport is not None:
+            self.transport.loseConnection()
+
+    def abandon(self, getter):
+        """
+        Called when a sent request is no longer wanted.
+        """
+        if not self._requests or getter is not self._requests[0]:
+            # Its response will be thrown away
+            return
+        self._updateFlow()
+        if self._bodyStarted and not self._canDrain():
+            self.log("Closing connection to abandon %s", getter.url)
+            self.close()
+
+    def updateFlow(self, getter):
+        if self._requests and getter is self._requests[0]:
+            self._updateFlow()
+
+    ### Overridden Methods ###
+
+    def connectionMade(self):
+        self._startIdleTimeout()
+        self.pool.connectionMade(self)
+
+    def connectionLost(self, reason):
+        self._cancelIdleTimeout()
+        self._closing = True
+        requests = list(self._requests)
+        self._requests.clear()
+        unanswered = []
+        for index, getter in enumerate(requests):
+            getter.detach()
+            if getter.abandoned:
+                continue
+            if index == 0 and self._status is not None:
+                getter.connectionFailed(reason)
+            elif getter.retries < MAX_RETRIES:
+                getter.retries += 1
+                unanswered.append(getter)
+            else:
+                getter.connectionFailed(reason)
+        self.pool.connectionLost(self, unanswered)
+
+    def lineReceived(self, line):
+        if self._chunkState is not None:
+            self._handleChunkLine(line)
+        elif self._status is None:
+            self._handleStatusLine(line)
+        elif line:
+            self._handleHeaderLine(line)
+        else:
+            self._handleEndHeaders()
+
+    def rawDataReceived(self, data):
+        if self._remaining is None:
+            part, rest = data, ''
+        else:
+            part = data[:self._remaining]
+            rest = data[self._remaining:]
+            self._remaining -= len(part)
+        if part:
+            self._notify('handleResponsePart', part)
+        if self._remaining != 0:
+            return
+        if self._chunkState is not None:
+            # The chunk data is followed by an empty line
+            self._chunkState = 'end'
+            self.setLineMode(rest)
+        else:
+            self._endResponse(rest)
+
+    ### Private Methods ###
+
+    def _resetResponse(self):
+        self._status = None
+        self._version = None
+        self._headers = {}
+        self._lastHeader = None
+        self._remaining = None
+        self._bodyStarted = False
+        self._interim = False
+        # None, or the part of a chunked body expected: 'size', 'data',
+        # 'end' of the chunk data or 'trailer'
+        self._chunkState = None
+
+    def _handleStatusLine(self, line):
+        if not line:
+            # Tolerate empty lines between responses
+            return
+        parts = line.split(None, 2)
+        if not self._requests or len(parts) < 2:
+            self.warning("Unexpected data from the server: %r", line[:80])
+            self.close()
+            return
+        try:
+            status = int(parts[1])
+        except ValueError:
+            self.warning("Invalid status line: %r", line[:80])
+            self.close()
+            return
+        # An interim response is followed by the real one
+        self._interim = 100 <= status < 200
+        self._status = status
+        self._version = parts[0]
+        message = ""
+        if len(parts) > 2:
+            message = parts[2]
+        if not self._interim:
+            self._notify('handleStatus', parts[0], parts[1], message)
+
+    def _handleHeaderLine(self, line):
+        if line[0] in ' \t' and self._lastHeader is not None:
+            # Continuation of the previous header
+            self._headers[self._lastHeader] += ' ' + line.strip()
+            return
+        if ':' not in line:
+            self.warning("Invalid header line: %r", line[:80])
+            self.close()
+            return
+        key, value = line.split(':', 1)
+        key, value = key.strip(), value.strip()
+        self._headers[key.lower()] = value
+        self._lastHeader = key.lower()
+        if (key.lower() == 'transfer-encoding'
+                and value.lower() == 'chunked'):
+            # Decoded here, the getter only sees the body
+            return
+        if not self._interim:
+            self._notify('handleHeader', key, value)
+
+    def _handleEndHeaders(self):
+        if self._interim:
+            self._resetResponse()
+            return
+        status = self._status
+        connection = self._headers.get('connection', '').lower()
+        if 'close' in connection:
+            self._closing = True
+        elif (self._version == 'HTTP/1.0'
+              and 'keep-alive' not in connection):
+            self._closing = True
+        if status in (http.NO_CONTENT, http.NOT_MODIFIED):
+            self._remaining = 0
+        elif 'content-length' in self._headers:
+            try:
+                self._remaining = int(self._headers['content-length'])
+            except ValueError:
+                self.warning("Invalid content length: %r",
+                             self._headers['content-length'])
+                self.close()
+                return
+        elif self._headers.get('transfer-encoding', '').lower() == 'chunked':
+            self._chunkState = 'size'
+        elif 'transfer-encoding' in self._headers:
+            # Not supported, the getter reports it
+            self._closing = True
+        else:
+            # Read up to the end of the connection
+            self._closing = True
+        self._bodyStarted = True
+        self._notify('handleEndHeaders')
+        if self._requests[0].abandoned and not self._canDrain():
+            self.close()
+            return
+        if self._chunkState is not None:
+            # The chunk sizes are read as lines
+            return
+        if self._remaining == 0:
+            self._endResponse('')
+        else:
+            self.setRawMode()
+
+    def _handleChunkLine(self, line):
+        state = self._chunkState
+        if state == 'end':
+            if line:
+                self.warning("Invalid end of chunk: %r", line[:80])
+                self.close()
+                return
+            self._chunkState = 'size'
+        elif state == 'size':
+            try:
+                size = int(line.split(';', 1)[0].strip(), 16)
+            except ValueError:
+                self.warning("Invalid chunk size: %r", line[:80])
+                self.close()
+                return
+            if size == 0:
+                self._chunkState = 'trailer'
+                return
+            self._chunkState = 'data'
+            self._remaining = size
+            self.setRawMode()
+        elif not line:
+            # Empty line ending the trailer, the trailer headers are ignored
+            self._endResponse('')
+
+    def _canDrain(self):
+        # The size of a chunked body is unknown, it's never drained
+        return (self._chunkState is None
+                and self._remaining is not None
+                and self._remaining <= MAX_DRAIN_SIZE)
+
+    def _endResponse(self, rest):
+        getter = self._requests.popleft()
+        getter.detach()
+        self._resetResponse()
+        if not getter.abandoned:
+            getter.handleResponseEnd()
+        if self._closing:
+            self.close()
+            return
+        if self._requests:
+            self._startResponse()
+        else:
+            self._startIdleTimeout()
+        self.setLineMode(rest)
+        self.pool.connectionAvailable(self)
+
+    def _startResponse(self):
+        self._updateFlow()
+
+    def _updateFlow(self):
+        if not self._requests or self.transport is None:
+            return
+        head = self._requests[0]
+        paused = head.paused and not head.abandoned
+        if paused and not self._transportPaused:
+            self.transport.pauseProducing()
+        elif not paused and self._transportPaused:
+            self.transport.resumeProducing()
+        self._transportPaused = paused
+
+    def _notify(self, method, *args):
+        head = self._requests[0]
+        if not head.abandoned:
+            getattr(head, method)(*args)
+
+    def _startIdleTimeout(self):
+        self._cancelIdleTimeout()
+        if self.pool.keepaliveTimeout > 0:
+            self._idleCall = reactor.callLater(self.pool.keepaliveTimeout,
+                                               self._onIdleTimeout)
+
+    def _cancelIdleTimeout(self):
+        if self._idleCall is not None:
+            self._idleCall.cancel()
+            self._idleCall = None
+
+    def _onIdleTimeout(self):
+        self._idleCall = None
+        self.log("Closing unused connection")
+        self.close()
+
+
+class PooledStreamGetter(http_client.StreamGetter):
+    """
+    Retrieves a stream using a connection of a L{ConnectionPool}.
+
+    The response is handled the same way than L{http_client.StreamGetter}
+    does, but canceling the request gives up its response instead of
+    closing the connection.
+    """
+
+    def __init__(self, requester, consumer, url,
+                 ifModifiedSince=None, ifUnmodifiedSince=None,
+                 start=None, size=None, timeout=0):
+        http_client.StreamGetter.__init__(self, consumer, url,
+                                          ifModifiedSince, ifUnmodifiedSince,
+                                          start, size, timeout)
+        self.requester = requester
+        self.connection = None
+        self.abandoned = False
+        self.paused = False
+        self.retries = 0
+
+    ### Public Methods ###
+
+    def connect(self, proxyAddress=None, proxyPort=None, timeout=0):
+        assert not self._connected, "Already connected"
+        self._connected = True
+        url = self.url
+        self.host = proxyAddress or url.hostname
+        self.port = proxyPort or url.port
+        if url.scheme != 'http':
+            msg = "URL scheme %s not implemented" % url.scheme
+            self._serverError(common.NOT_IMPLEMENTED, msg)
+        else:
+            self.log("Queuing request to %s:%s for %s",
+                     self.host, self.port, self.url)
+            pool = self.requester.getPool(self.host, self.port)
+            pool.submit(self)
+
+    def pause(self):
+        if not self.paused:
+            self.paused = True
+            if self.connection is not None:
+                self.connection.updateFlow(self)
+            self.log("Request paused for %s", self.url)
+
+    def resume(self):
+        if self.paused:
+            self.paused = False
+            if self.connection is not None:
+                self.connection.updateFlow(self)
+            self.log("Request resumed for %s", self.url)
+
+    def cancel(self):
+        self._cancelIdleCheck()
+        self.log("Request canceled for %s", self.url)
+        self._canceled = True
+        self._abandon()
+
+    def buildRequest(self):
+        """
+        @returns: the request to send to the server
+        @rtype:   str
+        """
+        lines = ['%s %s HTTP/1.1' % (self.HTTP_METHOD, self.url.location),
+                 'Host: %s' % self.url.host,
+                 'User-Agent: %s' % http_client.USER_AGENT]
+
+        if self.ifModifiedSince:
+            datestr = http.datetimeToString(self.ifModifiedSince)
+            lines.append('If-Modified-Since: %s' % datestr)
+
+        if self.ifUnmodifiedSince:
+            datestr = http.datetimeToString(self.ifUnmodifiedSince)
+            lines.append('If-Unmodified-Since: %s' % datestr)
+
+        if self.start or self.size:
+            start = self.start or 0
+            end = (self.size and (start + self.size - 1)) or None
+            lines.append('Range: bytes=%s-%s' % (start, end or ""))
+
+        return '\r\n'.join(lines) + '\r\n\r\n'
+
+    ### Called by the connections and the pool ###
+
+    def attach(self, connection):
+        self.connection = connection
+        # A retried request starts over
+        self.headers = {}
+        self.status = None
+        self.info = None
+        self._remaining = None
+        self._resetIdleCheck()
+
+    def detach(self):
+        self.connection = None
+
+    def connectFailed(self, reason):
+        self._serverError(common.SERVER_UNAVAILABLE, reason.getErrorMessage())
+
+    def connectionFailed(self, reason):
+        self.log("Connection lost for %s", self.url)
+        self.handleResponseEnd()
+        if not self._canceled:
+            self._serverError(common.SERVER_DISCONNECTED,
+                              reason.getErrorMessage())
+
+    ### Overridden Methods ###
+
+    def _cancel(self):
+        self._cancelIdleCheck()
+        if self.consumer:
+            self.consumer = None
+            self._abandon()
+
+    ### Private Methods ###
+
+    def _abandon(self):
+        if self.abandoned:
+            return
+        self.abandoned = True
+        if self.connection is not None:
+            self.connection.abandon(self)
@@ -58,6 +58,7 @@ class RequestManager(log.Loggable):
         return self.selector.setup()
 
     def cleanup(self):
+        self.client.cleanup()
         return self.selector.cleanup()
 
 
@@ -31,6 +31,8 @@ from flumotion.component.misc.httpserver.httpcached import resource_manager
 
 EXP_TABLE_CLEANUP_PERIOD = 30
 MAX_RESUME_COUNT = 20
+# Most blocks read ahead by a caching session kept until they are read
+MAX_UNREAD_BLOCKS = 16
 
 # A RemoteProducer will not be able to
 # produce faster than 6.25 Mibit/s (6.55 Mbit/s)
@@ -61,10 +63,16 @@ class CachingStrategy(log.Loggable):
 
     logCategory = "base-caching"
 
-    def __init__(self, cachemgr, reqmgr, ttl):
+    def __init__(self, cachemgr, reqmgr, ttl, readAhead=0):
+        """
+        @param readAhead: how many blocks following the one read from
+                          the server are requested at the same time
+        @type  readAhead: int
+        """
         self.cachemgr = cachemgr
         self.reqmgr = reqmgr
         self.ttl = ttl
+        self.readAhead = readAhead
 
         self._identifiers = {} # {IDENTIFIER: CachingSession}
         self._etimes = {} # {IDENTIFIER: EXPIRATION_TIME}
@@ -261,7 +269,7 @@ class BaseRemoteSource(resource_manager.DataSource):
             self.session._correction -= diff
             self.stats.onBytesRead(0, size, diff) # from cache
             return data
-        d = self.strategy.requestData(self.url, offset, size, self.mtime)
+        d = self.session.requestBlock(offset, size)
         d.addCallback(self._requestDataCb)
         d.addErrback(self._requestDataFailed)
         return d
@@ -316,6 +324,9 @@ class BaseCachingSession(object):
     def read(self, offset, size):
         return None
 
+    def requestBlock(self, offset, size):
+        raise NotImplementedError()
+
     def cancel(self):
         raise NotImplementedError()
 
@@ -341,6 +352,10 @@ class CachingSession(BaseCachingSession, log.Loggable):
     with a RemoteSource instance.
 
     It can recover request failures up to MAX_RESUME_COUNT times.
+
+    The blocks not cached yet are requested to the server once for
+    all the sources reading them at the same time, along with the blocks
+    following them when the strategy reads ahead.
     """
 
     logCategory = "caching-session"
@@ -383,6 +398,10 @@ class CachingSession(BaseCachingSession, log.Loggable):
 
         self._resumes = MAX_RESUME_COUNT
 
+        self._reqmgr = strategy.reqmgr
+        self._readAhead = strategy.readAhead
+        self._blocks = {} # {(OFFSET, SIZE): SharedBlock}
+
         self.logName = common.log_id(self) # To be able to track the instance
 
         self.strategy._onNewSession(self)
@@ -453,6 +472,44 @@ class CachingSession(BaseCachingSession, log.Loggable):
         self._file.seek(offset)
         return self._file.read(size)
 
+    def requestBlock(self, offset, size):
+        """
+        Retrieves a block of the resource the session can't read yet.
+
+        @returns: a deferred fired with the data of the block
+        """
+        key = (offset, size)
+        block = self._blocks.get(key, None)
+        if block is None:
+            block = self._retrieveBlock(offset, size)
+            d = block.wait()
+        elif block.readers > 0:
+            self.log("Sharing the retrieval of %d bytes at %d of %s",
+                     size, offset, self.url)
+            d = block.wait()
+            d.addCallback(self._blockShared)
+        else:
+            # Read ahead, it's given to its first reader
+            d = block.wait()
+            if block.isRetrieved():
+                del self._blocks[key]
+        block.readers += 1
+
+        for i in range(1, self._readAhead + 1):
+            start = offset + i * size
+            if start >= self.size:
+                break
+            if start + size <= self._bytes:
+                # Already cached by the session
+                continue
+            if (start, size) not in self._blocks:
+                self.log("Reading ahead %d bytes at %d of %s",
+                         size, start, self.url)
+                self._retrieveBlock(start, size)
+
+        self._dropBlocks()
+        return d
+
     def cancel(self):
         """
         After calling this method the session cannot be used anymore.
@@ -770,6 +827,89 @@ class CachingSession(BaseCachingSession, log.Loggable):
         self._request = req
         self.log("Retrieving data using %s", self._request.logName)
 
+    def _retrieveBlock(self, offset, size):
+        key = (offset, size)
+        block = SharedBlock()
+        self._blocks[key] = block
+        requester = BlockRequester(self._reqmgr, self.url, self.mtime)
+        d = requester.retrieve(offset, size)
+        d.addCallbacks(self._blockRetrieved, self._blockFailed,
+                       callbackArgs=(key, block), errbackArgs=(key, block))
+        return block
+
+    def _blockRetrieved(self, data, key, block):
+        if block.readers > 0 and self._blocks.get(key, None) is block:
+            # Only shared while being retrieved
+            del self._blocks[key]
+        block.retrieved(data)
+
+    def _blockFailed(self, failure, key, block):
+        # The next read will request it again
+        if self._blocks.get(key, None) is block:
+            del self._blocks[key]
+        block.failed(failure)
+
+    def _blockShared(self, data):
+        self.cache_stats.onRequestCoalesced(len(data))
+        return data
+
+    def _dropBlocks(self):
+        # Only the blocks read ahead are kept once retrieved
+        unread = []
+        for key, block in self._blocks.items():
+            if not block.isRetrieved():
+                continue
+            start, size = key
+            if start + size <= self._bytes:
+                # The session can read it
+                del self._blocks[key]
+            else:
+                unread.append(key)
+        excess = len(unread) - MAX_UNREAD_BLOCKS
+        if excess > 0:
+            unread.sort()
+            for key in unread[:excess]:
+                del self._blocks[key]
+
+
+class SharedBlock(object):
+    """
+    A block of data being retrieved for all the sources reading it.
+    """
+
+    def __init__(self):
+        self.readers = 0
+        self._data = None
+        self._failure = None
+        self._waiting = []
+
+    def isRetrieved(self):
+        return self._data is not None
+
+    def wait(self):
+        """
+        @returns: a deferred fired with the data of the block
+        """
+        if self._data is not None:
+            return defer.succeed(self._data)
+        if self._failure is not None:
+            return defer.fail(self._failure)
+        d = defer.Deferred()
+        self._waiting.append(d)
+        return d
+
+    def retrieved(self, data):
+        self._data = data
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(data)
+
+    def failed(self, failure):
+        self._failure = failure
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.errback(failure)
+
 
 class RemoteProducer(common.StreamConsumer, log.Loggable):
     """
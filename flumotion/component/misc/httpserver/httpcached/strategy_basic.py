@@ -48,8 +48,9 @@ class CachingStrategy(strategy_base.CachingStrategy):
 
     logCategory = LOG_CATEGORY
 
-    def __init__(self, cachemgr, reqmgr, ttl):
-        strategy_base.CachingStrategy.__init__(self, cachemgr, reqmgr, ttl)
+    def __init__(self, cachemgr, reqmgr, ttl, readAhead=0):
+        strategy_base.CachingStrategy.__init__(self, cachemgr, reqmgr, ttl,
+                                               readAhead)
 
     def _onCacheMiss(self, url, stats):
         session = strategy_base.CachingSession(self, url, self.cachemgr.stats)
@@ -15,6 +15,7 @@
 #
 # Headers in this file shall remain intact.
 
+import errno
 import string
 import time
 
@@ -34,7 +35,7 @@ from twisted.python.failure import Failure
 from flumotion.configure import configure
 from flumotion.common import log
 from flumotion.component.component import moods
-from flumotion.component.misc.httpserver import fileprovider
+from flumotion.component.misc.httpserver import fileprovider, zerocopy
 
 # register serializables
 from flumotion.common import messages
@@ -389,7 +390,14 @@ class File(resource.Resource, log.Loggable):
             # Set the provider first, because for very small file
             # the transfer could terminate right away.
             request._provider = provider
-            transfer = FileTransfer(provider, last + 1, consumer)
+            if consumer is request and not header and \
+                    canSendfile(request, provider):
+                # Nothing to rate-control or transform, let the kernel
+                # copy the file to the socket
+                self.debug("Sending file %s with sendfile", self._path)
+                transfer = SendfileTransfer(provider, last + 1, request)
+            else:
+                transfer = FileTransfer(provider, last + 1, consumer)
             request._transfer = transfer
 
             # The important NOT_DONE_YET was already returned by the render()
@@ -684,3 +692,145 @@ class FileTransfer(log.Loggable):
             self.consumer.finish()
             self.consumer = None
             self._finished = True
+
+
+# The private attributes of twisted's FileDescriptor read by
+# SendfileTransfer to know whether the transport flushed its buffer
+_TRANSPORT_BUFFER_ATTRIBUTES = ('dataBuffer', 'offset', '_tempDataLen')
+
+
+def canSendfile(request, provider):
+    """
+    Tells whether the body of a request can be sent from the provider
+    with sendfile(2): the provider must be backed by a local file, and
+    the request's transport must be a socket I can drive directly.
+    """
+    if not zerocopy.HAS_SENDFILE:
+        return False
+    fileno = getattr(provider, 'fileno', None)
+    if fileno is None or fileno() is None:
+        return False
+    transport = request.transport
+    if not isinstance(transport, abstract.FileDescriptor):
+        return False
+    for name in _TRANSPORT_BUFFER_ATTRIBUTES:
+        if not hasattr(transport, name):
+            # A twisted version buffering differently, the file is
+            # sent through the transport instead
+            return False
+    # Newer twisted.web versions keep the HTTP channel registered as the
+    # transport's producer and don't let us take its place
+    return transport.producer is None and hasattr(request, 'dataSent')
+
+
+class SendfileTransfer(log.Loggable):
+    """
+    A transfer of a local file over the network with sendfile(2), so
+    that the data is copied to the socket by the kernel, without going
+    through Python strings.
+
+    I am a pull producer registered in the request's transport, so the
+    reactor asks me for more once the socket is writable and the
+    transport has flushed what was written to it. To know that, I read
+    the private buffer attributes of twisted's FileDescriptor;
+    L{canSendfile} checks the transport has them.
+    """
+
+    logCategory = LOG_CATEGORY
+
+    # Maximum bytes sent by a sendfile call
+    chunkSize = 1024 * 1024
+    # Maximum sendfile calls before giving the reactor back control
+    maxCalls = 16
+
+    request = None
+
+    def __init__(self, provider, size, request):
+        """
+        @param provider: a file provider with a file descriptor
+        @type  provider: L{fileprovider.File}
+        @param size: file position to which file should be sent
+        @type  size: int
+        @param request: the request to send the file to
+        @type  request: L{httpserver.CancellableRequest}
+        """
+        self.provider = provider
+        self.size = size
+        self.request = request
+        self.transport = request.transport
+        self.written = self.provider.tell()
+        self.bytesWritten = 0
+        self._finished = False
+        # Have the headers written to the transport before the body
+        request.write('')
+        self.debug("Calling registerProducer on %r", self.transport)
+        self.transport.registerProducer(self, 0)
+
+    def resumeProducing(self):
+        if self._finished:
+            return
+        transport = self.transport
+        if len(transport.dataBuffer) - transport.offset or \
+                transport._tempDataLen:
+            # The transport will call me again once it sent its data
+            transport.startWriting()
+            return
+
+        outFd = transport.fileno()
+        inFd = self.provider.fileno()
+        for i in range(self.maxCalls):
+            count = min(self.chunkSize, self.size - self.written)
+            if count <= 0:
+                break
+            try:
+                sent = zerocopy.sendfile(outFd, inFd, self.written, count)
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    break
+                self.warning('Failure sending file %s: %s',
+                             self.provider, log.getExceptionMessage(e))
+                self._terminate()
+                return
+            if sent == 0:
+                self.warning('File %s is shorter than %d bytes',
+                             self.provider, self.size)
+                self._terminate()
+                return
+            self.written += sent
+            self.bytesWritten += sent
+            self.provider.skip(sent)
+            self.request.dataSent(sent)
+            if sent < count:
+                # The socket buffer is full
+                break
+
+        if self.written >= self.size:
+            self.debug('Sent entire file of %d bytes from %s',
+                       self.size, self.provider)
+            self._terminate()
+            return
+        # Wait for the socket to be writable again
+        transport.startWriting()
+
+    def pauseProducing(self):
+        pass
+
+    def stopProducing(self):
+        self.debug('Stop producing from %s at %d/%d bytes',
+                   self.provider, self.written, self.size)
+        self._terminate()
+
+    def _terminate(self):
+        if self._finished:
+            return
+        self._finished = True
+        if self.size != self.written:
+            self.warning("Terminated before sending the full %s bytes, "
+                         "only %s byte sent", self.size, self.written)
+        try:
+            self.provider.close()
+        finally:
+            self.provider = None
+            self.transport.unregisterProducer()
+            self.request.finish()
+            self.request = None
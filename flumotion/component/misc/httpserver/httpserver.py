@@ -32,6 +32,7 @@ from flumotion.component.base import http as httpbase
 from flumotion.component.component import moods
 from flumotion.component.misc.httpserver import httpfile, \
         localprovider, localpath
+from flumotion.component.misc.httpserver import memorycache
 from flumotion.component.misc.httpserver import serverstats
 from flumotion.component.misc.porter import porterclient
 from flumotion.twisted import fdserver
@@ -76,9 +77,23 @@ class CancellableRequest(server.Request):
         self._rangeLastByte = last
         self._resourceSize = size
 
+    def getResponseRange(self):
+        """
+        @returns: the first and last bytes of the resource sent,
+                  and its size; None when not known yet
+        @rtype:   tuple of (int, int, int)
+        """
+        return self._rangeFirstByte, self._rangeLastByte, self._resourceSize
+
     def write(self, data):
         server.Request.write(self, data)
-        size = len(data)
+        self.dataSent(len(data))
+
+    def dataSent(self, size):
+        """
+        Account for data of the body sent to the client, also when it was
+        sent straight to the transport instead of written to me.
+        """
         self._bytesWritten += size
         self.lastTimeWritten = time.time()
         # Update statistics
@@ -221,6 +236,7 @@ class HTTPFileStreamer(component.BaseComponent, log.Loggable):
         self._rateControlPlug = None
         self._fileProviderPlug = None
         self._metadataProviderPlug = None
+        self._memoryCache = None
         self._loggers = []
         self._requestModifiers = []
         self._logfilter = None
@@ -256,6 +272,7 @@ class HTTPFileStreamer(component.BaseComponent, log.Loggable):
         self.uiState.addKey('allow-browsing', False)
         self.uiState.addDictKey('request-statistics')
         self.uiState.addDictKey('provider-statistics')
+        self.uiState.addDictKey('memory-cache-statistics')
 
     def do_check(self):
         props = self.config['properties']
@@ -311,6 +328,12 @@ class HTTPFileStreamer(component.BaseComponent, log.Loggable):
         self.type = props.get('type', 'master')
         self.port = props.get('port', 8801)
         self._allowBrowsing = props.get('allow-browsing', False)
+        memoryCacheSize = props.get('memory-cache-size', 0)
+        if memoryCacheSize > 0:
+            self._memoryCache = memorycache.MemoryCache(
+                memoryCacheSize * 10 ** 6,
+                props.get('memory-cache-max-object-size', 1024) * 10 ** 3,
+                props.get('memory-cache-min-hits', 2))
         if self.type == 'slave':
             # already checked for these in do_check
             self._porterPath = props['porter-socket-path']
@@ -391,6 +414,13 @@ class HTTPFileStreamer(component.BaseComponent, log.Loggable):
         self.stats.startUpdates(updater)
         updater = StatisticsUpdater(self.uiState, "provider-statistics")
         self._fileProviderPlug.startStatsUpdates(updater)
+        self._fileProviderPlug.setServerStatistics(self.stats)
+        if self._rateControlPlug:
+            self._rateControlPlug.setServerStatistics(self.stats)
+        if self._memoryCache:
+            updater = StatisticsUpdater(self.uiState,
+                                        "memory-cache-statistics")
+            self._memoryCache.stats.startUpdates(updater)
         self._updateUptime()
 
         d = defer.Deferred()
@@ -447,6 +477,8 @@ class HTTPFileStreamer(component.BaseComponent, log.Loggable):
             self.stats.stopUpdates()
         if self._fileProviderPlug:
             self._fileProviderPlug.stopStatsUpdates()
+        if self._memoryCache:
+            self._memoryCache.stats.stopUpdates()
         if self.httpauth:
             self.httpauth.stopKeepAlive()
         if self._timeoutRequestsCallLater:
@@ -529,6 +561,8 @@ class HTTPFileStreamer(component.BaseComponent, log.Loggable):
         node = self._fileProviderPlug.getRootPath()
         if node is None:
             return None
+        if self._memoryCache:
+            node = memorycache.MemoryCachedPath(self._memoryCache, node)
 
         self.debug('Starting with mount point "%s"' % self.mountPoint)
         factory = httpfile.MimedFileFactory(self.httpauth,
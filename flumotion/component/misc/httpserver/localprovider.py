@@ -18,8 +18,10 @@
 import os
 import stat
 import errno
+import time
 
-from twisted.internet import defer
+from twisted.internet import defer, reactor
+from twisted.python import failure, threadpool
 
 from flumotion.common import log
 from flumotion.component.misc.httpserver import fileprovider, localpath
@@ -31,11 +33,18 @@ SEEK_SET = 0
 
 LOG_CATEGORY = "fileprovider-local"
 
+# Default amount of data read ahead of the position of files
+# when reading them in a pool of threads
+DEFAULT_READ_AHEAD = 256 * 1024
+
 
 class FileProviderLocalPlug(fileprovider.FileProviderPlug, log.Loggable):
     """
     I am a plug that provide local files directly,
     faking the file access is asynchronous.
+    When the io-threads property is set, the files are read
+    in a pool of threads instead, so a slow disk doesn't block
+    the reactor.
     """
 
     logcategory = LOG_CATEGORY
@@ -43,6 +52,19 @@ class FileProviderLocalPlug(fileprovider.FileProviderPlug, log.Loggable):
     def __init__(self, args):
         props = args['properties']
         self._path = props.get('path', None)
+        self._readAhead = props.get('read-ahead', DEFAULT_READ_AHEAD)
+        self._pool = None
+        threads = props.get('io-threads', 0)
+        if threads > 0:
+            self._pool = ReadPool(threads)
+
+    def start(self, component):
+        if self._pool is not None:
+            self._pool.start()
+
+    def stop(self, component):
+        if self._pool is not None:
+            self._pool.stop()
 
     def startStatsUpdates(self, updater):
         # No statistics for local file provider
@@ -51,15 +73,109 @@ class FileProviderLocalPlug(fileprovider.FileProviderPlug, log.Loggable):
     def stopStatsUpdates(self):
         pass
 
+    def setServerStatistics(self, stats):
+        if self._pool is not None:
+            self._pool.setServerStatistics(stats)
+
     def getRootPath(self):
         if self._path is None:
             return None
-        return LocalPath(self._path)
+        return LocalPath(self._path, self._pool, self._readAhead)
+
+
+class ReadPool(log.Loggable):
+    """
+    I read blocks of files in a bounded pool of threads.
+    I account the reads waiting for a thread and the time they take
+    in the server statistics, if I'm given them.
+    """
+
+    logCategory = LOG_CATEGORY
+
+    _stats = None
+    _shutdownId = None
+
+    def __init__(self, threads):
+        self._pool = threadpool.ThreadPool(0, threads)
+        self.pending = 0
+
+    def setServerStatistics(self, stats):
+        """
+        @type stats: L{serverstats.ServerStatistics}
+        """
+        self._stats = stats
+
+    def start(self):
+        if self._shutdownId is not None:
+            return
+        self.debug("Starting a pool of %d threads", self._pool.max)
+        self._pool.start()
+        self._shutdownId = reactor.addSystemEventTrigger(
+            'during', 'shutdown', self.stop)
+
+    def stop(self):
+        if self._shutdownId is None:
+            return
+        reactor.removeSystemEventTrigger(self._shutdownId)
+        self._shutdownId = None
+        self.debug("Stopping the pool of threads")
+        self._pool.stop()
+
+    def read(self, fileObj, offset, size):
+        """
+        Reads a block of a file in one of my threads.
+        The file must not be used by anybody else until the read is done.
+
+        @param fileObj: the file to read from
+        @type  fileObj: file
+        @param offset:  the position to read from
+        @type  offset:  long
+        @param size:    the maximum amount of bytes to read
+        @type  size:    int
+
+        @returns: a deferred fired with the data read
+        @rtype:   L{twisted.internet.defer.Deferred}
+        """
+        d = defer.Deferred()
+        self.pending += 1
+        if self._stats is not None:
+            self._stats.onReadQueued()
+        d.addBoth(self._readDone, time.time())
+        self._pool.callInThread(self._read, d, fileObj, offset, size)
+        return d
+
+    def _read(self, d, fileObj, offset, size):
+        # Called in one of the pool threads
+        try:
+            fileObj.seek(offset, SEEK_SET)
+            data = fileObj.read(size)
+        except:
+            reactor.callFromThread(d.errback, failure.Failure())
+        else:
+            reactor.callFromThread(d.callback, data)
+
+    def _readDone(self, result, started):
+        self.pending -= 1
+        if self._stats is not None:
+            self._stats.onReadDone(time.time() - started)
+        return result
 
 
 class LocalPath(localpath.LocalPath):
 
+    def __init__(self, path, pool=None, readAhead=DEFAULT_READ_AHEAD):
+        localpath.LocalPath.__init__(self, path)
+        self._pool = pool
+        self._readAhead = readAhead
+
+    def child(self, name):
+        childpath = self._getChildPath(name)
+        return LocalPath(childpath, self._pool, self._readAhead)
+
     def open(self):
+        if self._pool is not None:
+            return AsyncLocalFile(self._path, self.mimeType,
+                                  self._pool, self._readAhead)
         return LocalFile(self._path, self.mimeType)
 
 
@@ -147,6 +263,14 @@ class LocalFile(fileprovider.File, log.Loggable):
         except:
             return defer.fail()
 
+    def fileno(self):
+        if self._file is None:
+            raise FileClosedError("File closed")
+        return self._file.fileno()
+
+    def skip(self, size):
+        self.seek(self.tell() + size)
+
     def close(self):
         if self._file is not None:
             try:
@@ -165,3 +289,123 @@ class LocalFile(fileprovider.File, log.Loggable):
 
     def getLogFields(self):
         return {}
+
+
+class AsyncLocalFile(LocalFile):
+    """
+    I read a local file in the threads of a L{ReadPool}, keeping the
+    data following the current position in memory so the next reads
+    don't have to wait for the disk.
+    Only one block is read at a time, and the file is left alone
+    by the reactor thread meanwhile.
+    """
+
+    _fetching = None
+
+    def __init__(self, path, mimeType, pool, readAhead):
+        LocalFile.__init__(self, path, mimeType)
+        self._pool = pool
+        self._readAhead = readAhead
+        self._position = 0
+        # The data read from the file, starting at _bufferStart
+        self._buffer = ''
+        self._bufferStart = 0
+        self._eof = False
+        self._waiting = []
+
+    def __str__(self):
+        return "<AsyncLocalFile '%s'>" % self._path
+
+    def tell(self):
+        if self._file is None:
+            raise FileClosedError("File closed")
+        return self._position
+
+    def seek(self, offset):
+        if self._file is None:
+            raise FileClosedError("File closed")
+        self._position = offset
+
+    def read(self, size):
+        if self._file is None:
+            raise FileClosedError("File closed")
+        bufferEnd = self._bufferStart + len(self._buffer)
+        if self._position < self._bufferStart or self._position > bufferEnd:
+            # Seeked out of the buffered data, start again from there
+            self._buffer = ''
+            self._bufferStart = self._position
+            self._eof = False
+            bufferEnd = self._position
+        if (bufferEnd - self._position >= size) or self._eof:
+            start = self._position - self._bufferStart
+            data = self._buffer[start:start + size]
+            self._position += len(data)
+            if not self._eof and (bufferEnd - self._position
+                                  < self._readAhead):
+                self._fetch(self._readAhead)
+            return defer.succeed(data)
+        self._fetch(max(size, self._readAhead))
+        d = defer.Deferred()
+        self._waiting.append(d)
+        d.addCallback(lambda _: self.read(size))
+        return d
+
+    def fileno(self):
+        if self._file is None:
+            raise FileClosedError("File closed")
+        # Sending the file with sendfile(2) would block the reactor
+        # on the disk again
+        return None
+
+    def close(self):
+        if self._fetching is None or self._file is None:
+            LocalFile.close(self)
+            return
+        # A thread is still reading the file, close it when done
+        self._fetching.addBoth(self._closeFetched, self._file)
+        self._file = None
+        self._info = None
+        self._buffer = ''
+
+    def _fetch(self, size):
+        if self._fetching is not None:
+            return
+        offset = self._bufferStart + len(self._buffer)
+        d = self._pool.read(self._file, offset, size)
+        d.addCallbacks(self._cbFetched, self._ebFetched,
+                       callbackArgs=(offset, size), errbackArgs=(offset, ))
+        self._fetching = d
+
+    def _cbFetched(self, data, offset, size):
+        self._fetching = None
+        # The buffer could have been dropped by a seek meanwhile
+        if self._file is not None and (offset == self._bufferStart
+                                       + len(self._buffer)):
+            consumed = self._position - self._bufferStart
+            self._buffer = self._buffer[consumed:] + data
+            self._bufferStart = self._position
+            if len(data) < size:
+                self._eof = True
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(None)
+
+    def _ebFetched(self, fail, offset):
+        self._fetching = None
+        if fail.check(IOError):
+            cls = self._errorLookup.get(fail.value[0], FileError)
+            fail = failure.Failure(cls("Failed to read data from %s: %s"
+                                       % (self._path, str(fail.value))))
+        waiting, self._waiting = self._waiting, []
+        if not waiting:
+            self.debug("Failed to read ahead at %d in %s: %s",
+                       offset, self, fail.getErrorMessage())
+        for d in waiting:
+            d.errback(fail)
+
+    def _closeFetched(self, result, fileObj):
+        try:
+            fileObj.close()
+        except IOError, e:
+            self.warning("Failed to close file '%s': %s",
+                         self._path, str(e))
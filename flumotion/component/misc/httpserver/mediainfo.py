@@ -0,0 +1,122 @@
+# -*- test-case-name: flumotion.test.test_component_httpserver_ratecontrol -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""bitrate of media files from the start of their data.
+Understands the onMetaData tag of FLV files and the movie header of
+MP4 files having it before the media data.
+"""
+
+import struct
+
+__version__ = "$Rev$"
+
+# Containers the MP4 movie header is found in
+_MP4_CONTAINERS = ('moov', )
+
+
+def getBitrate(data, size=None):
+    """
+    Finds the bitrate of a media file from its first bytes.
+
+    @param data: the start of the file
+    @type  data: str
+    @param size: the size of the file, in bytes
+    @type  size: int
+
+    @returns: the bitrate in bits per second, or None if unknown
+    @rtype:   int
+    """
+    if data.startswith('FLV'):
+        return _getFLVBitrate(data, size)
+    if data[4:8] == 'ftyp':
+        duration = _getMP4Duration(data, 0, len(data))
+        if duration and size:
+            return int(size * 8 / duration)
+    return None
+
+
+def _getFLVBitrate(data, size):
+    rates = [_getAMFNumber(data, 'videodatarate'),
+             _getAMFNumber(data, 'audiodatarate')]
+    rates = [r for r in rates if r]
+    if rates:
+        # In kbps
+        return int(sum(rates) * 1000)
+    duration = _getAMFNumber(data, 'duration')
+    if duration and size:
+        return int(size * 8 / duration)
+    return None
+
+
+def _getAMFNumber(data, name):
+    # The properties of onMetaData are a name then a typed value,
+    # numbers being of type 0 followed by a big-endian double
+    key = struct.pack('>H', len(name)) + name + '\x00'
+    index = data.find(key)
+    if index < 0:
+        return None
+    index += len(key)
+    if index + 8 > len(data):
+        return None
+    value, = struct.unpack('>d', data[index:index + 8])
+    if value != value or value <= 0:
+        # NaN or meaningless
+        return None
+    return value
+
+
+def _getMP4Duration(data, start, end):
+    # Walks the boxes between start and end, looking for the movie header
+    while start + 8 <= end:
+        size, kind = struct.unpack('>I4s', data[start:start + 8])
+        headerSize = 8
+        if size == 1:
+            if start + 16 > end:
+                return None
+            size, = struct.unpack('>Q', data[start + 8:start + 16])
+            headerSize = 16
+        elif size == 0:
+            # Up to the end of the file
+            size = end - start
+        if size < headerSize:
+            return None
+        if kind in _MP4_CONTAINERS:
+            return _getMP4Duration(data, start + headerSize,
+                                   min(start + size, end))
+        if kind == 'mvhd':
+            return _parseMVHD(data, start + headerSize)
+        start += size
+    return None
+
+
+def _parseMVHD(data, start):
+    version = data[start:start + 1]
+    if version == '\x00':
+        fields = data[start + 12:start + 20]
+        if len(fields) < 8:
+            return None
+        timescale, duration = struct.unpack('>II', fields)
+    elif version == '\x01':
+        fields = data[start + 20:start + 32]
+        if len(fields) < 12:
+            return None
+        timescale, duration = struct.unpack('>IQ', fields)
+    else:
+        return None
+    if not (timescale and duration):
+        return None
+    return float(duration) / timescale
@@ -0,0 +1,279 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_component_providers -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""in-memory cache of small popular files.
+A tier kept in front of any file provider, holding the whole content
+of the files requested most often so they are served without reading
+them from the provider again.
+"""
+
+from twisted.internet import defer
+
+from flumotion.common import log
+from flumotion.component.misc.httpserver import cachestats
+from flumotion.component.misc.httpserver import fileprovider
+from flumotion.component.misc.httpserver.fileprovider import FileClosedError
+
+__version__ = "$Rev$"
+
+LOG_CATEGORY = "memory-cache"
+
+# How many requests of files not in the cache are remembered
+# before forgetting them all
+MAX_CANDIDATES = 10000
+
+
+class _Entry(object):
+    """
+    A cached file, linked in the least recently used order.
+    """
+
+    def __init__(self, key, mtime, data):
+        self.key = key
+        self.mtime = mtime
+        self.data = data
+        self.prev = None
+        self.next = None
+
+
+class MemoryCache(log.Loggable):
+    """
+    I keep the content of files in memory, within a budget of bytes,
+    evicting the least recently used ones when it is exceeded.
+
+    Files are only admitted when they're small enough and have been
+    requested a given number of times, so a single request of a file
+    doesn't push out the popular ones.
+    Entries are keyed by path and modification time; a modified file is
+    a different entry.
+    """
+
+    logCategory = LOG_CATEGORY
+
+    def __init__(self, maxSize, maxObjectSize, minHits):
+        """
+        @param maxSize:       the bytes the cached files can use
+        @type  maxSize:       int
+        @param maxObjectSize: the bytes of the biggest file to cache
+        @type  maxObjectSize: int
+        @param minHits:       the requests a file must get to be cached
+        @type  minHits:       int
+        """
+        self.maxSize = maxSize
+        self.maxObjectSize = min(maxObjectSize, maxSize)
+        self.minHits = minHits
+        self.size = 0
+        self.stats = cachestats.CacheStatistics()
+        self._entries = {} # {key: _Entry}
+        self._candidates = {} # {key: request count}
+        # The head is the most recently used entry
+        self._head = None
+        self._tail = None
+
+    def get(self, key, mtime):
+        """
+        @returns: the data of the file, or None if it's not cached
+                  with that modification time
+        @rtype:   str
+        """
+        entry = self._entries.get(key)
+        if entry is not None and entry.mtime != mtime:
+            self.debug("Dropping outdated %s", key)
+            self._remove(entry)
+            entry = None
+        if entry is None:
+            self.stats.onMemoryMiss()
+            return None
+        self.stats.onMemoryHit()
+        if entry is not self._head:
+            self._unlink(entry)
+            self._link(entry)
+        return entry.data
+
+    def wantsToCache(self, key, size):
+        """
+        Tells if a file not in the cache should be added to it,
+        counting one more request for it.
+
+        @rtype: bool
+        """
+        if size > self.maxObjectSize:
+            return False
+        if len(self._candidates) >= MAX_CANDIDATES:
+            self._candidates.clear()
+        hits = self._candidates.get(key, 0) + 1
+        if hits < self.minHits:
+            self._candidates[key] = hits
+            return False
+        self._candidates.pop(key, None)
+        return True
+
+    def put(self, key, mtime, data):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._remove(entry)
+        size = len(data)
+        while self._tail is not None and self.size + size > self.maxSize:
+            self.debug("Evicting %s", self._tail.key)
+            self._remove(self._tail)
+        entry = _Entry(key, mtime, data)
+        self._entries[key] = entry
+        self._link(entry)
+        self.size += size
+        self.stats.onMemoryUsage(self.size, self.maxSize)
+
+    def _remove(self, entry):
+        self._unlink(entry)
+        del self._entries[entry.key]
+        self.size -= len(entry.data)
+        self.stats.onMemoryUsage(self.size, self.maxSize)
+
+    def _link(self, entry):
+        entry.prev = None
+        entry.next = self._head
+        if self._head is not None:
+            self._head.prev = entry
+        self._head = entry
+        if self._tail is None:
+            self._tail = entry
+
+    def _unlink(self, entry):
+        if entry.prev is not None:
+            entry.prev.next = entry.next
+        else:
+            self._head = entry.next
+        if entry.next is not None:
+            entry.next.prev = entry.prev
+        else:
+            self._tail = entry.prev
+        entry.prev = None
+        entry.next = None
+
+
+class MemoryCachedPath(fileprovider.FilePath, log.Loggable):
+    """
+    I wrap a path of another file provider, opening the files
+    from a L{MemoryCache} when they are in it.
+    """
+
+    logCategory = LOG_CATEGORY
+
+    def __init__(self, cache, path, key=''):
+        self._cache = cache
+        self._path = path
+        self._key = key
+
+    def __str__(self):
+        return "<MemoryCachedPath %s>" % self._path
+
+    def getMimeType(self):
+        return self._path.mimeType
+    mimeType = property(getMimeType)
+
+    def child(self, name):
+        return MemoryCachedPath(self._cache, self._path.child(name),
+                                self._key + '/' + name)
+
+    def open(self):
+        d = defer.maybeDeferred(self._path.open)
+        d.addCallback(self._gotFile)
+        return d
+
+    def _gotFile(self, f):
+        mtime = f.getmtime()
+        data = self._cache.get(self._key, mtime)
+        if data is not None:
+            f.close()
+            return MemoryFile(data, mtime, f.mimeType)
+        size = f.getsize()
+        if not self._cache.wantsToCache(self._key, size):
+            return f
+        d = f.read(size)
+        d.addCallbacks(self._cbRead, self._ebRead,
+                       callbackArgs=(f, mtime, size), errbackArgs=(f, ))
+        return d
+
+    def _cbRead(self, data, f, mtime, size):
+        if len(data) != size:
+            # Changed while we were reading it, let it be read again
+            self.debug("Read %d bytes of %s instead of %d, not caching",
+                       len(data), self, size)
+            f.seek(0)
+            return f
+        f.close()
+        self._cache.put(self._key, mtime, data)
+        return MemoryFile(data, mtime, f.mimeType)
+
+    def _ebRead(self, failure, f):
+        self.warning("Failed to read %s to cache it: %s",
+                     self, failure.getErrorMessage())
+        f.seek(0)
+        return f
+
+
+class MemoryFile(fileprovider.File):
+    """
+    I am a file whose content is in memory.
+    """
+
+    # Overriding parent class properties to become attribute
+    mimeType = None
+
+    def __init__(self, data, mtime, mimeType):
+        self._data = data
+        self._mtime = mtime
+        self._position = 0
+        self.mimeType = mimeType
+
+    def getsize(self):
+        self._checkOpened()
+        return len(self._data)
+
+    def getmtime(self):
+        self._checkOpened()
+        return self._mtime
+
+    def tell(self):
+        self._checkOpened()
+        return self._position
+
+    def seek(self, offset):
+        self._checkOpened()
+        self._position = offset
+
+    def read(self, size):
+        self._checkOpened()
+        data = self._data[self._position:self._position + size]
+        self._position += len(data)
+        return defer.succeed(data)
+
+    def fileno(self):
+        self._checkOpened()
+        return None
+
+    def skip(self, size):
+        self.seek(self.tell() + size)
+
+    def close(self):
+        self._data = None
+
+    def getLogFields(self):
+        return {"memory-cache-status": "hit"}
+
+    def _checkOpened(self):
+        if self._data is None:
+            raise FileClosedError("File closed")
@@ -1,4 +1,4 @@
-# -*- Mode: Python; test-case-name: -*-
+# -*- test-case-name: flumotion.test.test_component_httpserver_ratecontrol -*-
 # vi:si:et:sw=4:sts=4:ts=4
 
 # Flumotion - a streaming media server
@@ -17,14 +17,30 @@
 
 __version__ = "$Rev$"
 
+import sys
 import time
+from collections import deque
 
 from flumotion.common import log
 
 from twisted.internet import reactor
 
+from flumotion.component.misc.httpserver import mediainfo
 from flumotion.component.plugs import base as plugbase
 
+# Seconds between the ticks of the shared rate controller
+DEFAULT_TICK_INTERVAL = 0.1
+# Sending rate of the adaptive rate controller, relative to the bitrate
+DEFAULT_RATE_MULTIPLE = 1.5
+# Seconds of media sent at once by the adaptive rate controller
+DEFAULT_BURST_DURATION = 10.0
+# Bytes of the start of a file looked at to find its bitrate
+SNIFF_SIZE = 64 * 1024
+# Bitrates of the files remembered for the requests not starting
+# at the beginning of them
+MAX_KNOWN_BITRATES = 1024
+UNLIMITED = sys.maxint
+
 
 class RateControllerPlug(plugbase.ComponentPlug):
 
@@ -35,6 +51,15 @@ class RateControllerPlug(plugbase.ComponentPlug):
     def createProducerConsumerProxy(self, consumer, request):
         pass
 
+    def setServerStatistics(self, stats):
+        """
+        Gives the statistics of the component, for the plug to report
+        what it did.
+
+        @type stats: L{serverstats.ServerStatistics}
+        """
+        pass
+
 
 class RateControllerFixedPlug(RateControllerPlug):
 
@@ -52,6 +77,198 @@ class RateControllerFixedPlug(RateControllerPlug):
             self._rateBytesPerSec, self._initialLevel)
 
 
+class RateControllerSharedPlug(RateControllerFixedPlug):
+    """
+    I rate control all the transfers at a fixed bitrate like
+    L{RateControllerFixedPlug}, but with a single timer driving a
+    L{TimingWheel}, so the cost of a tick only depends on the transfers
+    due in it.
+    """
+
+    def __init__(self, args):
+        RateControllerFixedPlug.__init__(self, args)
+        props = args['properties']
+        self._dripInterval = props.get('drip-interval',
+                                       TokenBucketConsumer._dripInterval)
+        self.wheel = _newTimingWheel(props, self._dripInterval)
+
+    def stop(self, component):
+        self.wheel.stop()
+
+    def createProducerConsumerProxy(self, consumer, request):
+        return ScheduledTokenBucketConsumer(self.wheel, self._dripInterval,
+                                            consumer, self._maxLevel,
+                                            self._rateBytesPerSec,
+                                            self._initialLevel)
+
+
+class RateControllerAdaptivePlug(RateControllerPlug):
+    """
+    I rate control every transfer at a multiple of the bitrate of the
+    file, after sending some seconds of it at once. Clients leaving early
+    then don't get much more than what they watched.
+
+    The bitrate is given by the metadata provider plug, as a bitrate or
+    duration item, or found in the start of FLV and MP4 files.
+    Transfers of files without a known bitrate are not rate controlled,
+    unless there's a fallback bitrate.
+
+    The transfers drip with a L{TimingWheel} like in
+    L{RateControllerSharedPlug}.
+    """
+
+    def __init__(self, args):
+        props = args['properties']
+        self.rateMultiple = props.get('rate-multiple', DEFAULT_RATE_MULTIPLE)
+        self.burstDuration = props.get('burst-duration',
+                                       DEFAULT_BURST_DURATION)
+        self.fallbackBitrate = props.get('fallback-bitrate')
+        self.dripInterval = props.get('drip-interval',
+                                      TokenBucketConsumer._dripInterval)
+        self.wheel = _newTimingWheel(props, self.dripInterval)
+        self.stats = None
+        self._bitrates = {}  # {path: bitrate}
+
+    def stop(self, component):
+        self.wheel.stop()
+
+    def setServerStatistics(self, stats):
+        self.stats = stats
+
+    def createProducerConsumerProxy(self, consumer, request):
+        # What we're given as request is the metadata of the file
+        metadata = request or {}
+        path = getattr(consumer, 'path', None)
+        return PacedTokenBucketConsumer(self, consumer, path,
+                                        metadata.get('bitrate'),
+                                        metadata.get('duration'))
+
+    def getKnownBitrate(self, path):
+        return self._bitrates.get(path)
+
+    def setKnownBitrate(self, path, bitrate):
+        if path is None:
+            return
+        # Prevent the known bitrates from growing endlessly
+        if len(self._bitrates) >= MAX_KNOWN_BITRATES:
+            self._bitrates.clear()
+        self._bitrates[path] = bitrate
+
+
+def _newTimingWheel(props, dripInterval):
+    tickInterval = props.get('tick-interval', DEFAULT_TICK_INTERVAL)
+    tickInterval = min(tickInterval, dripInterval)
+    slots = int(dripInterval / tickInterval + 0.5) + 1
+    return TimingWheel(tickInterval, slots)
+
+
+class TimingWheel(log.Loggable):
+    """
+    I call functions after a delay, rounded to a number of ticks,
+    with a single reactor timer. The calls due are kept in a ring of
+    slots, one per tick, so scheduling, cancelling and firing a call
+    cost the same whatever the number of calls.
+
+    The functions are given the time of the tick, so they don't need to
+    get it themselves.
+    """
+
+    logCategory = 'timing-wheel'
+
+    def __init__(self, tickInterval, slots):
+        """
+        @param tickInterval: the seconds between ticks
+        @type  tickInterval: float
+        @param slots:        the ticks of the longest delay, plus one
+        @type  slots:        int
+        """
+        self.tickInterval = tickInterval
+        self._slots = [{} for i in range(max(slots, 2))]
+        self._current = 0
+        self._scheduled = 0
+        self._lastTick = None
+        self._tickDC = None
+
+    def __len__(self):
+        return self._scheduled
+
+    def schedule(self, delay, function):
+        """
+        Calls a function with the time of the tick after a delay,
+        rounded to ticks and to the longest delay.
+
+        @param delay:    the delay in seconds
+        @type  delay:    float
+        @param function: called with the time of the tick
+        @type  function: callable
+
+        @returns: an object with a cancel() method, like a delayed call
+        """
+        ticks = int(delay / self.tickInterval + 0.5)
+        ticks = max(1, min(ticks, len(self._slots) - 1))
+        index = (self._current + ticks) % len(self._slots)
+        call = _WheelCall(self, index, function)
+        self._slots[index][call] = None
+        self._scheduled += 1
+        if self._tickDC is None:
+            self._lastTick = time.time()
+            self._tickDC = reactor.callLater(self.tickInterval, self._tick)
+        return call
+
+    def stop(self):
+        if self._tickDC is not None:
+            self._tickDC.cancel()
+            self._tickDC = None
+        for slot in self._slots:
+            slot.clear()
+        self._scheduled = 0
+
+    def _cancel(self, call):
+        if self._slots[call.index].pop(call, 0) is None:
+            self._scheduled -= 1
+
+    def _tick(self):
+        self._tickDC = None
+        now = time.time()
+        # Catch up with the ticks the reactor was late for
+        ticks = int((now - self._lastTick) / self.tickInterval)
+        ticks = max(1, min(ticks, len(self._slots)))
+        self._lastTick += ticks * self.tickInterval
+        for i in range(ticks):
+            self._current = (self._current + 1) % len(self._slots)
+            calls = self._slots[self._current]
+            if not calls:
+                continue
+            self._slots[self._current] = {}
+            self._scheduled -= len(calls)
+            for call in calls:
+                call.called = True
+                try:
+                    call.function(now)
+                except Exception, e:
+                    self.warning("Error in scheduled call: %s",
+                                 log.getExceptionMessage(e))
+        if self._scheduled and self._tickDC is None:
+            delay = max(0, self._lastTick + self.tickInterval - now)
+            self._tickDC = reactor.callLater(delay, self._tick)
+
+
+class _WheelCall(object):
+
+    __slots__ = ('wheel', 'index', 'function', 'called')
+
+    def __init__(self, wheel, index, function):
+        self.wheel = wheel
+        self.index = index
+        self.function = function
+        self.called = False
+
+    def cancel(self):
+        if not self.called:
+            self.called = True
+            self.wheel._cancel(self)
+
+
 class TokenBucketConsumer(log.Loggable):
     """
     Use a token bucket to proxy between a producer (e.g. FileTransfer) and a
@@ -82,7 +299,8 @@ class TokenBucketConsumer(log.Loggable):
         self.fillRate = fillRate # in bytes per second
         self.fillLevel = fillLevel # in bytes
 
-        self._buffers = [] # List of (offset, buffer) tuples
+        self._buffers = deque()  # Buffers waiting to be written
+        self._bufferOffset = 0  # Bytes of the first buffer already written
         self._buffersSize = 0
 
         self._finishing = False # If true, we'll stop once the current buffer
@@ -110,7 +328,15 @@ class TokenBucketConsumer(log.Loggable):
                   "initial level %d, maximum level %d",
                   fillRate, fillLevel, maxLevel)
 
-    def _dripAndTryWrite(self):
+    def _scheduleDrip(self):
+        """
+        Schedules the next drip.
+
+        @returns: an object with a cancel() method
+        """
+        return reactor.callLater(self._dripInterval, self._dripAndTryWrite)
+
+    def _dripAndTryWrite(self, now=None):
         """
         Re-fill our token bucket based on how long it has been since we last
         refilled it.
@@ -118,7 +344,8 @@ class TokenBucketConsumer(log.Loggable):
         """
         self._dripDC = None
 
-        now = time.time()
+        if now is None:
+            now = time.time()
         elapsed = now - self._lastDrip
         self._lastDrip = now
 
@@ -134,28 +361,39 @@ class TokenBucketConsumer(log.Loggable):
         if not self.consumer:
             return
 
-        while self.fillLevel > 0 and self._buffersSize > 0:
-            # If we're permitted to write at the moment, do so.
-            offset, buf = self._buffers[0]
-            sendbuf = buf[offset:offset+self.fillLevel]
-            sendBytes = len(sendbuf)
-
-            if sendBytes + offset == len(buf):
-                self._buffers.pop(0)
+        if self.fillLevel > 0 and self._buffersSize > 0:
+            # If we're permitted to write at the moment, do so,
+            # with all the data we can send in a single write.
+            sendbufs = []
+            while self.fillLevel > 0 and self._buffers:
+                offset = self._bufferOffset
+                buf = self._buffers[0]
+                sendbuf = buf[offset:offset+self.fillLevel]
+                sendBytes = len(sendbuf)
+
+                if sendBytes + offset == len(buf):
+                    self._buffers.popleft()
+                    self._bufferOffset = 0
+                else:
+                    self._bufferOffset = offset + sendBytes
+                self._buffersSize -= sendBytes
+                self.fillLevel -= sendBytes
+                sendbufs.append(sendbuf)
+
+            if len(sendbufs) == 1:
+                self.consumer.write(sendbufs[0])
             else:
-                self._buffers[0] = (offset + sendBytes, buf)
-            self._buffersSize -= sendBytes
-
-            self.consumer.write(sendbuf)
-            self.fillLevel -= sendBytes
+                self.consumer.write(''.join(sendbufs))
+            if not self.consumer:
+                # Stopped while writing
+                return
 
         if self._buffersSize > 0:
             # If we have data (and we're not already waiting for our next drip
             # interval), wait... this is what actually performs the data
             # throttling.
             if not (self._dripDC or self._paused):
-                self._dripDC = reactor.callLater(self._dripInterval,
-                    self._dripAndTryWrite)
+                self._dripDC = self._scheduleDrip()
         else:
             # No buffer remaining; ask for more data or finish
             if self._finishing:
@@ -196,7 +434,8 @@ class TokenBucketConsumer(log.Loggable):
 
         if self._buffersSize > 0:
             # make sure we release all the buffers, just in case
-            self._buffers = []
+            self._buffers.clear()
+            self._bufferOffset = 0
             self._buffersSize = 0
 
         self.consumer = None
@@ -243,7 +482,7 @@ class TokenBucketConsumer(log.Loggable):
             self.producer.resumeProducing()
 
     def write(self, data):
-        self._buffers.append((0, data))
+        self._buffers.append(data)
         self._buffersSize += len(data)
 
         self._tryWrite()
@@ -276,3 +515,104 @@ class TokenBucketConsumer(log.Loggable):
             else:
                 # we need to wait until we've written the data
                 self._unregister = True
+
+
+class ScheduledTokenBucketConsumer(TokenBucketConsumer):
+    """
+    I am a L{TokenBucketConsumer} dripping in the ticks of a shared
+    L{TimingWheel} instead of with my own timer.
+    """
+
+    def __init__(self, wheel, dripInterval, consumer, maxLevel, fillRate,
+                 fillLevel=0):
+        self._wheel = wheel
+        self._dripInterval = dripInterval
+        TokenBucketConsumer.__init__(self, consumer, maxLevel, fillRate,
+                                     fillLevel)
+
+    def _scheduleDrip(self):
+        return self._wheel.schedule(self._dripInterval, self._dripAndTryWrite)
+
+
+class PacedTokenBucketConsumer(ScheduledTokenBucketConsumer):
+    """
+    I send a file at a multiple of its bitrate once its start was sent,
+    for L{RateControllerAdaptivePlug}. Until the bitrate is known, I let
+    the data through, looking for the bitrate in it.
+
+    @ivar bitrate: the bitrate of the file, None if not known yet
+    @type bitrate: int
+    """
+
+    def __init__(self, plug, consumer, path, bitrate=None, duration=None):
+        self._plug = plug
+        self._path = path
+        self._received = 0  # Bytes written to us
+        self._sniffed = []  # Data looked at to find the bitrate
+        self._sniffedSize = 0
+        self.bitrate = None
+        ScheduledTokenBucketConsumer.__init__(self, plug.wheel,
+                                              plug.dripInterval, consumer,
+                                              UNLIMITED, UNLIMITED, UNLIMITED)
+
+        if not bitrate and duration:
+            size = self._getRange()[2]
+            if size:
+                bitrate = int(size * 8 / duration)
+        if not bitrate:
+            bitrate = plug.getKnownBitrate(path)
+        if bitrate:
+            self._setBitrate(bitrate)
+
+    def getBytesSent(self):
+        return self._received - self._buffersSize
+
+    def write(self, data):
+        if self._sniffed is not None:
+            self._sniff(data)
+        self._received += len(data)
+        ScheduledTokenBucketConsumer.write(self, data)
+
+    def stopProducing(self):
+        if self.consumer is not None and self.bitrate:
+            first, last, size = self._getRange()
+            if last is not None:
+                saved = last - first + 1 - self.getBytesSent()
+            else:
+                saved = self._buffersSize
+            if saved > 0 and self._plug.stats is not None:
+                self.debug("Transfer abandoned, %d bytes not sent", saved)
+                self._plug.stats.onBytesSaved(saved)
+        ScheduledTokenBucketConsumer.stopProducing(self)
+
+    def _getRange(self):
+        # The consumer is usually the request
+        getRange = getattr(self.consumer, 'getResponseRange', None)
+        if getRange is None:
+            return 0, None, None
+        return getRange()
+
+    def _sniff(self, data):
+        self._sniffed.append(data)
+        self._sniffedSize += len(data)
+        bitrate = mediainfo.getBitrate(''.join(self._sniffed),
+                                       self._getRange()[2])
+        if bitrate:
+            self.debug("Found bitrate %d of %s", bitrate, self._path)
+            self._plug.setKnownBitrate(self._path, bitrate)
+            self._setBitrate(bitrate)
+        elif self._sniffedSize >= SNIFF_SIZE:
+            self._sniffed = None
+            if self._plug.fallbackBitrate:
+                self._setBitrate(self._plug.fallbackBitrate)
+
+    def _setBitrate(self, bitrate):
+        self._sniffed = None
+        self.bitrate = bitrate
+        burst = int(bitrate * self._plug.burstDuration / 8)
+        self.fillRate = int(bitrate * self._plug.rateMultiple / 8)
+        self.maxLevel = max(burst, int(2 * self.fillRate * self._dripInterval))
+        self.fillLevel = max(0, burst - self.getBytesSent())
+        self._lastDrip = time.time()
+        self.debug("Sending at %d bytes per second after %d bytes",
+                   self.fillRate, burst)
@@ -57,6 +57,8 @@ class ServerStatistics(object):
         self.requestCountPeakTime = now
         self.finishedRequestCount = 0
         self.totalBytesSent = 0L
+        # Bytes rate control didn't send to clients leaving early
+        self.totalBytesSaved = 0L
 
         # Updated by a call to the update method
         self.meanRequestCount = 0
@@ -69,6 +71,17 @@ class ServerStatistics(object):
         self.bitratePeak = 0
         self.bitratePeakTime = now
 
+        # File reads done off the reactor by the file provider
+        self.readQueueDepth = 0
+        self.readQueueDepthPeak = 0
+        self.totalReadCount = 0
+        # Updated by a call to the update method
+        self.meanReadLatency = 0.0
+        self.readLatencyPeak = 0.0
+
+        self._readLatencies = 0.0
+        self._readLatencyMax = 0.0
+        self._lastReadCount = 0
         self._fileReadRatios = 0.0
         self._lastUpdateTime = now
         self._lastRequestCount = 0
@@ -94,6 +107,37 @@ class ServerStatistics(object):
         return 0.0
     meanFileReadRatio = property(getMeanFileReadRatio)
 
+    def onReadQueued(self):
+        """
+        Called by file providers when they queue a file read.
+        """
+        self.readQueueDepth += 1
+        if self.readQueueDepth > self.readQueueDepthPeak:
+            self.readQueueDepthPeak = self.readQueueDepth
+
+    def onReadDone(self, latency):
+        """
+        Called by file providers when a queued file read is done.
+
+        @param latency: the seconds since the read was queued
+        @type  latency: float
+        """
+        self.readQueueDepth -= 1
+        self.totalReadCount += 1
+        self._readLatencies += latency
+        if latency > self._readLatencyMax:
+            self._readLatencyMax = latency
+
+    def onBytesSaved(self, size):
+        """
+        Called by rate controllers when a client left before they sent
+        it the whole file.
+
+        @param size: the bytes not sent
+        @type  size: int
+        """
+        self.totalBytesSaved += size
+
     def _update(self):
         now = time.time()
         updateDelta = now - self._lastUpdateTime
@@ -145,6 +189,22 @@ class ServerStatistics(object):
 
         # Update bytes read statistic key too
         self._set("total-bytes-sent", self.totalBytesSent)
+        self._set("total-bytes-saved", self.totalBytesSaved)
+
+        # Update file read statistics, the latency is for the last period
+        readCount = self.totalReadCount - self._lastReadCount
+        if readCount > 0:
+            self.meanReadLatency = self._readLatencies / readCount
+        else:
+            self.meanReadLatency = 0.0
+        self.readLatencyPeak = self._readLatencyMax
+        self._set("read-queue-depth", self.readQueueDepth)
+        self._set("read-queue-depth-peak", self.readQueueDepthPeak)
+        self._set("mean-read-latency", self.meanReadLatency)
+        self._set("read-latency-peak", self.readLatencyPeak)
+        self._readLatencies = 0.0
+        self._readLatencyMax = 0.0
+        self._lastReadCount = self.totalReadCount
 
         self._lastRequestCount = self.totalRequestCount
         self._lastBytesSent = self.totalBytesSent
@@ -202,11 +262,16 @@ class ServerStatistics(object):
             FRR: File Read Ratio
             MBR: Mean Bitrate
             CBR: Current Bitrate
+            RQD: Read Queue Depth
+            MRL: Mean Read Latency
+            BSV: Bytes Saved by rate control
         """
         log.debug("stats-http-server",
                   "TRC: %s; CRC: %d; CRR: %.2f; MRR: %.2f; "
-                  "FRR: %.4f; MBR: %d; CBR: %d",
+                  "FRR: %.4f; MBR: %d; CBR: %d; RQD: %d; MRL: %.4f; "
+                  "BSV: %d",
                   self.totalRequestCount, self.currentRequestCount,
                   self.currentRequestRate, self.meanRequestRate,
                   self.meanFileReadRatio, self.meanBitrate,
-                  self.currentBitrate)
+                  self.currentBitrate, self.readQueueDepth,
+                  self.meanReadLatency, self.totalBytesSaved)
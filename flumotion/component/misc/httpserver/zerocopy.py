@@ -0,0 +1,77 @@
+# -*- test-case-name: flumotion.test.test_component_httpserver -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""zero-copy file transfers.
+Access to sendfile(2), which copies data from a file to a socket inside
+the kernel. Python 2 doesn't expose it, so on Linux it's called through
+ctypes; L{HAS_SENDFILE} tells whether it's available.
+"""
+
+import os
+import sys
+
+__version__ = "$Rev$"
+
+HAS_SENDFILE = False
+sendfile = None
+
+try:
+    sendfile = os.sendfile
+    HAS_SENDFILE = True
+except AttributeError:
+    pass
+
+if not HAS_SENDFILE and sys.platform.startswith('linux'):
+    try:
+        import ctypes
+        import ctypes.util
+
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _sendfile = _libc.sendfile64
+        _sendfile.argtypes = (ctypes.c_int, ctypes.c_int,
+                              ctypes.POINTER(ctypes.c_int64),
+                              ctypes.c_size_t)
+        _sendfile.restype = ctypes.c_ssize_t
+
+        def sendfile(outFd, inFd, offset, count):
+            """
+            Copy data from a file to a socket, as os.sendfile does.
+
+            @param outFd:  the descriptor to write to
+            @type  outFd:  int
+            @param inFd:   the descriptor of the file to read from
+            @type  inFd:   int
+            @param offset: the position in the file to read from; the
+                           position of inFd is not changed
+            @type  offset: long
+            @param count:  the maximum number of bytes to copy
+            @type  count:  int
+
+            @returns: the number of bytes copied
+            @raises OSError: if the copy failed, with EAGAIN if the socket
+                             is not ready for writing
+            """
+            position = ctypes.c_int64(offset)
+            sent = _sendfile(outFd, inFd, ctypes.byref(position), count)
+            if sent < 0:
+                code = ctypes.get_errno()
+                raise OSError(code, os.strerror(code))
+            return sent
+
+        HAS_SENDFILE = True
+    except (ImportError, AttributeError, OSError, TypeError):
+        pass
@@ -0,0 +1,402 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_porter -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""porter acceptor processes.
+When the porter runs with acceptor processes, each of them listens on
+the porter's port with SO_REUSEPORT, so the kernel spreads incoming
+connections over them. An acceptor reads the first line of each request
+and looks up the destination in its copy of the porter's paths and
+prefixes; the connection is then passed back to the porter, which hands
+it to the streamer over the connection the streamer logged in on.
+
+The porter and each acceptor talk over a socketpair. The porter sends
+lines updating the acceptor's copy of the mappings, and acknowledges
+every connection it gets with a 'sent' or 'failed' line; the acceptor
+sends the connections as FD-passing messages whose data is the request
+number, the avatar key and the buffered request. Every few seconds,
+the acceptor also sends 'stats' lines with the statistics it recorded
+since the previous ones, which the porter adds to its own.
+"""
+
+import errno
+import os
+import socket
+import sys
+import urllib
+
+from twisted.internet import defer, error, protocol, reactor
+from twisted.protocols import basic
+
+from flumotion.common import log
+from flumotion.common.poller import Poller
+from flumotion.component.misc.porter import pathtree, stats
+from flumotion.configure import configure
+from flumotion.twisted import fdserver
+from flumotion.twisted import reflect
+
+__version__ = "$Rev$"
+
+# Not exported by the socket module in python 2
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+# The file descriptor the acceptor gets its end of the socketpair on
+CHANNEL_FD = 3
+
+# Exit status of an acceptor that could not listen on the port
+EXIT_CANNOT_LISTEN = 3
+
+# How often an acceptor sends its statistics to the porter, in seconds
+STATS_INTERVAL = 5
+
+_BOOTSTRAP = """
+import sys
+sys.path.insert(0, sys.argv[1])
+from flumotion.common import boot
+boot.boot('flumotion.component.misc.porter.acceptor.main',
+          gst=False, installReactor=False)
+"""
+
+
+def _quote(path):
+    return urllib.quote(path, safe='')
+
+
+# Acceptor process side
+
+
+class ReusePortServerPort(fdserver.PassableServerPort):
+    """
+    A listening port that other processes can listen on as well.
+    """
+
+    def createInternetSocket(self):
+        s = fdserver.PassableServerPort.createInternetSocket(self)
+        s.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        return s
+
+
+class RemoteAvatar(object):
+    """
+    I stand in for a L{porter.PorterAvatar} in an acceptor process.
+    """
+
+    def __init__(self, key, channel):
+        self.key = key
+        self.avatarId = 'avatar %d' % key
+        self.attached = True
+        self._channel = channel
+
+    def isAttached(self):
+        return self.attached
+
+    def queueFileDescriptor(self, fileno, data):
+        return self._channel.handOff(self.key, fileno, data)
+
+
+class Acceptor(log.Loggable):
+    """
+    I take the place of the L{porter.Porter} for the porter protocols
+    running in an acceptor process, finding destinations in my copy of
+    the porter's mappings.
+    """
+
+    logCategory = 'porter-acceptor'
+
+    def __init__(self):
+        self._mappings = {}
+        self._prefixes = pathtree.PathTree()
+        self._avatars = {}
+        # avatarId -> key, for the statistics
+        self._avatarKeys = {}
+        # the statistics recorded since they were last taken
+        self._stats = stats.PorterStats()
+
+    def getStats(self):
+        return self._stats
+
+    def takeStats(self):
+        """
+        Take the statistics recorded since the last call.
+
+        @returns: a list of (mountPoint, avatarKey, state) tuples, see
+                  L{stats.PorterStats.getStates}
+        """
+        states = [(mountPoint, self._avatarKeys.get(avatarId), state)
+                  for mountPoint, avatarId, state in self._stats.getStates()]
+        self._stats.reset()
+        return states
+
+    def getAvatar(self, key, channel):
+        if key not in self._avatars:
+            avatar = RemoteAvatar(key, channel)
+            self._avatars[key] = avatar
+            self._avatarKeys[avatar.avatarId] = key
+        return self._avatars[key]
+
+    def setPath(self, path, avatar):
+        self._mappings[path] = avatar
+
+    def removePath(self, path):
+        self._mappings.pop(path, None)
+
+    def setPrefix(self, prefix, avatar):
+        self._prefixes[prefix] = avatar
+
+    def removePrefix(self, prefix):
+        if prefix in self._prefixes:
+            del self._prefixes[prefix]
+
+    def logout(self, key):
+        avatar = self._avatars.pop(key, None)
+        if avatar:
+            avatar.attached = False
+
+    def findDestination(self, path):
+        return self.lookupDestination(path)[1]
+
+    def lookupDestination(self, path):
+        if path in self._mappings:
+            return path, self._mappings[path]
+        prefix = self._prefixes.longestPrefix(path)
+        if prefix is None:
+            return None, None
+        return prefix, self._prefixes[prefix]
+
+
+class AcceptorChannel(basic.LineReceiver, log.Loggable):
+    """
+    The acceptor's end of the channel to the porter.
+    """
+
+    logCategory = 'porter-acceptor'
+    delimiter = '\n'
+
+    def __init__(self, acceptor):
+        self._acceptor = acceptor
+        self._serial = 0
+        self._pending = {}
+
+    def handOff(self, key, fileno, data):
+        """
+        Pass a client connection to the porter.
+
+        @returns: a deferred firing once the porter has queued the
+                  connection to the streamer, or failing if it couldn't
+        """
+        self._serial += 1
+        serial = self._serial
+        d = self._pending[serial] = defer.Deferred()
+
+        def queueFailed(failure):
+            if serial in self._pending:
+                self._pending.pop(serial).errback(failure)
+        self.transport.queueFileDescriptor(
+            fileno, '%d %d %s' % (serial, key, data)).addErrback(queueFailed)
+        return d
+
+    def sendStats(self):
+        """
+        Send the statistics recorded since the last time to the porter.
+        """
+        for mountPoint, key, state in self._acceptor.takeStats():
+            if mountPoint is None:
+                mountPoint = '-'
+            if key is None:
+                key = '-'
+            self.sendLine('stats %s %s %s' % (key, _quote(mountPoint),
+                                              state))
+
+    def lineReceived(self, line):
+        args = line.split(' ')
+        handler = getattr(self, 'do_' + args[0], None)
+        if not handler:
+            self.warning("Unknown command from porter: %r", line)
+            return
+        handler(*args[1:])
+
+    def do_path(self, key, path):
+        avatar = self._acceptor.getAvatar(int(key), self)
+        self._acceptor.setPath(urllib.unquote(path), avatar)
+
+    def do_unpath(self, path):
+        self._acceptor.removePath(urllib.unquote(path))
+
+    def do_prefix(self, key, prefix):
+        avatar = self._acceptor.getAvatar(int(key), self)
+        self._acceptor.setPrefix(urllib.unquote(prefix), avatar)
+
+    def do_unprefix(self, prefix):
+        self._acceptor.removePrefix(urllib.unquote(prefix))
+
+    def do_logout(self, key):
+        self._acceptor.logout(int(key))
+
+    def do_sent(self, serial):
+        d = self._pending.pop(int(serial), None)
+        if d:
+            d.callback(None)
+
+    def do_failed(self, serial):
+        d = self._pending.pop(int(serial), None)
+        if d:
+            d.errback(OSError(errno.EAGAIN,
+                              'Porter could not pass the connection'))
+
+    def connectionLost(self, reason):
+        self.info("Lost connection to the porter, stopping")
+        pending, self._pending = self._pending, {}
+        for d in pending.values():
+            d.errback(OSError(errno.EPIPE, 'Lost connection to the porter'))
+        if reactor.running:
+            reactor.stop()
+
+
+def main(args):
+    """
+    Run an acceptor process; started by the porter.
+    """
+    port, interface, protocolName = int(args[2]), args[3], args[4]
+
+    acceptor = Acceptor()
+    channel = AcceptorChannel(acceptor)
+    sock = socket.fromfd(CHANNEL_FD, socket.AF_UNIX, socket.SOCK_STREAM)
+    os.close(CHANNEL_FD)
+    transport = fdserver.FDServer(sock, channel, None, None, 0, reactor)
+    channel.makeConnection(transport)
+
+    # imported here; the porter module imports this one
+    from flumotion.component.misc.porter import porter
+    proto = reflect.namedAny(protocolName)
+    factory = porter.PorterProtocolFactory(acceptor, proto)
+    try:
+        reactor.listenWith(ReusePortServerPort, port, factory,
+                           interface=interface)
+    except error.CannotListenError, e:
+        log.warning('porter-acceptor', "Failed to listen on port %d: %s",
+                    port, log.getExceptionMessage(e))
+        return EXIT_CANNOT_LISTEN
+
+    log.info('porter-acceptor', "Acceptor %d listening on port %d",
+             os.getpid(), port)
+    Poller(channel.sendStats, STATS_INTERVAL)
+    reactor.run()
+    return 0
+
+
+# Porter side
+
+
+class AcceptorController(basic.LineReceiver, log.Loggable):
+    """
+    The porter's end of the channel to an acceptor process.
+    """
+
+    logCategory = 'porter'
+    delimiter = '\n'
+    # the statistics of a destination take a line
+    MAX_LENGTH = 256 * 1024
+
+    def __init__(self, porter):
+        self._porter = porter
+        self.process = None
+
+    def send(self, *args):
+        if self.transport and self.transport.connected:
+            self.transport.write(' '.join(map(str, args)) + '\n')
+
+    def pathChanged(self, path, key):
+        if key is None:
+            self.send('unpath', _quote(path))
+        else:
+            self.send('path', key, _quote(path))
+
+    def prefixChanged(self, prefix, key):
+        if key is None:
+            self.send('unprefix', _quote(prefix))
+        else:
+            self.send('prefix', key, _quote(prefix))
+
+    def avatarLoggedOut(self, key):
+        self.send('logout', key)
+
+    def fileDescriptorsReceived(self, fds, message):
+        serial, key, data = message.split(' ', 2)
+        for fd in fds:
+            avatar = self._porter.getAvatar(int(key))
+            if not avatar or not avatar.isAttached():
+                os.close(fd)
+                self.send('failed', serial)
+                continue
+            d = avatar.queueFileDescriptor(fd, data)
+            # the queue holds its own copy of the fd
+            os.close(fd)
+            d.addCallbacks(lambda _, s: self.send('sent', s),
+                           lambda f, s: self.send('failed', s),
+                           callbackArgs=(serial, ), errbackArgs=(serial, ))
+
+    def lineReceived(self, line):
+        args = line.split(' ')
+        if args[0] != 'stats' or len(args) < 4:
+            self.warning("Unexpected data from acceptor: %r", line)
+            return
+        key, mountPoint, state = args[1], args[2], ' '.join(args[3:])
+        avatarId = None
+        if key != '-':
+            avatar = self._porter.getAvatar(int(key))
+            if avatar:
+                avatarId = avatar.avatarId
+        if mountPoint == '-':
+            mountPoint = None
+        else:
+            mountPoint = urllib.unquote(mountPoint)
+        self._porter.getStats().mergeState(mountPoint, avatarId, state)
+
+
+class AcceptorProcessProtocol(protocol.ProcessProtocol):
+
+    def __init__(self, porter, controller):
+        self._porter = porter
+        self._controller = controller
+
+    def processEnded(self, status):
+        self._porter.acceptorEnded(self._controller, status)
+
+
+def spawnAcceptor(porter, port, interface, protocolName):
+    """
+    Start an acceptor process.
+
+    @returns: the L{AcceptorController} for the new process
+    """
+    parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    parent.setblocking(0)
+    controller = AcceptorController(porter)
+    transport = fdserver.FDReceiver(parent, controller, None, None,
+                                    child.fileno(), reactor)
+    controller.makeConnection(transport)
+
+    env = {}
+    env.update(os.environ)
+    env['FLU_DEBUG'] = log.getDebug()
+    argv = [sys.executable, '-c', _BOOTSTRAP, configure.pythondir,
+            str(port), interface, protocolName]
+    controller.process = reactor.spawnProcess(
+        AcceptorProcessProtocol(porter, controller), sys.executable,
+        args=argv, env=env, childFDs={0: 0, 1: 1, 2: 2,
+                                      CHANNEL_FD: child.fileno()})
+    child.close()
+    return controller
@@ -0,0 +1,162 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_porter -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""path prefix tree.
+A tree of path segments used by the porter to find the longest
+registered prefix of a request path without looking at every
+registered prefix.
+"""
+
+import bisect
+
+__version__ = "$Rev$"
+
+
+class _Node(object):
+    """
+    A node in the prefix tree, reached by consuming a number of complete
+    path segments (each one followed by a '/').
+
+    @ivar children: map of the next complete segment -> L{_Node}
+    @ivar partials: map of prefix tails (the part of a prefix after its
+                    last '/') ending below this node -> value
+    @ivar lengths:  sorted list of the distinct lengths of the keys in
+                    partials
+    """
+    __slots__ = ('children', 'partials', 'lengths')
+
+    def __init__(self):
+        self.children = {}
+        self.partials = {}
+        self.lengths = []
+
+    def isEmpty(self):
+        return not self.children and not self.partials
+
+
+class PathTree(object):
+    """
+    I map string prefixes to values, and find the value registered for
+    the longest prefix of a given path.
+
+    Matching has the same semantics as str.startswith, so the prefix
+    '/live' matches both '/live/stream' and '/livestream', and the empty
+    prefix matches every path. Lookups walk
+    one node per path segment, so their cost depends on the depth of the
+    path and not on how many prefixes are registered.
+    """
+
+    def __init__(self):
+        self._root = _Node()
+        self._prefixes = {}
+
+    def __len__(self):
+        return len(self._prefixes)
+
+    def __contains__(self, prefix):
+        return prefix in self._prefixes
+
+    def __getitem__(self, prefix):
+        return self._prefixes[prefix]
+
+    def __setitem__(self, prefix, value):
+        segments = prefix.split('/')
+        tail = segments.pop()
+        node = self._root
+        for segment in segments:
+            child = node.children.get(segment)
+            if child is None:
+                child = node.children[segment] = _Node()
+            node = child
+        if tail not in node.partials:
+            length = len(tail)
+            i = bisect.bisect_left(node.lengths, length)
+            if i == len(node.lengths) or node.lengths[i] != length:
+                node.lengths.insert(i, length)
+        node.partials[tail] = value
+        self._prefixes[prefix] = value
+
+    def __delitem__(self, prefix):
+        del self._prefixes[prefix]
+        segments = prefix.split('/')
+        tail = segments.pop()
+        path = [(None, self._root)]
+        for segment in segments:
+            path.append((segment, path[-1][1].children[segment]))
+        node = path[-1][1]
+        del node.partials[tail]
+        length = len(tail)
+        for key in node.partials:
+            if len(key) == length:
+                break
+        else:
+            node.lengths.remove(length)
+        # prune the nodes that no longer lead to any prefix
+        while len(path) > 1 and path[-1][1].isEmpty():
+            segment, _ = path.pop()
+            del path[-1][1].children[segment]
+
+    def get(self, prefix, default=None):
+        return self._prefixes.get(prefix, default)
+
+    def keys(self):
+        return self._prefixes.keys()
+
+    def values(self):
+        return self._prefixes.values()
+
+    def items(self):
+        return self._prefixes.items()
+
+    def longestPrefix(self, path):
+        """
+        Find the longest registered prefix of the given path.
+
+        @param path: the path to look up
+        @type  path: str
+
+        @returns: the longest matching prefix, or None
+        """
+        found = None
+        prefix = ''
+        node = self._root
+        segments = path.split('/')
+        for segment in segments:
+            if node.partials:
+                for length in reversed(node.lengths):
+                    if segment[:length] in node.partials:
+                        found = prefix + segment[:length]
+                        break
+            node = node.children.get(segment)
+            if node is None:
+                break
+            prefix = prefix + segment + '/'
+        return found
+
+    def lookup(self, path):
+        """
+        Find the value registered for the longest prefix of the given path.
+
+        @param path: the path to look up
+        @type  path: str
+
+        @returns: the value for the longest matching prefix, or None
+        """
+        prefix = self.longestPrefix(path)
+        if prefix is None:
+            return None
+        return self._prefixes[prefix]
@@ -15,6 +15,7 @@
 #
 # Headers in this file shall remain intact.
 
+import itertools
 import os
 import random
 import socket
@@ -28,9 +29,11 @@ from twisted.spread import pb
 from zope.interface import implements
 
 from flumotion.common import medium, log, messages, errors
+from flumotion.common.poller import Poller
 from flumotion.common.i18n import N_, gettexter
 from flumotion.component import component
 from flumotion.component.component import moods
+from flumotion.component.misc.porter import acceptor, pathtree, stats
 from flumotion.twisted import fdserver, checkers
 from flumotion.twisted import reflect
 
@@ -41,8 +44,12 @@ T_ = gettexter()
 class PorterAvatar(pb.Avatar, log.Loggable):
     """
     An Avatar in the porter representing a streamer
+
+    @ivar key: a number identifying this avatar to the acceptor processes
     """
 
+    key = None
+
     def __init__(self, avatarId, porter, mind):
         self.avatarId = avatarId
         self.porter = porter
@@ -57,6 +64,15 @@ class PorterAvatar(pb.Avatar, log.Loggable):
     def logout(self):
         self.debug("porter client %s logging out", self.avatarId)
         self.mind = None
+        self.porter.avatarLoggedOut(self)
+
+    def queueFileDescriptor(self, fileno, data):
+        """
+        Queue a client connection to be passed on to this streamer.
+
+        @rtype: L{twisted.internet.defer.Deferred}
+        """
+        return self.mind.broker.transport.queueFileDescriptor(fileno, data)
 
     def perspective_registerPath(self, path):
         self.log("Perspective called: registering path \"%s\"" % path)
@@ -77,6 +93,17 @@ class PorterAvatar(pb.Avatar, log.Loggable):
     def perspective_getPort(self):
         return self.porter._iptablesPort
 
+    def perspective_setMaxFileDescriptors(self, count):
+        """
+        Called by streamers that can receive several FDs in one message.
+
+        @param count: the maximum number of FDs per message
+        @type  count: int
+        """
+        count = max(1, min(count, fdserver.MAX_FDS_PER_MESSAGE))
+        self.log("Perspective called: sending up to %d FDs at once", count)
+        self.mind.broker.transport.maxFileDescriptorsPerMessage = count
+
 
 class PorterRealm(log.Loggable):
     """
@@ -97,6 +124,7 @@ class PorterRealm(log.Loggable):
                  avatarId, mind, interfaces)
         if pb.IPerspective in interfaces:
             avatar = PorterAvatar(avatarId, self.porter, mind)
+            self.porter.addAvatar(avatar)
             return pb.IPerspective, avatar, avatar.logout
         else:
             raise NotImplementedError("no interface")
@@ -114,6 +142,13 @@ class PorterMedium(component.BaseComponentMedium):
                 self.comp._password, self.comp._iptablesPort,
                 self.comp._interface, self.comp._external_interface)
 
+    def remote_getPorterStats(self):
+        """
+        Return the porter's request statistics, as described in
+        L{stats.PorterStats.getSnapshot}.
+        """
+        return self.comp.getStats().getSnapshot()
+
 
 class Porter(component.BaseComponent, log.Loggable):
     """
@@ -121,15 +156,25 @@ class Porter(component.BaseComponent, log.Loggable):
     The porter is what actually deals with incoming connections on a socket.
     It decides which streamer to direct the connection to, then passes the FD
     (along with some amount of already-read data) to the appropriate streamer.
+
+    Accepting and reading the first line can be spread over several
+    acceptor processes, see L{acceptor}.
     """
 
     componentMediumClass = PorterMedium
 
+    # Seconds to wait before restarting an acceptor process that died
+    ACCEPTOR_RESTART_DELAY = 1.0
+
+    # Seconds between updates of the statistics in the UI state
+    STATS_UPDATE_INTERVAL = 5
+
     def init(self):
         # We maintain a map of path -> avatar (the underlying transport is
-        # accessible from the avatar, we need this for FD-passing)
+        # accessible from the avatar, we need this for FD-passing), and a
+        # tree of prefix -> avatar for the longest-prefix lookups
         self._mappings = {}
-        self._prefixes = {}
+        self._prefixes = pathtree.PathTree()
 
         self._socketlistener = None
 
@@ -143,6 +188,60 @@ class Porter(component.BaseComponent, log.Loggable):
         self._interface = ''
         self._external_interface = ''
 
+        # Avatars by key, and the acceptor processes we pass their
+        # mappings to
+        self._avatars = {}
+        self._avatarKeys = itertools.count(1)
+        self._acceptorProcesses = 0
+        self._acceptors = []
+        self._protocolName = None
+        self._stopping = False
+
+        self._stats = stats.PorterStats()
+        self.uiState.addKey('porter-stats', None)
+        self._statsPoller = Poller(self._pollStats,
+                                   self.STATS_UPDATE_INTERVAL, start=False)
+
+    def getStats(self):
+        """
+        @rtype: L{stats.PorterStats}
+        """
+        return self._stats
+
+    def _pollStats(self):
+        self.uiState.set('porter-stats', self._stats.getSnapshot())
+
+    def observerAppend(self, observer, num):
+        component.BaseComponent.observerAppend(self, observer, num)
+        if not self._statsPoller.running:
+            self._statsPoller.start(immediately=True)
+
+    def observerRemove(self, observer, num):
+        component.BaseComponent.observerRemove(self, observer, num)
+        if num == 0:
+            self._statsPoller.stop()
+
+    def addAvatar(self, avatar):
+        """
+        Give a newly logged in avatar a key, by which acceptor processes
+        refer to it.
+
+        @type avatar: L{PorterAvatar}
+        """
+        avatar.key = self._avatarKeys.next()
+        self._avatars[avatar.key] = avatar
+
+    def getAvatar(self, key):
+        """
+        @returns: the avatar with the given key, or None
+        """
+        return self._avatars.get(key)
+
+    def avatarLoggedOut(self, avatar):
+        self._avatars.pop(avatar.key, None)
+        for controller in self._acceptors:
+            controller.avatarLoggedOut(avatar.key)
+
     def registerPath(self, path, avatar):
         """
         Register a path as being served by a streamer represented by this
@@ -159,6 +258,8 @@ class Porter(component.BaseComponent, log.Loggable):
             self.warning("Replacing existing mapping for path \"%s\"" % path)
 
         self._mappings[path] = avatar
+        for controller in self._acceptors:
+            controller.pathChanged(path, avatar.key)
 
     def deregisterPath(self, path, avatar):
         """
@@ -174,6 +275,8 @@ class Porter(component.BaseComponent, log.Loggable):
             if self._mappings[path] == avatar:
                 self.debug("Removing porter mapping for \"%s\"" % path)
                 del self._mappings[path]
+                for controller in self._acceptors:
+                    controller.pathChanged(path, None)
             else:
                 self.warning(
                     "Mapping not removed: refers to a different avatar")
@@ -186,15 +289,24 @@ class Porter(component.BaseComponent, log.Loggable):
         with a specified prefix. Where there are multiple matching prefixes,
         the longest is selected.
 
+        The empty prefix is not a valid prefix and is ignored.
+
         @param avatar: The avatar being registered
         @type  avatar: L{PorterAvatar}
         """
 
+        if not prefix:
+            # it would match every path, even invalid ones; use '/'
+            self.warning("Not setting empty prefix for porter")
+            return
+
         self.debug("Setting prefix \"%s\" for porter", prefix)
         if prefix in self._prefixes:
             self.warning("Overwriting prefix")
 
         self._prefixes[prefix] = avatar
+        for controller in self._acceptors:
+            controller.prefixChanged(prefix, avatar.key)
 
     def deregisterPrefix(self, prefix, avatar):
         """
@@ -212,22 +324,18 @@ class Porter(component.BaseComponent, log.Loggable):
         if self._prefixes[prefix] == avatar:
             self.debug("Removing prefix destination from porter")
             del self._prefixes[prefix]
+            for controller in self._acceptors:
+                controller.prefixChanged(prefix, None)
         else:
             self.warning(
                 "Not removing prefix destination: expected avatar not found")
 
     def findPrefixMatch(self, path):
-        found = None
-        # TODO: Horribly inefficient. Replace with pathtree code.
-        for prefix in self._prefixes.keys():
-            self.log("Checking: %r, %r" % (prefix, path))
-            if (path.startswith(prefix) and
-                (not found or len(found) < len(prefix))):
-                found = prefix
-        if found:
-            return self._prefixes[found]
-        else:
-            return None
+        """
+        Find the avatar registered for the longest prefix of this path.
+        @returns: The Avatar for this prefix, or None.
+        """
+        return self._prefixes.lookup(path)
 
     def findDestination(self, path):
         """
@@ -240,6 +348,19 @@ class Porter(component.BaseComponent, log.Loggable):
         else:
             return self.findPrefixMatch(path)
 
+    def lookupDestination(self, path):
+        """
+        Find the mount point, that is the registered path or longest
+        prefix, matching this path and its destination Avatar.
+        @returns: a (mountPoint, avatar) tuple, or (None, None).
+        """
+        if path in self._mappings:
+            return path, self._mappings[path]
+        prefix = self._prefixes.longestPrefix(path)
+        if prefix is None:
+            return None, None
+        return prefix, self._prefixes[prefix]
+
     def generateSocketPath(self):
         """
         Generate a socket pathname in an appropriate location
@@ -292,8 +413,53 @@ class Porter(component.BaseComponent, log.Loggable):
         # interface
         self._external_interface = props.get('external-interface',
             self._interface)
+        self._acceptorProcesses = props.get('acceptor-processes', 0)
+
+    def _startAcceptor(self):
+        controller = acceptor.spawnAcceptor(self, self._port, self._interface,
+                                            self._protocolName)
+        self._acceptors.append(controller)
+        # give it a copy of all our mappings
+        for path, avatar in self._mappings.items():
+            controller.pathChanged(path, avatar.key)
+        for prefix, avatar in self._prefixes.items():
+            controller.prefixChanged(prefix, avatar.key)
+        for avatar in self._mappings.values() + self._prefixes.values():
+            if not avatar.isAttached():
+                controller.avatarLoggedOut(avatar.key)
+
+    def acceptorEnded(self, controller, status):
+        """
+        Called when an acceptor process exits.
+        """
+        if controller in self._acceptors:
+            self._acceptors.remove(controller)
+        if controller.transport:
+            controller.transport.loseConnection()
+        if self._stopping:
+            return
+
+        exitCode = getattr(status.value, 'exitCode', None)
+        if exitCode == acceptor.EXIT_CANNOT_LISTEN:
+            self.warning("Acceptor failed to listen on interface %r on "
+                         "port %d", self._interface, self._port)
+            m = messages.Error(T_(N_(
+                "Network error: TCP port %d is not available."), self._port),
+                mid='acceptor-listen')
+            self.addMessage(m)
+            self.setMood(moods.sad)
+            return
+
+        self.warning("Acceptor process ended unexpectedly (%s), restarting",
+                     log.getFailureMessage(status))
+        reactor.callLater(self.ACCEPTOR_RESTART_DELAY, self._startAcceptor)
 
     def do_stop(self):
+        self._stopping = True
+        self._statsPoller.stop()
+        for controller in self._acceptors[:]:
+            # the acceptor stops when its connection to us goes away
+            controller.transport.loseConnection()
         d = None
         if self._socketlistener:
             # stopListening() calls (via a callLater) connectionLost(), which
@@ -346,6 +512,15 @@ class Porter(component.BaseComponent, log.Loggable):
                 self._porterProtocol)
             proto = HTTPPorterProtocol
 
+        # With acceptor processes, they listen for the incoming requests.
+        if self._acceptorProcesses:
+            self._protocolName = '%s.%s' % (proto.__module__, proto.__name__)
+            for i in range(self._acceptorProcesses):
+                self._startAcceptor()
+            self.info("Started %d acceptor processes for port %d",
+                      self._acceptorProcesses, self._port)
+            return
+
         # And of course we also want to listen for incoming requests in the
         # appropriate protocol (HTTP, RTSP, etc.)
         factory = PorterProtocolFactory(self, proto)
@@ -386,6 +561,10 @@ class PorterProtocol(protocol.Protocol, log.Loggable):
     We can't guarantee that we read precisely a line, so the buffer we
     accumulate will actually be larger than what we actually parse.
 
+    Incoming data is kept as a list of chunks and only the newly received
+    chunk is searched for a delimiter, so a first line that trickles in
+    byte by byte is not rescanned or recopied on every read.
+
     @cvar MAX_SIZE:   the maximum number of bytes allowed for the first line
     @cvar delimiters: a list of valid line delimiters I check for
     """
@@ -399,15 +578,20 @@ class PorterProtocol(protocol.Protocol, log.Loggable):
     # client should only ever be connected for a fraction of a second.
     PORTER_CLIENT_TIMEOUT = 30
 
-    # In fact, because we check \r, we'll never need to check for \r\n - we
-    # leave this in as \r\n is the more correct form. At the other end, this
-    # gets processed by a full protocol implementation, so being flexible hurts
-    # us not at all
+    # The first line ends at the first \r or \n; a \r immediately
+    # followed by \n is treated as a single \r\n delimiter. At the other
+    # end, this gets processed by a full protocol implementation, so being
+    # flexible hurts us not at all
     delimiters = ['\r\n', '\n', '\r']
 
     def __init__(self, porter):
         self._buffer = ''
+        self._chunks = []
+        self._received = 0
         self._porter = porter
+        self._stats = porter.getStats()
+        self._acceptTime = time.time()
+        self._mountPoint = None
         self.requestId = None # a string that should identify the request
 
         self._timeoutDC = reactor.callLater(self.PORTER_CLIENT_TIMEOUT,
@@ -433,22 +617,36 @@ class PorterProtocol(protocol.Protocol, log.Loggable):
             self._timeoutDC.cancel()
             self._timeoutDC = None
 
+    def _findDelimiter(self, data):
+        """
+        Return the offset of the first line delimiter character in data,
+        or -1 if there is none.
+        """
+        cr = data.find('\r')
+        lf = data.find('\n')
+        if cr == -1:
+            return lf
+        if lf == -1:
+            return cr
+        return min(cr, lf)
+
     def dataReceived(self, data):
-        self._buffer = self._buffer + data
-        self.log("Got data, buffer now \"%s\"" % self._buffer)
-        # We accept more than just '\r\n' (the true HTTP line end) in the
-        # interests of compatibility.
-        for delim in self.delimiters:
-            try:
-                line, remaining = self._buffer.split(delim, 1)
-                break
-            except ValueError:
-                # We didn't find this delimiter; continue with the others.
-                pass
-        else:
+        if self._buffer:
+            # We already handed off the first line; ignore anything else.
+            return
+        offset = self._received
+        self._chunks.append(data)
+        self._received += len(data)
+        self.log("Got %d bytes of data, %d bytes buffered",
+                 len(data), self._received)
+
+        # Only the new chunk needs to be searched: the previous ones are
+        # known not to contain a delimiter.
+        pos = self._findDelimiter(data)
+        if pos == -1:
             # Failed to find a valid delimiter.
             self.log("No valid delimiter found")
-            if len(self._buffer) > self.MAX_SIZE:
+            if self._received > self.MAX_SIZE:
 
                 # PROBE: dropping
                 self.debug("[fd %5d] (ts %f) (request-id %r) dropping, "
@@ -456,14 +654,42 @@ class PorterProtocol(protocol.Protocol, log.Loggable):
                            self.transport.fileno(), time.time(),
                            self.requestId)
 
+                self._stats.requestRejected(None, None,
+                                            stats.REJECT_BUFFER_EXCEEDED)
                 return self.transport.loseConnection()
             else:
                 # No delimiter found; haven't reached the length limit yet.
                 # Wait for more data.
                 return
 
-        # Got a line. self._buffer is still our entire buffer, should be
-        # provided to the slaved process.
+        # We have a complete line; join the chunks exactly once.
+        buffer = ''.join(self._chunks)
+        self._chunks = []
+        end = offset + pos
+        # We accept more than just '\r\n' (the true HTTP line end) in the
+        # interests of compatibility.
+        for delim in self.delimiters:
+            if buffer.startswith(delim, end):
+                break
+        line = buffer[:end]
+        remaining = buffer[end + len(delim):]
+        self._buffer = buffer
+        self.lineReceived(line, delim, remaining)
+
+    def lineReceived(self, line, delim, remaining):
+        """
+        Handle the complete first line of the request, and pass the
+        connection on to the streamer it is directed to.
+
+        @param line:      the first line, without its delimiter
+        @type  line:      str
+        @param delim:     the delimiter that ended the line
+        @type  delim:     str
+        @param remaining: the data received after the delimiter
+        @type  remaining: str
+        """
+        # self._buffer is still our entire buffer, should be provided to the
+        # slaved process.
         parsed = self.parseLine(line)
         if not parsed:
             self.log("Couldn't parse the first line")
@@ -490,12 +716,21 @@ class PorterProtocol(protocol.Protocol, log.Loggable):
 
         # Ok, we have an identifier. Is it one we know about, or do we have
         # a default destination?
-        destinationAvatar = self._porter.findDestination(identifier)
+        mountPoint, destinationAvatar = \
+            self._porter.lookupDestination(identifier)
+        self._mountPoint = mountPoint
+        avatarId = destinationAvatar and destinationAvatar.avatarId
+        self._stats.requestParsed(mountPoint, avatarId,
+                                  time.time() - self._acceptTime,
+                                  self._received)
 
         if not destinationAvatar or not destinationAvatar.isAttached():
             if destinationAvatar:
                 self.debug("There was an avatar, but it logged out?")
 
+            self._stats.requestRejected(mountPoint, avatarId,
+                                        stats.REJECT_NOT_FOUND)
+
             # PROBE: no destination; see send fd
             self.debug(
                 "[fd %5d] (ts %f) (request-id %r) no destination avatar found",
@@ -515,21 +750,28 @@ class PorterProtocol(protocol.Protocol, log.Loggable):
                    self.transport.fileno(), time.time(), self.requestId,
                    destinationAvatar.avatarId)
 
-        # TODO: Check out blocking characteristics of sendFileDescriptor, fix
-        # if it blocks.
-        try:
-            destinationAvatar.mind.broker.transport.sendFileDescriptor(
-                self.transport.fileno(), self._buffer)
-        except OSError, e:
-            self.warning("[fd %5d] failed to send FD: %s",
-                         self.transport.fileno(), log.getExceptionMessage(e))
-            self.writeServiceUnavailableResponse()
-            return self.transport.loseConnection()
-
+        # The FD is queued on the avatar's connection, so a streamer that is
+        # slow to accept FDs doesn't block the porter. Stop reading in the
+        # meantime; everything else the client sends is for the streamer.
+        self.transport.stopReading()
+        d = destinationAvatar.queueFileDescriptor(self.transport.fileno(),
+                                                  self._buffer)
+        d.addCallbacks(self._fileDescriptorSent, self._fileDescriptorFailed,
+                       callbackArgs=(destinationAvatar, ),
+                       errbackArgs=(destinationAvatar, ))
+
+    def _fileDescriptorSent(self, _, destinationAvatar):
+        now = time.time()
         # PROBE: sent fd; see no destination and fdserver.py
         self.debug("[fd %5d] (ts %f) (request-id %r) sent fd to avatarId %s",
-                   self.transport.fileno(), time.time(), self.requestId,
+                   self.transport.fileno(), now, self.requestId,
                    destinationAvatar.avatarId)
+        self._stats.requestSent(self._mountPoint, destinationAvatar.avatarId,
+                                now - self._acceptTime)
+
+        if not self.transport.connected:
+            # We timed out while the FD was queued
+            return
 
         # After this, we don't want to do anything with the FD, other than
         # close our reference to it - but not close the actual TCP connection.
@@ -538,6 +780,19 @@ class PorterProtocol(protocol.Protocol, log.Loggable):
         self.transport.keepSocketAlive = True
         self.transport.loseConnection()
 
+    def _fileDescriptorFailed(self, failure, destinationAvatar):
+        failure.trap(OSError)
+        self._stats.requestRejected(self._mountPoint,
+                                    destinationAvatar.avatarId,
+                                    stats.REJECT_SERVICE_UNAVAILABLE)
+        self.warning("[fd %5d] failed to send FD: %s",
+                     self.transport.fileno(),
+                     log.getFailureMessage(failure))
+        if not self.transport.connected:
+            return
+        self.writeServiceUnavailableResponse()
+        self.transport.loseConnection()
+
     def parseLine(self, line):
         """
         Parse the initial line of the request. Return an object that can be
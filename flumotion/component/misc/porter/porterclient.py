@@ -95,6 +95,16 @@ class PorterMedium(medium.BaseMedium):
         d.addErrback(handle_error)
         return d
 
+    def setMaxFileDescriptors(self, count):
+
+        def handle_error(failure):
+            self.debug('Old porter can only pass one FD at a time: %r',
+                       failure)
+
+        d = self.callRemote("setMaxFileDescriptors", count)
+        d.addErrback(handle_error)
+        return d
+
 
 class PorterClientFactory(fpb.ReconnectingPBClientFactory):
     """
@@ -171,6 +181,8 @@ class HTTPPorterClientFactory(PorterClientFactory):
         deferred.addCallback(self.medium.setRemoteReference)
         deferred.addCallback(lambda r: self.medium.getPort())
         deferred.addCallback(self._setRemotePort)
+        deferred.addCallback(lambda r: self.medium.setMaxFileDescriptors(
+            fdserver.MAX_FDS_PER_MESSAGE))
         for mount in self._mountPoints:
             self.debug("Registering mount point %s with porter", mount)
             deferred.addCallback(lambda r, m: self.registerPath(m), mount)
@@ -0,0 +1,347 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_porter -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""porter statistics.
+Histograms and counters describing how fast the porter passes incoming
+connections on, kept per destination.
+"""
+
+import math
+
+__version__ = "$Rev$"
+
+# Reasons for rejecting a request
+REJECT_NOT_FOUND = 'not-found'
+REJECT_SERVICE_UNAVAILABLE = 'service-unavailable'
+REJECT_BUFFER_EXCEEDED = 'buffer-exceeded'
+REJECTS = (REJECT_NOT_FOUND, REJECT_SERVICE_UNAVAILABLE,
+           REJECT_BUFFER_EXCEEDED)
+
+# The percentiles included in histogram snapshots
+PERCENTILES = (50.0, 90.0, 99.0, 99.9)
+
+
+class Histogram(object):
+    """
+    I record a distribution of non-negative integer values, in the manner
+    of an HDR histogram: values are counted in buckets whose width grows
+    with the magnitude of the values, so every value is known within a
+    fixed relative error while the number of buckets stays small.
+
+    Recording a value is a couple of arithmetic operations and a dict
+    update; nothing is allocated once a bucket exists.
+
+    @ivar subBucketBits: the number of significant bits kept for each
+                         value; the relative error is at most
+                         2 ** (1 - subBucketBits)
+    """
+
+    def __init__(self, subBucketBits=5):
+        self.subBucketBits = subBucketBits
+        self._subBuckets = 1 << subBucketBits
+        self._halfSubBuckets = self._subBuckets >> 1
+        self.reset()
+
+    def reset(self):
+        self._counts = {}
+        self._count = 0
+        self._total = 0
+        self._min = None
+        self._max = None
+
+    def _index(self, value):
+        if value < self._subBuckets:
+            return value
+        shift = math.frexp(value)[1] - self.subBucketBits
+        return (self._subBuckets + (shift - 1) * self._halfSubBuckets +
+                (value >> shift) - self._halfSubBuckets)
+
+    def _bounds(self, index):
+        """
+        @returns: the lowest and highest value counted in the given bucket
+        """
+        if index < self._subBuckets:
+            return index, index
+        shift, offset = divmod(index - self._subBuckets,
+                               self._halfSubBuckets)
+        shift += 1
+        low = (offset + self._halfSubBuckets) << shift
+        return low, low + (1 << shift) - 1
+
+    def record(self, value):
+        """
+        Record a value.
+
+        @type value: int
+        """
+        value = int(value)
+        if value < 0:
+            value = 0
+        index = self._index(value)
+        self._counts[index] = self._counts.get(index, 0) + 1
+        self._count += 1
+        self._total += value
+        if self._min is None or value < self._min:
+            self._min = value
+        if self._max is None or value > self._max:
+            self._max = value
+
+    def getCount(self):
+        return self._count
+
+    def merge(self, other):
+        """
+        Add the values recorded by another histogram to mine.
+
+        @type other: L{Histogram} with the same subBucketBits
+        """
+        if not other._count:
+            return
+        for index, count in other._counts.iteritems():
+            self._counts[index] = self._counts.get(index, 0) + count
+        self._count += other._count
+        self._total += other._total
+        if self._min is None or other._min < self._min:
+            self._min = other._min
+        if self._max is None or other._max > self._max:
+            self._max = other._max
+
+    def getState(self):
+        """
+        @returns: the recorded values, as a string without spaces to be
+                  passed to L{setState}
+        """
+        if not self._count:
+            return '-'
+        buckets = ','.join(['%d:%d' % item
+                            for item in sorted(self._counts.items())])
+        return '%d/%d/%d/%s' % (self._total, self._min, self._max, buckets)
+
+    def setState(self, state):
+        """
+        Replace the recorded values with the ones of the given state.
+
+        @param state: a state returned by L{getState}
+        @type  state: str
+        """
+        self.reset()
+        if state == '-':
+            return
+        total, minimum, maximum, buckets = state.split('/')
+        for bucket in buckets.split(','):
+            index, count = bucket.split(':')
+            self._counts[int(index)] = int(count)
+            self._count += int(count)
+        self._total = int(total)
+        self._min = int(minimum)
+        self._max = int(maximum)
+
+    def getMean(self):
+        if not self._count:
+            return None
+        return float(self._total) / self._count
+
+    def getValueAtPercentile(self, percentile):
+        """
+        @param percentile: the percentile, between 0 and 100
+        @type  percentile: float
+
+        @returns: the highest value in the bucket containing the given
+                  percentile, or None if nothing was recorded
+        """
+        if not self._count:
+            return None
+        wanted = max(1, int(math.ceil(self._count * percentile / 100.0)))
+        seen = 0
+        for index in sorted(self._counts):
+            seen += self._counts[index]
+            if seen >= wanted:
+                return min(self._bounds(index)[1], self._max)
+        return self._max
+
+    def getSnapshot(self):
+        """
+        @returns: a dict describing the distribution, with the count,
+                  min, max, mean, a few percentiles (as 'p50', 'p99.9',
+                  ...) and the non-empty buckets as a list of
+                  (low, high, count) tuples
+        """
+        snapshot = {'count': self._count,
+                    'min': self._min,
+                    'max': self._max,
+                    'mean': self.getMean()}
+        for percentile in PERCENTILES:
+            snapshot['p%g' % percentile] = \
+                self.getValueAtPercentile(percentile)
+        buckets = []
+        for index in sorted(self._counts):
+            low, high = self._bounds(index)
+            buckets.append((low, high, self._counts[index]))
+        snapshot['buckets'] = buckets
+        return snapshot
+
+
+class DestinationStats(object):
+    """
+    The statistics for one destination of the porter: the requests for a
+    mount point that went to one streamer.
+
+    @ivar firstLine: microseconds from accepting a connection to having
+                     parsed its first line
+    @ivar sent:      microseconds from accepting a connection to having
+                     passed it on to the streamer
+    @ivar buffered:  bytes read from a connection before passing it on
+    @ivar rejects:   number of rejected requests, by reason
+    """
+
+    def __init__(self, mountPoint, avatarId):
+        self.mountPoint = mountPoint
+        self.avatarId = avatarId
+        self.requests = 0
+        self.firstLine = Histogram()
+        self.sent = Histogram()
+        self.buffered = Histogram()
+        self.rejects = dict([(reason, 0) for reason in REJECTS])
+
+    def getState(self):
+        """
+        @returns: the recorded values, as a string to be passed to
+                  L{mergeState}
+        """
+        return ' '.join([str(self.requests),
+                         ','.join([str(self.rejects[reason])
+                                   for reason in REJECTS]),
+                         self.firstLine.getState(),
+                         self.sent.getState(),
+                         self.buffered.getState()])
+
+    def mergeState(self, state):
+        """
+        Add the values recorded in the given state to mine.
+
+        @param state: a state returned by L{getState}
+        @type  state: str
+        """
+        requests, rejects, firstLine, sent, buffered = state.split(' ')
+        self.requests += int(requests)
+        for reason, count in zip(REJECTS, rejects.split(',')):
+            self.rejects[reason] += int(count)
+        for histogram, histogramState in [(self.firstLine, firstLine),
+                                          (self.sent, sent),
+                                          (self.buffered, buffered)]:
+            other = Histogram(histogram.subBucketBits)
+            other.setState(histogramState)
+            histogram.merge(other)
+
+    def getSnapshot(self):
+        return {'mount-point': self.mountPoint,
+                'avatar-id': self.avatarId,
+                'requests': self.requests,
+                'rejects': self.rejects.copy(),
+                'first-line': self.firstLine.getSnapshot(),
+                'sent': self.sent.getSnapshot(),
+                'buffered': self.buffered.getSnapshot()}
+
+
+class PorterStats(object):
+    """
+    I keep the porter's statistics, for all requests together and per
+    destination.
+
+    Times are passed in as seconds since the connection was accepted,
+    and recorded in microseconds.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.total = DestinationStats(None, None)
+        self._destinations = {}
+
+    def _getDestination(self, mountPoint, avatarId):
+        key = (mountPoint, avatarId)
+        destination = self._destinations.get(key)
+        if destination is None:
+            destination = DestinationStats(mountPoint, avatarId)
+            self._destinations[key] = destination
+        return destination
+
+    def requestParsed(self, mountPoint, avatarId, seconds, buffered):
+        """
+        Record that the first line of a request was parsed.
+
+        @param mountPoint: the path or prefix the request matched, or None
+        @param avatarId:   the streamer the request is for, or None
+        @param seconds:    the time since the connection was accepted
+        @param buffered:   the number of bytes read from the connection
+        """
+        usecs = int(seconds * 1000000)
+        for stats in (self.total, self._getDestination(mountPoint,
+                                                       avatarId)):
+            stats.requests += 1
+            stats.firstLine.record(usecs)
+            stats.buffered.record(buffered)
+
+    def requestSent(self, mountPoint, avatarId, seconds):
+        """
+        Record that a connection was passed on to its streamer.
+        """
+        usecs = int(seconds * 1000000)
+        self.total.sent.record(usecs)
+        self._getDestination(mountPoint, avatarId).sent.record(usecs)
+
+    def requestRejected(self, mountPoint, avatarId, reason):
+        """
+        Record that a request was rejected.
+
+        @param reason: one of L{REJECTS}
+        """
+        self.total.rejects[reason] += 1
+        self._getDestination(mountPoint, avatarId).rejects[reason] += 1
+
+    def getStates(self):
+        """
+        Get the values recorded for every destination, to be merged in
+        the statistics of another process with L{mergeState}.
+
+        @returns: a list of (mountPoint, avatarId, state) tuples
+        """
+        return [(mountPoint, avatarId, destination.getState())
+                for (mountPoint, avatarId), destination
+                in sorted(self._destinations.items())]
+
+    def mergeState(self, mountPoint, avatarId, state):
+        """
+        Add the values recorded for a destination by another process.
+
+        @param state: a state returned by L{DestinationStats.getState}
+        """
+        for stats in (self.total, self._getDestination(mountPoint,
+                                                       avatarId)):
+            stats.mergeState(state)
+
+    def getSnapshot(self):
+        """
+        @returns: a dict with the snapshot of the totals under 'total',
+                  and a list of snapshots of every destination under
+                  'destinations'
+        """
+        destinations = [self._destinations[key].getSnapshot()
+                        for key in sorted(self._destinations)]
+        return {'total': self.total.getSnapshot(),
+                'destinations': destinations}
@@ -25,11 +25,16 @@
  * Receive a socket message on fd 'socket', containing one or more fds and a
  * message buffer. Limited to receiving MAX_RECEIVED_FDS fds. Reads a message
  * of up to 'size' bytes.
+ * The fds may arrive in one or several SCM_RIGHTS control messages.
  * ([fd], buffer) = fdpass.readfds(socket, size)
  *
  * Write a socket message on fd 'socket', containing one or more fds and a
- * message buffer.
+ * message buffer. All the fds are sent in a single SCM_RIGHTS control
+ * message, so at most MAX_RECEIVED_FDS can be sent at once.
  * fdpass.writefds(socket, [fd], buffer)
+ *
+ * The maximum number of fds per message is exported as
+ * fdpass.MAX_RECEIVED_FDS.
  */
 
 #include <Python.h>
@@ -37,7 +42,8 @@
 #include <sys/types.h>
 #include <sys/socket.h>
 
-#define MAX_RECEIVED_FDS 32
+/* SCM_MAX_FD in the Linux kernel; the most fds one message can carry */
+#define MAX_RECEIVED_FDS 253
 
 static PyObject *
 readfds(PyObject *self, PyObject *args)
@@ -47,7 +53,7 @@ readfds(PyObject *self, PyObject *args)
   struct msghdr msg;
   struct iovec iov[1];
   struct cmsghdr *msgptr;
-  int n;
+  int n, i, numfds;
 
   if (!PyArg_ParseTuple (args, "ii", &sockfd, &size))
     return NULL;
@@ -85,7 +91,7 @@ readfds(PyObject *self, PyObject *args)
 
   msgptr = CMSG_FIRSTHDR (&msg);
   while (msgptr != NULL) {
-    if (msgptr->cmsg_len != CMSG_LEN (sizeof (int)) ||
+    if (msgptr->cmsg_len < CMSG_LEN (sizeof (int)) ||
         msgptr->cmsg_level != SOL_SOCKET ||
         msgptr->cmsg_type != SCM_RIGHTS)
     {
@@ -94,11 +100,16 @@ readfds(PyObject *self, PyObject *args)
       goto done;
     }
 
-    fd = *((int *) CMSG_DATA (msgptr));
+    /* A single control message can carry several fds */
+    numfds = (msgptr->cmsg_len - CMSG_LEN (0)) / sizeof (int);
+    for (i = 0; i < numfds; i++)
+    {
+      fd = ((int *) CMSG_DATA (msgptr))[i];
 
-    fdobj = PyInt_FromLong ((long)fd);
-    PyList_Append (list, fdobj);
-    Py_DECREF (fdobj);
+      fdobj = PyInt_FromLong ((long)fd);
+      PyList_Append (list, fdobj);
+      Py_DECREF (fdobj);
+    }
 
     msgptr = CMSG_NXTHDR (&msg, msgptr);
   }
@@ -133,6 +144,11 @@ writefds(PyObject *self, PyObject *args)
     return NULL;
 
   numfds = PyList_Size (list);
+  if (numfds < 1 || numfds > MAX_RECEIVED_FDS)
+  {
+    PyErr_SetString(PyExc_ValueError, "Invalid number of fds");
+    return NULL;
+  }
 
   /* Stevens: Unix Network Programming, 3rd Ed. p 428.
    *
@@ -154,16 +170,16 @@ writefds(PyObject *self, PyObject *args)
     }
 
     msgptr = CMSG_FIRSTHDR (&msg);
+    msgptr->cmsg_len = CMSG_LEN (sizeof(int) * numfds);
+    msgptr->cmsg_level = SOL_SOCKET;
+    /* The control message type for FD-passing is called SCM_RIGHTS for some
+     * reason */
+    msgptr->cmsg_type = SCM_RIGHTS;
+
     for (i = 0; i < numfds; i++)
     {
-      msgptr->cmsg_len = CMSG_LEN (sizeof(int));
-      msgptr->cmsg_level = SOL_SOCKET;
-      /* The control message type for FD-passing is called SCM_RIGHTS for some
-       * reason */
-      msgptr->cmsg_type = SCM_RIGHTS;
-
-      /* And the actual data: a single int, our passed fd. Convert from python
-       * first, checking that it's valid.
+      /* And the actual data: our passed fds. Convert from python first,
+       * checking that they're valid.
        */
       fdobj = PyList_GetItem (list, i);
       if (!PyInt_Check (fdobj))
@@ -174,9 +190,7 @@ writefds(PyObject *self, PyObject *args)
       }
       fd = (int) PyInt_AsLong (fdobj);
 
-      *((int *) CMSG_DATA (msgptr)) = fd;
-
-      msgptr = CMSG_NXTHDR (&msg, msgptr);
+      ((int *) CMSG_DATA (msgptr))[i] = fd;
     }
 
     /* These are used for sending control messages on unconnected sockets; we
@@ -220,6 +234,11 @@ static PyMethodDef methods[] =
 PyMODINIT_FUNC
 initfdpass(void)
 {
-  Py_InitModule ("fdpass", methods);
+  PyObject *module;
+
+  module = Py_InitModule ("fdpass", methods);
+  if (module == NULL)
+    return;
+  PyModule_AddIntConstant (module, "MAX_RECEIVED_FDS", MAX_RECEIVED_FDS);
 }
 
@@ -15,6 +15,7 @@
 #
 # Headers in this file shall remain intact.
 
+import errno
 import os
 import random
 import shutil
@@ -33,6 +34,7 @@ else:
 
 from flumotion.common import testsuite, errors
 from flumotion.component.misc.httpserver import cachemanager, fileprovider
+from flumotion.component.misc.httpserver import cacheindex, cachepolicy
 
 attr = testsuite.attr
 
@@ -427,3 +429,347 @@ class TestCacheManager(testsuite.TestCase):
         dl.append(d)
 
         return defer.DeferredList(dl)
+
+
+class TestCacheShards(testsuite.TestCase):
+
+    skip = SKIP_MSG
+
+    def setUp(self):
+        from twisted.python import threadpool
+        reactor.threadpool = threadpool.ThreadPool(0, 10)
+        reactor.threadpool.start()
+
+        self.path = tempfile.mkdtemp(suffix=".flumotion.test")
+        self.dirs = [os.path.join(self.path, "disk%d" % i) for i in range(3)]
+        self.manager = cachemanager.CacheManager(DummyStats(), self.dirs,
+                                                 3 * CACHE_SIZE)
+        self.names = ["/file%d" % i for i in range(300)]
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+        reactor.threadpool.stop()
+        reactor.threadpool = None
+
+    def getPlacement(self):
+        placement = {}
+        for name in self.names:
+            path = self.manager.getCachePath(name)
+            placement[name] = os.path.dirname(path)
+        return placement
+
+    def testHashRing(self):
+        ring = cachemanager.HashRing()
+        for i in range(3):
+            ring.add(i, "item%d" % i)
+        keys = [self.manager.getIdentifier(n) for n in self.names]
+        before = dict([(k, ring.get(k)) for k in keys])
+        self.assertEqual(len(set(before.values())), 3)
+        ring.remove(1)
+        for key in keys:
+            if before[key] != 1:
+                self.assertEqual(ring.get(key), before[key])
+            else:
+                self.failIfEqual(ring.get(key), 1)
+        ring.remove(0)
+        ring.remove(2)
+        self.assertEqual(ring.get(keys[0]), None)
+
+    def testPlacement(self):
+        placement = self.getPlacement()
+        for directory in self.dirs:
+            self.failUnless(os.path.isdir(directory))
+            count = placement.values().count(directory)
+            self.failUnless(count > len(self.names) / 10, count)
+
+    def testAllocationPerDirectory(self):
+        name = self.names[0]
+        directory = os.path.dirname(self.manager.getCachePath(name))
+        d = self.manager.setUp()
+        d.addCallback(lambda _: self.manager.newTempFile(name, 100))
+
+        def complete(tempFile):
+            self.assertEqual(os.path.dirname(tempFile.name), directory)
+            tempFile.complete()
+            tempFile.close()
+            self.assertEqual(self.manager._shards[directory].usage, 100)
+            return self.manager.updateCacheUsage()
+        d.addCallback(complete)
+        d.addCallback(self.assertEqual, 100)
+        return d
+
+    def testFailedDirectory(self):
+        before = self.getPlacement()
+        failed = self.dirs[1]
+        retryPeriod = cachemanager.SHARD_RETRY_PERIOD
+        cachemanager.SHARD_RETRY_PERIOD = 0
+        d = self.manager.setUp()
+
+        def fail(_):
+            # The disk is gone
+            shutil.rmtree(failed)
+            open(failed, "w").close()
+            name = [n for n in self.names if before[n] == failed][0]
+            self.manager.reportError(self.manager.getCachePath(name),
+                                     IOError(errno.EIO, "I/O error"))
+
+        def waitChecks(_):
+            d = defer.Deferred()
+
+            def check():
+                if self.manager._checking:
+                    reactor.callLater(0.01, check)
+                else:
+                    d.callback(None)
+            check()
+            return d
+
+        def checkTakenOut(_):
+            after = self.getPlacement()
+            for name in self.names:
+                if before[name] == failed:
+                    self.failIfEqual(after[name], failed)
+                else:
+                    self.assertEqual(after[name], before[name])
+            # The disk is back
+            os.unlink(failed)
+            os.mkdir(failed)
+            return self.manager.updateCacheUsage()
+
+        def checkRestored(_):
+            self.assertEqual(self.getPlacement(), before)
+
+        def restore(result):
+            cachemanager.SHARD_RETRY_PERIOD = retryPeriod
+            return result
+        d.addCallback(fail)
+        d.addCallback(waitChecks)
+        d.addCallback(checkTakenOut)
+        d.addCallback(waitChecks)
+        d.addCallback(checkRestored)
+        d.addBoth(restore)
+        return d
+
+
+class TestCacheIndex(testsuite.TestCase):
+
+    skip = SKIP_MSG
+
+    def setUp(self):
+        from twisted.python import threadpool
+        reactor.threadpool = threadpool.ThreadPool(0, 10)
+        reactor.threadpool.start()
+
+        self.path = tempfile.mkdtemp(suffix=".flumotion.test")
+        self.indexes = []
+
+    def tearDown(self):
+        for index in self.indexes:
+            index.close()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+        reactor.threadpool.stop()
+        reactor.threadpool = None
+
+    def newIndex(self):
+        index = cacheindex.CacheIndex(self.path, ".tmp")
+        self.indexes.append(index)
+        return index
+
+    def createFile(self, name, size, atime):
+        path = os.path.join(self.path, name)
+        open(path, "w").write("x" * size)
+        os.utime(path, (atime, atime))
+
+    def testScan(self):
+        self.createFile("a", 10, 100)
+        self.createFile("b", 20, 50)
+        self.createFile("c.tmp", 30, 10)
+        index = self.newIndex()
+        d = index.load()
+        d.addCallback(self.assertEqual, 30)
+        d.addCallback(lambda _: self.assertEqual(len(index), 2))
+        d.addCallback(lambda _: self.assertEqual(index.popVictim(),
+                                                 ("b", 20)))
+        d.addCallback(lambda _: self.assertEqual(index.popVictim(),
+                                                 ("a", 10)))
+        d.addCallback(lambda _: self.assertEqual(index.popVictim(), None))
+        return d
+
+    def testChangesBeforeLoaded(self):
+        index = self.newIndex()
+        index.add("a", 10, 100)
+        d = index.load()
+        d.addCallback(self.assertEqual, 10)
+        return d
+
+    def testJournal(self):
+        index = self.newIndex()
+        d = index.load()
+
+        def change(_):
+            index.add("a", 10, 100)
+            index.add("b", 20, 200)
+            index.add("c", 30, 300)
+            index.touch("a", 400)
+            index.remove("c")
+            return self.newIndex().load()
+
+        def check(usage):
+            self.assertEqual(usage, 30)
+            loaded = self.indexes[-1]
+            self.assertEqual(loaded.popVictim(), ("b", 20))
+            self.assertEqual(loaded.popVictim(), ("a", 10))
+        d.addCallback(change)
+        d.addCallback(check)
+        return d
+
+    def testShared(self):
+        first = self.newIndex()
+        second = self.newIndex()
+        d = defer.DeferredList([first.load(), second.load()])
+        d.addCallback(lambda _: first.add("a", 10, 100))
+        d.addCallback(lambda _: second.add("b", 20, 200))
+        d.addCallback(lambda _: first.refresh())
+        d.addCallback(self.assertEqual, 30)
+        d.addCallback(lambda _: second.refresh())
+        d.addCallback(self.assertEqual, 30)
+        return d
+
+    def testHitsCountedOnce(self):
+        first = self.newIndex()
+        second = self.newIndex()
+        d = defer.DeferredList([first.load(), second.load()])
+
+        def touch(_):
+            first.add("a", 10, 100)
+            first.touch("a", 200)
+            second.refresh()
+            second.touch("a", 300)
+            return first.refresh()
+
+        def check(_):
+            self.assertEqual(first.get("a").hits, 2)
+            self.assertEqual(first.get("a").atime, 300)
+        d.addCallback(touch)
+        d.addCallback(check)
+        return d
+
+    def testCompaction(self):
+        minRecords = cacheindex.COMPACT_MIN_RECORDS
+        cacheindex.COMPACT_MIN_RECORDS = 10
+        index = self.newIndex()
+        other = self.newIndex()
+        d = defer.DeferredList([index.load(), other.load()])
+
+        def touch(_):
+            index.add("a", 10, 0)
+            index.add("b", 20, 1)
+            for i in range(2, 30):
+                index.touch("a", i)
+            return index.refresh()
+
+        def waitCompaction(_):
+            # The journal is rewritten in a thread
+            d = defer.Deferred()
+
+            def check():
+                if index._compacting:
+                    reactor.callLater(0.01, check)
+                else:
+                    d.callback(None)
+            check()
+            return d
+
+        def checkJournal(_):
+            lines = open(os.path.join(self.path,
+                                      cacheindex.INDEX_FILENAME)).readlines()
+            self.failUnless(len(lines) < 10)
+            # The other process reloads the rewritten journal
+            return other.refresh()
+        d.addCallback(touch)
+        d.addCallback(waitCompaction)
+        d.addCallback(checkJournal)
+        d.addCallback(self.assertEqual, 30)
+        d.addCallback(lambda _: self.assertEqual(other.popVictim(),
+                                                 ("b", 20)))
+
+        def restore(result):
+            cacheindex.COMPACT_MIN_RECORDS = minRecords
+            return result
+        d.addBoth(restore)
+        return d
+
+
+class TestEvictionPolicies(testsuite.TestCase):
+
+    def startPolicy(self, policyClass, *files):
+        entries = {}
+        for name, size, atime, hits in files:
+            entries[name] = cacheindex.CacheEntry(size, atime, hits)
+        policy = policyClass()
+        policy.start(entries)
+        return entries, policy
+
+    def popAll(self, entries, policy):
+        victims = []
+        name = policy.popVictim()
+        while name is not None:
+            victims.append(name)
+            policy.onRemoved(name, entries.pop(name))
+            name = policy.popVictim()
+        return victims
+
+    def access(self, entries, policy, name, atime):
+        entry = entries[name]
+        entry.atime = atime
+        entry.hits += 1
+        policy.onAccessed(name, entry)
+
+    def testLRU(self):
+        entries, policy = self.startPolicy(cachepolicy.LRUPolicy,
+                                           ("a", 10, 100, 5),
+                                           ("b", 10, 200, 1),
+                                           ("c", 10, 300, 1))
+        self.access(entries, policy, "a", 400)
+        self.assertEqual(self.popAll(entries, policy), ["b", "c", "a"])
+
+    def testLFU(self):
+        entries, policy = self.startPolicy(cachepolicy.LFUPolicy,
+                                           ("a", 10, 100, 5),
+                                           ("b", 10, 200, 1),
+                                           ("c", 10, 300, 2))
+        self.access(entries, policy, "b", 400)
+        self.access(entries, policy, "b", 500)
+        self.assertEqual(self.popAll(entries, policy), ["c", "b", "a"])
+
+    def testLFUAging(self):
+        entries, policy = self.startPolicy(cachepolicy.LFUPolicy,
+                                           ("old", 10, 100, 5),
+                                           ("a", 10, 200, 4))
+        self.assertEqual(policy.popVictim(), "a")
+        policy.onRemoved("a", entries.pop("a"))
+        # New files start from the priority of the last deleted one
+        entries["new"] = cacheindex.CacheEntry(10, 300, 0)
+        policy.onAdded("new", entries["new"])
+        self.access(entries, policy, "new", 400)
+        self.access(entries, policy, "new", 500)
+        self.assertEqual(self.popAll(entries, policy), ["old", "new"])
+
+    def testGDSF(self):
+        entries, policy = self.startPolicy(cachepolicy.GDSFPolicy,
+                                           ("small", 10, 100, 1),
+                                           ("big", 1000, 200, 10),
+                                           ("popular", 1000, 300, 50))
+        self.assertEqual(self.popAll(entries, policy),
+                         ["big", "popular", "small"])
+
+    def testUnknownPolicy(self):
+        path = tempfile.mkdtemp(suffix=".flumotion.test")
+        try:
+            self.assertRaises(errors.PropertyError,
+                              cachemanager.CacheManager, DummyStats(), path,
+                              evictionPolicy="fifo")
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
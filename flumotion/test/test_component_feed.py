@@ -17,15 +17,19 @@
 
 import errno
 import os
+import shutil
+import socket
+import tempfile
 
 from twisted.internet import reactor, defer, main
 from twisted.python import log as tlog
 from twisted.python import failure
 
 from flumotion.common import testsuite
-from flumotion.common import log, errors
+from flumotion.common import common, log, errors
 from flumotion.component import feed
 from flumotion.component.bouncers import htpasswdcrypt
+from flumotion.configure import configure
 from flumotion.twisted import pb as fpb
 from flumotion.worker import feedserver
 
@@ -72,6 +76,11 @@ def countOpenFileDescriptors():
 
 class FeedServer(feedserver.FeedServer):
     _deferredAvatarLogout = None
+    listenLocal = False
+
+    def _listenLocal(self, factory):
+        if self.listenLocal:
+            feedserver.FeedServer._listenLocal(self, factory)
 
     def waitForAvatarExit(self):
         if self._deferredAvatarLogout is None:
@@ -84,12 +93,18 @@ class FeedServer(feedserver.FeedServer):
         # closed
         reactor.callLater(0, self.waitForAvatarExit().callback, None)
 
+
+class LocalFeedServer(FeedServer):
+    listenLocal = True
+
 # these tests test both flumotion.worker.feedserver and
 # flumotion.component.feed.
 
 
 class FeedTestCase(testsuite.TestCase, log.Loggable):
     slow = True
+    feedServerClass = FeedServer
+    listeningFDs = 1
 
     bouncerconf = {'name': 'testbouncer',
                    'plugs': {},
@@ -101,8 +116,8 @@ class FeedTestCase(testsuite.TestCase, log.Loggable):
 
         self.brain = FakeWorkerBrain()
         self._bouncer = bouncer = htpasswdcrypt.HTPasswdCrypt(self.bouncerconf)
-        self.feedServer = FeedServer(self.brain, bouncer, 0)
-        self.assertAdditionalFDsOpen(1, 'setUp (socket)')
+        self.feedServer = self.feedServerClass(self.brain, bouncer, 0)
+        self.assertAdditionalFDsOpen(self.listeningFDs, 'setUp (socket)')
 
     def assertAdditionalFDsOpen(self, additionalFDs=0, debug=''):
         actual = countOpenFileDescriptors()
@@ -409,3 +424,69 @@ class TestDownstreamFeedClient(FeedTestCase, log.Loggable):
         d.addCallback(gotFeed)
         d.addCallback(checkfds)
         return d
+
+
+class TestLocalFeedClient(FeedTestCase, log.Loggable):
+    feedServerClass = LocalFeedServer
+    listeningFDs = 2
+
+    def setUp(self):
+        self._rundir = configure.rundir
+        # Short enough for a unix socket path
+        configure.rundir = tempfile.mkdtemp()
+        FeedTestCase.setUp(self)
+        self.path = common.feedServerSocketPath(self.feedServer.getPortNum())
+
+    def tearDown(self):
+        d = FeedTestCase.tearDown(self)
+
+        def restoreRundir(_):
+            shutil.rmtree(configure.rundir)
+            configure.rundir = self._rundir
+        d.addCallback(restoreRundir)
+        return d
+
+    def requestFeed(self, host):
+        client = feed.FeedMedium(logName='frobby')
+        d = client.requestFeed(host, self.feedServer.getPortNum(),
+                               fpb.Authenticator(username='user',
+                                                 password='test'),
+                               '/foo/bar:baz')
+
+        def gotFeed((feedId, fd)):
+            os.close(fd)
+            return self.brain.waitForFD()
+
+        def feedReadyOnServer((componentId, feedName, fd, eaterId)):
+            # fromfd() dups the fd, that is closed by the server
+            sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+            address = sock.getsockname()
+            sock.close()
+            d = self.feedServer.waitForAvatarExit()
+            d.addCallback(lambda _: address)
+            return d
+
+        d.addCallback(gotFeed)
+        d.addCallback(feedReadyOnServer)
+        return d
+
+    def testLocalHost(self):
+        self.failUnless(os.path.exists(self.path))
+        d = self.requestFeed('127.0.0.1')
+        # The address of a unix socket is its path
+        d.addCallback(lambda address: self.failUnless(
+            isinstance(address, str)))
+        return d
+
+    def testFallbackToTCP(self):
+        d = self.feedServer._uport.stopListening()
+
+        def staleSocket(_):
+            self.feedServer._uport = None
+            open(self.path, 'w').close()
+            return self.requestFeed('127.0.0.1')
+
+        d.addCallback(staleSocket)
+        d.addCallback(lambda address: self.assertEquals(
+            address[1], self.feedServer.getPortNum()))
+        return d
@@ -17,7 +17,9 @@
 
 import time
 
-from flumotion.common import testsuite
+import gst
+
+from flumotion.common import componentui, testsuite
 
 from twisted.internet import defer, reactor
 
@@ -73,6 +75,35 @@ class TestFeeder(testsuite.TestCase):
 
         return d
 
+    def testJoinLatency(self):
+        clientId = '/default/muxer-video'
+        c = self.feeder.clientConnected(clientId, 3, lambda _: None)
+        connected = c.uiState.get('last-connect')
+        self.failUnless(c.isJoining())
+
+        # only the stream headers were sent
+        c.setStats((10, None, None, None, time.time(), 0,
+                    gst.CLOCK_TIME_NONE, gst.CLOCK_TIME_NONE))
+        self.failUnless(c.isJoining())
+        self.clientAssertEquals(c, 'join-latency', None)
+
+        c.setStats((30, None, None, None, time.time(), 0, 0, 0),
+                   when=connected + 0.5)
+        self.failIf(c.isJoining())
+        self.clientAssertEquals(c, 'join-latency', 0.5)
+
+        # a new connection joins again
+        self.feeder.clientConnected(clientId, 4, lambda _: None)
+        self.failUnless(c.isJoining())
+        self.clientAssertEquals(c, 'join-latency', None)
+
+    def testJoinLatencyUnsupported(self):
+        c = self.feeder.clientConnected('/default/muxer-video', 3,
+                                        lambda _: None)
+        c.setStats((10, None, None, None, time.time(), 0))
+        self.failIf(c.isJoining())
+        self.clientAssertEquals(c, 'join-latency', None)
+
     def clientAssertEquals(self, client, key, value):
         self.assertEquals(client.uiState.get(key), value)
 
@@ -82,3 +113,115 @@ class TestFeeder(testsuite.TestCase):
         self.clientAssertEquals(client, 'bytes-read-total', brt)
         self.clientAssertEquals(client, 'buffers-dropped-total', bdt)
         self.clientAssertEquals(client, 'reconnects', reconnects)
+
+
+class FakeFeederElement:
+
+    def __init__(self):
+        self.stats = {}
+        self.calls = 0
+
+    def emit(self, signal, fd):
+        assert signal == 'get-stats'
+        self.calls += 1
+        return self.stats.get(fd, ())
+
+
+class FakeBroker:
+    pass
+
+
+class FakeObserver:
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.calls = []
+
+    def callRemote(self, method, *args):
+        self.calls.append((method, ) + args)
+        return defer.succeed(None)
+
+
+class TestFeederStatsCollector(testsuite.TestCase):
+
+    def setUp(self):
+        self.feeders = [feeder.Feeder('video:default'),
+                        feeder.Feeder('audio:default')]
+        self.elements = {}
+        for f in self.feeders:
+            self.elements[f.elementName] = FakeFeederElement()
+        self.collector = feeder.FeederStatsCollector()
+
+    def collect(self):
+        self.collector.collect(self.feeders, self.elements.get)
+        return self.collector.delta
+
+    def testCollect(self):
+        video, audio = self.feeders
+        c1 = video.clientConnected('/default/muxer', 3, lambda _: None)
+        c2 = video.clientConnected('/default/disker', 4, lambda _: None)
+        c3 = audio.clientConnected('/default/muxer', 5, lambda _: None)
+        videoElement = self.elements[video.elementName]
+        videoElement.stats[3] = (10, 0, 0, 1, 2 * gst.SECOND, 0)
+        videoElement.stats[4] = (20, 0, 0, 1, 2 * gst.SECOND, 0)
+        # the audio feeder does not know its client anymore
+
+        self.assertEquals(self.collect(), {
+            c1: (10, 0, 0, 1, 2 * gst.SECOND, 0),
+            c2: (20, 0, 0, 1, 2 * gst.SECOND, 0)})
+        self.assertEquals(c1.uiState.get('bytes-read-current'), 10)
+        self.assertEquals(c1.uiState.get('last-activity'), 2.0)
+        self.assertEquals(c2.uiState.get('bytes-read-current'), 20)
+        self.assertEquals(c3.uiState.get('bytes-read-current'), 0)
+
+        # only the connection time of c1 changed
+        videoElement.stats[3] = (10, 0, 0, 2, 2 * gst.SECOND, 0)
+        videoElement.stats[4] = (25, 0, 0, 2, 3 * gst.SECOND, 0)
+        self.assertEquals(self.collect(), {
+            c2: (25, 0, 0, 2, 3 * gst.SECOND, 0)})
+        self.assertEquals(c2.uiState.get('bytes-read-total'), 25)
+        self.assertEquals(videoElement.calls, 4)
+
+    def testReconnected(self):
+        video = self.feeders[0]
+        c = video.clientConnected('/default/muxer', 3, lambda _: None)
+        videoElement = self.elements[video.elementName]
+        videoElement.stats[3] = videoElement.stats[4] = (0, 0, 0, 0, 0, 0)
+        self.assertEquals(self.collect().keys(), [c])
+        self.assertEquals(self.collect(), {})
+
+        # the same statistics, over a new connection
+        video.clientConnected('/default/muxer', 4, lambda _: None)
+        self.assertEquals(self.collect().keys(), [c])
+
+    def testOneMessage(self):
+        video, audio = self.feeders
+        c1 = video.clientConnected('/default/muxer', 3, lambda _: None)
+        c2 = audio.clientConnected('/default/muxer', 4, lambda _: None)
+        self.elements[video.elementName].stats[3] = (10, 0, 0, 1, 0, 0)
+        self.elements[audio.elementName].stats[4] = (20, 0, 0, 1, 0, 0)
+        uiState = componentui.WorkerComponentUIState()
+        broker = FakeBroker()
+        observers = [FakeObserver(broker) for i in range(3)]
+        for state, observer in zip((uiState, c1.uiState, c2.uiState),
+                                   observers):
+            state.getStateToCacheAndObserveFor(None, observer)
+
+        self.collector.collect(self.feeders, self.elements.get, uiState)
+        self.assertEquals(observers[1].calls, [])
+        self.assertEquals(observers[2].calls, [])
+        calls = observers[0].calls
+        self.assertEquals(len(calls), 1)
+        self.assertEquals(calls[0][0], 'batch')
+        batches = dict([(state, mutations)
+                        for _, state, mutations in calls[0][1]])
+        self.assertEquals(batches[c1.uiState],
+                          [('set', 'bytes-read-current', 10),
+                           ('set', 'buffers-dropped-current', 0),
+                           ('set', 'bytes-read-total', 10),
+                           ('set', 'buffers-dropped-total', 0)])
+        self.assertEquals(batches[c2.uiState],
+                          [('set', 'bytes-read-current', 20),
+                           ('set', 'buffers-dropped-current', 0),
+                           ('set', 'bytes-read-total', 20),
+                           ('set', 'buffers-dropped-total', 0)])
@@ -20,7 +20,7 @@ import shutil
 import tempfile
 from StringIO import StringIO
 
-from twisted.internet import defer
+from twisted.internet import abstract, defer, protocol, reactor
 from twisted.trial import unittest
 from twisted.web import client, server, http, error
 from twisted.web.resource import Resource
@@ -29,7 +29,7 @@ from twisted.web.static import Data
 from flumotion.common import log
 from flumotion.common import testsuite
 from flumotion.component.misc.httpserver import httpfile, httpserver
-from flumotion.component.misc.httpserver import localprovider
+from flumotion.component.misc.httpserver import localprovider, zerocopy
 from flumotion.component.plugs.base import ComponentPlug
 from flumotion.component.plugs.cortado import cortado
 from flumotion.test import test_http
@@ -810,5 +810,123 @@ class TestDirectory(testsuite.TestCase):
         return fr.finishDeferred
 
 
+class SendfileRequest(object):
+    """
+    The parts of a request used by a SendfileTransfer, over a real socket.
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.sent = 0
+        self.finished = False
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def dataSent(self, size):
+        self.sent += size
+
+    def finish(self):
+        self.finished = True
+        self.transport.loseConnection()
+
+
+class BufferlessTransport(abstract.FileDescriptor):
+    """
+    A transport of a twisted version without the buffer attributes
+    read by a SendfileTransfer.
+    """
+
+    def __getattribute__(self, name):
+        if name in httpfile._TRANSPORT_BUFFER_ATTRIBUTES:
+            raise AttributeError(name)
+        return abstract.FileDescriptor.__getattribute__(self, name)
+
+
+class SendfileServer(protocol.Protocol):
+
+    def connectionMade(self):
+        provider = self.factory.provider
+        provider.seek(self.factory.first)
+        self.factory.request = SendfileRequest(self.transport)
+        httpfile.SendfileTransfer(provider, self.factory.last + 1,
+                                  self.factory.request)
+
+
+class SendfileClient(protocol.Protocol):
+
+    def connectionMade(self):
+        self.data = []
+
+    def dataReceived(self, data):
+        self.data.append(data)
+
+    def connectionLost(self, reason):
+        self.factory.received.callback(''.join(self.data))
+
+
+class TestSendfile(testsuite.TestCase):
+
+    if not zerocopy.HAS_SENDFILE:
+        skip = "sendfile is not available"
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        # Big enough to fill the socket buffers a few times
+        self.content = ''.join([chr(i % 251) for i in xrange(256 * 1024)]) * 12
+        os.write(fd, self.content)
+        os.close(fd)
+        self.port = None
+
+    def tearDown(self):
+        os.unlink(self.path)
+        if self.port:
+            return self.port.stopListening()
+
+    def sendFile(self, first, last):
+        provider = localprovider.LocalFile(self.path, None)
+        serverFactory = protocol.ServerFactory()
+        serverFactory.protocol = SendfileServer
+        serverFactory.provider = provider
+        serverFactory.first = first
+        serverFactory.last = last
+        self.port = reactor.listenTCP(0, serverFactory, interface='127.0.0.1')
+
+        clientFactory = protocol.ClientFactory()
+        clientFactory.protocol = SendfileClient
+        clientFactory.received = defer.Deferred()
+        reactor.connectTCP('127.0.0.1', self.port.getHost().port,
+                           clientFactory)
+
+        def received(data):
+            request = serverFactory.request
+            self.failUnless(request.finished)
+            self.assertEquals(request.sent, last - first + 1)
+            self.assertEquals(provider._file, None)
+            return data
+        return clientFactory.received.addCallback(received)
+
+    def testFull(self):
+        d = self.sendFile(0, len(self.content) - 1)
+        d.addCallback(self.assertEquals, self.content)
+        return d
+
+    def testRange(self):
+        d = self.sendFile(1000, 2000000)
+        d.addCallback(self.assertEquals, self.content[1000:2000001])
+        return d
+
+    def testCanSendfile(self):
+        provider = localprovider.LocalFile(self.path, None)
+        # Fake transports are not sockets
+        self.failIf(httpfile.canSendfile(FakeRequest(), provider))
+        request = SendfileRequest(abstract.FileDescriptor())
+        self.failUnless(httpfile.canSendfile(request, provider))
+        # The transport must have the buffers SendfileTransfer reads
+        request = SendfileRequest(BufferlessTransport())
+        self.failIf(httpfile.canSendfile(request, provider))
+        provider.close()
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,332 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+from twisted.internet import defer, reactor
+from twisted.protocols import policies
+from twisted.web import http, resource
+from twisted.web.server import NOT_DONE_YET, Site
+
+from flumotion.common.testsuite import TestCase
+from flumotion.component.misc.httpserver.httpcached import common
+from flumotion.component.misc.httpserver.httpcached import http_pool
+from flumotion.component.misc.httpserver.httpcached import http_utils
+
+BIG_SIZE = 4 * 1024 * 1024
+
+
+class Data(resource.Resource):
+    """
+    Serves a string, with single range requests.
+    Unlike twisted.web.static.File, it supports pipelined requests.
+    """
+
+    isLeaf = True
+
+    def __init__(self, data):
+        resource.Resource.__init__(self)
+        self.data = data
+
+    def render_GET(self, request):
+        data = self.data
+        ranges = request.getHeader('range')
+        if ranges is not None:
+            start, end = ranges.split('=', 1)[1].split('-')
+            start = int(start)
+            end = int(end or len(data) - 1)
+            request.setResponseCode(http.PARTIAL_CONTENT)
+            request.setHeader('content-range', 'bytes %d-%d/%d'
+                              % (start, end, len(data)))
+            data = data[start:end + 1]
+        request.setHeader('content-length', str(len(data)))
+        return data
+
+
+class ChunkedData(Data):
+    """
+    Serves a string without content length, for HTTP/1.1 clients the
+    response is chunked.
+    """
+
+    def render_GET(self, request):
+        data = self.data
+        ranges = request.getHeader('range')
+        if ranges is not None:
+            start, end = ranges.split('=', 1)[1].split('-')
+            start = int(start)
+            end = int(end or len(data) - 1)
+            request.setResponseCode(http.PARTIAL_CONTENT)
+            request.setHeader('content-range', 'bytes %d-%d/%d'
+                              % (start, end, len(data)))
+            data = data[start:end + 1]
+        for i in range(0, len(data), 5):
+            request.write(data[i:i + 5])
+        request.finish()
+        return NOT_DONE_YET
+
+
+class CountingFactory(policies.WrappingFactory):
+
+    connections = 0
+
+    def registerProtocol(self, p):
+        self.connections += 1
+        policies.WrappingFactory.registerProtocol(self, p)
+
+
+class Consumer(object):
+
+    def __init__(self):
+        self.data = []
+        self.info = None
+        self.error = None
+        self.deferred = defer.Deferred()
+
+    def serverError(self, getter, code, message):
+        self._done(code)
+
+    def conditionFail(self, getter, code, message):
+        self._done(code)
+
+    def streamNotAvailable(self, getter, code, message):
+        self._done(code)
+
+    def onInfo(self, getter, info):
+        self.info = info
+
+    def onData(self, getter, data):
+        self.data.append(data)
+
+    def streamDone(self, getter):
+        self._done(None)
+
+    def _done(self, error):
+        self.error = error
+        self.deferred.callback(self)
+
+
+class TestConnectionPool(TestCase):
+
+    def setUp(self):
+        root = resource.Resource()
+        root.putChild("a", Data("content of a"))
+        root.putChild("b", Data("content of b"))
+        root.putChild("big", Data("x" * BIG_SIZE))
+        root.putChild("chunked", ChunkedData("content of chunked"))
+        self.site = CountingFactory(Site(root))
+        self.httpserver = reactor.listenTCP(0, self.site,
+                                            interface="127.0.0.1")
+        self.port = self.httpserver.getHost().port
+        self.requester = None
+
+    def tearDown(self):
+        if self.requester is not None:
+            self.requester.cleanup()
+        for channel in self.site.protocols.keys():
+            channel.transport.loseConnection()
+        d = defer.maybeDeferred(self.httpserver.stopListening)
+        # Let the connections close
+        d.addCallback(lambda _: delay(None, 0.1))
+        return d
+
+    def testConnectionReused(self):
+        self.setUpRequester()
+        d = self.retrieve("a")
+        d.addCallback(self.checkContent, "content of a")
+        d.addCallback(lambda _: self.retrieve("b", start=3, size=5))
+        d.addCallback(self.checkContent, "tent ")
+        d.addCallback(lambda _: self.retrieve("a"))
+        d.addCallback(self.checkContent, "content of a")
+        d.addCallback(lambda _: self.assertEqual(self.countConnections(), 1))
+        return d
+
+    def testPipelined(self):
+        self.setUpRequester(maxConnections=1, pipelineDepth=3)
+        d = defer.gatherResults([self.retrieve("a"),
+                                 self.retrieve("b", start=8),
+                                 self.retrieve("a", size=7)])
+
+        def check(consumers):
+            self.checkContent(consumers[0], "content of a")
+            self.checkContent(consumers[1], "of b")
+            self.checkContent(consumers[2], "content")
+            self.assertEqual(self.countConnections(), 1)
+
+        d.addCallback(check)
+        return d
+
+    def testConnectionLimit(self):
+        self.setUpRequester(maxConnections=2, pipelineDepth=1)
+        retrievals = [self.retrieve("a") for i in range(5)]
+        pool = self.requester.getPool("127.0.0.1", self.port)
+        self.assertEqual(pool._connecting, 2)
+        d = defer.gatherResults(retrievals)
+
+        def check(consumers):
+            for consumer in consumers:
+                self.checkContent(consumer, "content of a")
+            self.assertEqual(self.countConnections(), 2)
+
+        d.addCallback(check)
+        return d
+
+    def testIdleEviction(self):
+        self.setUpRequester(keepaliveTimeout=0.1)
+        pool = self.requester.getPool("127.0.0.1", self.port)
+        d = self.retrieve("a")
+        d.addCallback(lambda _: self.assertEqual(len(pool), 1))
+        d.addCallback(delay, 0.3)
+        d.addCallback(lambda _: self.assertEqual(len(pool), 0))
+        d.addCallback(lambda _: self.retrieve("b"))
+        d.addCallback(self.checkContent, "content of b")
+        d.addCallback(lambda _: self.assertEqual(self.countConnections(), 2))
+        return d
+
+    def testNotFoundKeepsConnection(self):
+        self.setUpRequester()
+        d = self.retrieve("missing")
+        d.addCallback(lambda c: self.assertEqual(c.error,
+                                                 common.STREAM_NOTFOUND))
+        # Notified before the end of the response
+        d.addCallback(delay, 0.1)
+        d.addCallback(lambda _: self.retrieve("a"))
+        d.addCallback(self.checkContent, "content of a")
+        d.addCallback(lambda _: self.assertEqual(self.countConnections(), 1))
+        return d
+
+    def testCancelBigResponse(self):
+        # Too big to be drained, the connection is closed and the
+        # pipelined request sent again on a new one
+        d = self.retrieveCanceled("big")
+        d.addCallback(self.checkContent, "content of a")
+        d.addCallback(lambda _: self.assertEqual(self.countConnections(), 2))
+        return d
+
+    def testCancelSmallResponse(self):
+        # Drained, the connection is kept
+        d = self.retrieveCanceled("b")
+        d.addCallback(self.checkContent, "content of a")
+        d.addCallback(lambda _: self.assertEqual(self.countConnections(), 1))
+        return d
+
+    def testChunkedResponse(self):
+        self.setUpRequester()
+        d = self.retrieve("chunked", start=3)
+        d.addCallback(self.checkContent, "tent of chunked")
+        d.addCallback(lambda c: self.assertEqual(c.info.size, 15))
+        d.addCallback(lambda _: self.retrieve("a"))
+        d.addCallback(self.checkContent, "content of a")
+        d.addCallback(lambda _: self.assertEqual(self.countConnections(), 1))
+        return d
+
+    def testChunkedPipelined(self):
+        self.setUpRequester(maxConnections=1, pipelineDepth=3)
+        d = defer.gatherResults([self.retrieve("chunked", size=18),
+                                 self.retrieve("a"),
+                                 self.retrieve("chunked", start=11)])
+
+        def check(consumers):
+            self.checkContent(consumers[0], "content of chunked")
+            self.checkContent(consumers[1], "content of a")
+            self.checkContent(consumers[2], "chunked")
+            self.assertEqual(self.countConnections(), 1)
+
+        d.addCallback(check)
+        return d
+
+    def testCancelChunkedResponse(self):
+        # Its size is unknown, the connection is closed
+        d = self.retrieveCanceled("chunked")
+        d.addCallback(self.checkContent, "content of a")
+        d.addCallback(lambda _: self.assertEqual(self.countConnections(), 2))
+        return d
+
+    def testStaleConnectionRetried(self):
+        self.setUpRequester()
+        d = self.retrieve("a")
+
+        def closeServerSide(_):
+            for channel in self.site.protocols.keys():
+                channel.transport.loseConnection()
+            # The client sends before noticing the connection is closed
+            return self.retrieve("b")
+
+        d.addCallback(closeServerSide)
+        d.addCallback(self.checkContent, "content of b")
+        return d
+
+    def testServerUnavailable(self):
+        self.setUpRequester()
+        d = defer.maybeDeferred(self.httpserver.stopListening)
+        d.addCallback(lambda _: self.retrieve("a"))
+        d.addCallback(lambda c: self.assertEqual(c.error,
+                                                 common.SERVER_UNAVAILABLE))
+        d.addCallback(lambda _: setattr(self, "httpserver",
+                                        reactor.listenTCP(0, self.site)))
+        return d
+
+    ### Helper functions ###
+
+    def setUpRequester(self, **kwargs):
+        self.requester = http_pool.PooledStreamRequester(2, 5, **kwargs)
+
+    def getUrl(self, name):
+        return http_utils.Url(hostname="localhost", port=self.port,
+                              path="/" + name)
+
+    def retrieve(self, name, start=None, size=None):
+        consumer = Consumer()
+        self.requester.retrieve(consumer, self.getUrl(name),
+                                "127.0.0.1", self.port,
+                                start=start, size=size)
+        return consumer.deferred
+
+    def retrieveCanceled(self, name):
+        """
+        Pipelines a request after one canceled before its response.
+        """
+        self.setUpRequester(maxConnections=1, pipelineDepth=2)
+        canceled = Consumer()
+
+        def retrieve(_):
+            getter = self.requester.retrieve(canceled, self.getUrl(name),
+                                             "127.0.0.1", self.port)
+            d = self.retrieve("a")
+            getter.cancel()
+            return d
+
+        def check(consumer):
+            self.failIf(canceled.deferred.called)
+            return consumer
+
+        d = self.retrieve("a")
+        d.addCallback(retrieve)
+        d.addCallback(check)
+        return d
+
+    def checkContent(self, consumer, content):
+        self.assertEqual(consumer.error, None)
+        self.assertEqual("".join(consumer.data), content)
+        return consumer
+
+    def countConnections(self):
+        return self.site.connections
+
+
+def delay(ret, t):
+    d = defer.Deferred()
+    reactor.callLater(t, d.callback, ret)
+    return d
@@ -1305,11 +1305,87 @@ class TestBasicCachingStrategy(TestCase):
         d.callback(None)
         return d
 
-    def _setup(self, _, files, resources, ttl=DEFAULT_TTL):
+    def testSharedBlocks(self):
+        data = os.urandom(BLOCK_SIZE*4 + EXTRA_DATA)
+        mtime = time.time()
+
+        d = defer.Deferred()
+
+        d.addCallback(self._setup, [], [ResDef("/dummy", data, mtime)])
+
+        # The file is not cached and the resource exists.
+        # The session is waiting for its temporary file,
+        # so two sources reading at the same time request the blocks
+        # to the server, but only once.
+
+        d.addCallback(self._set, "cachemgr", "new_temp_delay", 0.8)
+        d.addCallback(self._getSource, "http://www.flumotion.net/dummy")
+        d.addCallback(self._gotSource, "source1", "session")
+        d.addCallback(self._getSource, "http://www.flumotion.net/dummy")
+        d.addCallback(self._gotSource, "source2")
+        d.addCallback(self._checkSessions, 1)
+        d.addCallback(self._checkReqCount, 1)
+
+        d.addCallback(lambda _: defer.gatherResults([
+            self._readAllData(self.sources["source1"]),
+            self._readAllData(self.sources["source2"])]))
+        d.addCallback(lambda r: [self._checkData(x, data) for x in r])
+        d.addCallback(self._checkReqCount, 1 + 5)
+        d.addCallback(self._checkReqsSize,
+                      [None] + [BLOCK_SIZE]*4 + [EXTRA_DATA])
+        d.addCallback(lambda _: self.assertEqual(
+            self.cachemgr.stats.saved, len(data)))
+        d.addCallback(self._closeSource, "source1")
+        d.addCallback(self._closeSource, "source2")
+        d.addCallback(self._waitFinished, "session")
+        d.addCallback(self._checkFilesCompleted)
+
+        d.callback(None)
+        return d
+
+    def testReadAhead(self):
+        data = os.urandom(BLOCK_SIZE*4 + EXTRA_DATA)
+        mtime = time.time()
+
+        d = defer.Deferred()
+
+        d.addCallback(self._setup, [], [ResDef("/dummy", data, mtime)],
+                      readAhead=2)
+
+        # The file is not cached and the resource exists.
+        # The session is waiting for its temporary file,
+        # so the source requests the blocks to the server
+        # with the two next ones.
+
+        d.addCallback(self._set, "cachemgr", "new_temp_delay", 0.8)
+        d.addCallback(self._getSource, "http://www.flumotion.net/dummy")
+        d.addCallback(self._gotSource, "source", "session")
+        d.addCallback(self._checkReqCount, 1)
+
+        d.addCallback(lambda _: self.sources["source"].read(0, BLOCK_SIZE))
+        d.addCallback(self._checkData, data[:BLOCK_SIZE])
+        d.addCallback(self._checkReqCount, 1 + 3)
+        d.addCallback(lambda _: self._readAllData(self.sources["source"],
+                                                  acc=data[:BLOCK_SIZE]))
+        d.addCallback(self._checkData, data)
+        d.addCallback(self._checkReqCount, 1 + 5)
+        d.addCallback(self._checkReqsSize,
+                      [None] + [BLOCK_SIZE]*4 + [EXTRA_DATA])
+        # Read ahead, not shared
+        d.addCallback(lambda _: self.assertEqual(
+            self.cachemgr.stats.coalesced, 0))
+        d.addCallback(self._closeSource, "source")
+        d.addCallback(self._waitFinished, "session")
+
+        d.callback(None)
+        return d
+
+    def _setup(self, _, files, resources, ttl=DEFAULT_TTL, readAhead=0):
         self.cachemgr = DummyCacheMgr(*files)
         self.reqmgr = DummyReqMgr(*resources)
         self.stgy = strategy_basic.CachingStrategy(self.cachemgr,
-                                                   self.reqmgr, ttl)
+                                                   self.reqmgr, ttl,
+                                                   readAhead)
         return self.stgy.setup()
 
     def _getSource(self, _, urlstr):
@@ -1602,7 +1678,8 @@ class DummyRequestStatistics(object):
 class DummyStatistics:
 
     def __init__(self):
-        pass
+        self.coalesced = 0
+        self.saved = 0
 
     def onCopyStarted(self):
         pass
@@ -1613,6 +1690,10 @@ class DummyStatistics:
     def onCopyFinished(self, size):
         pass
 
+    def onRequestCoalesced(self, size):
+        self.coalesced += 1
+        self.saved += size
+
 
 class DummyCacheMgr(object):
 
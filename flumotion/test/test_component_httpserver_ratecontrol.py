@@ -0,0 +1,268 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+import struct
+
+from twisted.internet import defer, reactor
+
+from flumotion.common.testsuite import TestCase
+from flumotion.component.misc.httpserver import mediainfo, ratecontrol
+
+
+def wait(delay):
+    d = defer.Deferred()
+    reactor.callLater(delay, d.callback, None)
+    return d
+
+
+def makeFLV(**properties):
+    data = ''
+    for name, value in properties.items():
+        data += struct.pack('>H', len(name)) + name
+        data += '\x00' + struct.pack('>d', value)
+    metadata = ('\x02\x00\x0aonMetaData\x08' +
+                struct.pack('>I', len(properties)) + data + '\x00\x00\x09')
+    return ('FLV\x01\x05\x00\x00\x00\x09\x00\x00\x00\x00' +
+            '\x12' + struct.pack('>I', len(metadata))[1:] + '\x00' * 7 +
+            metadata)
+
+
+def makeBox(kind, data):
+    return struct.pack('>I', len(data) + 8) + kind + data
+
+
+def makeMP4(duration, timescale, moovFirst=True):
+    ftyp = makeBox('ftyp', 'isom\x00\x00\x02\x00isomiso2')
+    mvhd = makeBox('mvhd', '\x00' * 12 + struct.pack('>II', timescale,
+                                                     duration) + '\x00' * 80)
+    moov = makeBox('moov', mvhd)
+    # The media data is bigger than what we look at
+    mdat = struct.pack('>I', 1 << 30) + 'mdat' + '\x00' * 100
+    if moovFirst:
+        return ftyp + moov + mdat
+    return ftyp + mdat + moov
+
+
+class DummyStats(object):
+
+    def __init__(self):
+        self.saved = 0
+
+    def onBytesSaved(self, size):
+        self.saved += size
+
+
+class DummyConsumer(object):
+
+    path = "/file"
+
+    def __init__(self, size=None):
+        self.writes = []
+        self.finished = False
+        self.size = size
+
+    def getResponseRange(self):
+        if self.size is None:
+            return None, None, None
+        return 0, self.size - 1, self.size
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+    def write(self, data):
+        self.writes.append(data)
+
+    def finish(self):
+        self.finished = True
+
+
+class TestTimingWheel(TestCase):
+
+    def setUp(self):
+        self.wheel = ratecontrol.TimingWheel(0.01, 5)
+        self.calls = []
+
+    def tearDown(self):
+        self.wheel.stop()
+
+    def testFire(self):
+        self.wheel.schedule(0.01, self.calls.append)
+        self.wheel.schedule(0.03, self.calls.append)
+        # Longer than the wheel, rounded down
+        self.wheel.schedule(10, self.calls.append)
+        self.assertEqual(len(self.wheel), 3)
+
+        def check(_):
+            self.assertEqual(len(self.calls), 3)
+            self.assertEqual(len(self.wheel), 0)
+            # No more ticks when there's nothing to call
+            self.assertEqual(self.wheel._tickDC, None)
+        d = wait(0.2)
+        d.addCallback(check)
+        return d
+
+    def testCancel(self):
+        call = self.wheel.schedule(0.02, self.calls.append)
+        self.wheel.schedule(0.02, self.calls.append)
+        call.cancel()
+        call.cancel()
+        self.assertEqual(len(self.wheel), 1)
+
+        def check(_):
+            self.assertEqual(len(self.calls), 1)
+            self.assertEqual(len(self.wheel), 0)
+        d = wait(0.1)
+        d.addCallback(check)
+        return d
+
+
+class TestScheduledTokenBucketConsumer(TestCase):
+
+    def setUp(self):
+        self.wheel = ratecontrol.TimingWheel(0.01, 6)
+        self.consumer = DummyConsumer()
+        self.bucket = ratecontrol.ScheduledTokenBucketConsumer(
+            self.wheel, 0.05, self.consumer, 1000, 10000, 100)
+
+    def tearDown(self):
+        self.wheel.stop()
+
+    def testRate(self):
+        self.bucket.resumeProducing()
+        self.bucket.write("a" * 150)
+        self.bucket.write("b" * 150)
+        self.bucket.write("c" * 150)
+        # The initial level is sent at once
+        self.assertEqual(self.consumer.writes, ["a" * 100])
+        self.assertEqual(len(self.wheel), 1)
+        self.bucket.finish()
+
+        def check(_):
+            # Written in batches at the rate
+            data = "".join(self.consumer.writes)
+            self.assertEqual(data, "a" * 150 + "b" * 150 + "c" * 150)
+            self.failUnless(len(self.consumer.writes) < 5)
+            self.failUnless(self.consumer.finished)
+        d = wait(0.2)
+        d.addCallback(check)
+        return d
+
+    def testStop(self):
+        self.bucket.resumeProducing()
+        self.bucket.write("a" * 500)
+        self.bucket.stopProducing()
+        self.assertEqual(len(self.wheel), 0)
+        self.failUnless(self.consumer.finished is False)
+
+
+class TestMediaInfo(TestCase):
+
+    def testFLVDatarates(self):
+        data = makeFLV(duration=10.0, videodatarate=400.0,
+                       audiodatarate=64.0)
+        self.assertEqual(mediainfo.getBitrate(data, 1000), 464000)
+
+    def testFLVDuration(self):
+        data = makeFLV(duration=10.0, width=320.0)
+        self.assertEqual(mediainfo.getBitrate(data, 100000), 80000)
+        self.assertEqual(mediainfo.getBitrate(data), None)
+
+    def testMP4(self):
+        data = makeMP4(90000 * 20, 90000)
+        self.assertEqual(mediainfo.getBitrate(data, 1000000), 400000)
+
+    def testMP4MovieHeaderAtTheEnd(self):
+        data = makeMP4(90000 * 20, 90000, False)
+        self.assertEqual(mediainfo.getBitrate(data, 1000000), None)
+
+    def testUnknown(self):
+        self.assertEqual(mediainfo.getBitrate("x" * 1000, 1000), None)
+        self.assertEqual(mediainfo.getBitrate("FLV", 1000), None)
+
+
+class TestPacedTokenBucketConsumer(TestCase):
+
+    def setUp(self):
+        # 1 s of media at once, then at the bitrate
+        props = {'burst-duration': 1.0, 'rate-multiple': 1.0,
+                 'drip-interval': 0.05, 'tick-interval': 0.01}
+        self.plug = ratecontrol.RateControllerAdaptivePlug(
+            {'properties': props})
+        self.stats = DummyStats()
+        self.plug.setServerStatistics(self.stats)
+
+    def tearDown(self):
+        self.plug.stop(None)
+
+    def createBucket(self, consumer, metadata=None):
+        bucket = self.plug.createProducerConsumerProxy(consumer, metadata)
+        bucket.resumeProducing()
+        return bucket
+
+    def testBitrateFromData(self):
+        consumer = DummyConsumer(10000)
+        bucket = self.createBucket(consumer)
+        # 8 kbps, 1000 bytes per second
+        data = makeFLV(videodatarate=8.0)
+        data += "x" * (3000 - len(data))
+        bucket.write(data[:10])
+        self.assertEqual(bucket.bitrate, None)
+        bucket.write(data[10:])
+        self.assertEqual(bucket.bitrate, 8000)
+        self.assertEqual(bucket.getBytesSent(), 1000)
+        self.assertEqual(self.plug.getKnownBitrate("/file"), 8000)
+
+        def check(_):
+            sent = bucket.getBytesSent()
+            self.failUnless(1000 < sent < 2000, sent)
+        d = wait(0.3)
+        d.addCallback(check)
+        return d
+
+    def testBitrateFromMetadata(self):
+        consumer = DummyConsumer(10000)
+        bucket = self.createBucket(consumer, {'duration': 10})
+        self.assertEqual(bucket.bitrate, 8000)
+        bucket.write("x" * 3000)
+        self.assertEqual(bucket.getBytesSent(), 1000)
+
+    def testKnownBitrate(self):
+        self.plug.setKnownBitrate("/file", 16000)
+        bucket = self.createBucket(DummyConsumer())
+        self.assertEqual(bucket.bitrate, 16000)
+
+    def testUnknownBitrate(self):
+        consumer = DummyConsumer(10000)
+        bucket = self.createBucket(consumer)
+        bucket.write("x" * ratecontrol.SNIFF_SIZE)
+        bucket.write("x" * 1000)
+        self.assertEqual(bucket.bitrate, None)
+        self.assertEqual(bucket.getBytesSent(), ratecontrol.SNIFF_SIZE + 1000)
+        bucket.stopProducing()
+        self.assertEqual(self.stats.saved, 0)
+
+    def testAbandoned(self):
+        consumer = DummyConsumer(10000)
+        bucket = self.createBucket(consumer, {'bitrate': 8000})
+        bucket.write("x" * 3000)
+        bucket.stopProducing()
+        self.assertEqual(self.stats.saved, 9000)
+        bucket.stopProducing()
+        self.assertEqual(self.stats.saved, 9000)
@@ -15,6 +15,7 @@
 #
 # Headers in this file shall remain intact.
 
+from twisted.internet import defer, reactor
 from twisted.trial import unittest
 
 from flumotion.common import testsuite
@@ -38,6 +39,21 @@ CONFIG = {
 }
 
 
+class FakeBroker:
+    pass
+
+
+class FakeObserver:
+
+    def __init__(self):
+        self.broker = FakeBroker()
+        self.calls = []
+
+    def callRemote(self, method, *args):
+        self.calls.append((method, ) + args)
+        return defer.succeed(None)
+
+
 class StreamerTestCase(testsuite.TestCase):
 
     slow = True
@@ -95,5 +111,63 @@ class TestStreamDataPlug(StreamerTestCase):
     testGetStreamData.skip = 'See #1137'
 
 
+class TestUIState(StreamerTestCase):
+
+    def setUp(self):
+        StreamerTestCase.setUp(self)
+        self.updates = []
+
+        def updateState(set):
+            self.updates.append(set)
+            set('clients-current', len(self.updates))
+        self.component.updateState = updateState
+
+    def testNotObserved(self):
+        self.component.update_ui_state()
+        self.assertEquals(self.updates, [])
+        self.assertEquals(self.component.uiState.get('clients-current'), None)
+
+    def testObserved(self):
+        uiState = self.component.uiState
+        observer = FakeObserver()
+        uiState.getStateToCacheAndObserveFor(None, observer)
+        # not before PB has finished setting up the observer
+        self.assertEquals(self.updates, [])
+
+        def later(result=None):
+            d = defer.Deferred()
+            reactor.callLater(0, d.callback, result)
+            return d
+
+        def checkUpdated(_):
+            self.assertEquals(len(self.updates), 1)
+            self.failUnless(('batch', [('set', 'clients-current', 1)])
+                            in observer.calls)
+            # throttled
+            self.component.update_ui_state()
+            self.assertEquals(len(self.updates), 1)
+            uiState.stoppedObserving(None, observer)
+            self.component.update_ui_state()
+            self.assertEquals(len(self.updates), 1)
+            return later()
+
+        def checkNotUpdated(_):
+            self.assertEquals(len(self.updates), 1)
+            # updated right away when observed again
+            uiState.getStateToCacheAndObserveFor(None, observer)
+            return later()
+
+        def checkUpdatedAgain(_):
+            self.assertEquals(len(self.updates), 2)
+            self.assertEquals(uiState.get('clients-current'), 2)
+            uiState.stoppedObserving(None, observer)
+
+        d = later()
+        d.addCallback(checkUpdated)
+        d.addCallback(checkNotUpdated)
+        d.addCallback(checkUpdatedAgain)
+        return d
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -32,8 +32,10 @@ from flumotion.common import testsuite
 from flumotion.component.misc.httpserver import localpath
 from flumotion.component.misc.httpserver import localprovider
 from flumotion.component.misc.httpserver import cachedprovider
+from flumotion.component.misc.httpserver import memorycache
+from flumotion.component.misc.httpserver import serverstats
 from flumotion.component.misc.httpserver.fileprovider \
-    import InsecureError, NotFoundError, CannotOpenError
+    import InsecureError, NotFoundError, CannotOpenError, FileClosedError
 
 attr = testsuite.attr
 
@@ -354,6 +356,205 @@ class CachedProviderFileTest(testsuite.TestCase):
         return self.cachedFile.close()
 
 
+class AsyncLocalProviderFileTest(testsuite.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(suffix=".flumotion.test")
+        self.data = ''.join([chr(i % 256) for i in range(1000)])
+        open(os.path.join(self.path, 'a'), "w").write(self.data)
+
+        plugProps = {"properties": {"path": self.path,
+                                    "io-threads": 2,
+                                    "read-ahead": 64}}
+        self.fileProviderPlug = \
+            localprovider.FileProviderLocalPlug(plugProps)
+        self.stats = serverstats.ServerStatistics()
+        self.fileProviderPlug.setServerStatistics(self.stats)
+        self.fileProviderPlug.start(None)
+        self.file = self.fileProviderPlug.getRootPath().child('a').open()
+
+    def tearDown(self):
+        self.file.close()
+        self.fileProviderPlug.stop(None)
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def readAll(self, size):
+        chunks = []
+
+        def readChunk(data):
+            chunks.append(data)
+            if not data:
+                return ''.join(chunks)
+            return self.file.read(size).addCallback(readChunk)
+        return self.file.read(size).addCallback(readChunk)
+
+    def testOpen(self):
+        self.failUnless(isinstance(self.file, localprovider.AsyncLocalFile))
+        self.assertEqual(self.file.getsize(), len(self.data))
+        self.assertEqual(self.file.fileno(), None)
+
+    def testReadAll(self):
+        d = self.readAll(10)
+        d.addCallback(self.assertEqual, self.data)
+        d.addCallback(lambda _: self.assertEqual(self.file.tell(),
+                                                 len(self.data)))
+        return d
+
+    def testReadBiggerThanReadAhead(self):
+        d = self.readAll(300)
+        d.addCallback(self.assertEqual, self.data)
+        return d
+
+    def testSeek(self):
+
+        def seekAndRead(_, offset, size):
+            self.file.seek(offset)
+            d = self.file.read(size)
+            d.addCallback(self.assertEqual, self.data[offset:offset + size])
+            return d
+
+        d = defer.succeed(None)
+        for offset in (500, 510, 10, 990, 0, 2000):
+            d.addCallback(seekAndRead, offset, 20)
+        return d
+
+    def testSeekWhileReadingAhead(self):
+        d = self.file.read(10)
+        d.addCallback(self.assertEqual, self.data[:10])
+        # The block following the position is being read now
+        d.addCallback(lambda _: self.file.seek(700))
+        d.addCallback(lambda _: self.file.read(100))
+        d.addCallback(self.assertEqual, self.data[700:800])
+        return d
+
+    def testCloseWhileReadingAhead(self):
+        d = self.file.read(10)
+
+        def close(_):
+            self.file.close()
+            self.assertRaises(FileClosedError, self.file.read, 10)
+        d.addCallback(close)
+        return d
+
+    def testStatistics(self):
+        d = self.readAll(10)
+
+        def check(_):
+            self.assertEqual(self.stats.readQueueDepth, 0)
+            self.failUnless(self.stats.readQueueDepthPeak >= 1)
+            # 64 bytes are read at a time
+            self.failUnless(self.stats.totalReadCount >= 1000 / 64)
+            self.stats._update()
+            self.stats.stopUpdates()
+            self.failUnless(self.stats.meanReadLatency > 0)
+        d.addCallback(check)
+        return d
+
+
+class MemoryCacheTest(testsuite.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(suffix=".flumotion.test")
+        self.createFile('a', 'test file a')
+        self.createFile('b', 'test file b')
+        self.createFile('big', 'x' * 200)
+        self.cache = memorycache.MemoryCache(25, 100, 2)
+        self.root = memorycache.MemoryCachedPath(
+            self.cache, localprovider.LocalPath(self.path))
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def createFile(self, name, data, mtime=1):
+        path = os.path.join(self.path, name)
+        open(path, "w").write(data)
+        os.utime(path, (mtime, mtime))
+
+    def openFile(self, name):
+        d = self.root.child(name).open()
+
+        def read(f):
+            self.opened = f
+            d = f.read(f.getsize())
+            d.addCallback(lambda data: (f.close(), data)[1])
+            return d
+        d.addCallback(read)
+        return d
+
+    def openTimes(self, name, times):
+        d = defer.succeed(None)
+        for i in range(times):
+            d.addCallback(lambda _: self.openFile(name))
+        return d
+
+    def testAdmittedAfterHits(self):
+        d = self.openFile('a')
+        d.addCallback(self.assertEqual, 'test file a')
+        d.addCallback(lambda _: self.failUnless(
+            isinstance(self.opened, localprovider.LocalFile)))
+        d.addCallback(lambda _: self.openFile('a'))
+        d.addCallback(self.assertEqual, 'test file a')
+        d.addCallback(lambda _: self.failUnless(
+            isinstance(self.opened, memorycache.MemoryFile)))
+        d.addCallback(lambda _: self.assertEqual(self.cache.size, 11))
+
+        def checkStats(_):
+            stats = self.cache.stats
+            self.assertEqual(stats.memoryHitCount, 1)
+            self.assertEqual(stats.memoryMissCount, 2)
+            self.assertEqual(stats.memoryUsage, 11)
+        d.addCallback(lambda _: self.openFile('a'))
+        d.addCallback(checkStats)
+        return d
+
+    def testTooBig(self):
+        d = self.openTimes('big', 3)
+        d.addCallback(lambda _: self.failUnless(
+            isinstance(self.opened, localprovider.LocalFile)))
+        d.addCallback(lambda _: self.assertEqual(self.cache.size, 0))
+        return d
+
+    def testRange(self):
+        d = self.openTimes('a', 2)
+
+        def readRange(_):
+            f = self.root.child('a').open()
+            f.addCallback(lambda f: (f.seek(5), f)[1])
+            f.addCallback(lambda f: f.read(4))
+            return f
+        d.addCallback(readRange)
+        d.addCallback(self.assertEqual, 'file')
+        return d
+
+    def testModified(self):
+        d = self.openTimes('a', 2)
+        d.addCallback(lambda _: self.createFile('a', 'new file a', 2))
+        d.addCallback(lambda _: self.openFile('a'))
+        d.addCallback(self.assertEqual, 'new file a')
+        d.addCallback(lambda _: self.assertEqual(self.cache.size, 0))
+        return d
+
+    def testEviction(self):
+        d = self.openTimes('a', 2)
+        d.addCallback(lambda _: self.openTimes('b', 2))
+        d.addCallback(lambda _: self.openTimes('a', 1))
+        d.addCallback(lambda _: self.createFile('c', 'test file c'))
+        # Room for two files, the least recently used one goes away
+        d.addCallback(lambda _: self.openTimes('c', 2))
+
+        def check(_):
+            self.assertEqual(self.cache.size, 22)
+            self.assertEqual(self.cache.get('/b', 1), None)
+            self.assertEqual(self.cache.get('/a', 1), 'test file a')
+            self.assertEqual(self.cache.get('/c', 1), 'test file c')
+        d.addCallback(check)
+        return d
+
+    def testNotFound(self):
+        d = self.root.child('foo').open()
+        return self.assertFailure(d, NotFoundError)
+
+
 def pass_through(result, fun, *args, **kwargs):
     fun(*args, **kwargs)
     return result
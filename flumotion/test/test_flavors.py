@@ -33,10 +33,40 @@ class TestStateRemoteCache(flavors.StateRemoteCache):
 pb.setUnjellyableForClass(TestStateCacheable, TestStateRemoteCache)
 
 
+class OldTestStateCacheable(flavors.StateCacheable):
+    pass
+
+
+class OldTestStateRemoteCache(flavors.StateRemoteCache):
+    # the remote cache of a peer from before observe_batch
+
+    def remoteMessageReceived(self, broker, message, args, kw):
+        if message == 'batch':
+            raise AttributeError("%r has no attribute 'observe_batch'"
+                                 % (self, ))
+        return flavors.StateRemoteCache.remoteMessageReceived(
+            self, broker, message, args, kw)
+
+pb.setUnjellyableForClass(OldTestStateCacheable, OldTestStateRemoteCache)
+
+
 class FakeObject:
     pass
 
 
+class FakeObserver:
+
+    def __init__(self, broker=None):
+        if broker is None:
+            broker = FakeObject()
+        self.broker = broker
+        self.calls = []
+
+    def callRemote(self, method, *args):
+        self.calls.append((method, ) + args)
+        return defer.succeed(None)
+
+
 class FakeListener:
     # listener interface
     implements(flavors.IStateListener)
@@ -53,11 +83,18 @@ class FakeListener:
 
 class TestRoot(testsuite.TestManagerRoot):
 
-    def remote_getState(self):
-        self.state = TestStateCacheable()
+    def remote_getState(self, old=False):
+        if old:
+            klass = OldTestStateCacheable
+        else:
+            klass = TestStateCacheable
+        self.state = klass()
         self.state.addKey('name', 'lois')
         self.state.addListKey('children')
         self.state.addDictKey('nationalities')
+        self.pet = klass()
+        self.pet.addKey('name', 'krypto')
+        self.state.addKey('pet', self.pet)
         return self.state
 
     def remote_setStateName(self, name):
@@ -81,6 +118,27 @@ class TestRoot(testsuite.TestManagerRoot):
     def remote_haveAdopted(self, name):
         return self.state.remove('children', name)
 
+    def remote_moveHouse(self):
+        self.state.beginBatch()
+        self.state.set('name', 'lana')
+        self.state.append('children', 'jon')
+        self.state.setitem('nationalities', 'lana', 'kansas')
+        self.state.set('name', 'lois')
+        self.state.setitem('nationalities', 'lana', 'metropolis')
+        return self.state.commitBatch()
+
+    def remote_renamePet(self):
+        self.state.beginBatch()
+        self.pet.beginBatch(self.state)
+        self.pet.set('name', 'streaky')
+        self.pet.commitBatch()
+        self.state.set('name', 'kara')
+        return self.state.commitBatch()
+
+    def remote_renamePetAndName(self):
+        d = self.remote_renamePet()
+        return defer.DeferredList([d, self.state.set('name', 'lara')])
+
 
 class StateTest(testsuite.TestCase):
 
@@ -284,6 +342,75 @@ class TestStateSet(StateTest):
         d.addCallback(check_remove_results_and_stop)
         return d
 
+    def testStateBatchListener(self):
+        d = self.runClient()
+        d.addCallback(lambda _: self.perspective.callRemote('getState'))
+
+        def add_listener_and_move_house(state):
+            d.state = state  # monkeypatch
+            self.listen(state)
+            return self.perspective.callRemote('moveHouse')
+
+        def check_results_and_stop(_):
+            self.assertEquals(self.changes, [
+                ('append', d.state, 'children', 'jon'),
+                ('set', d.state, 'name', 'lois'),
+                ('setitem', d.state, 'nationalities', 'lana', 'metropolis')])
+            self.assertEquals(d.state.get('children'), ['jon'])
+            self.assertEquals(d.state.get('nationalities'),
+                              {'lana': 'metropolis'})
+            return self.stopClient()
+
+        d.addCallback(add_listener_and_move_house)
+        d.addCallback(check_results_and_stop)
+        return d
+
+    def testStateBatchParentListener(self):
+        d = self.runClient()
+        d.addCallback(lambda _: self.perspective.callRemote('getState'))
+
+        def add_listeners_and_rename_pet(state):
+            d.state = state  # monkeypatch
+            self.listen(state)
+            self.listen(state.get('pet'))
+            return self.perspective.callRemote('renamePet')
+
+        def check_results_and_stop(_):
+            pet = d.state.get('pet')
+            self.assertEquals(self.changes, [
+                ('set', pet, 'name', 'streaky'),
+                ('set', d.state, 'name', 'kara')])
+            return self.stopClient()
+
+        d.addCallback(add_listeners_and_rename_pet)
+        d.addCallback(check_results_and_stop)
+        return d
+
+    def testStateBatchOldListener(self):
+        d = self.runClient()
+        d.addCallback(lambda _: self.perspective.callRemote('getState', True))
+
+        def add_listeners_and_rename(state):
+            d.state = state  # monkeypatch
+            self.listen(state)
+            self.listen(state.get('pet'))
+            return self.perspective.callRemote('renamePetAndName')
+
+        def check_results_and_stop(_):
+            # the peer failed the batch, then got its mutations one by
+            # one before the mutation made after the batch
+            self.assertEquals(len(self.flushLoggedErrors(AttributeError)), 1)
+            pet = d.state.get('pet')
+            self.assertEquals(self.changes, [
+                ('set', pet, 'name', 'streaky'),
+                ('set', d.state, 'name', 'kara'),
+                ('set', d.state, 'name', 'lara')])
+            return self.stopClient()
+
+        d.addCallback(add_listeners_and_rename)
+        d.addCallback(check_results_and_stop)
+        return d
+
 
 class TestFullListener(StateTest):
 
@@ -442,3 +569,94 @@ class TestState(testsuite.TestCase):
         self.assertEquals(c.get('adict'), {})
         self.assertRaises(KeyError, c.delitem, 'randomdictkey', 'value')
         self.assertRaises(KeyError, c.delitem, 'adict', 'akey')
+
+    def testStateBatch(self):
+        c = flavors.StateCacheable()
+        observer = FakeObserver()
+        c.getStateToCacheAndObserveFor(None, observer)
+
+        c.addKey('akey')
+        c.addListKey('alist')
+        c.addDictKey('adict')
+
+        c.beginBatch()
+        c.set('akey', 'avalue')
+        c.append('alist', 'avalue')
+        c.setitem('adict', 'akey', 'avalue')
+        c.beginBatch()
+        c.set('akey', 'bvalue')
+        c.setitem('adict', 'akey', 'bvalue')
+        c.setitem('adict', 'bkey', 'avalue')
+        c.delitem('adict', 'bkey')
+        c.commitBatch()
+        # the state is changed at once, the observers only told at the end
+        self.assertEquals(c.get('akey'), 'bvalue')
+        self.assertEquals(observer.calls, [])
+        c.commitBatch()
+        self.assertEquals(observer.calls, [('batch', [
+            ('append', 'alist', 'avalue'),
+            ('set', 'akey', 'bvalue'),
+            ('setitem', 'adict', 'akey', 'bvalue'),
+            ('setitem', 'adict', 'bkey', 'avalue'),
+            ('delitem', 'adict', 'bkey', 'avalue')])])
+
+        # a set drops the previous mutations of the key
+        observer.calls = []
+        c.beginBatch()
+        c.append('alist', 'bvalue')
+        c.set('alist', ['cvalue'])
+        c.commitBatch()
+        self.assertEquals(observer.calls,
+                          [('batch', [('set', 'alist', ['cvalue'])])])
+
+        # mutations outside batches are sent right away
+        observer.calls = []
+        c.beginBatch()
+        c.commitBatch()
+        c.set('akey', 'cvalue')
+        self.assertEquals(observer.calls, [('set', 'akey', 'cvalue')])
+        self.assertRaises(AssertionError, c.commitBatch)
+
+    def testStateBatchParent(self):
+        broker = FakeObject()
+        parent = flavors.StateCacheable()
+        parentObserver = FakeObserver(broker)
+        parent.getStateToCacheAndObserveFor(None, parentObserver)
+        parent.addKey('akey')
+        c = flavors.StateCacheable()
+        observer = FakeObserver(broker)
+        c.getStateToCacheAndObserveFor(None, observer)
+        c.addKey('akey')
+
+        # sent in the batch of the parent
+        parent.beginBatch()
+        c.beginBatch(parent)
+        c.set('akey', 'avalue')
+        c.commitBatch()
+        parent.set('akey', 'bvalue')
+        parent.commitBatch()
+        self.assertEquals(observer.calls, [])
+        self.assertEquals(parentObserver.calls, [('batch', [
+            ('batch', c, [('set', 'akey', 'avalue')]),
+            ('set', 'akey', 'bvalue')])])
+
+        # sent on its own without a batch of the parent
+        parentObserver.calls = []
+        c.beginBatch(parent)
+        c.set('akey', 'bvalue')
+        c.commitBatch()
+        self.assertEquals(observer.calls,
+                          [('batch', [('set', 'akey', 'bvalue')])])
+        self.assertEquals(parentObserver.calls, [])
+
+        # or when observed by other peers than the parent
+        observer.calls = []
+        c.getStateToCacheAndObserveFor(None, FakeObserver(FakeObject()))
+        parent.beginBatch()
+        c.beginBatch(parent)
+        c.set('akey', 'cvalue')
+        c.commitBatch()
+        parent.commitBatch()
+        self.assertEquals(observer.calls,
+                          [('batch', [('set', 'akey', 'cvalue')])])
+        self.assertEquals(parentObserver.calls, [])
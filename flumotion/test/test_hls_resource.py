@@ -14,6 +14,7 @@
 # Headers in this file shall remain intact.
 
 import base64
+import os
 
 from twisted.trial import unittest
 from twisted.web import server
@@ -29,6 +30,7 @@ import flumotion.component.common.streamer.fragmentedresource as fresources
 from flumotion.component.common.streamer.resources import ERROR_TEMPLATE,\
     HTTP_VERSION
 from flumotion.component.consumers.hlsstreamer import resources, hlsring
+from flumotion.component.consumers.hlsstreamer import fragmentspool
 from flumotion.component.base.http import HTTPAuthentication
 
 MAIN_PLAYLIST=\
@@ -40,6 +42,14 @@ MAIN_PLAYLIST=\
 http://localhost/fragment-0.webm
 """
 
+RENDITIONS_PLAYLIST=\
+"""#EXTM3U
+#EXT-X-STREAM-INF:PROGRAM-ID=1,BANDWIDTH=800000
+http://localhost/high/stream.m3u8
+#EXT-X-STREAM-INF:PROGRAM-ID=1,BANDWIDTH=200000
+http://localhost/low/stream.m3u8
+"""
+
 FRAGMENT = 'fragment1'
 
 
@@ -109,6 +119,7 @@ class FakeRequest:
         self.cookies = {}
         self.session = None
         self.headers = {}
+        self.receivedHeaders = {}
         self.response = http.OK
         self.data = ""
         self.clientproto=''
@@ -144,6 +155,14 @@ class FakeRequest:
     def write(self, text):
         self.data = self.data + text
 
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+        while self.producer:
+            producer.resumeProducing()
+
+    def unregisterProducer(self):
+        self.producer = None
+
     def finish(self):
         if isinstance(self.onFinish, defer.Deferred):
             self.onFinish.callback(self)
@@ -151,6 +170,7 @@ class FakeRequest:
     getUser = lambda s: s.user
     getPassword = lambda s: s.passwd
     getClientIP = lambda s: s.ip
+    getHeader = lambda s, k: s.receivedHeaders.get(k.lower())
     getAllHeaders = lambda s: s.headers
     getBytesSent = lambda s: ''
     getDuration = lambda s: 0
@@ -268,11 +288,109 @@ class TestAppleStreamerSessions(unittest.TestCase):
         d.addCallback(self.checkResponse, MAIN_PLAYLIST)
         return d
 
+    def testPlaylistNotModified(self):
+        return self.requestPlaylistTwice(lambda etag: etag,
+                                         http.NOT_MODIFIED)
+
+    def testPlaylistNotModifiedList(self):
+        return self.requestPlaylistTwice(
+            lambda etag: '"other", %s' % etag, http.NOT_MODIFIED)
+
+    def testPlaylistNotModifiedAny(self):
+        return self.requestPlaylistTwice(lambda etag: '*',
+                                         http.NOT_MODIFIED)
+
+    def testPlaylistModified(self):
+        return self.requestPlaylistTwice(lambda etag: '"other"', http.OK)
+
+    def requestPlaylistTwice(self, ifNoneMatch, response):
+        """
+        Requests the main playlist, then again with the If-None-Match
+        header made from its ETag by the given function.
+        """
+
+        def checkResponse(request):
+            self.assertEquals(request.response, response)
+            if response == http.NOT_MODIFIED:
+                self.assertEquals(request.data, '')
+            else:
+                self.assertEquals(request.data, MAIN_PLAYLIST)
+            for d in reactor.getDelayedCalls():
+                d.cancel()
+
+        def resendRequest(request):
+            self.assertEquals(request.response, http.OK)
+            etag = request.headers['ETag']
+            d = defer.Deferred()
+            request = FakeRequest(self.site, "GET",
+                    "/localhost/stream.m3u8", onFinish=d)
+            request.receivedHeaders['if-none-match'] = ifNoneMatch(etag)
+            self.resource.render_GET(request)
+            return d
+
+        d = self.processRequest("GET", "/localhost/stream.m3u8")
+        d.addCallback(resendRequest)
+        d.addCallback(checkResponse)
+        return d
+
     def testGetFragment(self):
         d = self.processRequest("GET", "/localhost/fragment-0.webm")
         d.addCallback(self.checkResponse, FRAGMENT)
         return d
 
+    def testGetChunkedFragment(self):
+
+        def checkFragment(request):
+            self.assertEquals(request.headers['content-length'],
+                              len('header' + FRAGMENT + 'x'))
+            self.checkResponse(request, 'header' + FRAGMENT + 'x')
+
+        self.streamer.ring.addFragment(['header', FRAGMENT, 'x'], 1, 10)
+        d = self.processRequest("GET", "/localhost/fragment-1.webm")
+        d.addCallback(checkFragment)
+        return d
+
+    def testGetSpooledFragment(self):
+
+        def checkFragment(request):
+            self.assertEquals(request.headers['content-length'],
+                              len(FRAGMENT))
+            self.checkResponse(request, FRAGMENT)
+
+        directory = self.mktemp()
+        os.makedirs(directory)
+        spool = fragmentspool.FragmentSpool(directory)
+        fragment = spool.store([FRAGMENT], len(FRAGMENT))
+        self.streamer.ring._fragmentsDict['fragment-0.webm'] = fragment
+        d = self.processRequest("GET", "/localhost/fragment-0.webm")
+        d.addCallback(checkFragment)
+        return d
+
+    def testGetRenditions(self):
+
+        def getVariantPlaylist(request):
+            self.assertEquals(request.data, RENDITIONS_PLAYLIST)
+            return self.processRequest("GET", "/localhost/low/stream.m3u8")
+
+        def getFragment(request):
+            self.failUnless('\nhttp://localhost/low/fragment-0.webm\n' in
+                            request.data)
+            return self.processRequest("GET", "/localhost/low/fragment-0.webm")
+
+        renditions = hlsring.HLSRenditions("main.m3u8")
+        renditions.setHostname("localhost")
+        for name, bitrate in (('high', 800000), ('low', 200000)):
+            ring = hlsring.HLSRing("main.m3u8", "stream.m3u8", bitrate)
+            renditions.addRendition(name, ring)
+            renditions.addFragment(name, FRAGMENT + name, 0, 10)
+        self.resource.ring = renditions
+
+        d = self.processRequest("GET", "/localhost/main.m3u8")
+        d.addCallback(getVariantPlaylist)
+        d.addCallback(getFragment)
+        d.addCallback(self.checkResponse, FRAGMENT + 'low')
+        return d
+
     def testNewSession(self):
 
         def checkSessionCreated(request):
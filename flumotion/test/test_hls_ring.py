@@ -13,9 +13,13 @@
 
 # Headers in this file shall remain intact.
 
+import os
+import shutil
+import tempfile
+
 from twisted.trial import unittest
 
-from flumotion.component.consumers.hlsstreamer import hlsring
+from flumotion.component.consumers.hlsstreamer import fragmentspool, hlsring
 
 
 class TestHLSRing(unittest.TestCase):
@@ -120,6 +124,241 @@ http://localhost:8000/fragment-5.webm?GKID=%s
         self.assertEqual(self.ring._renderStreamPlaylist(args),
                 self.STREAM_WITH_GKID_PLAYLIST % tuple(5*[ID]))
 
+    def testStreamPlaylistCached(self):
+        self.ring._hostname = 'http://localhost:8000/'
+        self.ring.title = 'Title'
+        for i in range(6):
+            self.ring.addFragment('', i, 2)
+        version = self.ring.getPlaylistVersion()
+        playlist = self.ring.renderPlaylist('stream.m3u8', {})
+        self.assertIdentical(self.ring.renderPlaylist('stream.m3u8', {}),
+                playlist)
+        self.assertEqual(self.ring.getPlaylistVersion(), version)
+
+        # Duplicates don't change the playlist
+        self.ring.addFragment('', 5, 2)
+        self.assertEqual(self.ring.getPlaylistVersion(), version)
+        self.assertIdentical(self.ring.renderPlaylist('stream.m3u8', {}),
+                playlist)
+
+        self.ring.addFragment('', 6, 2)
+        self.failUnless(self.ring.getPlaylistVersion() > version)
+        playlist = self.ring.renderPlaylist('stream.m3u8', {})
+        self.failUnless(playlist.startswith(
+            self.STREAM_PLAYLIST.replace('SEQUENCE:1', 'SEQUENCE:2')[:60]))
+        self.failUnless(playlist.endswith('fragment-6.webm\n'))
+
+    def testCachedPlaylistWithArgs(self):
+        self.ring._hostname = 'http://localhost:8000/'
+        self.ring.title = 'Title'
+        for i in range(6):
+            self.ring.addFragment('', i, 2)
+        # Render without args first, so the args are spliced into the
+        # cached playlist
+        self.ring.renderPlaylist('stream.m3u8', {})
+        self.assertEqual(self.ring.renderPlaylist('stream.m3u8',
+                {'GKID': ['12345'], 'FLUREQID': ['1']}),
+                self.STREAM_WITH_GKID_PLAYLIST % tuple(5 * ['12345']))
+        self.assertEqual(self.ring.renderPlaylist('live.m3u8',
+                {'GKID': ['12345']}), self.MAIN_PLAYLIST.replace(
+                'stream.m3u8', 'stream.m3u8?GKID=12345'))
+
+    def testEncryptionKeysURI(self):
+        ring = hlsring.HLSRing('main.m3u8', 'stream.m3u8', keyInterval=1)
+        ring.setHostname('localhost:8000/mp')
+        ring.addFragment('fragment', 0, 2)
+        self.failUnless('URI="http://localhost:8000/mp/key?key='
+                        'fragment-0.webm"' in
+                        ring.renderPlaylist('stream.m3u8', {}))
+        self.assertEqual(len(ring.getEncryptionKey('fragment-0.webm')), 16)
+
+        ring = hlsring.HLSRing('main.m3u8', 'stream.m3u8', keyInterval=1,
+                               keysURI='https://keys/key')
+        ring.setHostname('localhost:8000/mp')
+        ring.addFragment('fragment', 0, 2)
+        self.failUnless('URI="https://keys/key?key=fragment-0.webm"' in
+                        ring.renderPlaylist('stream.m3u8', {}))
+
+    def testPlaylistETag(self):
+        for i in range(6):
+            self.ring.addFragment('', i, 2)
+        etag = self.ring.getPlaylistETag('stream.m3u8', {})
+        self.assertEqual(self.ring.getPlaylistETag('stream.m3u8', {}), etag)
+        self.assertNotEqual(self.ring.getPlaylistETag('stream.m3u8',
+                {'GKID': ['1']}), etag)
+        self.ring.addFragment('', 6, 2)
+        self.assertNotEqual(self.ring.getPlaylistETag('stream.m3u8', {}),
+                etag)
+        self.assertRaises(hlsring.PlaylistNotFound,
+                self.ring.getPlaylistETag, 'other.m3u8', {})
+
+    def testFragmentWindow(self):
+        window = hlsring.FragmentWindow()
+        for sequenceNumber, duration in [(1, 4), (2, 2), (3, 3), (4, 5)]:
+            window.append(sequenceNumber, duration, sequenceNumber * 10)
+        self.assertEqual(len(window), 4)
+        self.failUnless(3 in window)
+        self.assertEqual(window[3], 30)
+        self.assertEqual(list(window), [10, 20, 30, 40])
+        self.assertEqual(window.getShortestDuration(), 2)
+        self.assertEqual(window.popleft(), 10)
+        self.assertEqual(window.popleft(), 20)
+        self.failIf(2 in window)
+        self.assertEqual(window.getFirstSequenceNumber(), 3)
+        self.assertEqual(window.getShortestDuration(), 3)
+
+    def testTargetDurationFollowsWindow(self):
+        durations = [1, 3, 3, 3, 3, 3, 2]
+        for i, duration in enumerate(durations):
+            self.ring.addFragment('', i, duration)
+        # fragment 0 left the window; the shortest is now 2
+        self.assertEqual(self.ring._getTargetDuration(), 2)
+
+
+class TestHLSRingSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.ring = hlsring.HLSRing('live.m3u8', 'stream.m3u8',
+                '300000', 'title', window=5, spoolDirectory=self.directory,
+                memoryBudget=25)
+        self.ring._spool.segmentSize = 64
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _data(self, i):
+        return ['fragment', '-%02d' % i]
+
+    def testSpillToDisk(self):
+        for i in range(4):
+            self.ring.addFragment(self._data(i), i, 2)
+        # 11 bytes per fragment: the two newest stay in memory
+        names = list(self.ring._availableFragments)
+        for name in names[:2]:
+            fragment = self.ring.getFragment(name)
+            self.failUnless(isinstance(fragment, fragmentspool.DiskFragment))
+        for name in names[2:]:
+            self.assertEqual(self.ring.getFragment(name),
+                             self._data(names.index(name)))
+        self.assertEqual(self.ring._memoryUsed, 22)
+        for i, name in enumerate(names):
+            fragment = self.ring.getFragment(name)
+            self.assertEqual(hlsring.getFragmentLength(fragment), 11)
+            self.assertEqual(''.join(fragment), ''.join(self._data(i)))
+        # the segment files are unlinked as soon as they're created
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def testEviction(self):
+        for i in range(30):
+            self.ring.addFragment(self._data(i), i, 2)
+        self.assertEqual(len(self.ring._fragmentsDict),
+                         self.ring.maxBuffers)
+        self.assertEqual(self.ring._memoryUsed, 22)
+        oldest = self.ring.getFragment(self.ring._availableFragments[0])
+        self.assertEqual(oldest.read(), 'fragment-%02d' % (30 - 11))
+        segments = set([self.ring.getFragment(name).segment
+                        for name in list(self.ring._availableFragments)[:-2]])
+        # only the segments of the fragments in the ring are referenced
+        self.assertEqual(sum([s.refs for s in segments]), 9)
+        self.ring.reset()
+        self.assertEqual(self.ring._memoryUsed, 0)
+        self.assertEqual(sum([s.refs for s in segments]), 0)
+
+    def testDiskFragmentChunks(self):
+        spool = fragmentspool.FragmentSpool(self.directory, 16)
+        data = 'x' * (fragmentspool.CHUNK_SIZE + 10)
+        fragment = spool.store([data], len(data))
+        chunks = list(fragment)
+        self.assertEqual([len(c) for c in chunks],
+                         [fragmentspool.CHUNK_SIZE, 10])
+        self.assertEqual(fragment.read(), data)
+        spool.release(fragment)
+        self.assertEqual(fragment.segment.refs, 0)
+
+
+class TestHLSRenditions(unittest.TestCase):
+
+    def setUp(self):
+        self.renditions = hlsring.HLSRenditions('main.m3u8', 'title')
+        self.renditions.setHostname('localhost:8000')
+        for name, bitrate in (('high', 800000), ('low', 200000)):
+            self.renditions.addRendition(name, hlsring.HLSRing('main.m3u8',
+                'stream.m3u8', bitrate, 'title', window=2))
+
+    def testMainPlaylist(self):
+        self.assertEqual(self.renditions.renderPlaylist('main.m3u8', {}),
+                         "#EXTM3U\n"
+                         "#EXT-X-STREAM-INF:PROGRAM-ID=1,BANDWIDTH=800000\n"
+                         "http://localhost:8000/high/stream.m3u8\n"
+                         "#EXT-X-STREAM-INF:PROGRAM-ID=1,BANDWIDTH=200000\n"
+                         "http://localhost:8000/low/stream.m3u8\n")
+        self.assertEqual(self.renditions.renderPlaylist('main.m3u8',
+                                                        {'GKID': ['a']}),
+                         "#EXTM3U\n"
+                         "#EXT-X-STREAM-INF:PROGRAM-ID=1,BANDWIDTH=800000\n"
+                         "http://localhost:8000/high/stream.m3u8?GKID=a\n"
+                         "#EXT-X-STREAM-INF:PROGRAM-ID=1,BANDWIDTH=200000\n"
+                         "http://localhost:8000/low/stream.m3u8?GKID=a\n")
+
+    def testRenditionResources(self):
+        self.renditions.addFragment('high', 'high-0', 0, 2)
+        self.renditions.addFragment('low', 'low-0', 0, 2)
+        self.assertEqual(self.renditions.getFragment('low/fragment-0.webm'),
+                         'low-0')
+        self.assertEqual(self.renditions.getFragment('high/fragment-0.webm'),
+                         'high-0')
+        playlist = self.renditions.renderPlaylist('low/stream.m3u8', {})
+        self.failUnless('\nhttp://localhost:8000/low/fragment-0.webm\n' in
+                        playlist)
+        self.assertNotEqual(
+            self.renditions.getPlaylistETag('low/stream.m3u8', {}),
+            self.renditions.getPlaylistETag('high/stream.m3u8', {}))
+        for name in ('other/stream.m3u8', 'low/main.m3u8', 'stream.m3u8'):
+            self.assertRaises(hlsring.PlaylistNotFound,
+                              self.renditions.renderPlaylist, name, {})
+            self.assertRaises(hlsring.PlaylistNotFound,
+                              self.renditions.getPlaylistETag, name, {})
+        for name in ('fragment-0.webm', 'other/fragment-0.webm',
+                     'low/fragment-1.webm'):
+            self.assertRaises(hlsring.FragmentNotFound,
+                              self.renditions.getFragment, name)
+
+    def testEncryptionKeys(self):
+        renditions = hlsring.HLSRenditions('main.m3u8', 'title')
+        for name in ('high', 'low'):
+            renditions.addRendition(name, hlsring.HLSRing('main.m3u8',
+                'stream.m3u8', 200000, 'title', window=2, keyInterval=1))
+        # like the streamer, set once the renditions are added
+        renditions.setHostname('localhost:8000/mp')
+        renditions.addFragment('high', 'high-0', 0, 2)
+        renditions.addFragment('low', 'low-0', 0, 2)
+        playlist = renditions.renderPlaylist('low/stream.m3u8', {})
+        self.failUnless('#EXT-X-KEY:METHOD=AES-128,URI="http://'
+                        'localhost:8000/mp/key?key=low/fragment-0.webm"'
+                        in playlist, playlist)
+        low = renditions.getEncryptionKey('low/fragment-0.webm')
+        high = renditions.getEncryptionKey('high/fragment-0.webm')
+        self.assertEqual(len(low), 16)
+        self.assertNotEqual(low, high)
+        self.assertRaises(hlsring.KeyNotFound,
+                          renditions.getEncryptionKey, 'fragment-0.webm')
+
+    def testSequenceAligner(self):
+        aligner = hlsring.SequenceAligner(3)
+        # The renditions are cut at about the same time, in any order
+        self.assertEqual(aligner.getSequenceNumber(1000, 100), 0)
+        self.assertEqual(aligner.getSequenceNumber(1002, 100), 0)
+        self.assertEqual(aligner.getSequenceNumber(1100, 100), 1)
+        self.assertEqual(aligner.getSequenceNumber(1200, 100), 2)
+        self.assertEqual(aligner.getSequenceNumber(1101, 100), 1)
+        self.assertEqual(aligner.getSequenceNumber(1300, 100), 3)
+        # Too old to be remembered
+        self.assertEqual(aligner.getSequenceNumber(1000, 100), None)
+        # Numbers keep growing after a reset
+        aligner.reset()
+        self.assertEqual(aligner.getSequenceNumber(0, 100), 4)
+
 
 if __name__ == '__main__':
     unittest.main()
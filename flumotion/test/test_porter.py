@@ -17,19 +17,27 @@
 
 import cgi
 import errno
+import os
+import random
 import string
 from urllib2 import urlparse
 
-from flumotion.common import testsuite
-from flumotion.component.misc.porter import porter
+from twisted.internet import defer
+
+from flumotion.common import componentui, testsuite
+from flumotion.component.misc.porter import acceptor, porter, pathtree
+from flumotion.component.misc.porter import stats
+from flumotion.twisted import fdserver
 
 
 class FakeTransport:
     connected = True
+    disconnecting = False
     _fileno = 5
 
     def __init__(self, protocol, overloaded=False):
         self.written = ''
+        self.sent = []
         self.protocol = protocol
         self.overloaded = overloaded
 
@@ -37,9 +45,15 @@ class FakeTransport:
         self.connected = False
         self.protocol.connectionLost(None)
 
-    def sendFileDescriptor(self, fd, data):
+    def queueFileDescriptor(self, fd, data):
         if self.overloaded:
-            raise OSError(errno.EAGAIN, 'Resource temporarily unavailable')
+            return defer.fail(
+                OSError(errno.EAGAIN, 'Resource temporarily unavailable'))
+        self.sent.append((fd, data))
+        return defer.succeed(None)
+
+    def stopReading(self):
+        pass
 
     def write(self, data):
         self.written += data
@@ -50,15 +64,29 @@ class FakeTransport:
 
 class FakePorter:
     foundDestination = False
+    avatar = None
+
+    def __init__(self):
+        self.stats = stats.PorterStats()
+
+    def getStats(self):
+        return self.stats
+
+    def lookupDestination(self, path):
+        avatar = self.findDestination(path)
+        if avatar:
+            return path, avatar
+        return None, None
 
     def findDestination(self, path):
         self.foundDestination = True
         if path == '/existing':
-            return FakeAvatar(overloaded=False)
+            self.avatar = FakeAvatar(overloaded=False)
         elif path == '/overloaded':
-            return FakeAvatar(overloaded=True)
-
-        return None
+            self.avatar = FakeAvatar(overloaded=True)
+        else:
+            return None
+        return self.avatar
 
 
 class FakeBroker:
@@ -82,6 +110,9 @@ class FakeAvatar:
     def isAttached(self):
         return True
 
+    def queueFileDescriptor(self, fileno, data):
+        return self.mind.broker.transport.queueFileDescriptor(fileno, data)
+
 
 class TestPorterProtocol(testsuite.TestCase):
 
@@ -134,6 +165,9 @@ class TestHTTPPorterProtocol(testsuite.TestCase):
         self.failUnless(self.p.foundDestination)
         self.failUnless(self.t.written)
         self.failIf(self.t.written.find('404') < 0)
+        total = self.p.stats.total
+        self.assertEquals(total.rejects[stats.REJECT_NOT_FOUND], 1)
+        self.assertEquals(total.sent.getCount(), 0)
 
     def testRightLocationFound(self):
         self.pp.dataReceived('GET ')
@@ -144,6 +178,52 @@ class TestHTTPPorterProtocol(testsuite.TestCase):
         self.failUnless(self.p.foundDestination)
         self.failIf(self.t.written)
 
+    def testByteAtATime(self):
+        request = 'GET /existing HTTP/1.1\r\nHost: localhost\r\n\r\n'
+        self.pp.requestId = None
+        for c in request:
+            self.failUnless(self.t.connected)
+            self.pp.dataReceived(c)
+            if self.p.foundDestination:
+                break
+        self.failIf(self.t.connected)
+        transport = self.p.avatar.mind.broker.transport
+        self.assertEquals(transport.sent, [(5, 'GET /existing HTTP/1.1\r')])
+
+    def testBufferPassedOn(self):
+        request = 'GET /existing HTTP/1.1\r\nHost: localhost\r\n\r\n'
+        self.pp.requestId = None
+        self.pp.dataReceived(request[:10])
+        self.pp.dataReceived(request[10:])
+        self.failIf(self.t.connected)
+        transport = self.p.avatar.mind.broker.transport
+        self.assertEquals(transport.sent, [(5, request)])
+        snapshot = self.p.stats.getSnapshot()
+        self.assertEquals(snapshot['total']['requests'], 1)
+        self.assertEquals(snapshot['total']['buffered']['max'], len(request))
+        destination, = snapshot['destinations']
+        self.assertEquals(destination['mount-point'], '/existing')
+        self.assertEquals(destination['avatar-id'], 'testAvatar')
+        self.assertEquals(destination['sent']['count'], 1)
+
+    def testRequestIdInjected(self):
+        self.pp.requestId = 'ID'
+        self.pp.dataReceived('GET /exis')
+        self.pp.dataReceived('ting?a=b HTTP/1.1\nHost: localhost\n\n')
+        transport = self.p.avatar.mind.broker.transport
+        self.assertEquals(transport.sent, [
+            (5, 'GET /existing?a=b&%s=ID HTTP/1.1\nHost: localhost\n\n'
+             % self.pp.requestIdParameter)])
+
+    def testBufferExceeded(self):
+        self.pp.dataReceived('GET /' + 'a' * (self.pp.MAX_SIZE - 5))
+        self.failUnless(self.t.connected)
+        self.pp.dataReceived('a')
+        self.failIf(self.t.connected)
+        self.failIf(self.p.foundDestination)
+        self.assertEquals(
+            self.p.stats.total.rejects[stats.REJECT_BUFFER_EXCEEDED], 1)
+
     def testErrorSendingFileDescriptors(self):
         self.pp.dataReceived('GET ')
         self.failUnless(self.t.connected)
@@ -153,6 +233,32 @@ class TestHTTPPorterProtocol(testsuite.TestCase):
         self.failUnless(self.p.foundDestination)
         self.failUnless(self.t.written)
         self.failIf(self.t.written.find('503') < 0)
+        self.assertEquals(
+            self.p.stats.total.rejects[stats.REJECT_SERVICE_UNAVAILABLE], 1)
+
+
+class TestRTSPPorterProtocol(testsuite.TestCase):
+
+    def setUp(self):
+        self.p = FakePorter()
+        self.pp = porter.RTSPPorterProtocol(self.p)
+        self.t = FakeTransport(self.pp)
+        self.pp.transport = self.t
+
+    def testRightLocationFound(self):
+        self.pp.requestId = None
+        request = 'DESCRIBE rtsp://localhost/existing RTSP/1.0\r\nCSeq: 1\r\n'
+        for c in request:
+            self.pp.dataReceived(c)
+        self.failIf(self.t.connected)
+        self.failIf(self.t.written)
+        transport = self.p.avatar.mind.broker.transport
+        self.assertEquals(len(transport.sent), 1)
+
+    def testWrongProtocol(self):
+        self.pp.dataReceived('DESCRIBE rtsp://localhost/existing HTTP/1.0\n')
+        self.failIf(self.t.connected)
+        self.failIf(self.p.foundDestination)
 
 
 class TestHTTPPorterProtocolParser(testsuite.TestCase):
@@ -266,3 +372,357 @@ class TestHTTPPorterProtocolParser(testsuite.TestCase):
             unparsed = self.pp.unparseLine(injected)
             self.containsSameInfo(line, unparsed,
                                   {self.pp.requestIdParameter: ['ID']})
+
+
+class TestPathTree(testsuite.TestCase):
+
+    def setUp(self):
+        self.tree = pathtree.PathTree()
+
+    def testEmpty(self):
+        self.assertIdentical(self.tree.lookup('/test'), None)
+        self.assertIdentical(self.tree.lookup(''), None)
+
+    def testLongestPrefix(self):
+        self.tree['/'] = 'root'
+        self.tree['/live/'] = 'live'
+        self.tree['/live/hd'] = 'hd'
+        self.assertEquals(self.tree.lookup('/'), 'root')
+        self.assertEquals(self.tree.lookup('/other'), 'root')
+        self.assertEquals(self.tree.lookup('/live'), 'root')
+        self.assertEquals(self.tree.lookup('/live/'), 'live')
+        self.assertEquals(self.tree.lookup('/live/sd/stream'), 'live')
+        self.assertEquals(self.tree.lookup('/live/hd'), 'hd')
+        self.assertEquals(self.tree.lookup('/live/hd2/stream'), 'hd')
+        self.assertIdentical(self.tree.lookup('relative'), None)
+
+    def testEmptyPrefix(self):
+        self.tree[''] = 'all'
+        self.assertEquals(self.tree.lookup('/live'), 'all')
+        self.assertEquals(self.tree.lookup(''), 'all')
+
+    def testPartialSegment(self):
+        self.tree['/live'] = 'live'
+        self.tree['/li'] = 'li'
+        self.assertEquals(self.tree.lookup('/livestream'), 'live')
+        self.assertEquals(self.tree.lookup('/live/stream'), 'live')
+        self.assertEquals(self.tree.lookup('/lit'), 'li')
+        self.assertIdentical(self.tree.lookup('/l'), None)
+
+    def testRemove(self):
+        self.tree['/a/'] = 'a'
+        self.tree['/a/b/c'] = 'c'
+        self.assertEquals(self.tree.lookup('/a/b/cd'), 'c')
+        del self.tree['/a/b/c']
+        self.failIf('/a/b/c' in self.tree)
+        self.assertEquals(self.tree.lookup('/a/b/cd'), 'a')
+        del self.tree['/a/']
+        self.assertIdentical(self.tree.lookup('/a/b/cd'), None)
+        self.failIf(self.tree._root.children)
+        self.assertEquals(len(self.tree), 0)
+
+    def testMatchesStartswith(self):
+        alphabet = 'ab/'
+
+        def randomPath():
+            return ''.join([random.choice(alphabet)
+                            for i in range(random.randint(0, 6))])
+
+        prefixes = {}
+        for i in range(200):
+            prefix = randomPath()
+            prefixes[prefix] = i
+            self.tree[prefix] = i
+        for prefix in random.sample(prefixes.keys(), len(prefixes) / 3):
+            del prefixes[prefix]
+            del self.tree[prefix]
+
+        for i in range(500):
+            path = randomPath()
+            found = None
+            for prefix in prefixes:
+                if (path.startswith(prefix) and
+                    (found is None or len(found) < len(prefix))):
+                    found = prefix
+            if found is None:
+                self.assertIdentical(self.tree.lookup(path), None)
+            else:
+                self.assertEquals(self.tree.lookup(path), prefixes[found])
+
+
+class TestHistogram(testsuite.TestCase):
+
+    def setUp(self):
+        self.histogram = stats.Histogram(subBucketBits=5)
+
+    def testEmpty(self):
+        snapshot = self.histogram.getSnapshot()
+        self.assertEquals(snapshot['count'], 0)
+        self.assertEquals(snapshot['p99'], None)
+        self.assertEquals(snapshot['buckets'], [])
+
+    def testBucketsContainValues(self):
+        for value in range(5000) + [10 ** 6, 10 ** 9]:
+            index = self.histogram._index(value)
+            low, high = self.histogram._bounds(index)
+            self.failUnless(low <= value <= high, (value, low, high))
+            # the bucket width is bounded relative to the value
+            self.failUnless(high - low <= max(1, value / 16))
+
+    def testPercentiles(self):
+        for value in range(1, 1001):
+            self.histogram.record(value)
+        self.assertEquals(self.histogram.getCount(), 1000)
+        self.assertEquals(self.histogram.getMean(), 500.5)
+        for percentile, exact in [(50, 500), (90, 900), (99, 990)]:
+            value = self.histogram.getValueAtPercentile(percentile)
+            self.failUnless(exact <= value <= exact * 17 / 16,
+                            (percentile, value))
+        self.assertEquals(self.histogram.getValueAtPercentile(100), 1000)
+        snapshot = self.histogram.getSnapshot()
+        self.assertEquals(snapshot['min'], 1)
+        self.assertEquals(sum([c for l, h, c in snapshot['buckets']]), 1000)
+
+    def testStateMerged(self):
+        other = stats.Histogram()
+        other.setState(self.histogram.getState())
+        self.assertEquals(other.getCount(), 0)
+        for value in [3, 70, 5000]:
+            self.histogram.record(value)
+        other.setState(self.histogram.getState())
+        self.assertEquals(other.getSnapshot(), self.histogram.getSnapshot())
+        for value in [1, 80]:
+            other.record(value)
+        self.histogram.merge(other)
+        snapshot = self.histogram.getSnapshot()
+        self.assertEquals(snapshot['count'], 8)
+        self.assertEquals(snapshot['min'], 1)
+        self.assertEquals(snapshot['max'], 5000)
+        self.assertEquals(snapshot['mean'], (5073 * 2 + 81) / 8.0)
+
+
+def makePorter():
+    p = porter.Porter.__new__(porter.Porter)
+    p.uiState = componentui.WorkerComponentUIState()
+    p.init()
+    return p
+
+
+class TestPorterAvatar(testsuite.TestCase):
+
+    def testSetMaxFileDescriptors(self):
+        mind = FakeMind()
+        avatar = porter.PorterAvatar('streamer', None, mind)
+        avatar.perspective_setMaxFileDescriptors(16)
+        self.assertEquals(
+            mind.broker.transport.maxFileDescriptorsPerMessage, 16)
+        avatar.perspective_setMaxFileDescriptors(100000)
+        self.assertEquals(
+            mind.broker.transport.maxFileDescriptorsPerMessage,
+            fdserver.MAX_FDS_PER_MESSAGE)
+
+
+class TestPorterDestinations(testsuite.TestCase):
+
+    def setUp(self):
+        self.porter = makePorter()
+
+    def testFindDestination(self):
+        a, b, c = FakeAvatar(), FakeAvatar(), FakeAvatar()
+        self.porter.registerPrefix('/', a)
+        self.porter.registerPrefix('/live/', b)
+        self.porter.registerPath('/live/exact', c)
+        self.assertIdentical(self.porter.findDestination('/x'), a)
+        self.assertIdentical(self.porter.findDestination('/live/x'), b)
+        self.assertIdentical(self.porter.findDestination('/live/exact'), c)
+
+        self.porter.deregisterPrefix('/live/', a)
+        self.assertIdentical(self.porter.findDestination('/live/x'), b)
+        self.porter.deregisterPrefix('/live/', b)
+        self.assertIdentical(self.porter.findDestination('/live/x'), a)
+
+    def testEmptyPrefixIgnored(self):
+        a = FakeAvatar()
+        self.porter.registerPrefix('', a)
+        self.assertIdentical(self.porter.findDestination('/x'), None)
+        self.assertEquals(self.porter.lookupDestination('/x'), (None, None))
+
+    def testLookupDestination(self):
+        a, b = FakeAvatar(), FakeAvatar()
+        self.porter.registerPrefix('/live/', a)
+        self.porter.registerPath('/live/exact', b)
+        self.assertEquals(self.porter.lookupDestination('/live/x'),
+                          ('/live/', a))
+        self.assertEquals(self.porter.lookupDestination('/live/exact'),
+                          ('/live/exact', b))
+        self.assertEquals(self.porter.lookupDestination('/vod/x'),
+                          (None, None))
+
+    def testStatsInUIState(self):
+        self.porter.getStats().requestRejected(
+            None, None, stats.REJECT_NOT_FOUND)
+        self.porter._pollStats()
+        snapshot = self.porter.uiState.get('porter-stats')
+        self.assertEquals(
+            snapshot['total']['rejects'][stats.REJECT_NOT_FOUND], 1)
+
+
+class FakeController:
+
+    def __init__(self):
+        self.sent = []
+
+    def pathChanged(self, path, key):
+        self.sent.append(('path', path, key))
+
+    def prefixChanged(self, prefix, key):
+        self.sent.append(('prefix', prefix, key))
+
+    def avatarLoggedOut(self, key):
+        self.sent.append(('logout', key))
+
+
+class TestPorterAcceptorNotifications(testsuite.TestCase):
+
+    def setUp(self):
+        self.porter = makePorter()
+        self.controller = FakeController()
+        self.porter._acceptors.append(self.controller)
+
+    def testMappingsReplicated(self):
+        a = FakeAvatar()
+        self.porter.addAvatar(a)
+        self.assertIdentical(self.porter.getAvatar(a.key), a)
+        self.porter.registerPath('/live', a)
+        self.porter.registerPrefix('/vod/', a)
+        self.porter.deregisterPath('/live', a)
+        self.porter.deregisterPrefix('/vod/', a)
+        self.porter.avatarLoggedOut(a)
+        self.assertEquals(self.controller.sent,
+                          [('path', '/live', a.key),
+                           ('prefix', '/vod/', a.key),
+                           ('path', '/live', None),
+                           ('prefix', '/vod/', None),
+                           ('logout', a.key)])
+        self.assertEquals(self.porter.getAvatar(a.key), None)
+
+
+class LineTransport(FakeTransport):
+
+    def __init__(self, protocol, overloaded=False):
+        FakeTransport.__init__(self, protocol, overloaded)
+        self.lines = []
+
+    def write(self, data):
+        self.lines.extend(data.splitlines())
+
+
+class TestAcceptorChannel(testsuite.TestCase):
+
+    def setUp(self):
+        self.acceptor = acceptor.Acceptor()
+        self.channel = acceptor.AcceptorChannel(self.acceptor)
+        self.channel.transport = LineTransport(self.channel)
+
+    def testMappings(self):
+        self.channel.lineReceived('path 1 %2Flive%20stream')
+        self.channel.lineReceived('prefix 2 %2Fvod%2F')
+        live = self.acceptor.findDestination('/live stream')
+        self.assertEquals(live.key, 1)
+        self.assertEquals(self.acceptor.findDestination('/vod/a').key, 2)
+        self.assertEquals(self.acceptor.findDestination('/other'), None)
+
+        self.channel.lineReceived('logout 1')
+        self.failIf(live.isAttached())
+        self.channel.lineReceived('unpath %2Flive%20stream')
+        self.channel.lineReceived('unprefix %2Fvod%2F')
+        self.assertEquals(self.acceptor.findDestination('/live stream'),
+                          None)
+        self.assertEquals(self.acceptor.findDestination('/vod/a'), None)
+
+    def testSendStats(self):
+        self.channel.lineReceived('path 3 %2Flive%20stream')
+        avatar = self.acceptor.findDestination('/live stream')
+        recorder = self.acceptor.getStats()
+        recorder.requestParsed('/live stream', avatar.avatarId, 0.001, 100)
+        recorder.requestRejected(None, None, stats.REJECT_NOT_FOUND)
+        self.channel.sendStats()
+        lines = self.channel.transport.lines
+        lines.sort()
+        self.assertEquals(len(lines), 2)
+        self.failUnless(lines[0].startswith('stats - - 0 1,0,0 '))
+        self.failUnless(lines[1].startswith('stats 3 %2Flive%20stream 1 '))
+        # only what was recorded since
+        self.channel.sendStats()
+        self.assertEquals(len(lines), 2)
+
+    def testHandOff(self):
+        self.channel.lineReceived('path 3 %2Flive')
+        avatar = self.acceptor.findDestination('/live')
+        results = []
+        d1 = avatar.queueFileDescriptor(7, 'GET /live HTTP/1.0')
+        d1.addCallbacks(results.append, results.append)
+        d2 = avatar.queueFileDescriptor(8, 'GET /live HTTP/1.1')
+        d2.addCallbacks(results.append, results.append)
+        self.assertEquals(self.channel.transport.sent,
+                          [(7, '1 3 GET /live HTTP/1.0'),
+                           (8, '2 3 GET /live HTTP/1.1')])
+        self.failIf(results)
+
+        self.channel.lineReceived('failed 2')
+        self.channel.lineReceived('sent 1')
+        self.assertEquals(len(results), 2)
+        results[0].trap(OSError)
+        self.assertEquals(results[1], None)
+
+
+class TestAcceptorController(testsuite.TestCase):
+
+    def setUp(self):
+        self.porter = makePorter()
+        self.controller = acceptor.AcceptorController(self.porter)
+        self.controller.transport = LineTransport(self.controller)
+
+    def testStatsMerged(self):
+        streamer = FakeAvatar()
+        self.porter.addAvatar(streamer)
+        recorder = stats.PorterStats()
+        recorder.requestParsed('/live', 'acceptor avatar', 0.002, 100)
+        recorder.requestSent('/live', 'acceptor avatar', 0.003)
+        recorder.requestRejected(None, None, stats.REJECT_NOT_FOUND)
+        states = dict([(mountPoint, state) for mountPoint, avatarId, state
+                       in recorder.getStates()])
+        live, rejected = states['/live'], states[None]
+        # lines can be split anywhere
+        data = 'stats %d %%2Flive %s\nstats - - %s\n' % (
+            streamer.key, live, rejected)
+        self.controller.dataReceived(data[:10])
+        self.controller.dataReceived(data[10:])
+
+        snapshot = self.porter.getStats().getSnapshot()
+        self.assertEquals(snapshot['total']['requests'], 1)
+        self.assertEquals(snapshot['total']['sent']['count'], 1)
+        self.assertEquals(
+            snapshot['total']['rejects'][stats.REJECT_NOT_FOUND], 1)
+        destination = [d for d in snapshot['destinations']
+                       if d['mount-point'] == '/live'][0]
+        self.assertEquals(destination['avatar-id'], streamer.avatarId)
+        self.assertEquals(destination['first-line']['max'], 2000)
+
+    def testFileDescriptorsReceived(self):
+        good = FakeAvatar()
+        busy = FakeAvatar(overloaded=True)
+        self.porter.addAvatar(good)
+        self.porter.addAvatar(busy)
+        for serial, key in [(1, good.key), (2, busy.key), (3, 99)]:
+            r, w = os.pipe()
+            os.close(w)
+            self.controller.fileDescriptorsReceived(
+                [r], '%d %d GET / HTTP/1.0\r\n' % (serial, key))
+            # the controller closes the received fd
+            self.assertRaises(OSError, os.fstat, r)
+        self.assertEquals(self.controller.transport.lines,
+                          ['sent 1', 'failed 2', 'failed 3'])
+        sent = good.mind.broker.transport.sent
+        self.assertEquals([data for fd, data in sent],
+                          ['GET / HTTP/1.0\r\n'])
@@ -0,0 +1,139 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_twisted_fdserver -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+import os
+import socket
+
+from twisted.internet import protocol, reactor
+
+from flumotion.common import testsuite
+from flumotion.extern.fdpass import fdpass
+from flumotion.twisted import fdserver
+
+
+class RecordingProtocol(protocol.Protocol):
+
+    def __init__(self):
+        self.data = ''
+        self.received = []
+
+    def dataReceived(self, data):
+        self.data += data
+
+    def fileDescriptorsReceived(self, fds, message):
+        self.received.append((fds, message))
+
+
+class TestFDPassing(testsuite.TestCase):
+
+    def setUp(self):
+        self.local, self.remote = socket.socketpair(socket.AF_UNIX,
+                                                    socket.SOCK_STREAM)
+        self.local.setblocking(0)
+        self.server = fdserver.FDServer(self.local, protocol.Protocol(),
+                                        None, None, 0, reactor)
+        self.server.stopReading()
+        self.client = fdserver.FDClient.__new__(fdserver.FDClient)
+        self.client.socket = self.remote
+        self.client.fileno = self.remote.fileno
+        self.client.connected = True
+        self.client.protocol = RecordingProtocol()
+        self.pipes = [os.pipe() for i in range(3)]
+
+    def tearDown(self):
+        self.server.stopReading()
+        self.server.stopWriting()
+        self.local.close()
+        self.remote.close()
+        for r, w in self.pipes:
+            os.close(r)
+            os.close(w)
+        for fds, message in self.client.protocol.received:
+            for fd in fds:
+                os.close(fd)
+
+    def assertSameFile(self, fd1, fd2):
+        self.assertEquals(os.fstat(fd1).st_ino, os.fstat(fd2).st_ino)
+
+    def testQueueSingle(self):
+        sent = []
+        d = self.server.queueFileDescriptor(self.pipes[0][0], 'GET /')
+        d.addCallback(sent.append)
+        self.assertEquals(sent, [None])
+        self.assertEquals(self.server.getQueuedFileDescriptors(), 0)
+
+        self.client.doRead()
+        received = self.client.protocol.received
+        self.assertEquals(len(received), 1)
+        self.assertEquals(received[0][1], 'GET /')
+        self.assertSameFile(received[0][0][0], self.pipes[0][0])
+
+    def testBatch(self):
+        self.server.maxFileDescriptorsPerMessage = 3
+        # Queue up while the socket isn't writable, then flush as one
+        self.server._fdRemainder = 'PB'
+        for i, (r, w) in enumerate(self.pipes):
+            self.server.queueFileDescriptor(r, 'request %d' % i)
+        self.assertEquals(self.server.getQueuedFileDescriptors(), 3)
+        self.server.doWrite()
+        self.assertEquals(self.server.getQueuedFileDescriptors(), 0)
+
+        fds, message = fdpass.readfds(self.remote.fileno(), 64 * 1024)
+        self.assertEquals(len(fds), 3)
+        self.client._recordsReceived(fds, message[2:], 0)
+        received = self.client.protocol.received
+        self.assertEquals([m for f, m in received],
+                          ['request 0', 'request 1', 'request 2'])
+        for (fds, message), (r, w) in zip(received, self.pipes):
+            self.assertEquals(len(fds), 1)
+            self.assertSameFile(fds[0], r)
+
+    def _testPartialRecord(self, split):
+        r, w = self.pipes[0]
+        record = fdserver._makeRecord('GET /stream HTTP/1.0\r\n')
+        fdpass.writefds(self.local.fileno(), [r], 'pb' + record[:split])
+        self.client.doRead()
+        self.failIf(self.client.protocol.received)
+        self.assertEquals(self.client.protocol.data, 'pb')
+
+        self.local.send(record[split:] + ' data')
+        self.client.doRead()
+        received = self.client.protocol.received
+        self.assertEquals(len(received), 1)
+        self.assertEquals(received[0][1], 'GET /stream HTTP/1.0\r\n')
+        self.assertEquals(self.client.protocol.data, 'pb data')
+
+    def testPartialSignature(self):
+        self._testPartialRecord(10)
+
+    def testPartialHeader(self):
+        self._testPartialRecord(18)
+
+    def testPartialData(self):
+        self._testPartialRecord(30)
+
+    def testQueueFull(self):
+        self.server.maxQueuedFileDescriptors = 1
+        self.server._fdRemainder = 'PB'
+        self.server.queueFileDescriptor(self.pipes[0][0])
+        d = self.server.queueFileDescriptor(self.pipes[1][0])
+        failures = []
+        d.addErrback(failures.append)
+        self.assertEquals(len(failures), 1)
+        failures[0].trap(OSError)
+        self.server._fdRemainder = ''
+        self.server.doWrite()
@@ -18,7 +18,8 @@
 from flumotion.common import log
 from flumotion.extern.fdpass import fdpass
 
-from twisted.internet import unix, main, address, tcp
+from twisted.internet import unix, main, address, tcp, defer
+from twisted.python import failure
 from twisted.spread import pb
 
 import errno
@@ -40,25 +41,172 @@ __version__ = "$Rev$"
 # unrelated data.
 # So, we prefix the message with a 16 byte randomly generated magic signature,
 # and a length, and if we receive file descriptors decode based on this.
+# Several FDs can be passed in one message; the message then carries one
+# signature, length and data record per FD, in the same order as the FDs.
 #
 # map() instead of a string to workaround gettext encoding problems.
 #
 MAGIC_SIGNATURE = ''.join(map(chr, [253, 252, 142, 127, 7, 71, 185, 234,
                                     161, 117, 238, 216, 220, 54, 200, 163]))
+HEADER_SIZE = struct.calcsize("@16sI")
+
+# The most FDs we can receive, or send, in a single message
+MAX_FDS_PER_MESSAGE = fdpass.MAX_RECEIVED_FDS
+
+
+def _makeRecord(data):
+    return struct.pack("@16sI", MAGIC_SIGNATURE, len(data)) + data
+
+
+def _fixRepr(connection):
+    # Connections made from a socketpair have no listening port to name in
+    # their repr
+    if connection.server is None:
+        connection.repstr = "<%s #%s on socketpair>" % (
+            connection.protocol.__class__.__name__, connection.sessionno)
+
+
+def _findSignatureStart(message):
+    # Return where a signature cut short at the end of message starts,
+    # or -1
+    for length in range(min(len(message), len(MAGIC_SIGNATURE) - 1), 0, -1):
+        if MAGIC_SIGNATURE.startswith(message[-length:]):
+            return len(message) - length
+    return -1
 
 
 class FDServer(unix.Server):
+    """
+    I pass file descriptors to the process at the other end of a unix
+    socket.
+
+    FDs can either be sent synchronously with L{sendFileDescriptor}, or
+    queued with L{queueFileDescriptor}, which never blocks: queued FDs are
+    sent when the socket is writable, several of them coalesced in one
+    message if the other end told us it can handle that.
+
+    @ivar maxFileDescriptorsPerMessage: how many queued FDs may be sent in
+                                        a single message
+    @ivar maxQueuedFileDescriptors:     how many FDs may be waiting to be
+                                        sent before queueing fails
+    """
+
+    maxFileDescriptorsPerMessage = 1
+    maxQueuedFileDescriptors = 1024
+
+    def __init__(self, *args, **kwargs):
+        unix.Server.__init__(self, *args, **kwargs)
+        _fixRepr(self)
+        # list of (fd, data, deferred) waiting to be sent
+        self._fdQueue = []
+        # the part of the last message the socket did not accept; it has
+        # to go out before anything else
+        self._fdRemainder = ''
 
     def sendFileDescriptor(self, fileno, data=""):
-        message = struct.pack("@16sI", MAGIC_SIGNATURE, len(data)) + data
-        return fdpass.writefds(self.fileno(), [fileno], message)
+        return fdpass.writefds(self.fileno(), [fileno], _makeRecord(data))
+
+    def queueFileDescriptor(self, fileno, data=""):
+        """
+        Queue a file descriptor to be sent, along with some data.
+
+        The file descriptor is duplicated, so the caller may close its own
+        copy at any time.
+
+        @rtype:   L{twisted.internet.defer.Deferred}
+        @returns: a deferred firing when the file descriptor has been sent,
+                  or failing with an OSError if it could not be sent or
+                  the queue is full
+        """
+        if not self.connected or self.disconnecting:
+            return defer.fail(OSError(errno.EPIPE, 'Connection is closed'))
+        if len(self._fdQueue) >= self.maxQueuedFileDescriptors:
+            return defer.fail(OSError(errno.EAGAIN, 'Too many queued FDs'))
+        d = defer.Deferred()
+        self._fdQueue.append((os.dup(fileno), data, d))
+        if len(self._fdQueue) == 1 and not self._fdRemainder:
+            self._flushFileDescriptors()
+        return d
+
+    def getQueuedFileDescriptors(self):
+        """
+        @returns: the number of file descriptors waiting to be sent
+        """
+        return len(self._fdQueue)
+
+    def _flushFileDescriptors(self):
+        while self._fdQueue and not self._fdRemainder:
+            batch = self._fdQueue[:self.maxFileDescriptorsPerMessage]
+            fds = [fd for fd, data, d in batch]
+            message = ''.join([_makeRecord(data) for fd, data, d in batch])
+            try:
+                sent = fdpass.writefds(self.fileno(), fds, message)
+            except OSError, e:
+                if e.errno in (errno.EWOULDBLOCK, errno.EAGAIN, errno.ENOBUFS):
+                    # wait for the socket to become writable again
+                    self.startWriting()
+                    return
+                del self._fdQueue[:len(batch)]
+                for fd, data, d in batch:
+                    os.close(fd)
+                    d.errback(failure.Failure(e))
+                continue
+
+            del self._fdQueue[:len(batch)]
+            # the kernel holds its own references to the FDs now
+            for fd, data, d in batch:
+                os.close(fd)
+            if sent < len(message):
+                self._fdRemainder = message[sent:]
+                self.startWriting()
+            for fd, data, d in batch:
+                d.callback(None)
+
+    def _writeRemainder(self):
+        try:
+            sent = self.socket.send(self._fdRemainder)
+        except socket.error, e:
+            if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN, errno.ENOBUFS):
+                return None
+            return main.CONNECTION_LOST
+        self._fdRemainder = self._fdRemainder[sent:]
+
+    def doWrite(self):
+        if self._fdRemainder:
+            ret = self._writeRemainder()
+            if ret or self._fdRemainder:
+                return ret
+        self._flushFileDescriptors()
+        if self._fdRemainder:
+            return None
+        ret = unix.Server.doWrite(self)
+        # the normal write path stops writing once its own buffer is empty
+        if self._fdQueue and not ret:
+            self.startWriting()
+        return ret
+
+    def connectionLost(self, reason):
+        queue, self._fdQueue = self._fdQueue, []
+        for fd, data, d in queue:
+            os.close(fd)
+            d.errback(failure.Failure(
+                OSError(errno.EPIPE, 'Connection lost')))
+        unix.Server.connectionLost(self, reason)
 
 
 class FDPort(unix.Port):
     transport = FDServer
 
 
-class FDClient(unix.Client): #, log.Loggable):
+class FDReceiverMixin:
+    """
+    I read messages carrying file descriptors from a unix socket, and hand
+    them to my protocol's fileDescriptorsReceived method, and any other
+    data to its dataReceived method.
+    """
+
+    # FDs and data of a message whose records did not arrive completely
+    _fdPending = None
 
     def doRead(self):
         if not self.connected:
@@ -74,6 +222,14 @@ class FDClient(unix.Client): #, log.Loggable):
             if not message:
                 return main.CONNECTION_DONE
 
+            if self._fdPending:
+                # The rest of the records of an earlier message; this data
+                # is always sent before anything else.
+                pendingFds, pending = self._fdPending
+                self._fdPending = None
+                return self._recordsReceived(pendingFds + fds,
+                                             pending + message, 0)
+
             if len(fds) > 0:
                 # Look for our magic cookie in (possibly) the midst of other
                 # data. Pass surrounding chunks, if any, onto dataReceived(),
@@ -82,6 +238,16 @@ class FDClient(unix.Client): #, log.Loggable):
                 # Pass the actual FDs and their message to
                 # fileDescriptorsReceived()
                 offset = message.find(MAGIC_SIGNATURE)
+                if offset < 0:
+                    offset = _findSignatureStart(message)
+                if offset >= 0 and offset + HEADER_SIZE > len(message):
+                    # Only part of the record arrived; wait for the rest
+                    if offset > 0:
+                        ret = self.protocol.dataReceived(message[0:offset])
+                        if ret:
+                            return ret
+                    self._fdPending = (fds, message[offset:])
+                    return
                 if offset < 0:
                     # Old servers did not send this; be hopeful that this
                     # doesn't have bits of other protocol (i.e. PB) mixed up
@@ -92,20 +258,52 @@ class FDClient(unix.Client): #, log.Loggable):
                     if ret:
                         return ret
 
-                msglen = struct.unpack("@I", message[offset+16:offset+20])[0]
-                offset += 20
-                ret = self.protocol.fileDescriptorsReceived(fds,
-                    message[offset:offset+msglen])
-                if ret:
-                    return ret
-
-                if offset+msglen < len(message):
-                    return self.protocol.dataReceived(message[offset+msglen:])
-                return ret
+                return self._recordsReceived(fds, message, offset)
             else:
               #  self.debug("No FDs, passing to dataReceived")
                 return self.protocol.dataReceived(message)
 
+    def _recordsReceived(self, fds, message, offset):
+        # There is one record for every FD in the message; hand each FD
+        # over with its own data.
+        while fds:
+            end = offset + HEADER_SIZE
+            if len(message) < end:
+                self._fdPending = (fds, message[offset:])
+                return
+            signature, msglen = struct.unpack("@16sI", message[offset:end])
+            if signature != MAGIC_SIGNATURE:
+                # Should not happen; don't leak the FDs we can't use
+                for fd in fds:
+                    os.close(fd)
+                return main.CONNECTION_LOST
+            if len(message) < end + msglen:
+                self._fdPending = (fds, message[offset:])
+                return
+            ret = self.protocol.fileDescriptorsReceived([fds.pop(0)],
+                message[end:end+msglen])
+            if ret:
+                return ret
+            offset = end + msglen
+
+        if offset < len(message):
+            return self.protocol.dataReceived(message[offset:])
+
+
+class FDClient(FDReceiverMixin, unix.Client): #, log.Loggable):
+    pass
+
+
+class FDReceiver(FDReceiverMixin, unix.Server):
+    """
+    I receive file descriptors on an already connected unix socket, for
+    instance one end of a socketpair.
+    """
+
+    def __init__(self, *args, **kwargs):
+        unix.Server.__init__(self, *args, **kwargs)
+        _fixRepr(self)
+
 
 class FDConnector(unix.Connector):
 
@@ -137,37 +335,36 @@ class FDPassingBroker(pb.Broker, log.Loggable):
     # We create an appropriate protocol object, and attach it to the reactor.
 
     def fileDescriptorsReceived(self, fds, message):
-        if len(fds) == 1:
-            fd = fds[0]
+        for fd in fds:
+            self._fileDescriptorReceived(fd, message)
 
-            # Note that we hardcode IPv4 here!
-            sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+    def _fileDescriptorReceived(self, fd, message):
+        # Note that we hardcode IPv4 here!
+        sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
 
-            # PROBE: received fd; see porter.py
-            self.debug("[fd %5d] (ts %f) received fd from %d, created socket",
-                       sock.fileno(), time.time(), fd)
+        # PROBE: received fd; see porter.py
+        self.debug("[fd %5d] (ts %f) received fd from %d, created socket",
+                   sock.fileno(), time.time(), fd)
 
-            # Undocumentedly (other than a comment in
-            # Python/Modules/socketmodule.c), socket.fromfd() calls dup() on
-            # the passed FD before it actually wraps it in a socket object.
-            # So, we need to close the FD that we originally had...
-            os.close(fd)
+        # Undocumentedly (other than a comment in
+        # Python/Modules/socketmodule.c), socket.fromfd() calls dup() on
+        # the passed FD before it actually wraps it in a socket object.
+        # So, we need to close the FD that we originally had...
+        os.close(fd)
 
-            try:
-                peeraddr = sock.getpeername()
-            except socket.error:
-                self.info("Socket disconnected before being passed to client")
-                sock.close()
-                return
+        try:
+            peeraddr = sock.getpeername()
+        except socket.error:
+            self.info("Socket disconnected before being passed to client")
+            sock.close()
+            return
 
-            # Based on bits in tcp.Port.doRead()
-            addr = address._ServerFactoryIPv4Address('TCP',
-                peeraddr[0], peeraddr[1])
-            protocol = self.childFactory.buildProtocol(addr)
+        # Based on bits in tcp.Port.doRead()
+        addr = address._ServerFactoryIPv4Address('TCP',
+            peeraddr[0], peeraddr[1])
+        protocol = self.childFactory.buildProtocol(addr)
 
-            self._connectionClass(sock, protocol, peeraddr, message)
-        else:
-            self.warning("Unexpected: FD-passing message with len(fds) != 1")
+        self._connectionClass(sock, protocol, peeraddr, message)
 
 
 class _SocketMaybeCloser(tcp._SocketCloser):
@@ -189,7 +386,7 @@ class _SocketMaybeCloser(tcp._SocketCloser):
             from twisted import version as v
             if (v.major, v.minor, v.micro) > (11, 0, 0):
                 args.append(orderly)
-            tcp.Server._closeSocket(self, *args)
+            tcp._SocketCloser._closeSocket(self, *args)
 
 
 class PassableServerConnection(_SocketMaybeCloser, tcp.Server):
@@ -202,3 +399,15 @@ class PassableServerConnection(_SocketMaybeCloser, tcp.Server):
 
 class PassableServerPort(tcp.Port):
     transport = PassableServerConnection
+
+
+class PassableUNIXServerConnection(_SocketMaybeCloser, unix.Server):
+    """
+    A subclass of unix.Server that permits passing the FDs used to other
+    processes, for connections from the same host
+    """
+    pass
+
+
+class PassableUNIXServerPort(unix.Port):
+    transport = PassableUNIXServerConnection
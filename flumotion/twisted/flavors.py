@@ -21,7 +21,10 @@ Flumotion Twisted-like flavors
 Inspired by L{twisted.spread.flavors}
 """
 
+import weakref
+
 from twisted.internet import defer
+from twisted.python import failure
 from twisted.spread import pb
 from zope.interface import Interface
 from flumotion.common import log
@@ -97,14 +100,64 @@ class IStateCacheableListener(Interface):
         """
 
 
+# the mutations a batch can hold; a batch holds the batches of other
+# state objects committed in it
+_BATCH_MUTATIONS = ('set', 'append', 'remove', 'setitem', 'delitem',
+                    'batch')
+
+# broker -> whether its peer handles observe_batch, or the list of the
+# messages waiting for the first batch sent to it to tell
+_batchSupport = weakref.WeakKeyDictionary()
+
+
+class _StateBatch:
+    """
+    I hold the mutations made to a state object in a batch, in order,
+    dropping the ones overwritten by later mutations.
+    """
+
+    def __init__(self, parent=None):
+        self.depth = 1
+        self.parent = parent
+        self._mutations = []
+        self._keyIndexes = {}  # key -> indexes of its mutations
+        self._itemIndexes = {}  # (key, subkey) -> index of its setitem
+
+    def add(self, method, args):
+        key = args[0]
+        index = len(self._mutations)
+        if method == 'set':
+            # last write wins
+            for i in self._keyIndexes.get(key, ()):
+                self._mutations[i] = None
+            self._keyIndexes[key] = []
+        elif method == 'setitem':
+            i = self._itemIndexes.get((key, args[1]))
+            if i is not None:
+                self._mutations[i] = None
+            self._itemIndexes[(key, args[1])] = index
+        elif method == 'delitem':
+            self._itemIndexes.pop((key, args[1]), None)
+        self._mutations.append((method, ) + args)
+        self._keyIndexes.setdefault(key, []).append(index)
+
+    def getMutations(self):
+        return [m for m in self._mutations if m is not None]
+
+
 class StateCacheable(pb.Cacheable):
     """
     I am a cacheable state object.
 
     I cache key-value pairs, where values can be either single objects
     or list of objects.
+
+    My mutations can be batched, see L{beginBatch}.
     """
 
+    # not set in __init__, proxies are not initialized by it
+    _batch = None
+
     def __init__(self):
         self._observers = []
         self._hooks = []
@@ -144,7 +197,7 @@ class StateCacheable(pb.Cacheable):
         self._dict[key] = value
 
     def hasKey(self, key):
-        return key in self._dict.keys()
+        return key in self._dict
 
     def keys(self):
         return self._dict.keys()
@@ -155,7 +208,7 @@ class StateCacheable(pb.Cacheable):
 
         Return otherwise in case where key is present but value None.
         """
-        if not key in self._dict.keys():
+        if not key in self._dict:
             raise KeyError('%s in %r' % (key, self))
 
         v = self._dict[key]
@@ -170,31 +223,29 @@ class StateCacheable(pb.Cacheable):
         Set a given state key to the given value.
         Notifies observers of this Cacheable through observe_set.
         """
-        if not key in self._dict.keys():
+        if not key in self._dict:
             raise KeyError('%s in %r' % (key, self))
 
         self._dict[key] = value
-        dList = [o.callRemote('set', key, value) for o in self._observers]
-        return defer.DeferredList(dList)
+        return self._notifyObservers('set', key, value)
 
     def append(self, key, value):
         """
         Append the given object to the given list.
         Notifies observers of this Cacheable through observe_append.
         """
-        if not key in self._dict.keys():
+        if not key in self._dict:
             raise KeyError('%s in %r' % (key, self))
 
         self._dict[key].append(value)
-        dList = [o.callRemote('append', key, value) for o in self._observers]
-        return defer.DeferredList(dList)
+        return self._notifyObservers('append', key, value)
 
     def remove(self, key, value):
         """
         Remove the given object from the given list.
         Notifies observers of this Cacheable through observe_remove.
         """
-        if not key in self._dict.keys():
+        if not key in self._dict:
             raise KeyError('%s in %r' % (key, self))
 
         try:
@@ -202,22 +253,18 @@ class StateCacheable(pb.Cacheable):
         except ValueError:
             raise ValueError('value %r not in list %r for key %r' % (
                 value, self._dict[key], key))
-        dList = [o.callRemote('remove', key, value) for o in self._observers]
-        dl = defer.DeferredList(dList)
-        return dl
+        return self._notifyObservers('remove', key, value)
 
     def setitem(self, key, subkey, value):
         """
         Set a value in the given dict.
         Notifies observers of this Cacheable through observe_setitem.
         """
-        if not key in self._dict.keys():
+        if not key in self._dict:
             raise KeyError('%s in %r' % (key, self))
 
         self._dict[key][subkey] = value
-        dList = [o.callRemote('setitem', key, subkey, value)
-                for o in self._observers]
-        return defer.DeferredList(dList)
+        return self._notifyObservers('setitem', key, subkey, value)
 
     def delitem(self, key, subkey):
         """
@@ -225,7 +272,7 @@ class StateCacheable(pb.Cacheable):
         to the dict; it is the subkey (and its value) that will be removed.
         Notifies observers of this Cacheable through observe_delitem.
         """
-        if not key in self._dict.keys():
+        if not key in self._dict:
             raise KeyError('%s in %r' % (key, self))
 
         try:
@@ -233,10 +280,121 @@ class StateCacheable(pb.Cacheable):
         except KeyError:
             raise KeyError('key %r not in dict %r for key %r' % (
                 subkey, self._dict[key], key))
-        dList = [o.callRemote('delitem', key, subkey, value) for o in
-                self._observers]
-        dl = defer.DeferredList(dList)
-        return dl
+        return self._notifyObservers('delitem', key, subkey, value)
+
+    def beginBatch(self, parent=None):
+        """
+        Start a batch of mutations. Until the matching L{commitBatch}, my
+        observers are not notified of my mutations; they are then sent
+        all of them in a single observe_batch message, without the ones
+        overwritten by later mutations of the batch, like setting a key
+        set before.
+
+        Batches can be nested, only the outermost one is sent. A batch
+        must be committed before returning to the reactor, so that no
+        observer is added while it is open.
+
+        Peers from before observe_batch are sent the mutations one by
+        one instead, once the first batch sent to them failed.
+
+        If a parent state is given and has an open batch when mine is
+        committed, my mutations are sent in its batch instead, so that
+        the mutations of several states take one message. This is only
+        done when the parent state is observed by the same peers as me,
+        typically because I am one of its values.
+
+        @param parent: the state whose batch mine is sent in
+        @type  parent: L{StateCacheable}
+        """
+        if self._batch:
+            self._batch.depth += 1
+        else:
+            self._batch = _StateBatch(parent)
+
+    def commitBatch(self):
+        """
+        End a batch of mutations started with L{beginBatch}, and notify my
+        observers of them if it is the outermost one.
+
+        @rtype: L{twisted.internet.defer.Deferred}
+        """
+        assert self._batch, 'no batch of mutations was begun'
+        self._batch.depth -= 1
+        if self._batch.depth:
+            return defer.succeed(None)
+
+        mutations = self._batch.getMutations()
+        parent = self._batch.parent
+        self._batch = None
+        if not mutations:
+            return defer.succeed(None)
+        if (parent is not None and parent._batch
+                and self._hasObserversOf(parent)):
+            parent._batch.add('batch', (self, mutations))
+            return defer.succeed(None)
+        dList = [self._callObserver(o, 'batch', mutations)
+                 for o in self._observers]
+        return defer.DeferredList(dList)
+
+    def _hasObserversOf(self, other):
+        # whether I am observed through the same brokers as the other state
+        mine = dict([(id(o.broker), None) for o in self._observers])
+        theirs = dict([(id(o.broker), None) for o in other._observers])
+        return mine == theirs
+
+    def _notifyObservers(self, method, *args):
+        if not self._observers:
+            return defer.succeed(None)
+        if self._batch:
+            self._batch.add(method, args)
+            return defer.succeed(None)
+        dList = [self._callObserver(o, method, *args)
+                 for o in self._observers]
+        return defer.DeferredList(dList)
+
+    def _callObserver(self, observer, method, *args):
+        broker = observer.broker
+        support = _batchSupport.get(broker)
+        if isinstance(support, list):
+            # wait for the first batch to keep the messages in order
+            d = defer.Deferred()
+            support.append((self, observer, method, args, d))
+            return d
+        if method != 'batch' or support:
+            return observer.callRemote(method, *args)
+        if support is not None:
+            return self._callUnbatched(observer, args[0])
+
+        # the first batch sent to the peer tells if it handles them
+        waiting = _batchSupport[broker] = []
+
+        def sent(result):
+            if (isinstance(result, failure.Failure)
+                    and result.check(AttributeError)
+                    and 'observe_batch' in result.getErrorMessage()):
+                _batchSupport[broker] = False
+                result = self._callUnbatched(observer, args[0])
+            else:
+                _batchSupport[broker] = True
+            for state, o, m, a, d in waiting:
+                state._callObserver(o, m, *a).chainDeferred(d)
+            return result
+
+        d = observer.callRemote(method, *args)
+        d.addBoth(sent)
+        return d
+
+    def _callUnbatched(self, observer, mutations):
+        dList = []
+        for mutation in mutations:
+            if mutation[0] != 'batch':
+                dList.append(observer.callRemote(*mutation))
+                continue
+            state, stateMutations = mutation[1:]
+            for o in state._observers:
+                if o.broker is observer.broker:
+                    dList.append(state._callUnbatched(o, stateMutations))
+        return defer.DeferredList(dList)
 
     # pb.Cacheable methods
 
@@ -309,7 +467,7 @@ class StateRemoteCache(pb.RemoteCache):
     # our methods
 
     def hasKey(self, key):
-        return key in self._dict.keys()
+        return key in self._dict
 
     def keys(self):
         return self._dict.keys()
@@ -320,7 +478,7 @@ class StateRemoteCache(pb.RemoteCache):
 
         Return otherwise in case where key is present but value None.
         """
-        if not key in self._dict.keys():
+        if not key in self._dict:
             raise KeyError('%s in %r' % (key, self))
 
         v = self._dict[key]
@@ -472,6 +630,30 @@ class StateRemoteCache(pb.RemoteCache):
 
         self._notifyListeners(4, key, subkey, value)
 
+    def observe_batch(self, mutations):
+        self._observeBatch(mutations)
+
+    def _observeBatch(self, mutations, parent=None):
+        # if we also subclass from Cacheable, then we're a proxy, so proxy
+        # the mutations as a batch too
+        proxy = hasattr(self, 'beginBatch')
+        if proxy:
+            StateCacheable.beginBatch(self, parent)
+        try:
+            for mutation in mutations:
+                if mutation[0] not in _BATCH_MUTATIONS:
+                    raise ValueError('unknown mutation %r' % (mutation[0], ))
+                if mutation[0] == 'batch':
+                    # the batch of another state, sent in mine
+                    state, stateMutations = mutation[1:]
+                    state._observeBatch(stateMutations, self)
+                    continue
+                observe = getattr(self, 'observe_' + mutation[0])
+                observe(*mutation[1:])
+        finally:
+            if proxy:
+                StateCacheable.commitBatch(self)
+
     def invalidate(self):
         """Invalidate this StateRemoteCache.
 
@@ -20,7 +20,9 @@ implementation of a PB Server through which other components can request
 to eat from or feed to this worker's components.
 """
 
-from twisted.internet import reactor
+import os
+
+from twisted.internet import reactor, error, defer
 from twisted.spread import pb
 from twisted.cred import portal
 from zope.interface import implements
@@ -48,6 +50,7 @@ class FeedServer(log.Loggable):
         """
         self._brain = brain
         self._tport = None
+        self._uport = None
         self.listen(bouncer, portNum)
 
     def getPortNum(self):
@@ -67,11 +70,33 @@ class FeedServer(log.Loggable):
         self._tport = tport
         self.debug('Listening for feed requests on TCP port %d',
                    self.getPortNum())
+        self._listenLocal(factory)
+
+    def _listenLocal(self, factory):
+        # Components on this host connect through a unix socket named
+        # after our TCP port, so that their feeds skip the TCP/IP stack
+        path = common.feedServerSocketPath(self.getPortNum())
+        try:
+            if os.path.exists(path):
+                # Left behind by a worker that did not shut down; we
+                # hold its port now
+                os.unlink(path)
+            self._uport = reactor.listenWith(
+                fdserver.PassableUNIXServerPort, path, factory,
+                mode=0600)
+        except (OSError, error.CannotListenError), e:
+            self.warning('Cannot listen for local feed requests on %s: %s',
+                         path, log.getExceptionMessage(e))
+            return
+        self.debug('Listening for local feed requests on %s', path)
 
     def shutdown(self):
-        d = self._tport.stopListening()
+        l = [defer.maybeDeferred(self._tport.stopListening)]
+        if self._uport:
+            l.append(defer.maybeDeferred(self._uport.stopListening))
         self._tport = None
-        return d
+        self._uport = None
+        return defer.DeferredList(l)
 
     ### IRealm method
 
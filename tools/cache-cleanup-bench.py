@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""
+Benchmark of the cache cleanup of the on-demand HTTP server.
+
+Compares finding the files to delete from the cache index with listing
+and stating every file of the cache directory, as was done before.
+The index is measured with a million entries; the directory scan with
+real files, and its cost per file is extrapolated to a million.
+
+Run from an uninstalled tree with:
+    python tools/cache-cleanup-bench.py [index entries] [scanned files]
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from twisted.internet import reactor
+
+from flumotion.component.misc.httpserver import cacheindex
+
+# Fraction of the cached files deleted by a cleanup
+CLEANUP_RATIO = 0.01
+
+
+def writeJournal(path, entries):
+    handle = open(os.path.join(path, cacheindex.INDEX_FILENAME), 'w')
+    for i in xrange(entries):
+        handle.write("+ %040x %d %d\n" % (i, random.randint(1, 1 << 20),
+                                          random.randint(0, 1 << 30)))
+    handle.close()
+
+
+def benchIndex(path, entries):
+    writeJournal(path, entries)
+    index = cacheindex.CacheIndex(path)
+    start = time.time()
+    d = index.load()
+
+    def loaded(usage):
+        print 'index: loaded %d entries in %.2f s (in a thread)' % (
+            len(index), time.time() - start)
+        start2 = time.time()
+        index.refresh()
+        refresh = time.time() - start2
+        target = usage * (1 - CLEANUP_RATIO)
+        victims = 0
+        start2 = time.time()
+        while index.usage > target:
+            index.popVictim()
+            victims += 1
+        cleanup = time.time() - start2
+        print 'index: usage refresh %.6f s' % refresh
+        print 'index: cleanup picked %d victims in %.4f s (%.2f us each)' % (
+            victims, cleanup, cleanup * 1e6 / victims)
+        index.close()
+    d.addCallback(loaded)
+    return d
+
+
+def benchScan(path, files):
+    for i in xrange(files):
+        handle = open(os.path.join(path, "%040x" % i), 'w')
+        handle.close()
+    start = time.time()
+    found = []
+    for name in os.listdir(path):
+        name = os.path.join(path, name)
+        found.append((name, os.stat(name)))
+    found.sort(key=lambda f: f[1].st_atime)
+    elapsed = time.time() - start
+    print 'scan: listed and stated %d files in %.4f s' % (files, elapsed)
+    print 'scan: extrapolated to 1M files: %.2f s on the reactor thread' % (
+        elapsed * 1000000 / files)
+
+
+def main(args):
+    entries = 1000000
+    files = 20000
+    if len(args) > 1:
+        entries = int(args[1])
+    if len(args) > 2:
+        files = int(args[2])
+
+    indexPath = tempfile.mkdtemp(prefix='cache-cleanup-bench-')
+    scanPath = tempfile.mkdtemp(prefix='cache-cleanup-bench-')
+    try:
+        benchScan(scanPath, files)
+        d = benchIndex(indexPath, entries)
+        d.addErrback(lambda f: f.printTraceback())
+        d.addBoth(lambda _: reactor.stop())
+        reactor.run()
+    finally:
+        shutil.rmtree(indexPath, ignore_errors=True)
+        shutil.rmtree(scanPath, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
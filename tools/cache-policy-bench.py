@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""
+Trace replay benchmark of the eviction policies of the HTTP cache.
+
+Replays a request log through a simulated cache for every eviction
+policy, cleaning it up between the same watermarks as the cache manager,
+and reports the byte and request hit ratios.
+
+The log is in the format written by the request logger plug; the size
+of a file is the most bytes sent for it. Without a log, a synthetic
+trace with Zipf popularity and long-tailed sizes is replayed.
+
+Run from an uninstalled tree with:
+    python tools/cache-policy-bench.py [cache size in MB] [request log]
+"""
+
+import bisect
+import random
+import re
+import sys
+import time
+
+from flumotion.component.misc.httpserver import cacheindex, cachemanager
+from flumotion.component.misc.httpserver import cachepolicy
+
+SYNTHETIC_FILES = 20000
+SYNTHETIC_REQUESTS = 500000
+ZIPF_ALPHA = 0.8
+
+_LOG_LINE = re.compile(r'^\S+ \S+ \S+ \[[^\]]*\] "\S+ (\S+)[^"]*" '
+                       r'(\d+) (\d+)')
+
+
+def readLog(path):
+    requests = []
+    sizes = {}
+    for line in open(path):
+        match = _LOG_LINE.match(line)
+        if match is None:
+            continue
+        uri, code, sent = match.group(1), match.group(2), match.group(3)
+        if code not in ('200', '206'):
+            continue
+        requests.append(uri)
+        sizes[uri] = max(sizes.get(uri, 0), long(sent))
+    return [(r, sizes[r]) for r in requests]
+
+
+def syntheticTrace(files, requests):
+    rand = random.Random(42)
+    sizes = []
+    for i in xrange(files):
+        # Most files are small, a few are big
+        sizes.append(int(min(rand.paretovariate(1.2) * 64 * 1024,
+                             512 * 1024 * 1024)))
+    weights = [1.0 / (rank + 1) ** ZIPF_ALPHA for rank in xrange(files)]
+    total = sum(weights)
+    cumulative = []
+    acc = 0.0
+    for weight in weights:
+        acc += weight / total
+        cumulative.append(acc)
+    trace = []
+    for i in xrange(requests):
+        name = min(bisect.bisect(cumulative, rand.random()), files - 1)
+        trace.append(("%d" % name, sizes[name]))
+    return trace
+
+
+def replay(trace, policyClass, cacheSize):
+    highUsage = cacheSize * cachemanager.DEFAULT_CLEANUP_HIGH_WATERMARK
+    lowUsage = cacheSize * cachemanager.DEFAULT_CLEANUP_LOW_WATERMARK
+    entries = {}
+    policy = policyClass()
+    policy.start(entries)
+    usage = 0
+    hits = hitBytes = totalBytes = 0
+    for atime, (name, size) in enumerate(trace):
+        totalBytes += size
+        entry = entries.get(name)
+        if entry is not None:
+            hits += 1
+            hitBytes += size
+            entry.atime = atime
+            entry.hits += 1
+            policy.onAccessed(name, entry)
+            continue
+        if size > cacheSize:
+            continue
+        entry = cacheindex.CacheEntry(size, atime)
+        entries[name] = entry
+        policy.onAdded(name, entry)
+        usage += size
+        if usage > highUsage:
+            while usage > lowUsage:
+                victim = policy.popVictim()
+                entry = entries.pop(victim)
+                policy.onRemoved(victim, entry)
+                usage -= entry.size
+    return (float(hitBytes) / max(totalBytes, 1),
+            float(hits) / max(len(trace), 1))
+
+
+def main(args):
+    cacheSize = 1000
+    if len(args) > 1:
+        cacheSize = int(args[1])
+    cacheSize *= 10 ** 6
+
+    if len(args) > 2:
+        trace = readLog(args[2])
+        print 'replaying %d requests of %s' % (len(trace), args[2])
+    else:
+        trace = syntheticTrace(SYNTHETIC_FILES, SYNTHETIC_REQUESTS)
+        print 'replaying %d synthetic requests of %d files' % (
+            len(trace), SYNTHETIC_FILES)
+    files = dict(trace)
+    print 'cache of %d MB for %d MB of files' % (
+        cacheSize / 10 ** 6, sum(files.itervalues()) / 10 ** 6)
+
+    print '%8s %16s %16s %10s' % ('policy', 'byte hit ratio',
+                                  'hit ratio', 'time s')
+    names = cachepolicy.POLICIES.keys()
+    names.sort()
+    for name in names:
+        start = time.time()
+        byteRatio, ratio = replay(trace, cachepolicy.POLICIES[name],
+                                  cacheSize)
+        print '%8s %15.1f%% %15.1f%% %10.2f' % (
+            name, byteRatio * 100, ratio * 100, time.time() - start)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
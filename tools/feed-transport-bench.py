@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""
+Benchmark of the transports of feeds between components.
+
+Feeds raw 1080p video through the feeder and eater elements of
+components, connected by a TCP connection over the loopback interface
+(feeds between hosts) and by a unix socket (feeds between components
+on the same host), and reports the throughput reached and the CPU used.
+The CPU time includes producing the frames, the same for both.
+
+Run from an uninstalled tree with:
+    python tools/feed-transport-bench.py [frames]
+"""
+
+import os
+import socket
+import sys
+import time
+
+import pygst
+pygst.require('0.10')
+import gst
+
+from flumotion.component import feedcomponent
+
+WIDTH = 1920
+HEIGHT = 1080
+FRAME_SIZE = WIDTH * HEIGHT * 3 / 2 # I420
+
+SOURCE = ('videotestsrc num-buffers=%d pattern=black ! '
+          'video/x-raw-yuv,format=(fourcc)I420,width=%d,height=%d,'
+          'framerate=25/1 ! ')
+SINK = ' ! fakesink sync=false'
+
+
+def socketPair(transport):
+    if transport == 'unix':
+        return socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client.connect(server.getsockname())
+    sock, address = server.accept()
+    server.close()
+    return client, sock
+
+
+def bench(transport, frames):
+    feedSocket, eatSocket = socketPair(transport)
+    templates = feedcomponent.ParseLaunchComponent
+    feeder = gst.parse_launch(SOURCE % (frames, WIDTH, HEIGHT)
+                              + templates.FEEDER_TMPL % {'name': 'feeder'})
+    eater = gst.parse_launch(templates.FDSRC_TMPL % {'name': 'eater'}
+                             + ' ! ' + templates.DEPAY_TMPL
+                             % {'name': 'eater'} + SINK)
+    eater.get_by_name('eater').set_property('fd', eatSocket.fileno())
+
+    eater.set_state(gst.STATE_PLAYING)
+    feeder.set_state(gst.STATE_PAUSED)
+    feeder.get_state()
+    feeder.get_by_name('feeder').emit('add', feedSocket.fileno())
+    start = time.time()
+    cpuStart = os.times()
+    feeder.set_state(gst.STATE_PLAYING)
+
+    # gdppay serializes the end of stream to the eater
+    message = eater.get_bus().poll(gst.MESSAGE_EOS | gst.MESSAGE_ERROR, -1)
+    elapsed = time.time() - start
+    cpuEnd = os.times()
+    cpu = (cpuEnd[0] - cpuStart[0]) + (cpuEnd[1] - cpuStart[1])
+    feeder.set_state(gst.STATE_NULL)
+    eater.set_state(gst.STATE_NULL)
+    feedSocket.close()
+    eatSocket.close()
+    if message.type == gst.MESSAGE_ERROR:
+        print '%10s error: %s' % (transport, message.parse_error()[1])
+        return
+
+    print '%10s %10.1f %10.1f %14.2f' % (transport, frames / elapsed,
+        frames * FRAME_SIZE / elapsed / 10 ** 6, cpu * 1000 / frames)
+
+
+def main(args):
+    frames = 1000
+    if len(args) > 1:
+        frames = int(args[1])
+
+    print 'feeding %d frames of %dx%d I420 video' % (frames, WIDTH, HEIGHT)
+    print '%10s %10s %10s %14s' % ('transport', 'frames/s', 'MB/s',
+                                   'cpu ms/frame')
+    for transport in ('tcp', 'unix'):
+        bench(transport, frames)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""
+Micro-benchmarks for the HLS ring.
+
+Run from an uninstalled tree with:
+    python tools/hls-bench.py
+"""
+
+import sys
+import time
+
+from flumotion.component.consumers.hlsstreamer import hlsring
+
+
+def makeRing(window):
+    ring = hlsring.HLSRing('main.m3u8', 'stream.m3u8', window=window)
+    ring.setHostname('localhost:8000')
+    return ring
+
+
+def benchAddFragment(windows=(5, 100, 1000, 10000), fragments=100000):
+    print 'adding fragments (%d fragments per window)' % fragments
+    print '%8s %15s %15s' % ('window', 'usec/fragment', 'usec/render')
+    for window in windows:
+        ring = makeRing(window)
+        addFragment = ring.addFragment
+        start = time.time()
+        for i in xrange(fragments):
+            addFragment('', i, 2)
+        added = time.time() - start
+
+        # render the playlist after each new fragment, like polling
+        # clients do
+        renders = max(10, min(1000, 1000000 / window))
+        start = time.time()
+        for i in xrange(fragments, fragments + renders):
+            addFragment('', i, 2)
+            ring.renderPlaylist('stream.m3u8', {})
+        rendered = time.time() - start
+        print '%8d %15.3f %15.3f' % (window, added * 1e6 / fragments,
+                                     rendered * 1e6 / renders)
+
+
+def benchRenderCached(window=1000, requests=10000):
+    print 'rendering an unchanged playlist (window %d)' % window
+    print '%8s %15s' % ('args', 'usec/request')
+    ring = makeRing(window)
+    for i in xrange(window):
+        ring.addFragment('', i, 2)
+    for args in ({}, {'GKID': ['12345']}):
+        start = time.time()
+        for i in xrange(requests):
+            ring.renderPlaylist('stream.m3u8', dict(args))
+        print '%8s %15.3f' % (bool(args) and 'yes' or 'no',
+                              (time.time() - start) * 1e6 / requests)
+
+
+def main(args):
+    benchAddFragment()
+    benchRenderCached()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""
+Throughput benchmark for the on-demand HTTP server's file transfers.
+
+Sends a file over loopback TCP connections, reading it through the
+provider (FileTransfer) and with sendfile (SendfileTransfer).
+
+Run from an uninstalled tree with:
+    python tools/httpfile-bench.py [size in MB] [transfers]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+from twisted.internet import defer, protocol, reactor
+
+from flumotion.component.misc.httpserver import httpfile, localprovider
+from flumotion.component.misc.httpserver import zerocopy
+
+
+class Request(object):
+    """
+    The parts of a request used by the transfers.
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def dataSent(self, size):
+        pass
+
+    def registerProducer(self, producer, streaming):
+        self.transport.registerProducer(producer, streaming)
+
+    def unregisterProducer(self):
+        self.transport.unregisterProducer()
+
+    def finish(self):
+        self.transport.loseConnection()
+
+
+class Server(protocol.Protocol):
+
+    def connectionMade(self):
+        provider = localprovider.LocalFile(self.factory.path, None)
+        self.factory.transferClass(provider, provider.getsize(),
+                                   Request(self.transport))
+
+
+class Client(protocol.Protocol):
+
+    def connectionMade(self):
+        self.received = 0
+
+    def dataReceived(self, data):
+        self.received += len(data)
+
+    def connectionLost(self, reason):
+        self.factory.done.callback(self.received)
+
+
+def transfer(port):
+    factory = protocol.ClientFactory()
+    factory.protocol = Client
+    factory.done = defer.Deferred()
+    reactor.connectTCP('127.0.0.1', port, factory)
+    return factory.done
+
+
+def bench(path, size, transfers):
+    factory = protocol.ServerFactory()
+    factory.protocol = Server
+    factory.path = path
+    port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+    portNumber = port.getHost().port
+
+    modes = [('read+write', httpfile.FileTransfer)]
+    if zerocopy.HAS_SENDFILE:
+        modes.append(('sendfile', httpfile.SendfileTransfer))
+    else:
+        print 'sendfile is not available, only measuring read+write'
+
+    print 'sending a %d MB file %d times' % (size / (1024 * 1024),
+                                            transfers)
+    print '%12s %12s %12s' % ('mode', 'MB/s', 'cpu s/GB')
+
+    def run(_, name, transferClass):
+        factory.transferClass = transferClass
+        start = time.time()
+        cpuStart = time.clock()
+        d = defer.succeed(None)
+        for i in xrange(transfers):
+            d.addCallback(lambda _: transfer(portNumber))
+
+        def report(received):
+            assert received == size, received
+            elapsed = time.time() - start
+            cpu = time.clock() - cpuStart
+            total = float(size * transfers)
+            print '%12s %12.1f %12.3f' % (name,
+                total / elapsed / (1024 * 1024),
+                cpu / (total / (1024 * 1024 * 1024)))
+        d.addCallback(report)
+        return d
+
+    d = defer.succeed(None)
+    for name, transferClass in modes:
+        d.addCallback(run, name, transferClass)
+    d.addCallback(lambda _: port.stopListening())
+    return d
+
+
+def main(args):
+    size = 256
+    transfers = 4
+    if len(args) > 1:
+        size = int(args[1])
+    if len(args) > 2:
+        transfers = int(args[2])
+    size *= 1024 * 1024
+
+    fd, path = tempfile.mkstemp(prefix='httpfile-bench-')
+    try:
+        block = os.urandom(1024 * 1024)
+        for i in xrange(size / len(block)):
+            os.write(fd, block)
+        os.close(fd)
+
+        d = bench(path, size, transfers)
+        d.addErrback(lambda f: f.printTraceback())
+        d.addBoth(lambda _: reactor.stop())
+        reactor.run()
+    finally:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
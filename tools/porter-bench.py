@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""
+Micro-benchmarks for the porter.
+
+Run from an uninstalled tree with:
+    python tools/porter-bench.py
+"""
+
+import random
+import sys
+import timeit
+
+from twisted.internet import defer
+
+from flumotion.component.misc.porter import pathtree, porter, stats
+
+
+class BenchTransport:
+    keepSocketAlive = False
+    connected = True
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+
+    def fileno(self):
+        return 5
+
+    def write(self, data):
+        pass
+
+    def queueFileDescriptor(self, fd, data):
+        return defer.succeed(None)
+
+    def stopReading(self):
+        pass
+
+    def loseConnection(self):
+        self.protocol.connectionLost(None)
+
+
+class BenchAvatar:
+    avatarId = 'bench'
+
+    def __init__(self):
+        self.mind = self
+        self.broker = self
+        self.transport = BenchTransport(None)
+
+    def isAttached(self):
+        return True
+
+    def queueFileDescriptor(self, fd, data):
+        return self.transport.queueFileDescriptor(fd, data)
+
+
+class BenchPorter:
+
+    def __init__(self):
+        self.avatar = BenchAvatar()
+        self.stats = stats.PorterStats()
+
+    def getStats(self):
+        return self.stats
+
+    def lookupDestination(self, path):
+        return '/live/', self.avatar
+
+
+def makePrefixes(count):
+    prefixes = []
+    for i in range(count):
+        prefixes.append('/%s/%s/stream-%d/' % (
+            random.choice(['live', 'vod', 'event']),
+            random.choice(['hd', 'sd', 'mobile']), i))
+    return prefixes
+
+
+def benchPrefixLookup(sizes=(10, 100, 1000, 10000, 100000), lookups=10000):
+    print 'prefix lookup (%d lookups per size)' % lookups
+    print '%10s %15s' % ('prefixes', 'usec/lookup')
+    for size in sizes:
+        tree = pathtree.PathTree()
+        prefixes = makePrefixes(size)
+        for prefix in prefixes:
+            tree[prefix] = prefix
+        paths = [random.choice(prefixes) + 'file.flv?a=b'
+                 for i in range(lookups)]
+        lookup = tree.lookup
+
+        def run():
+            for path in paths:
+                lookup(path)
+        best = min(timeit.repeat(run, number=1, repeat=3))
+        print '%10d %15.3f' % (size, best * 1e6 / lookups)
+
+
+def benchFirstLine(requests=2000):
+    print 'first line parsing (%d requests per case)' % requests
+    print '%6s %8s %8s %15s' % ('proto', 'line', 'mode', 'usec/request')
+    cases = [
+        (porter.HTTPPorterProtocol, 'GET /live/stream.flv?a=%s HTTP/1.1\r\n'),
+        (porter.RTSPPorterProtocol,
+         'DESCRIBE rtsp://localhost/live/stream?a=%s RTSP/1.0\r\n')]
+    bporter = BenchPorter()
+    for protocolClass, firstLine in cases:
+        for headerSize in (0, 3000):
+            request = (firstLine % ('x' * headerSize) +
+                       'Host: localhost\r\n\r\n')
+            for mode in ('bulk', 'byte'):
+                if mode == 'bulk':
+                    chunks = [request]
+                else:
+                    chunks = list(request)
+
+                def run():
+                    for i in range(requests):
+                        p = protocolClass(bporter)
+                        p.requestId = None
+                        p.transport = BenchTransport(p)
+                        for chunk in chunks:
+                            p.dataReceived(chunk)
+                        p.connectionLost(None)
+                best = min(timeit.repeat(run, number=1, repeat=3))
+                print '%6s %8d %8s %15.3f' % (
+                    protocolClass.scheme, headerSize, mode,
+                    best * 1e6 / requests)
+
+
+def main(args):
+    benchPrefixLookup()
+    benchFirstLine()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
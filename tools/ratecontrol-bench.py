@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""
+Benchmark of the rate control of the on-demand HTTP server.
+
+Throttles many transfers at once, each with a timer of its own
+(ratecontroller-fixed) and with a timer shared by all of them
+(ratecontroller-shared), and reports the CPU used, the reactor timers
+pending and the rate actually reached.
+
+Run from an uninstalled tree with:
+    python tools/ratecontrol-bench.py [transfers] [seconds]
+"""
+
+import sys
+import time
+
+from twisted.internet import defer, reactor
+
+from flumotion.component.misc.httpserver import ratecontrol
+
+RATE = 8000  # in bits per second
+CHUNK_SIZE = 4096
+
+
+class Consumer(object):
+    """
+    The parts of a request used by the rate controller.
+    """
+
+    def __init__(self):
+        self.received = 0
+        self.writes = 0
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+    def write(self, data):
+        self.received += len(data)
+        self.writes += 1
+
+    def finish(self):
+        pass
+
+
+class Producer(object):
+    """
+    Writes a chunk each time it's resumed, like a FileTransfer.
+    """
+
+    def __init__(self, consumer):
+        self.consumer = consumer
+        self._data = "x" * CHUNK_SIZE
+
+    def resumeProducing(self):
+        self.consumer.write(self._data)
+
+    def pauseProducing(self):
+        pass
+
+    def stopProducing(self):
+        pass
+
+
+def bench(name, plug, transfers, duration):
+    consumers = []
+    buckets = []
+    start = time.time()
+    cpuStart = time.clock()
+    for i in xrange(transfers):
+        consumer = Consumer()
+        bucket = plug.createProducerConsumerProxy(consumer, None)
+        bucket.registerProducer(Producer(bucket), True)
+        consumers.append(consumer)
+        buckets.append(bucket)
+    timers = [0]
+
+    def sample():
+        timers[0] = max(timers[0], len(reactor.getDelayedCalls()))
+        if time.time() - start < duration:
+            reactor.callLater(0.5, sample)
+        else:
+            d.callback(None)
+
+    def report(_):
+        elapsed = time.time() - start
+        cpu = time.clock() - cpuStart
+        for bucket in buckets:
+            bucket.stopProducing()
+        plug.stop(None)
+        received = sum([c.received for c in consumers])
+        writes = sum([c.writes for c in consumers])
+        print '%8s %10.3f %10d %12.1f %12.1f' % (
+            name, cpu / elapsed, timers[0],
+            received * 8.0 / elapsed / transfers, float(writes) / elapsed)
+
+    d = defer.Deferred()
+    d.addCallback(report)
+    reactor.callLater(0.5, sample)
+    return d
+
+
+def main(args):
+    transfers = 20000
+    duration = 10
+    if len(args) > 1:
+        transfers = int(args[1])
+    if len(args) > 2:
+        duration = int(args[2])
+
+    props = {'properties': {'rate': RATE, 'initial-level': 0}}
+    print 'throttling %d transfers at %d bps for %d s' % (
+        transfers, RATE, duration)
+    print '%8s %10s %10s %12s %12s' % ('plug', 'cpu s/s', 'timers',
+                                       'bps/transfer', 'writes/s')
+
+    d = defer.succeed(None)
+    d.addCallback(lambda _: bench(
+        'fixed', ratecontrol.RateControllerFixedPlug(props),
+        transfers, duration))
+    d.addCallback(lambda _: bench(
+        'shared', ratecontrol.RateControllerSharedPlug(props),
+        transfers, duration))
+    d.addErrback(lambda f: f.printTraceback())
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main(sys.argv)